@@ -4,24 +4,50 @@ Ele define todas as rotas (URLs), a lógica de negócios e a interação com o b
 """
 
 # --- Importação e Instalação de Módulos Essenciais ---
+import asyncio
 import os
 import subprocess
 import sys
 import sqlite3
 import json
 import locale
+import multiprocessing
+import threading
+import time
+import queue
+import random
+import shutil
+import tempfile
+import traceback
+import tracemalloc
+import uuid
+from concurrent.futures import Future, ProcessPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 from functools import wraps
-from collections import OrderedDict
+from collections import OrderedDict, deque
+import gzip
+import itertools
 import io # Para criar o arquivo em memória
 import csv # Para gerar o arquivo CSV
-import xml.etree.ElementTree as ET # Import para gerar XML
-from xml.dom import minidom # Import para formatar (indentar) o XML
+from xml.sax.saxutils import escape # Para escrever o texto dos elementos do XML
+
+from formatacao import (para_centavos, formatar_brl, formatar_reais, data_iso, data_hora_iso, formatar_data,
+                        registrar_filtros)
+from previsao import PREVISAO_DISPONIVEL, np, matriz_vendas_diarias, calcular_previsoes
+from repositorio import repositorio
+from rfm import RFM_VETORIZADO, SEGMENTOS, SEGMENTO_SEM_COMPRAS, ROTULOS_SEGMENTOS, calcular_rfm, pontuar
+from serializacao import ORJSON_DISPONIVEL, ProvedorJsonRapido, colunas_para_arrays
+import serializacao
+from fragmentos import ResultadoAdiado, configurar_templates
+import nfe
+import backup
 
 # Bloco para tentar importar as bibliotecas necessárias e instalá-las se não existirem.
 try:
+    import click
     from flask import (Flask, render_template, request, redirect, url_for,
-                       session, flash, jsonify, g, Response)
+                       session, flash, jsonify, g, Response, has_request_context, stream_with_context)
     from werkzeug.security import generate_password_hash, check_password_hash
 except ImportError:
     print("Tentando instalar dependências ausentes (Flask, Werkzeug)...")
@@ -29,8 +55,9 @@ except ImportError:
         subprocess.check_call([sys.executable, "-m", "pip", "install", "flask"])
         subprocess.check_call([sys.executable, "-m", "pip", "install", "werkzeug"])
         # Reimporta após a instalação
+        import click
         from flask import (Flask, render_template, request, redirect, url_for,
-                           session, flash, jsonify, g, Response )
+                           session, flash, jsonify, g, Response, has_request_context, stream_with_context)
         from werkzeug.security import generate_password_hash, check_password_hash
         print("Dependências instaladas com sucesso.")
     except Exception as e:
@@ -43,6 +70,648 @@ except ImportError:
 app = Flask(__name__)
 app.secret_key = os.urandom(24)
 DATABASE = os.path.join(app.root_path, 'controle_estoque.db')
+registrar_filtros(app)
+# jsonify e request.get_json passam a usar o orjson, quando instalado (ver serializacao.py).
+app.json = ProvedorJsonRapido(app)
+
+# Fragmentação (sharding) opcional por usuário: quando ativada, cada usuario_id grava em seu próprio
+# arquivo SQLite e o DATABASE principal passa a servir apenas como diretório global de autenticação.
+# Com SHARDING_BUCKETS = 0 cada usuário tem um arquivo; com N > 0 os usuários são distribuídos em N arquivos.
+app.config['SHARDING_ATIVO'] = os.environ.get('CONTROLE_ESTOQUE_SHARDING', '0') == '1'
+app.config['SHARDING_DIR'] = os.environ.get('CONTROLE_ESTOQUE_SHARDING_DIR', os.path.join(app.root_path, 'shards'))
+app.config['SHARDING_BUCKETS'] = int(os.environ.get('CONTROLE_ESTOQUE_SHARDING_BUCKETS', '0'))
+
+# Migrações incrementais dos bancos já existentes. Cada item é aplicado uma única vez e o número da última
+# migração aplicada fica no PRAGMA user_version. O schema.sql deve sempre refletir o resultado de todas elas.
+MIGRACOES = [
+    # 1. Contador de alterações do catálogo, usado pela sincronização incremental do painel de compras.
+    '''
+    ALTER TABLE roupas ADD COLUMN versao INTEGER NOT NULL DEFAULT 0;
+    CREATE TABLE IF NOT EXISTS catalogo_versao (
+        usuario_id INTEGER PRIMARY KEY,
+        versao INTEGER NOT NULL DEFAULT 0
+    );
+    CREATE INDEX IF NOT EXISTS idx_roupas_usuario_versao ON roupas (usuario_id, versao);
+    CREATE TRIGGER IF NOT EXISTS trg_roupas_versao_insert AFTER INSERT ON roupas
+    BEGIN
+        INSERT INTO catalogo_versao (usuario_id, versao) VALUES (NEW.usuario_id, 1)
+            ON CONFLICT (usuario_id) DO UPDATE SET versao = versao + 1;
+        UPDATE roupas SET versao = (SELECT versao FROM catalogo_versao WHERE usuario_id = NEW.usuario_id)
+        WHERE id = NEW.id;
+    END;
+    CREATE TRIGGER IF NOT EXISTS trg_roupas_versao_update
+        AFTER UPDATE OF codigo_produto, tipo_roupa, cor, detalhes, preco_unitario, quantidade ON roupas
+    BEGIN
+        INSERT INTO catalogo_versao (usuario_id, versao) VALUES (NEW.usuario_id, 1)
+            ON CONFLICT (usuario_id) DO UPDATE SET versao = versao + 1;
+        UPDATE roupas SET versao = (SELECT versao FROM catalogo_versao WHERE usuario_id = NEW.usuario_id)
+        WHERE id = NEW.id;
+    END;
+    ''',
+    # 2. Carrinhos e chaves de idempotência da API JSON de checkout (PDV e leitores de código de barras).
+    '''
+    CREATE TABLE IF NOT EXISTS carrinhos (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        usuario_id INTEGER NOT NULL,
+        cliente_id INTEGER NOT NULL,
+        funcionario_id INTEGER,
+        criado_em TEXT NOT NULL DEFAULT (DATETIME('now', 'localtime')),
+        finalizado_em TEXT,
+        FOREIGN KEY (usuario_id) REFERENCES usuarios(id),
+        FOREIGN KEY (cliente_id) REFERENCES clientes(id),
+        FOREIGN KEY (funcionario_id) REFERENCES funcionarios(id)
+    );
+    CREATE TABLE IF NOT EXISTS carrinho_itens (
+        carrinho_id INTEGER NOT NULL,
+        roupa_id INTEGER NOT NULL,
+        quantidade INTEGER NOT NULL,
+        PRIMARY KEY (carrinho_id, roupa_id),
+        FOREIGN KEY (carrinho_id) REFERENCES carrinhos(id),
+        FOREIGN KEY (roupa_id) REFERENCES roupas(id)
+    );
+    CREATE TABLE IF NOT EXISTS chaves_idempotencia (
+        usuario_id INTEGER NOT NULL,
+        chave TEXT NOT NULL,
+        status INTEGER NOT NULL,
+        resposta TEXT NOT NULL,
+        criado_em TEXT NOT NULL DEFAULT (DATETIME('now', 'localtime')),
+        PRIMARY KEY (usuario_id, chave)
+    );
+    ''',
+    # 3. Dinheiro em centavos (inteiros) e datas em formato ISO, com índice de vendas por usuário e data.
+    '''
+    DROP TRIGGER IF EXISTS trg_roupas_versao_update;
+    ALTER TABLE roupas ADD COLUMN preco_centavos INTEGER;
+    UPDATE roupas SET preco_centavos = CAST(ROUND(preco_unitario * 100) AS INTEGER) WHERE preco_unitario IS NOT NULL;
+    ALTER TABLE roupas DROP COLUMN preco_unitario;
+    CREATE TRIGGER trg_roupas_versao_update
+        AFTER UPDATE OF codigo_produto, tipo_roupa, cor, detalhes, preco_centavos, quantidade ON roupas
+    BEGIN
+        INSERT INTO catalogo_versao (usuario_id, versao) VALUES (NEW.usuario_id, 1)
+            ON CONFLICT (usuario_id) DO UPDATE SET versao = versao + 1;
+        UPDATE roupas SET versao = (SELECT versao FROM catalogo_versao WHERE usuario_id = NEW.usuario_id)
+        WHERE id = NEW.id;
+    END;
+    UPDATE roupas
+    SET data_entrada = substr(data_entrada, 7, 4) || '-' || substr(data_entrada, 4, 2) || '-' ||
+                       substr(data_entrada, 1, 2) || ' ' || substr(data_entrada, 14, 8)
+    WHERE data_entrada GLOB '[0-9][0-9]/[0-9][0-9]/[0-9][0-9][0-9][0-9] - [0-9][0-9]:[0-9][0-9]:[0-9][0-9]';
+
+    ALTER TABLE vendas ADD COLUMN valor_total_centavos INTEGER NOT NULL DEFAULT 0;
+    UPDATE vendas SET valor_total_centavos = CAST(ROUND(valor_total_venda * 100) AS INTEGER);
+    ALTER TABLE vendas DROP COLUMN valor_total_venda;
+    CREATE INDEX IF NOT EXISTS idx_vendas_usuario_data ON vendas (usuario_id, data_venda, valor_total_centavos);
+
+    UPDATE usuarios
+    SET data_nascimento = substr(data_nascimento, 7, 4) || '-' || substr(data_nascimento, 4, 2) || '-' ||
+                          substr(data_nascimento, 1, 2)
+    WHERE data_nascimento GLOB '[0-9][0-9]/[0-9][0-9]/[0-9][0-9][0-9][0-9]';
+    ''',
+    # 4. Registro dos anos de vendas arquivados em arquivos SQLite separados.
+    '''
+    CREATE TABLE IF NOT EXISTS arquivos_vendas (
+        ano INTEGER PRIMARY KEY,
+        arquivo TEXT NOT NULL,
+        linhas INTEGER NOT NULL,
+        total_centavos INTEGER NOT NULL,
+        arquivado_em TEXT NOT NULL DEFAULT (DATETIME('now', 'localtime'))
+    );
+    ''',
+    # 5. Livro de movimentos de estoque e instantâneos de saldo por produto.
+    '''
+    CREATE TABLE movimentos_estoque (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        usuario_id INTEGER NOT NULL,
+        roupa_id INTEGER NOT NULL,
+        tipo TEXT NOT NULL CHECK (tipo IN ('entrada', 'venda', 'ajuste', 'devolucao')),
+        quantidade INTEGER NOT NULL,
+        venda_id INTEGER,
+        observacao TEXT,
+        criado_em TEXT NOT NULL DEFAULT (DATETIME('now', 'localtime'))
+    );
+    CREATE INDEX idx_movimentos_roupa_data ON movimentos_estoque (roupa_id, criado_em);
+    CREATE TABLE snapshots_estoque (
+        usuario_id INTEGER NOT NULL,
+        roupa_id INTEGER NOT NULL,
+        movimento_id INTEGER NOT NULL,
+        saldo INTEGER NOT NULL,
+        criado_em TEXT NOT NULL,
+        PRIMARY KEY (roupa_id, movimento_id)
+    );
+    CREATE INDEX idx_snapshots_roupa_data ON snapshots_estoque (roupa_id, criado_em);
+    -- O histórico anterior ao livro não existe: o estoque atual entra como saldo inicial na data de entrada do produto.
+    INSERT INTO movimentos_estoque (usuario_id, roupa_id, tipo, quantidade, observacao, criado_em)
+    SELECT usuario_id, id, 'ajuste', quantidade, 'Saldo inicial',
+           CASE WHEN data_entrada GLOB '[0-9][0-9][0-9][0-9]-*' THEN data_entrada ELSE DATETIME('now', 'localtime') END
+    FROM roupas
+    ORDER BY id;
+    ''',
+    # 6. Registro de alterações (changelog) para a sincronização incremental de integrações.
+    '''
+    CREATE TABLE changelog (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        usuario_id INTEGER NOT NULL,
+        tabela TEXT NOT NULL,
+        registro_id INTEGER NOT NULL,
+        operacao TEXT NOT NULL CHECK (operacao IN ('insert', 'update', 'delete')),
+        criado_em TEXT NOT NULL DEFAULT (DATETIME('now', 'localtime'))
+    );
+    CREATE INDEX idx_changelog_usuario_seq ON changelog (usuario_id, seq);
+    CREATE INDEX idx_changelog_registro ON changelog (tabela, registro_id, seq);
+    -- Com pausado = 1 (dentro da transação de uma manutenção, como o arquivamento de vendas) nada é registrado.
+    CREATE TABLE changelog_controle (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        pausado INTEGER NOT NULL DEFAULT 0
+    );
+    INSERT INTO changelog_controle (id, pausado) VALUES (1, 0);
+    CREATE TRIGGER trg_changelog_roupas_insert AFTER INSERT ON roupas
+    WHEN NOT EXISTS (SELECT 1 FROM changelog_controle WHERE pausado = 1)
+    BEGIN
+        INSERT INTO changelog (usuario_id, tabela, registro_id, operacao) VALUES (NEW.usuario_id, 'roupas', NEW.id, 'insert');
+    END;
+    CREATE TRIGGER trg_changelog_roupas_update AFTER UPDATE OF codigo_produto, data_entrada, tipo_roupa, tecido, quantidade, cor, tamanhos, detalhes,
+        preco_centavos, quantida_vendas ON roupas
+    WHEN NOT EXISTS (SELECT 1 FROM changelog_controle WHERE pausado = 1)
+    BEGIN
+        INSERT INTO changelog (usuario_id, tabela, registro_id, operacao) VALUES (NEW.usuario_id, 'roupas', NEW.id, 'update');
+    END;
+    CREATE TRIGGER trg_changelog_roupas_delete AFTER DELETE ON roupas
+    WHEN NOT EXISTS (SELECT 1 FROM changelog_controle WHERE pausado = 1)
+    BEGIN
+        INSERT INTO changelog (usuario_id, tabela, registro_id, operacao) VALUES (OLD.usuario_id, 'roupas', OLD.id, 'delete');
+    END;
+    CREATE TRIGGER trg_changelog_vendas_insert AFTER INSERT ON vendas
+    WHEN NOT EXISTS (SELECT 1 FROM changelog_controle WHERE pausado = 1)
+    BEGIN
+        INSERT INTO changelog (usuario_id, tabela, registro_id, operacao) VALUES (NEW.usuario_id, 'vendas', NEW.id, 'insert');
+    END;
+    CREATE TRIGGER trg_changelog_vendas_update AFTER UPDATE ON vendas
+    WHEN NOT EXISTS (SELECT 1 FROM changelog_controle WHERE pausado = 1)
+    BEGIN
+        INSERT INTO changelog (usuario_id, tabela, registro_id, operacao) VALUES (NEW.usuario_id, 'vendas', NEW.id, 'update');
+    END;
+    CREATE TRIGGER trg_changelog_vendas_delete AFTER DELETE ON vendas
+    WHEN NOT EXISTS (SELECT 1 FROM changelog_controle WHERE pausado = 1)
+    BEGIN
+        INSERT INTO changelog (usuario_id, tabela, registro_id, operacao) VALUES (OLD.usuario_id, 'vendas', OLD.id, 'delete');
+    END;
+    CREATE TRIGGER trg_changelog_clientes_insert AFTER INSERT ON clientes
+    WHEN NOT EXISTS (SELECT 1 FROM changelog_controle WHERE pausado = 1)
+    BEGIN
+        INSERT INTO changelog (usuario_id, tabela, registro_id, operacao) VALUES (NEW.usuario_id, 'clientes', NEW.id, 'insert');
+    END;
+    CREATE TRIGGER trg_changelog_clientes_update AFTER UPDATE ON clientes
+    WHEN NOT EXISTS (SELECT 1 FROM changelog_controle WHERE pausado = 1)
+    BEGIN
+        INSERT INTO changelog (usuario_id, tabela, registro_id, operacao) VALUES (NEW.usuario_id, 'clientes', NEW.id, 'update');
+    END;
+    CREATE TRIGGER trg_changelog_clientes_delete AFTER DELETE ON clientes
+    WHEN NOT EXISTS (SELECT 1 FROM changelog_controle WHERE pausado = 1)
+    BEGIN
+        INSERT INTO changelog (usuario_id, tabela, registro_id, operacao) VALUES (OLD.usuario_id, 'clientes', OLD.id, 'delete');
+    END;
+    CREATE TRIGGER trg_changelog_funcionarios_insert AFTER INSERT ON funcionarios
+    WHEN NOT EXISTS (SELECT 1 FROM changelog_controle WHERE pausado = 1)
+    BEGIN
+        INSERT INTO changelog (usuario_id, tabela, registro_id, operacao) VALUES (NEW.usuario_id, 'funcionarios', NEW.id, 'insert');
+    END;
+    CREATE TRIGGER trg_changelog_funcionarios_update AFTER UPDATE ON funcionarios
+    WHEN NOT EXISTS (SELECT 1 FROM changelog_controle WHERE pausado = 1)
+    BEGIN
+        INSERT INTO changelog (usuario_id, tabela, registro_id, operacao) VALUES (NEW.usuario_id, 'funcionarios', NEW.id, 'update');
+    END;
+    CREATE TRIGGER trg_changelog_funcionarios_delete AFTER DELETE ON funcionarios
+    WHEN NOT EXISTS (SELECT 1 FROM changelog_controle WHERE pausado = 1)
+    BEGIN
+        INSERT INTO changelog (usuario_id, tabela, registro_id, operacao) VALUES (OLD.usuario_id, 'funcionarios', OLD.id, 'delete');
+    END;
+    ''',
+    # 7. Trava de liderança e registro das execuções da manutenção agendada.
+    '''
+    CREATE TABLE manutencao_lider (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        processo TEXT,
+        expira_em REAL NOT NULL DEFAULT 0
+    );
+    CREATE TABLE manutencao_execucoes (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        tarefa TEXT NOT NULL,
+        banco TEXT NOT NULL,
+        inicio TEXT NOT NULL,
+        duracao_ms REAL NOT NULL,
+        sucesso INTEGER NOT NULL,
+        detalhe TEXT,
+        processo TEXT
+    );
+    CREATE INDEX idx_manutencao_tarefa ON manutencao_execucoes (tarefa, banco, inicio);
+    ''',
+    # 8. Previsão de demanda e ponto de reposição por produto.
+    '''
+    CREATE TABLE previsoes_estoque (
+        roupa_id INTEGER PRIMARY KEY,
+        usuario_id INTEGER NOT NULL,
+        media_7d REAL NOT NULL,
+        media_28d REAL NOT NULL,
+        demanda_diaria REAL NOT NULL,
+        desvio REAL NOT NULL,
+        dias_cobertura REAL,
+        ponto_reposicao INTEGER NOT NULL,
+        estoque_baixo INTEGER NOT NULL,
+        calculado_em TEXT NOT NULL
+    );
+    CREATE INDEX idx_previsoes_usuario_baixo ON previsoes_estoque (usuario_id, estoque_baixo);
+    ''',
+    # 9. Grade de variantes (tamanho x cor) com estoque próprio; vendas e carrinhos passam a indicar a variante.
+    '''
+    CREATE TABLE variantes (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        usuario_id INTEGER NOT NULL,
+        roupa_id INTEGER NOT NULL,
+        tamanho TEXT NOT NULL,
+        cor TEXT NOT NULL,
+        quantidade INTEGER NOT NULL DEFAULT 0 CHECK (quantidade >= 0),
+        FOREIGN KEY (usuario_id) REFERENCES usuarios(id),
+        FOREIGN KEY (roupa_id) REFERENCES roupas(id)
+    );
+    CREATE UNIQUE INDEX idx_variantes_roupa_tamanho_cor ON variantes (roupa_id, tamanho, cor);
+    CREATE INDEX idx_variantes_usuario_tamanho_cor ON variantes (usuario_id, tamanho, cor, quantidade);
+    ALTER TABLE vendas ADD COLUMN variante_id INTEGER REFERENCES variantes(id);
+    CREATE INDEX idx_vendas_variante ON vendas (variante_id) WHERE variante_id IS NOT NULL;
+    -- variante_id = 0 indica produto sem grade (a chave primária não pode depender de NULL).
+    CREATE TABLE carrinho_itens_novo (
+        carrinho_id INTEGER NOT NULL,
+        roupa_id INTEGER NOT NULL,
+        variante_id INTEGER NOT NULL DEFAULT 0,
+        quantidade INTEGER NOT NULL,
+        PRIMARY KEY (carrinho_id, roupa_id, variante_id),
+        FOREIGN KEY (carrinho_id) REFERENCES carrinhos(id),
+        FOREIGN KEY (roupa_id) REFERENCES roupas(id)
+    );
+    INSERT INTO carrinho_itens_novo (carrinho_id, roupa_id, quantidade)
+    SELECT carrinho_id, roupa_id, quantidade FROM carrinho_itens;
+    DROP TABLE carrinho_itens;
+    ALTER TABLE carrinho_itens_novo RENAME TO carrinho_itens;
+    CREATE TRIGGER trg_changelog_variantes_insert AFTER INSERT ON variantes
+    WHEN NOT EXISTS (SELECT 1 FROM changelog_controle WHERE pausado = 1)
+    BEGIN
+        INSERT INTO changelog (usuario_id, tabela, registro_id, operacao) VALUES (NEW.usuario_id, 'variantes', NEW.id, 'insert');
+    END;
+    CREATE TRIGGER trg_changelog_variantes_update AFTER UPDATE ON variantes
+    WHEN NOT EXISTS (SELECT 1 FROM changelog_controle WHERE pausado = 1)
+    BEGIN
+        INSERT INTO changelog (usuario_id, tabela, registro_id, operacao) VALUES (NEW.usuario_id, 'variantes', NEW.id, 'update');
+    END;
+    CREATE TRIGGER trg_changelog_variantes_delete AFTER DELETE ON variantes
+    WHEN NOT EXISTS (SELECT 1 FROM changelog_controle WHERE pausado = 1)
+    BEGIN
+        INSERT INTO changelog (usuario_id, tabela, registro_id, operacao) VALUES (OLD.usuario_id, 'variantes', OLD.id, 'delete');
+    END;
+    ''',
+    # 10. Estoque por local (lojas e depósitos), transferências entre locais e agregados por local mantidos por
+    #     gatilhos. O estoque atual de cada usuário vai para a 'Loja Principal', onde também ficam as vendas antigas
+    #     (as dos anos já arquivados são somadas pelo complemento da migração, ver complementar_migracao).
+    '''
+    UPDATE changelog_controle SET pausado = 1;
+    CREATE TABLE locais (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        usuario_id INTEGER NOT NULL,
+        nome TEXT NOT NULL,
+        tipo TEXT NOT NULL DEFAULT 'loja' CHECK (tipo IN ('loja', 'deposito')),
+        ativo INTEGER NOT NULL DEFAULT 1,
+        FOREIGN KEY (usuario_id) REFERENCES usuarios(id)
+    );
+    CREATE UNIQUE INDEX idx_locais_usuario_nome ON locais (usuario_id, nome);
+    CREATE TABLE estoque_local (
+        usuario_id INTEGER NOT NULL,
+        local_id INTEGER NOT NULL,
+        roupa_id INTEGER NOT NULL,
+        variante_id INTEGER NOT NULL DEFAULT 0,
+        tamanho TEXT NOT NULL DEFAULT '',
+        cor TEXT NOT NULL DEFAULT '',
+        quantidade INTEGER NOT NULL DEFAULT 0 CHECK (quantidade >= 0),
+        PRIMARY KEY (roupa_id, variante_id, local_id)
+    ) WITHOUT ROWID;
+    CREATE INDEX idx_estoque_local_usuario_local ON estoque_local (usuario_id, local_id, quantidade);
+    CREATE TABLE disponibilidade_grade (
+        usuario_id INTEGER NOT NULL,
+        tamanho TEXT NOT NULL,
+        cor TEXT NOT NULL,
+        local_id INTEGER NOT NULL,
+        quantidade INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (usuario_id, tamanho, cor, local_id)
+    ) WITHOUT ROWID;
+    CREATE TABLE vendas_local_dia (
+        usuario_id INTEGER NOT NULL,
+        local_id INTEGER NOT NULL,
+        data_venda TEXT NOT NULL,
+        vendas INTEGER NOT NULL DEFAULT 0,
+        itens INTEGER NOT NULL DEFAULT 0,
+        total_centavos INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (usuario_id, local_id, data_venda)
+    ) WITHOUT ROWID;
+    CREATE TABLE transferencias (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        usuario_id INTEGER NOT NULL,
+        roupa_id INTEGER NOT NULL,
+        variante_id INTEGER NOT NULL DEFAULT 0,
+        origem_id INTEGER NOT NULL,
+        destino_id INTEGER NOT NULL,
+        quantidade INTEGER NOT NULL CHECK (quantidade > 0),
+        observacao TEXT,
+        criado_em TEXT NOT NULL DEFAULT (DATETIME('now', 'localtime')),
+        FOREIGN KEY (origem_id) REFERENCES locais(id),
+        FOREIGN KEY (destino_id) REFERENCES locais(id)
+    );
+    CREATE INDEX idx_transferencias_usuario ON transferencias (usuario_id, id);
+    ALTER TABLE vendas ADD COLUMN local_id INTEGER REFERENCES locais(id);
+    ALTER TABLE carrinhos ADD COLUMN local_id INTEGER REFERENCES locais(id);
+
+    INSERT INTO locais (usuario_id, nome, tipo) SELECT DISTINCT usuario_id, 'Loja Principal', 'loja' FROM roupas;
+    INSERT INTO estoque_local (usuario_id, local_id, roupa_id, variante_id, quantidade)
+    SELECT r.usuario_id, l.id, r.id, 0, r.quantidade
+    FROM roupas r JOIN locais l ON l.usuario_id = r.usuario_id
+    WHERE r.quantidade > 0 AND NOT EXISTS (SELECT 1 FROM variantes v WHERE v.roupa_id = r.id);
+    INSERT INTO estoque_local (usuario_id, local_id, roupa_id, variante_id, tamanho, cor, quantidade)
+    SELECT v.usuario_id, l.id, v.roupa_id, v.id, v.tamanho, v.cor, v.quantidade
+    FROM variantes v JOIN locais l ON l.usuario_id = v.usuario_id
+    WHERE v.quantidade > 0;
+    UPDATE vendas SET local_id = (SELECT l.id FROM locais l WHERE l.usuario_id = vendas.usuario_id);
+    INSERT INTO disponibilidade_grade (usuario_id, tamanho, cor, local_id, quantidade)
+    SELECT usuario_id, tamanho, cor, local_id, SUM(quantidade) FROM estoque_local WHERE variante_id <> 0
+    GROUP BY usuario_id, tamanho, cor, local_id;
+    INSERT INTO vendas_local_dia (usuario_id, local_id, data_venda, vendas, itens, total_centavos)
+    SELECT usuario_id, local_id, data_venda, COUNT(*), SUM(quantidade_vendida), SUM(valor_total_centavos)
+    FROM vendas WHERE local_id IS NOT NULL
+    GROUP BY usuario_id, local_id, data_venda;
+
+    CREATE TRIGGER trg_estoque_local_insert AFTER INSERT ON estoque_local WHEN NEW.variante_id <> 0
+    BEGIN
+        INSERT INTO disponibilidade_grade (usuario_id, tamanho, cor, local_id, quantidade)
+        VALUES (NEW.usuario_id, NEW.tamanho, NEW.cor, NEW.local_id, NEW.quantidade)
+        ON CONFLICT (usuario_id, tamanho, cor, local_id) DO UPDATE SET quantidade = quantidade + excluded.quantidade;
+    END;
+    CREATE TRIGGER trg_estoque_local_update AFTER UPDATE OF quantidade ON estoque_local WHEN NEW.variante_id <> 0
+    BEGIN
+        UPDATE disponibilidade_grade SET quantidade = quantidade + NEW.quantidade - OLD.quantidade
+        WHERE usuario_id = NEW.usuario_id AND tamanho = NEW.tamanho AND cor = NEW.cor AND local_id = NEW.local_id;
+    END;
+    CREATE TRIGGER trg_estoque_local_delete AFTER DELETE ON estoque_local WHEN OLD.variante_id <> 0
+    BEGIN
+        UPDATE disponibilidade_grade SET quantidade = quantidade - OLD.quantidade
+        WHERE usuario_id = OLD.usuario_id AND tamanho = OLD.tamanho AND cor = OLD.cor AND local_id = OLD.local_id;
+    END;
+    CREATE TRIGGER trg_vendas_local_insert AFTER INSERT ON vendas
+    WHEN NEW.local_id IS NOT NULL AND NOT EXISTS (SELECT 1 FROM changelog_controle WHERE pausado = 1)
+    BEGIN
+        INSERT INTO vendas_local_dia (usuario_id, local_id, data_venda, vendas, itens, total_centavos)
+        VALUES (NEW.usuario_id, NEW.local_id, NEW.data_venda, 1, NEW.quantidade_vendida, NEW.valor_total_centavos)
+        ON CONFLICT (usuario_id, local_id, data_venda) DO UPDATE SET vendas = vendas + 1,
+            itens = itens + excluded.itens, total_centavos = total_centavos + excluded.total_centavos;
+    END;
+    CREATE TRIGGER trg_vendas_local_delete AFTER DELETE ON vendas
+    WHEN OLD.local_id IS NOT NULL AND NOT EXISTS (SELECT 1 FROM changelog_controle WHERE pausado = 1)
+    BEGIN
+        UPDATE vendas_local_dia SET vendas = vendas - 1, itens = itens - OLD.quantidade_vendida,
+                                    total_centavos = total_centavos - OLD.valor_total_centavos
+        WHERE usuario_id = OLD.usuario_id AND local_id = OLD.local_id AND data_venda = OLD.data_venda;
+    END;
+    UPDATE changelog_controle SET pausado = 0;
+    ''',
+    # 11. Segmentação RFM: totais de compras de cada cliente, mantidos a cada venda, com as notas e o segmento,
+    # e os limites dos quintis de cada usuário. As notas são calculadas no primeiro acesso ou na manutenção.
+    # As compras dos anos já arquivados são somadas pelo complemento da migração (ver complementar_migracao).
+    '''
+    CREATE TABLE clientes_rfm (
+        cliente_id INTEGER PRIMARY KEY REFERENCES clientes(id),
+        usuario_id INTEGER NOT NULL,
+        primeira_compra TEXT NOT NULL,
+        ultima_compra TEXT NOT NULL,
+        compras INTEGER NOT NULL,
+        total_centavos INTEGER NOT NULL,
+        recencia INTEGER,
+        frequencia INTEGER,
+        monetario INTEGER,
+        segmento TEXT
+    );
+    CREATE INDEX idx_clientes_rfm_usuario_segmento ON clientes_rfm (usuario_id, segmento);
+    CREATE TABLE rfm_limites (
+        usuario_id INTEGER PRIMARY KEY,
+        recencia TEXT NOT NULL,
+        frequencia TEXT NOT NULL,
+        monetario TEXT NOT NULL,
+        clientes INTEGER NOT NULL,
+        calculado_em TEXT NOT NULL
+    );
+    INSERT INTO clientes_rfm (cliente_id, usuario_id, primeira_compra, ultima_compra, compras, total_centavos)
+    SELECT v.cliente_id, v.usuario_id, MIN(v.data_venda), MAX(v.data_venda), COUNT(DISTINCT v.data_venda),
+           SUM(v.valor_total_centavos)
+    FROM vendas v
+             JOIN clientes c ON c.id = v.cliente_id AND c.usuario_id = v.usuario_id
+    GROUP BY v.cliente_id;
+    ''',
+    # 12. Vendas por dia pré-agregadas por dimensão (total, produto, funcionário e cliente) para a API de métricas.
+    # Como vendas_local_dia, é mantido por gatilhos e conserva as vendas arquivadas (controle pausado).
+    # Os anos arquivados antes desta migração são somados pelo seu complemento (ver complementar_migracao).
+    '''
+    CREATE TABLE vendas_diarias (
+        usuario_id INTEGER NOT NULL,
+        dimensao TEXT NOT NULL,
+        data_venda TEXT NOT NULL,
+        chave INTEGER NOT NULL,
+        vendas INTEGER NOT NULL DEFAULT 0,
+        itens INTEGER NOT NULL DEFAULT 0,
+        total_centavos INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (usuario_id, dimensao, data_venda, chave)
+    ) WITHOUT ROWID;
+    INSERT INTO vendas_diarias (usuario_id, dimensao, data_venda, chave, vendas, itens, total_centavos)
+    SELECT usuario_id, 'total', data_venda, 0, COUNT(*), SUM(quantidade_vendida), SUM(valor_total_centavos)
+    FROM vendas GROUP BY usuario_id, data_venda
+    UNION ALL
+    SELECT usuario_id, 'roupa', data_venda, roupa_id, COUNT(*), SUM(quantidade_vendida), SUM(valor_total_centavos)
+    FROM vendas GROUP BY usuario_id, data_venda, roupa_id
+    UNION ALL
+    SELECT usuario_id, 'funcionario', data_venda, COALESCE(funcionario_id, 0), COUNT(*), SUM(quantidade_vendida),
+           SUM(valor_total_centavos)
+    FROM vendas GROUP BY usuario_id, data_venda, COALESCE(funcionario_id, 0)
+    UNION ALL
+    SELECT usuario_id, 'cliente', data_venda, COALESCE(cliente_id, 0), COUNT(*), SUM(quantidade_vendida),
+           SUM(valor_total_centavos)
+    FROM vendas GROUP BY usuario_id, data_venda, COALESCE(cliente_id, 0);
+    CREATE TRIGGER trg_vendas_diarias_insert AFTER INSERT ON vendas
+    WHEN NOT EXISTS (SELECT 1 FROM changelog_controle WHERE pausado = 1)
+    BEGIN
+        INSERT INTO vendas_diarias (usuario_id, dimensao, data_venda, chave, vendas, itens, total_centavos)
+        VALUES (NEW.usuario_id, 'total', NEW.data_venda, 0, 1, NEW.quantidade_vendida, NEW.valor_total_centavos),
+               (NEW.usuario_id, 'roupa', NEW.data_venda, NEW.roupa_id, 1, NEW.quantidade_vendida,
+                NEW.valor_total_centavos),
+               (NEW.usuario_id, 'funcionario', NEW.data_venda, COALESCE(NEW.funcionario_id, 0), 1,
+                NEW.quantidade_vendida, NEW.valor_total_centavos),
+               (NEW.usuario_id, 'cliente', NEW.data_venda, COALESCE(NEW.cliente_id, 0), 1, NEW.quantidade_vendida,
+                NEW.valor_total_centavos)
+        ON CONFLICT (usuario_id, dimensao, data_venda, chave) DO UPDATE SET vendas = vendas + 1,
+            itens = itens + excluded.itens, total_centavos = total_centavos + excluded.total_centavos;
+    END;
+    CREATE TRIGGER trg_vendas_diarias_delete AFTER DELETE ON vendas
+    WHEN NOT EXISTS (SELECT 1 FROM changelog_controle WHERE pausado = 1)
+    BEGIN
+        UPDATE vendas_diarias SET vendas = vendas - 1, itens = itens - OLD.quantidade_vendida,
+                                  total_centavos = total_centavos - OLD.valor_total_centavos
+        WHERE usuario_id = OLD.usuario_id AND data_venda = OLD.data_venda
+          AND ((dimensao = 'total' AND chave = 0) OR (dimensao = 'roupa' AND chave = OLD.roupa_id)
+               OR (dimensao = 'funcionario' AND chave = COALESCE(OLD.funcionario_id, 0))
+               OR (dimensao = 'cliente' AND chave = COALESCE(OLD.cliente_id, 0)));
+    END;
+    ''',
+    # 13. Faixa de ids de cada ano arquivado: as buscas de vendas por id só anexam os arquivos que podem contê-las.
+    #     Os anos já arquivados têm a faixa preenchida pelo complemento da migração (ver complementar_migracao).
+    '''
+    ALTER TABLE arquivos_vendas ADD COLUMN id_min INTEGER;
+    ALTER TABLE arquivos_vendas ADD COLUMN id_max INTEGER;
+    ''',
+    # 14. Método e caminho da requisição que usou cada chave de idempotência: a mesma chave em outra operação é
+    #     recusada. As chaves anteriores ficam sem esses dados até vencerem (tarefa de manutenção 'limpeza').
+    '''
+    ALTER TABLE chaves_idempotencia ADD COLUMN metodo TEXT;
+    ALTER TABLE chaves_idempotencia ADD COLUMN caminho TEXT;
+    ''',
+    # 15. Saldo inicial do livro de estoque refeito com as vendas anteriores a ele: a migração 5 lançou só o estoque
+    #     da época, e o saldo em datas passadas não contava as unidades vendidas desde a entrada do produto. Cada
+    #     venda anterior ao livro ganha o seu movimento e o saldo inicial passa a somar essas unidades. As vendas
+    #     dos anos arquivados e o ajuste do saldo inicial ficam no complemento da migração (ver complementar_migracao).
+    '''
+    CREATE INDEX IF NOT EXISTS idx_movimentos_venda ON movimentos_estoque (venda_id);
+    -- O saldo inicial vai para a data de entrada do produto, também quando ela está no formato DD/MM/AAAA.
+    UPDATE movimentos_estoque
+    SET criado_em = COALESCE((SELECT CASE
+                                  WHEN r.data_entrada GLOB '[0-9][0-9][0-9][0-9]-*' THEN r.data_entrada
+                                  WHEN r.data_entrada GLOB '[0-9][0-9]/[0-9][0-9]/[0-9][0-9][0-9][0-9]*' THEN
+                                      SUBSTR(r.data_entrada, 7, 4) || '-' || SUBSTR(r.data_entrada, 4, 2) || '-' ||
+                                      SUBSTR(r.data_entrada, 1, 2) || ' ' ||
+                                      COALESCE(NULLIF(LTRIM(SUBSTR(r.data_entrada, 11), ' -'), ''), '00:00:00')
+                              END
+                              FROM roupas r WHERE r.id = movimentos_estoque.roupa_id), criado_em)
+    WHERE tipo = 'ajuste' AND observacao = 'Saldo inicial' AND venda_id IS NULL;
+    -- Vendas sem movimento no livro, na sua data (e nunca antes do saldo inicial do produto).
+    INSERT INTO movimentos_estoque (usuario_id, roupa_id, tipo, quantidade, venda_id, observacao, criado_em)
+    SELECT v.usuario_id, v.roupa_id, 'venda', -v.quantidade_vendida, v.id, 'Venda anterior ao livro',
+           MAX(v.data_venda, s.criado_em)
+    FROM vendas v
+    JOIN movimentos_estoque s ON s.roupa_id = v.roupa_id AND s.tipo = 'ajuste' AND s.observacao = 'Saldo inicial'
+                             AND s.venda_id IS NULL
+    WHERE NOT EXISTS (SELECT 1 FROM movimentos_estoque m WHERE m.venda_id = v.id)
+    ORDER BY v.id;
+    -- Os instantâneos gravados não contam os movimentos acima; são refeitos por 'flask snapshot-estoque'.
+    DELETE FROM snapshots_estoque;
+    ''',
+]
+
+# Réplica analítica opcional: as consultas de relatório (métricas e exportação) leem uma cópia do banco
+# atualizada pela API de backup do SQLite, sem disputar o arquivo em que as vendas são gravadas.
+# REPLICA_MAX_ATRASO é o atraso máximo tolerado (em segundos) e REPLICA_INTERVALO a frequência da atualização agendada.
+app.config['REPLICA_ANALITICA'] = os.environ.get('CONTROLE_ESTOQUE_REPLICA', '0') == '1'
+app.config['REPLICA_MAX_ATRASO'] = int(os.environ.get('CONTROLE_ESTOQUE_REPLICA_MAX_ATRASO', '60'))
+app.config['REPLICA_INTERVALO'] = int(os.environ.get('CONTROLE_ESTOQUE_REPLICA_INTERVALO', '30'))
+
+# Escrita agrupada (group commit) opcional: uma única thread grava no banco e confirma, em uma só transação,
+# as unidades de escrita que chegam dentro da janela ESCRITA_JANELA_MS (até ESCRITA_MAX_LOTE unidades por lote).
+app.config['ESCRITA_AGRUPADA'] = os.environ.get('CONTROLE_ESTOQUE_ESCRITA_AGRUPADA', '0') == '1'
+app.config['ESCRITA_JANELA_MS'] = float(os.environ.get('CONTROLE_ESTOQUE_ESCRITA_JANELA_MS', '5'))
+app.config['ESCRITA_MAX_LOTE'] = int(os.environ.get('CONTROLE_ESTOQUE_ESCRITA_MAX_LOTE', '64'))
+
+# Coalescência de leituras (single-flight): leituras idênticas (mesmo banco, SQL e parâmetros) feitas ao mesmo
+# tempo por requisições do processo são executadas uma única vez; as demais aguardam o resultado da primeira.
+app.config['LEITURAS_COALESCIDAS'] = os.environ.get('CONTROLE_ESTOQUE_COALESCER_LEITURAS', '1') == '1'
+
+# Cache por processo do cadastro do usuário, da empresa e dos funcionários (até CACHE_REGISTROS_MAX registros).
+# As alterações feitas no processo invalidam o cache na hora; nos demais, o registro expira em CACHE_REGISTROS_TTL s.
+app.config['CACHE_REGISTROS_MAX'] = int(os.environ.get('CONTROLE_ESTOQUE_CACHE_REGISTROS_MAX', '1000'))
+app.config['CACHE_REGISTROS_TTL'] = float(os.environ.get('CONTROLE_ESTOQUE_CACHE_REGISTROS_TTL', '60'))
+
+# Arquivo morto de vendas: os anos fechados são movidos para um arquivo SQLite por ano nesta pasta e
+# anexados (ATTACH) às consultas apenas quando o período consultado os alcança.
+app.config['ARQUIVO_DIR'] = os.environ.get('CONTROLE_ESTOQUE_ARQUIVO_DIR', os.path.join(app.root_path, 'arquivo'))
+
+# Livro de estoque: a cada ESTOQUE_SNAPSHOT_INTERVALO movimentos de um produto, o saldo é gravado em
+# snapshots_estoque, para que o saldo em uma data some no máximo esse número de movimentos.
+app.config['ESTOQUE_SNAPSHOT_INTERVALO'] = int(os.environ.get('CONTROLE_ESTOQUE_SNAPSHOT_INTERVALO', '50'))
+
+# Manutenção agendada opcional (ANALYZE/optimize, vacuum incremental, checkpoint do WAL e aquecimento do cache).
+# Cada processo verifica as tarefas a cada MANUTENCAO_INTERVALO segundos, mas só o líder (linha de trava) as executa.
+app.config['MANUTENCAO_ATIVA'] = os.environ.get('CONTROLE_ESTOQUE_MANUTENCAO', '0') == '1'
+app.config['MANUTENCAO_AQUECER'] = os.environ.get('CONTROLE_ESTOQUE_MANUTENCAO_AQUECER', '1') == '1'
+app.config['MANUTENCAO_INTERVALO'] = int(os.environ.get('CONTROLE_ESTOQUE_MANUTENCAO_INTERVALO', '60'))
+app.config['MANUTENCAO_INTERVALOS'] = {'otimizar': 6 * 3600, 'vacuum': 24 * 3600, 'checkpoint': 5 * 60,
+                                       'aquecimento': 3600, 'previsao': 24 * 3600, 'rfm': 24 * 3600,
+                                       'limpeza': 3600}
+# API de checkout: a tarefa 'limpeza' remove as chaves de idempotência com mais de IDEMPOTENCIA_RETENCAO_HORAS
+# e os carrinhos abertos há mais de CARRINHO_ABANDONO_HORAS sem serem finalizados.
+app.config['IDEMPOTENCIA_RETENCAO_HORAS'] = int(os.environ.get('CONTROLE_ESTOQUE_IDEMPOTENCIA_RETENCAO_HORAS', '48'))
+app.config['CARRINHO_ABANDONO_HORAS'] = int(os.environ.get('CONTROLE_ESTOQUE_CARRINHO_ABANDONO_HORAS', '24'))
+app.config['MANUTENCAO_VACUUM_PAGINAS'] = 1000
+
+# Previsão de demanda por produto (requer NumPy): janela de vendas diárias analisada e prazo de reposição, em dias.
+app.config['PREVISAO_JANELA_DIAS'] = int(os.environ.get('CONTROLE_ESTOQUE_PREVISAO_JANELA_DIAS', '90'))
+app.config['PREVISAO_PRAZO_REPOSICAO'] = int(os.environ.get('CONTROLE_ESTOQUE_PREVISAO_PRAZO_REPOSICAO', '7'))
+
+# Perfil de memória opcional (tracemalloc): pico e memória retida por rota e as linhas que mais alocaram.
+# As requisições medidas são executadas uma de cada vez; PERFIL_MEMORIA_ROTAS (endpoints separados por vírgula)
+# limita a medição a algumas rotas e PERFIL_MEMORIA_LINHAS é a quantidade de linhas guardadas por rota.
+app.config['PERFIL_MEMORIA'] = os.environ.get('CONTROLE_ESTOQUE_PERFIL_MEMORIA', '0') == '1'
+app.config['PERFIL_MEMORIA_ROTAS'] = {rota.strip() for rota in
+                                      os.environ.get('CONTROLE_ESTOQUE_PERFIL_MEMORIA_ROTAS', '').split(',')
+                                      if rota.strip()}
+app.config['PERFIL_MEMORIA_LINHAS'] = int(os.environ.get('CONTROLE_ESTOQUE_PERFIL_MEMORIA_LINHAS', '10'))
+
+# Cache dos templates: bytecode compilado em disco (JINJA_BYTECODE_DIR; padrão: diretório temporário do sistema)
+# e fragmentos renderizados pela tag {% cache %}, até CACHE_FRAGMENTOS_MAX fragmentos por processo.
+app.config['JINJA_BYTECODE'] = os.environ.get('CONTROLE_ESTOQUE_JINJA_BYTECODE', '1') == '1'
+app.config['JINJA_BYTECODE_DIR'] = os.environ.get('CONTROLE_ESTOQUE_JINJA_BYTECODE_DIR') or None
+app.config['CACHE_FRAGMENTOS'] = os.environ.get('CONTROLE_ESTOQUE_CACHE_FRAGMENTOS', '1') == '1'
+app.config['CACHE_FRAGMENTOS_MAX'] = int(os.environ.get('CONTROLE_ESTOQUE_CACHE_FRAGMENTOS_MAX', '1000'))
+
+# Exportação de NF-e com um XML por venda: quantidade de processos que geram os documentos (0 = um por CPU).
+app.config['NFE_PROCESSOS'] = int(os.environ.get('CONTROLE_ESTOQUE_NFE_PROCESSOS', '0'))
+
+# Atualizações em tempo real (SSE): sob o Hypercorn, cada conexão aberta ocupa uma thread do executor que roda a
+# aplicação WSGI (min(32, CPUs + 4) threads), então o total de conexões fica, por padrão, na metade delas.
+# EVENTOS_HEARTBEAT é o intervalo (s) dos comentários que mantêm a conexão viva e detectam clientes desconectados;
+# após EVENTOS_DURACAO_MAXIMA (s) o fluxo é encerrado e o navegador reconecta, liberando a thread.
+app.config['EVENTOS_MAX_CONEXOES'] = int(os.environ.get('CONTROLE_ESTOQUE_EVENTOS_MAX_CONEXOES',
+                                                        str(max(1, min(32, (os.cpu_count() or 1) + 4) // 2))))
+app.config['EVENTOS_MAX_POR_USUARIO'] = int(os.environ.get('CONTROLE_ESTOQUE_EVENTOS_MAX_POR_USUARIO', '4'))
+app.config['EVENTOS_HEARTBEAT'] = float(os.environ.get('CONTROLE_ESTOQUE_EVENTOS_HEARTBEAT', '15'))
+app.config['EVENTOS_DURACAO_MAXIMA'] = float(os.environ.get('CONTROLE_ESTOQUE_EVENTOS_DURACAO_MAXIMA', '300'))
+
+# Controle de admissão: cada rota tem uma classe de prioridade ('critica' para o checkout, 'normal', 'baixa' para
+# relatórios e 'exportacao' para backup e NF-e enviados em fluxo). Rotas de prioridade baixa e de exportação são
+# recusadas (503 com Retry-After) quando há ADMISSAO_LIMITE_CHECKOUT requisições do checkout em andamento ou
+# ADMISSAO_MAX_BAIXA (ADMISSAO_MAX_EXPORTACAO) delas já em execução; cada usuário tem no máximo
+# ADMISSAO_MAX_POR_USUARIO requisições não críticas simultâneas. ADMISSAO_PRAZO_MS é o tempo máximo das consultas
+# de cada classe (0 = sem prazo) e ADMISSAO_ROTAS troca a classe de endpoints ('endpoint=classe' separados por
+# vírgula).
+app.config['ADMISSAO_ATIVA'] = os.environ.get('CONTROLE_ESTOQUE_ADMISSAO', '1') == '1'
+app.config['ADMISSAO_MAX_BAIXA'] = int(os.environ.get('CONTROLE_ESTOQUE_ADMISSAO_MAX_BAIXA', '2'))
+app.config['ADMISSAO_MAX_EXPORTACAO'] = int(os.environ.get('CONTROLE_ESTOQUE_ADMISSAO_MAX_EXPORTACAO', '2'))
+app.config['ADMISSAO_MAX_POR_USUARIO'] = int(os.environ.get('CONTROLE_ESTOQUE_ADMISSAO_MAX_POR_USUARIO', '4'))
+app.config['ADMISSAO_LIMITE_CHECKOUT'] = int(os.environ.get('CONTROLE_ESTOQUE_ADMISSAO_LIMITE_CHECKOUT', '4'))
+app.config['ADMISSAO_RETRY_AFTER'] = int(os.environ.get('CONTROLE_ESTOQUE_ADMISSAO_RETRY_AFTER', '5'))
+app.config['ADMISSAO_PRAZO_MS'] = {
+    'critica': 0,
+    'normal': int(os.environ.get('CONTROLE_ESTOQUE_ADMISSAO_PRAZO_NORMAL_MS', '0')),
+    'baixa': int(os.environ.get('CONTROLE_ESTOQUE_ADMISSAO_PRAZO_BAIXA_MS', '15000')),
+    # Backup e exportação de NF-e leem o histórico inteiro do usuário em conexões próprias, durante o envio.
+    'exportacao': 0,
+}
+app.config['ADMISSAO_ROTAS'] = dict(item.strip().split('=', 1) for item in
+                                    os.environ.get('CONTROLE_ESTOQUE_ADMISSAO_ROTAS', '').split(',') if '=' in item)
+
+# Tabelas que pertencem a um usuário (tenant), na ordem em que devem ser copiadas entre bancos.
+# Os agregados (disponibilidade_grade, vendas_local_dia e vendas_diarias) não são copiados: os gatilhos os refazem.
+TABELAS_TENANT = ('empresas', 'funcionarios', 'clientes', 'locais', 'roupas', 'variantes', 'estoque_local', 'vendas',
+                  'movimentos_estoque', 'snapshots_estoque', 'transferencias', 'clientes_rfm', 'rfm_limites')
+# Dados de trabalho do usuário que não entram no backup, mas apontam para os registros das tabelas acima:
+# são descartados quando uma restauração substitui os dados do usuário (os itens saem junto com os carrinhos).
+TABELAS_TRABALHO_USUARIO = ('carrinhos', 'previsoes_estoque', 'chaves_idempotencia')
 
 try:
     locale.setlocale(locale.LC_TIME, 'pt_BR.UTF-8')
@@ -52,32 +721,133 @@ except locale.Error:
 
 # --- Gerenciamento Padronizado do Banco de Dados ---
 
+def conectar(caminho):
+    """
+    Abre uma conexão SQLite com o row_factory padrão da aplicação e o cache de instruções dimensionado para
+    as instruções registradas na camada de acesso a dados.
+    """
+    db = sqlite3.connect(caminho, cached_statements=repositorio.tamanho_cache())
+    db.row_factory = sqlite3.Row
+    return db
+
+
+def caminho_shard(usuario_id):
+    """
+    Retorna o arquivo SQLite que guarda os dados do usuário quando o sharding está ativo.
+    Sem buckets configurados, cada usuário tem seu próprio arquivo; caso contrário, o usuário
+    é distribuído pelo resto da divisão do seu id pelo número de buckets.
+    """
+    buckets = app.config['SHARDING_BUCKETS']
+    if buckets > 0:
+        nome = f"shard_{int(usuario_id) % buckets:03d}.db"
+    else:
+        nome = f"usuario_{int(usuario_id)}.db"
+    return os.path.join(app.config['SHARDING_DIR'], nome)
+
+
+# Bancos (principal e shards) já preparados neste processo, para não repetir a verificação a cada requisição.
+_bancos_prontos = set()
+_bancos_lock = threading.Lock()
+
+
+def preparar_banco(caminho):
+    """Cria o shard (quando for o caso), aplica as migrações pendentes e ativa o WAL, uma única vez por processo."""
+    if caminho in _bancos_prontos:
+        return
+    with _bancos_lock:
+        if caminho in _bancos_prontos:
+            return
+        if caminho != DATABASE:
+            criar_shard(caminho)
+        if os.path.exists(caminho):
+            db = sqlite3.connect(caminho)
+            try:
+                aplicar_migracoes(db)
+                # Em WAL, as leituras longas (backup e exportações enviadas em fluxo) leem um instantâneo sem
+                # bloquear as escritas. O modo fica gravado no arquivo; os shards já são criados nele.
+                db.execute('PRAGMA journal_mode=WAL')
+            finally:
+                db.close()
+        _bancos_prontos.add(caminho)
+
+
+def caminho_db_atual():
+    """Retorna o arquivo de banco usado pela requisição atual (shard do usuário ou o banco principal)."""
+    if app.config['SHARDING_ATIVO'] and has_request_context() and 'usuario_id' in session:
+        return caminho_shard(session['usuario_id'])
+    return DATABASE
+
+
 def get_db():
     """
     Abre uma nova conexão com o banco de dados se não houver uma para a requisição atual.
     A conexão é armazenada no objeto `g` do Flask, que é único para cada requisição.
+    Com o sharding ativo, a conexão é aberta no shard do usuário logado.
     """
     if 'db' not in g:
-        g.db = sqlite3.connect(DATABASE)
-        g.db.row_factory = sqlite3.Row
+        caminho = caminho_db_atual()
+        preparar_banco(caminho)
+        g.db = aplicar_prazo_consulta(conectar(caminho))
     return g.db
 
 
+def get_db_diretorio():
+    """
+    Retorna a conexão com o diretório global (tabela 'usuarios').
+    Sem sharding, o diretório é o próprio banco principal e a mesma conexão é reaproveitada.
+    """
+    if not app.config['SHARDING_ATIVO']:
+        return get_db()
+    if 'db_diretorio' not in g:
+        preparar_banco(DATABASE)
+        g.db_diretorio = aplicar_prazo_consulta(conectar(DATABASE))
+    return g.db_diretorio
+
+
 @app.teardown_appcontext
 def close_db(exception):
     """
     Fecha a conexão com o banco de dados automaticamente no final da requisição.
     """
-    db = g.pop('db', None)
-    if db is not None:
-        db.close()
+    for chave in ('db', 'db_diretorio', 'db_relatorio'):
+        db = g.pop(chave, None)
+        if db is not None:
+            db.close()
+
+
+def ler_schema():
+    """Retorna o conteúdo do schema.sql da aplicação."""
+    with open(os.path.join(app.root_path, 'schema.sql'), mode='r', encoding='utf-8') as f:
+        return f.read()
+
+
+def aplicar_migracoes(db, ate=None):
+    """
+    Aplica, em ordem, as migrações de MIGRACOES ainda não registradas no PRAGMA user_version do banco
+    (com ate, só até essa versão). Bancos vazios são ignorados, pois o schema.sql já cria a versão mais recente.
+    """
+    if db.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'roupas'").fetchone() is None:
+        return
+    versao = db.execute('PRAGMA user_version').fetchone()[0]
+    for numero, script in enumerate(MIGRACOES[versao:], start=versao + 1):
+        if ate is not None and numero > ate:
+            break
+        # O complemento em Python (quando houver) roda na mesma transação do script da migração.
+        try:
+            db.executescript(f"BEGIN;\n{script}")
+            complementar_migracao(db, numero)
+            db.execute(f"PRAGMA user_version = {numero}")
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        print(f"Migração {numero} aplicada.")
 
 
 def init_db():
     """Lê o schema.sql e cria as tabelas do banco de dados."""
     db = get_db()
-    with open('schema.sql', mode='r') as f:
-        db.cursor().executescript(f.read())
+    db.cursor().executescript(ler_schema())
     db.commit()
     print("Banco de dados inicializado com sucesso.")
 
@@ -89,30 +859,2087 @@ def init_db_command():
 # =======================================================================
 
 
-def query_db(query, args=(), one=False):
+def query_db(query, args=(), one=False, diretorio=False, coalescer=False):
     """
     Executa uma consulta de LEITURA (SELECT) usando a conexão da requisição atual.
+    Com diretorio=True a consulta é feita no diretório global de usuários.
+    Com coalescer=True, requisições simultâneas com a mesma consulta compartilham uma única execução
+    (ver Coalescência de Leituras); use apenas em leituras que toleram não enxergar uma escrita feita
+    pela própria requisição, como buscas de autocompletar.
+    """
+    db = get_db_diretorio() if diretorio else get_db()
+
+    def ler():
+        cur = db.execute(query, args)
+        rv = cur.fetchall()
+        cur.close()
+        return rv
+
+    if coalescer:
+        rv = list(ler_coalescido(('db', DATABASE if diretorio else caminho_db_atual()), query, args, ler))
+    else:
+        rv = ler()
+    return (rv[0] if rv else None) if one else rv
+
+
+def consultar(nome, args=(), one=False, coalescer=False):
+    """
+    Equivalente de query_db para as instruções registradas em repositorio.py: executa a instrução pelo nome
+    na conexão da requisição atual e retorna linhas tipadas (ver Camada de Acesso a Dados).
     """
     db = get_db()
-    cur = db.execute(query, args)
-    rv = cur.fetchall()
-    cur.close()
+
+    def ler():
+        return repositorio.linhas(db, nome, args)
+
+    if coalescer:
+        rv = ler_coalescido(('db', caminho_db_atual()), repositorio.sql(nome), args, ler)
+    else:
+        rv = ler()
     return (rv[0] if rv else None) if one else rv
 
 
-def execute_db(query, args=()):
+def execute_db(query, args=(), diretorio=False):
     """
     Executa uma consulta de ESCRITA (INSERT, UPDATE, DELETE) e faz o commit.
+    Com a escrita agrupada ativa, a instrução é enviada à thread de escrita e confirmada em lote.
     """
-    db = get_db()
     try:
-        db.execute(query, args)
-        db.commit()
+        executar_escrita(lambda db: db.execute(query, args), diretorio=diretorio)
     except sqlite3.Error as e:
-        db.rollback()
         print(f"Erro no banco de dados: {e}")
 
 
+def executar_escrita(unidade, diretorio=False):
+    """
+    Executa uma unidade de escrita, isto é, uma função que recebe a conexão e executa uma ou mais
+    instruções que devem ser confirmadas juntas. A unidade não deve chamar commit() nem rollback().
+    Retorna o valor devolvido pela unidade ou propaga a exceção levantada por ela.
+    """
+    caminho = DATABASE if diretorio else caminho_db_atual()
+    if app.config['ESCRITA_AGRUPADA']:
+        preparar_banco(caminho)  # Garante que o banco exista e esteja migrado antes de a thread de escrita abri-lo.
+        return escritor_agrupado().executar(caminho, unidade)
+    db = get_db_diretorio() if diretorio else get_db()
+    try:
+        resultado = unidade(db)
+        db.commit()
+        return resultado
+    except Exception:
+        db.rollback()
+        raise
+
+
+# --- Réplica Analítica para Consultas de Relatório ---
+
+# Estado das réplicas deste processo: arquivo de origem -> {'atualizada_em': timestamp, 'assinatura': ...}
+_replicas = {}
+_replicas_lock = threading.Lock()
+_agendador_replica = None
+
+
+def caminho_replica(caminho):
+    """Retorna o arquivo da réplica analítica de um banco (principal ou shard)."""
+    return caminho + '.analitico'
+
+
+def assinatura_banco(caminho):
+    """Identifica a versão em disco de um banco (arquivo principal e WAL), para evitar cópias desnecessárias."""
+    assinatura = []
+    for arquivo in (caminho, caminho + '-wal'):
+        try:
+            info = os.stat(arquivo)
+            assinatura.append((info.st_mtime_ns, info.st_size))
+        except FileNotFoundError:
+            assinatura.append(None)
+    return tuple(assinatura)
+
+
+def atualizar_replica(caminho, forcar=False):
+    """
+    Copia um instantâneo consistente do banco para a sua réplica usando a API de backup do SQLite.
+    A cópia só é feita se o banco mudou desde a última atualização (ou se forcar=True); cada cópia é do
+    banco inteiro. Ela é gravada em um arquivo temporário e trocada pela réplica com os.replace, então as
+    leituras já abertas seguem no instantâneo anterior e nenhuma delas atrasa a cópia. Com uma cópia do
+    mesmo banco em andamento, retorna na hora com o instantâneo anterior, se este processo já tiver um.
+    Retorna o horário (timestamp) do instantâneo disponível na réplica.
+    """
+    with _replicas_lock:
+        estado = _replicas.setdefault(caminho, {'atualizada_em': None, 'assinatura': None,
+                                                'copiando': threading.Lock()})
+    replica = caminho_replica(caminho)
+    if not estado['copiando'].acquire(blocking=estado['atualizada_em'] is None):
+        return estado['atualizada_em']
+    try:
+        assinatura = assinatura_banco(caminho)
+        inicio = time.time()
+        if forcar or estado['atualizada_em'] is None or assinatura != estado['assinatura'] \
+                or not os.path.exists(replica):
+            temporario = f"{replica}.{os.getpid()}.tmp"
+            try:
+                origem = sqlite3.connect(caminho)
+                destino = sqlite3.connect(temporario)
+                try:
+                    # Um único passo de backup copia todas as páginas sob a mesma transação de leitura
+                    # (instantâneo); com a origem em WAL, as escritas seguem durante a cópia.
+                    origem.backup(destino)
+                    # A réplica é aberta somente leitura: fora do WAL, ela não precisa do arquivo -shm.
+                    destino.execute('PRAGMA journal_mode=DELETE')
+                finally:
+                    destino.close()
+                    origem.close()
+                os.replace(temporario, replica)
+            except BaseException:
+                if os.path.exists(temporario):
+                    os.remove(temporario)
+                raise
+            estado['assinatura'] = assinatura
+        # Se nada mudou, a réplica continua idêntica à origem e pode ser considerada atual.
+        estado['atualizada_em'] = inicio
+        return inicio
+    finally:
+        estado['copiando'].release()
+
+
+def _loop_agendador_replica():
+    """Atualiza periodicamente todas as réplicas já usadas por este processo."""
+    while True:
+        time.sleep(app.config['REPLICA_INTERVALO'])
+        for caminho in list(_replicas):
+            try:
+                atualizar_replica(caminho)
+            except sqlite3.Error as e:
+                print(f"Erro ao atualizar a réplica analítica de {caminho}: {e}")
+
+
+def iniciar_agendador_replica():
+    """Inicia (uma única vez por processo) a thread que atualiza as réplicas em segundo plano."""
+    global _agendador_replica
+    with _replicas_lock:
+        if _agendador_replica is None:
+            _agendador_replica = threading.Thread(target=_loop_agendador_replica, name='replica-analitica',
+                                                  daemon=True)
+            _agendador_replica.start()
+
+
+def get_db_relatorio():
+    """
+    Retorna a conexão usada pelas consultas de relatório da requisição atual.
+    Com a réplica analítica ativa, abre a réplica em modo somente leitura, atualizando-a antes
+    caso o instantâneo esteja mais antigo que REPLICA_MAX_ATRASO. Sem réplica, usa get_db().
+    """
+    if not app.config['REPLICA_ANALITICA']:
+        return get_db()
+    if 'db_relatorio' not in g:
+        caminho = caminho_db_atual()
+        get_db()  # Garante que o shard do usuário exista antes de copiá-lo.
+        iniciar_agendador_replica()
+        estado = _replicas.get(caminho)
+        if estado is None or estado['atualizada_em'] is None \
+                or time.time() - estado['atualizada_em'] > app.config['REPLICA_MAX_ATRASO']:
+            try:
+                atualizar_replica(caminho)
+            except (sqlite3.Error, OSError) as e:
+                # O relatório usa o instantâneo anterior; sem nenhum, lê o próprio banco.
+                print(f"Erro ao atualizar a réplica analítica de {caminho}: {e}")
+                if _replicas[caminho]['atualizada_em'] is None:
+                    g.db_relatorio = get_db()
+                    return g.db_relatorio
+        g.db_relatorio = sqlite3.connect(f"file:{caminho_replica(caminho)}?mode=ro", uri=True)
+        g.db_relatorio.row_factory = sqlite3.Row
+        aplicar_prazo_consulta(g.db_relatorio)
+        g.relatorio_atualizado_em = _replicas[caminho]['atualizada_em']
+    return g.db_relatorio
+
+
+def query_relatorio(query, args=(), one=False):
+    """
+    Executa uma consulta de LEITURA de relatório (métricas, exportação) na réplica analítica,
+    quando ativa, ou no banco da requisição atual. Relatórios já toleram dados com algum atraso,
+    então consultas idênticas simultâneas são sempre coalescidas.
+    """
+    db = get_db_relatorio()
+
+    def ler():
+        cur = db.execute(query, args)
+        rv = cur.fetchall()
+        cur.close()
+        return rv
+
+    rv = list(ler_coalescido(('relatorio', caminho_db_atual()), query, args, ler))
+    return (rv[0] if rv else None) if one else rv
+
+
+def query_tuplas(query, args=(), relatorio=False):
+    """
+    Executa uma consulta de LEITURA e retorna (colunas, linhas), com as linhas como tuplas simples em vez
+    de sqlite3.Row. Usada pelas respostas grandes, que são serializadas direto das tuplas do cursor.
+    Com relatorio=True a consulta é feita na conexão de relatórios (réplica analítica, quando ativa) e,
+    como em query_relatorio, coalescida com as consultas idênticas em andamento.
+    """
+    db = get_db_relatorio() if relatorio else get_db()
+
+    def ler():
+        cur = db.cursor()
+        cur.row_factory = None
+        cur.execute(query, args)
+        linhas = cur.fetchall()
+        colunas = [descricao[0] for descricao in cur.description]
+        cur.close()
+        return colunas, linhas
+
+    if not relatorio:
+        return ler()
+    colunas, linhas = ler_coalescido(('tuplas', caminho_db_atual()), query, args, ler)
+    return list(colunas), list(linhas)
+
+
+def frescor_relatorio():
+    """Retorna, em formato ISO, o horário dos dados lidos pelas consultas de relatório da requisição."""
+    atualizado_em = g.get('relatorio_atualizado_em') if app.config['REPLICA_ANALITICA'] else None
+    if atualizado_em is None:
+        return datetime.now().isoformat(timespec='seconds')
+    return datetime.fromtimestamp(atualizado_em).isoformat(timespec='seconds')
+
+
+# --- Coalescência de Leituras (Single-Flight) ---
+
+class CoalescedorLeituras:
+    """
+    Deduplica leituras idênticas em andamento no processo (single-flight). A primeira requisição com uma
+    chave (banco, SQL, parâmetros) é a líder e executa a consulta; as que chegam enquanto ela não termina
+    são seguidoras e recebem o mesmo resultado (ou a mesma exceção), sem executar a consulta de novo.
+    A chave sai do registro assim que a líder termina: não é um cache, só junta as consultas simultâneas.
+    Funciona com threads (executar) e com rotas assíncronas (executar_async), que compartilham as chaves.
+    """
+
+    def __init__(self):
+        self._em_voo = {}
+        self._lock = threading.Lock()
+        self.lideres = 0
+        self.seguidores = 0
+        self.por_rota = {}
+
+    def _entrar(self, chave, rota):
+        """Registra a chamada e retorna (futuro, lider): lider=True se não havia consulta igual em andamento."""
+        with self._lock:
+            futuro = self._em_voo.get(chave)
+            lider = futuro is None
+            if lider:
+                futuro = self._em_voo[chave] = Future()
+                self.lideres += 1
+            else:
+                self.seguidores += 1
+            contagem = self.por_rota.setdefault(rota, [0, 0])
+            contagem[0 if lider else 1] += 1
+        return futuro, lider
+
+    def _conduzir(self, chave, futuro, ler):
+        """Executa a leitura da líder e publica o resultado para as seguidoras."""
+        try:
+            resultado = ler()
+        except BaseException as e:
+            futuro.set_exception(e)
+        else:
+            futuro.set_result(resultado)
+        finally:
+            with self._lock:
+                self._em_voo.pop(chave, None)
+
+    @staticmethod
+    def _interrompida(e):
+        """A leitura da líder foi interrompida pelo prazo da requisição dela (ver Controle de Admissão)."""
+        return isinstance(e, sqlite3.OperationalError) and str(e) == 'interrupted'
+
+    def executar(self, chave, ler, rota=None):
+        """
+        Executa ler() na thread atual, ou aguarda a líder em andamento com a mesma chave. O prazo das consultas
+        é de cada requisição: se a leitura da líder for interrompida pelo prazo dela, a seguidora não recebe o
+        erro e repete a leitura, agora com o próprio prazo.
+        """
+        while True:
+            futuro, lider = self._entrar(chave, rota)
+            if lider:
+                self._conduzir(chave, futuro, ler)
+                return futuro.result()
+            try:
+                return futuro.result()
+            except sqlite3.OperationalError as e:
+                if not self._interrompida(e):
+                    raise
+
+    async def executar_async(self, chave, ler, rota=None):
+        """
+        Versão para corrotinas: a líder executa ler() em uma thread do executor padrão do loop e todas
+        aguardam o futuro sem bloquear o loop de eventos. O cancelamento de quem aguarda não cancela a
+        leitura compartilhada com as demais. Como em executar, a seguidora repete a leitura interrompida pelo
+        prazo da líder.
+        """
+        while True:
+            futuro, lider = self._entrar(chave, rota)
+            if lider:
+                asyncio.get_running_loop().run_in_executor(None, self._conduzir, chave, futuro, ler)
+                return await asyncio.shield(asyncio.wrap_future(futuro))
+            try:
+                return await asyncio.shield(asyncio.wrap_future(futuro))
+            except sqlite3.OperationalError as e:
+                if not self._interrompida(e):
+                    raise
+
+    def estatisticas(self):
+        """Contadores do processo: líderes (consultas executadas), seguidoras (consultas evitadas) e a taxa."""
+        def resumo(lideres, seguidores):
+            total = lideres + seguidores
+            return {'lideres': lideres, 'seguidores': seguidores,
+                    'taxa_deduplicacao': round(seguidores / total, 4) if total else 0.0}
+
+        with self._lock:
+            dados = resumo(self.lideres, self.seguidores)
+            dados['em_andamento'] = len(self._em_voo)
+            dados['por_rota'] = {rota or '-': resumo(*contagem) for rota, contagem in sorted(
+                self.por_rota.items(), key=lambda item: item[1][1], reverse=True)}
+        return dados
+
+
+_coalescedor = CoalescedorLeituras()
+
+
+def chave_leitura(origem, query, args):
+    """Monta a chave de coalescência; retorna None se os parâmetros não forem hasheáveis."""
+    chave = (origem, query, tuple(args.items()) if isinstance(args, dict) else tuple(args))
+    try:
+        hash(chave)
+    except TypeError:
+        return None
+    return chave
+
+
+def ler_coalescido(origem, query, args, ler):
+    """
+    Executa a leitura ler() pelo coalescedor do processo. origem identifica a fonte (tipo de conexão e
+    arquivo do banco), para que bancos e shards diferentes nunca compartilhem resultados. O resultado
+    pode ser entregue a várias requisições: quem o recebe deve copiá-lo antes de alterá-lo.
+    """
+    chave = chave_leitura(origem, query, args) if app.config['LEITURAS_COALESCIDAS'] else None
+    if chave is None:
+        return ler()
+    return _coalescedor.executar(chave, ler, rota=request.endpoint if has_request_context() else None)
+
+
+async def query_db_async(query, args=(), one=False):
+    """
+    Equivalente de query_db(..., coalescer=True) para rotas assíncronas (async def): a consulta roda em uma
+    thread com conexão própria e é coalescida com as leituras idênticas em andamento, síncronas ou não.
+    """
+    caminho = caminho_db_atual()
+    preparar_banco(caminho)
+
+    def ler():
+        db = conectar(caminho)
+        try:
+            return db.execute(query, args).fetchall()
+        finally:
+            db.close()
+
+    chave = chave_leitura(('db', caminho), query, args) if app.config['LEITURAS_COALESCIDAS'] else None
+    if chave is None:
+        rv = await asyncio.to_thread(ler)
+    else:
+        rv = list(await _coalescedor.executar_async(chave, ler,
+                                                    rota=request.endpoint if has_request_context() else None))
+    return (rv[0] if rv else None) if one else rv
+
+
+@app.cli.command('bench-coalescencia')
+@click.option('--clientes', default='1,8,32', help='Quantidades de requisições simultâneas, separadas por vírgula.')
+@click.option('--linhas', default=200000, help='Linhas da tabela agregada pela consulta simulada.')
+def bench_coalescencia_command(clientes, linhas):
+    """Mede a mesma consulta disparada por várias threads, com e sem coalescência: 'flask bench-coalescencia'."""
+    caminho = os.path.join(tempfile.mkdtemp(prefix='bench_coalescencia_'), 'bench.db')
+    db = sqlite3.connect(caminho)
+    db.execute('CREATE TABLE bench (id INTEGER PRIMARY KEY, grupo INTEGER, valor INTEGER)')
+    db.executemany('INSERT INTO bench (grupo, valor) VALUES (?, ?)', ((i % 97, i) for i in range(linhas)))
+    db.commit()
+    db.close()
+    query = 'SELECT grupo, SUM(valor), COUNT(*) FROM bench WHERE valor >= ? GROUP BY grupo ORDER BY grupo'
+
+    def ler():
+        conexao = sqlite3.connect(caminho)
+        try:
+            return conexao.execute(query, (0,)).fetchall()
+        finally:
+            conexao.close()
+
+    def rodar(n_clientes, consultar):
+        barreira = threading.Barrier(n_clientes)
+
+        def cliente():
+            barreira.wait()
+            consultar()
+
+        threads = [threading.Thread(target=cliente) for _ in range(n_clientes)]
+        inicio = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return (time.perf_counter() - inicio) * 1000
+
+    print(f"{'clientes':>8} | {'sem coalescência':>16} | {'com coalescência':>16} | consultas executadas")
+    for n_clientes in (int(n) for n in clientes.split(',')):
+        coalescedor = CoalescedorLeituras()
+        direto = rodar(n_clientes, ler)
+        coalescido = rodar(n_clientes, lambda: coalescedor.executar(('bench', query, (0,)), ler))
+        print(f"{n_clientes:>8} | {direto:>13.1f} ms | {coalescido:>13.1f} ms | "
+              f"{coalescedor.lideres} de {n_clientes}")
+
+
+# --- Cache de Registros do Tenant (Usuário, Empresa e Funcionários) ---
+
+class CacheRegistros:
+    """
+    Cache LRU, por processo, dos registros pequenos lidos a todo momento (cadastro do usuário, empresa e
+    funcionários). As rotas que alteram esses registros chamam invalidar; como os outros processos não
+    recebem a invalidação, cada valor também expira após ttl segundos.
+    As chaves são tuplas (tipo, usuario_id, ...), e os contadores de acertos e faltas são separados por tipo.
+    """
+
+    def __init__(self, max_itens=1000, ttl=60):
+        self.max_itens = max_itens
+        self.ttl = ttl
+        self._itens = OrderedDict()
+        # Geração de cada (tipo, usuario_id): um valor lido antes de uma invalidação não é guardado depois dela.
+        self._geracoes = {}
+        self._contadores = {}
+        self._lock = threading.Lock()
+
+    def obter(self, chave, carregar):
+        """Retorna o valor da chave, carregando-o com carregar() (e guardando-o) quando não está no cache."""
+        agora = time.monotonic()
+        grupo = chave[:2]
+        with self._lock:
+            contadores = self._contadores.setdefault(chave[0], [0, 0])
+            item = self._itens.get(chave)
+            if item is not None and item[1] > agora:
+                self._itens.move_to_end(chave)
+                contadores[0] += 1
+                return item[0]
+            contadores[1] += 1
+            geracao = self._geracoes.get(grupo, 0)
+        valor = carregar()
+        with self._lock:
+            if self._geracoes.get(grupo, 0) == geracao:
+                self._itens[chave] = (valor, agora + self.ttl)
+                self._itens.move_to_end(chave)
+                while len(self._itens) > self.max_itens:
+                    self._itens.popitem(last=False)
+        return valor
+
+    def invalidar(self, tipo, usuario_id):
+        """Descarta todos os registros do tipo pertencentes ao usuário."""
+        grupo = (tipo, usuario_id)
+        with self._lock:
+            self._geracoes[grupo] = self._geracoes.get(grupo, 0) + 1
+            for chave in [chave for chave in self._itens if chave[:2] == grupo]:
+                del self._itens[chave]
+
+    def limpar(self):
+        with self._lock:
+            self._itens.clear()
+            self._contadores.clear()
+
+    def estatisticas(self):
+        with self._lock:
+            tipos = {tipo: {'acertos': acertos, 'faltas': faltas,
+                            'taxa_acerto': round(acertos / (acertos + faltas), 4) if acertos + faltas else 0.0}
+                     for tipo, (acertos, faltas) in sorted(self._contadores.items())}
+            return {'itens': len(self._itens), 'max_itens': self.max_itens, 'ttl': self.ttl, 'tipos': tipos}
+
+
+_cache_registros = CacheRegistros(app.config['CACHE_REGISTROS_MAX'], app.config['CACHE_REGISTROS_TTL'])
+
+
+def invalidar_registros(tipo, usuario_id):
+    """Descarta do cache os registros do tipo ('usuario', 'empresa' ou 'funcionario') após uma alteração."""
+    _cache_registros.invalidar(tipo, usuario_id)
+
+
+def usuario_cadastro(usuario_id):
+    """Nome, sobrenome, data de nascimento e e-mail do usuário (sem o hash da senha)."""
+    return _cache_registros.obter(('usuario', usuario_id), lambda: query_db(
+        'SELECT id, nome, sobrenome, data_nascimento, email FROM usuarios WHERE id = ?', [usuario_id],
+        one=True, diretorio=True))
+
+
+def empresa_do_usuario(usuario_id):
+    """Dados da empresa do usuário, ou None se ainda não foram cadastrados."""
+    return _cache_registros.obter(('empresa', usuario_id), lambda: query_db(
+        'SELECT * FROM empresas WHERE usuario_id = ?', [usuario_id], one=True))
+
+
+def funcionario_por_nome(usuario_id, nome_completo):
+    """Id do funcionário do usuário com esse nome completo, ou None."""
+    def carregar():
+        funcionario = query_db('SELECT id FROM funcionarios WHERE nome_completo = ? AND usuario_id = ?',
+                               (nome_completo, usuario_id), one=True)
+        return funcionario['id'] if funcionario else None
+
+    return _cache_registros.obter(('funcionario', usuario_id, 'nome', nome_completo), carregar)
+
+
+def funcionario_ativo(usuario_id, funcionario_id):
+    """Indica se o funcionário existe, pertence ao usuário e está ativo (sem data de fim de contrato)."""
+    return _cache_registros.obter(('funcionario', usuario_id, 'ativo', funcionario_id), lambda: query_db(
+        "SELECT 1 FROM funcionarios WHERE id = ? AND usuario_id = ? "
+        "AND (data_fim_contrato IS NULL OR data_fim_contrato = '')",
+        (funcionario_id, usuario_id), one=True) is not None)
+
+
+# --- Escrita Agrupada (Group Commit) ---
+
+class EscritorAgrupado:
+    """
+    Thread única de escrita. As requisições enviam unidades de escrita (funções que recebem a conexão)
+    e aguardam o resultado; a thread agrupa as unidades que chegam dentro da janela de latência em uma
+    só transação, isolando cada unidade em um SAVEPOINT, e faz um único commit (e um único fsync) por lote.
+    O erro de uma unidade desfaz apenas as instruções dela e é devolvido somente a quem a enviou.
+    """
+
+    def __init__(self, janela_ms=5, max_lote=64):
+        self.janela = janela_ms / 1000
+        self.max_lote = max_lote
+        self.fila = queue.Queue()
+        self.lotes = 0
+        self.unidades = 0
+        self._conexoes = {}
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def enviar(self, caminho, unidade):
+        """Enfileira uma unidade de escrita para o banco em 'caminho' e retorna um Future com o resultado."""
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, name='escritor-agrupado', daemon=True)
+                self._thread.start()
+        futuro = Future()
+        self.fila.put((caminho, unidade, futuro))
+        return futuro
+
+    def executar(self, caminho, unidade):
+        """Envia a unidade e bloqueia até o commit do lote que a contém."""
+        return self.enviar(caminho, unidade).result()
+
+    def _conexao(self, caminho):
+        if caminho not in self._conexoes:
+            db = sqlite3.connect(caminho, isolation_level=None)
+            db.row_factory = sqlite3.Row
+            self._conexoes[caminho] = db
+        return self._conexoes[caminho]
+
+    def _loop(self):
+        while True:
+            lote = [self.fila.get()]
+            # Recolhe o que chegou enquanto o lote anterior era gravado. Só vale a pena esperar pela janela
+            # quando há concorrência; um cliente sozinho não deve pagar a latência da janela.
+            while len(lote) < self.max_lote and not self.fila.empty():
+                lote.append(self.fila.get_nowait())
+            limite = time.monotonic() + self.janela
+            while 1 < len(lote) < self.max_lote:
+                restante = limite - time.monotonic()
+                if restante <= 0:
+                    break
+                try:
+                    lote.append(self.fila.get(timeout=restante))
+                except queue.Empty:
+                    break
+            por_banco = OrderedDict()
+            for caminho, unidade, futuro in lote:
+                por_banco.setdefault(caminho, []).append((unidade, futuro))
+            for caminho, itens in por_banco.items():
+                self._executar_lote(caminho, itens)
+
+    def _executar_lote(self, caminho, itens):
+        resultados = []
+        try:
+            db = self._conexao(caminho)
+            db.execute('BEGIN IMMEDIATE')
+            for unidade, futuro in itens:
+                db.execute('SAVEPOINT unidade')
+                try:
+                    resultados.append((futuro, unidade(db), None))
+                    db.execute('RELEASE unidade')
+                except Exception as e:
+                    db.execute('ROLLBACK TO unidade')
+                    db.execute('RELEASE unidade')
+                    resultados.append((futuro, None, e))
+            db.execute('COMMIT')
+        except Exception as e:
+            # Falha na transação do lote (ex.: banco bloqueado): nenhuma unidade foi gravada.
+            conexao = self._conexoes.get(caminho)
+            if conexao is not None and conexao.in_transaction:
+                conexao.execute('ROLLBACK')
+            for unidade, futuro in itens:
+                futuro.set_exception(e)
+            return
+        self.lotes += 1
+        self.unidades += len(itens)
+        for futuro, resultado, erro in resultados:
+            if erro is not None:
+                futuro.set_exception(erro)
+            else:
+                futuro.set_result(resultado)
+
+
+_escritor = None
+_escritor_lock = threading.Lock()
+
+
+def escritor_agrupado():
+    """Retorna o escritor agrupado do processo, criando-o na primeira utilização."""
+    global _escritor
+    with _escritor_lock:
+        if _escritor is None:
+            _escritor = EscritorAgrupado(app.config['ESCRITA_JANELA_MS'], app.config['ESCRITA_MAX_LOTE'])
+        return _escritor
+
+
+@app.cli.command('bench-escrita')
+@click.option('--clientes', default='1,8,32', help='Quantidades de clientes concorrentes, separadas por vírgula.')
+@click.option('--escritas', default=200, help='Escritas feitas por cada cliente.')
+def bench_escrita_command(clientes, escritas):
+    """Mede escritas/s com commit individual e com escrita agrupada: 'flask bench-escrita'."""
+    pasta = tempfile.mkdtemp(prefix='bench_escrita_')
+
+    def preparar(nome):
+        caminho = os.path.join(pasta, nome)
+        db = sqlite3.connect(caminho)
+        db.execute('CREATE TABLE IF NOT EXISTS bench (id INTEGER PRIMARY KEY, cliente INTEGER, valor TEXT)')
+        db.commit()
+        db.close()
+        return caminho
+
+    def rodar(n_clientes, escrever):
+        threads = [threading.Thread(target=escrever, args=(i,)) for i in range(n_clientes)]
+        inicio = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return n_clientes * escritas / (time.perf_counter() - inicio)
+
+    print(f"{'clientes':>8} | {'commit individual':>18} | {'agrupada':>12} | lotes")
+    for n_clientes in (int(n) for n in clientes.split(',')):
+        caminho_direto = preparar(f'direto_{n_clientes}.db')
+        caminho_agrupado = preparar(f'agrupado_{n_clientes}.db')
+        erros = []
+
+        def escrever_direto(cliente):
+            db = sqlite3.connect(caminho_direto, timeout=30)
+            for i in range(escritas):
+                try:
+                    db.execute('INSERT INTO bench (cliente, valor) VALUES (?, ?)', (cliente, f'v{i}'))
+                    db.commit()
+                except sqlite3.OperationalError as e:
+                    db.rollback()
+                    erros.append(e)
+            db.close()
+
+        escritor = EscritorAgrupado(app.config['ESCRITA_JANELA_MS'], app.config['ESCRITA_MAX_LOTE'])
+
+        def escrever_agrupado(cliente):
+            for i in range(escritas):
+                escritor.executar(caminho_agrupado, lambda db, i=i: db.execute(
+                    'INSERT INTO bench (cliente, valor) VALUES (?, ?)', (cliente, f'v{i}')))
+
+        direto = rodar(n_clientes, escrever_direto)
+        agrupado = rodar(n_clientes, escrever_agrupado)
+        print(f"{n_clientes:>8} | {direto:>14.0f} w/s | {agrupado:>8.0f} w/s | {escritor.lotes}"
+              + (f" ({len(erros)} erros 'database is locked' no commit individual)" if erros else ''))
+
+
+# --- Ferramentas de Fragmentação (Sharding) ---
+
+def criar_shard(caminho):
+    """Cria o arquivo do shard com o schema completo, caso ele ainda não exista."""
+    if os.path.exists(caminho):
+        return False
+    os.makedirs(os.path.dirname(caminho), exist_ok=True)
+    db = conectar(caminho)
+    try:
+        db.executescript(ler_schema())
+        db.commit()
+        # WAL permite que as leituras do tenant não bloqueiem a sua escrita. Só é ativado depois do schema,
+        # que precisa definir o auto_vacuum antes de qualquer escrita no arquivo.
+        db.execute('PRAGMA journal_mode=WAL')
+    finally:
+        db.close()
+    return True
+
+
+def listar_shards():
+    """Lista os arquivos de shard existentes no diretório configurado."""
+    pasta = app.config['SHARDING_DIR']
+    if not os.path.isdir(pasta):
+        return []
+    return sorted(os.path.join(pasta, nome) for nome in os.listdir(pasta) if nome.endswith('.db'))
+
+
+def colunas_tabela(db, tabela, esquema='main'):
+    """Retorna os nomes das colunas de uma tabela, na ordem da definição."""
+    return [linha[1] for linha in db.execute(f"PRAGMA {esquema}.table_info({tabela})").fetchall()]
+
+
+def migrar_usuario_para_shard(usuario_id, remover_origem=False):
+    """
+    Copia todas as linhas de um usuário do banco principal para o seu shard, preservando os ids.
+    Retorna um dicionário com a quantidade de linhas copiadas por tabela.
+    """
+    caminho = caminho_shard(usuario_id)
+    criar_shard(caminho)
+    db = conectar(caminho)
+    copiadas = {}
+    try:
+        db.execute('ATTACH DATABASE ? AS origem', (DATABASE,))
+        for tabela in TABELAS_TENANT:
+            # Copia apenas as colunas que existem nos dois bancos, para tolerar schemas antigos.
+            origem = set(colunas_tabela(db, tabela, 'origem'))
+            colunas = ', '.join(c for c in colunas_tabela(db, tabela) if c in origem)
+            cur = db.execute(f"INSERT OR IGNORE INTO main.{tabela} ({colunas}) "
+                             f"SELECT {colunas} FROM origem.{tabela} WHERE usuario_id = ?", (usuario_id,))
+            copiadas[tabela] = cur.rowcount
+        db.commit()
+        if remover_origem:
+            for tabela in reversed(TABELAS_TENANT):
+                db.execute(f"DELETE FROM origem.{tabela} WHERE usuario_id = ?", (usuario_id,))
+            db.commit()
+        db.execute('DETACH DATABASE origem')
+    finally:
+        db.close()
+    return copiadas
+
+
+def consultar_todos_shards(query, args=()):
+    """
+    Executa uma consulta de leitura em todos os shards (consultas administrativas entre tenants).
+    Retorna uma lista de tuplas (arquivo do shard, linhas).
+    """
+    resultados = []
+    for caminho in listar_shards():
+        db = sqlite3.connect(f"file:{caminho}?mode=ro", uri=True)
+        db.row_factory = sqlite3.Row
+        try:
+            resultados.append((os.path.basename(caminho), db.execute(query, args).fetchall()))
+        finally:
+            db.close()
+    return resultados
+
+
+@app.cli.command('criar-shards')
+def criar_shards_command():
+    """Cria os arquivos de shard para todos os usuários do diretório: 'flask criar-shards'."""
+    db = conectar(DATABASE)
+    try:
+        usuarios = db.execute('SELECT id FROM usuarios ORDER BY id').fetchall()
+    finally:
+        db.close()
+    for usuario in usuarios:
+        caminho = caminho_shard(usuario['id'])
+        status = 'criado' if criar_shard(caminho) else 'já existia'
+        print(f"Usuário {usuario['id']}: {caminho} ({status})")
+
+
+@app.cli.command('migrar-shards')
+@click.option('--usuario', 'usuario_id', type=int, default=None, help='Migra apenas este usuário.')
+@click.option('--remover-origem', is_flag=True, help='Remove as linhas do banco principal após a cópia.')
+def migrar_shards_command(usuario_id, remover_origem):
+    """Copia os dados de cada usuário do banco principal para o seu shard: 'flask migrar-shards'."""
+    db = conectar(DATABASE)
+    try:
+        if usuario_id is None:
+            ids = [linha['id'] for linha in db.execute('SELECT id FROM usuarios ORDER BY id').fetchall()]
+        else:
+            ids = [usuario_id]
+    finally:
+        db.close()
+    for uid in ids:
+        copiadas = migrar_usuario_para_shard(uid, remover_origem=remover_origem)
+        resumo = ', '.join(f"{tabela}={total}" for tabela, total in copiadas.items())
+        print(f"Usuário {uid} migrado para {caminho_shard(uid)}: {resumo}")
+
+
+@app.cli.command('consultar-shards')
+@click.argument('consulta')
+def consultar_shards_command(consulta):
+    """Executa uma consulta somente leitura em todos os shards: 'flask consultar-shards "SELECT ..."'."""
+    for arquivo, linhas in consultar_todos_shards(consulta):
+        for linha in linhas:
+            print(arquivo, *tuple(linha), sep=' | ')
+
+
+# --- Arquivo Morto de Vendas (Particionamento por Ano) ---
+
+def caminho_arquivo_vendas(caminho_db, ano):
+    """Retorna o arquivo SQLite que guarda as vendas arquivadas de um ano de um banco (principal ou shard)."""
+    nome = os.path.splitext(os.path.basename(caminho_db))[0]
+    return os.path.join(app.config['ARQUIVO_DIR'], f"{nome}_vendas_{int(ano)}.db")
+
+
+def arquivos_vendas_registrados(db, ano_inicio=None, ano_fim=None, ids=None):
+    """
+    Lista (ano, arquivo) dos anos arquivados do banco, opcionalmente só os do intervalo de anos e os que
+    podem conter algum dos ids informados (anos sem faixa de ids registrada entram sempre).
+    """
+    arquivados = []
+    # A faixa de ids existe a partir da migração 13; os complementos das migrações anteriores leem sem ela.
+    faixa = 'id_min, id_max' if 'id_min' in colunas_tabela(db, 'arquivos_vendas') else 'NULL, NULL'
+    for ano, arquivo, id_min, id_max in db.execute(
+            f"SELECT ano, arquivo, {faixa} FROM arquivos_vendas ORDER BY ano").fetchall():
+        if (ano_inicio is not None and ano < ano_inicio) or (ano_fim is not None and ano > ano_fim):
+            continue
+        if ids is not None and id_min is not None and not any(id_min <= int(i) <= id_max for i in ids):
+            continue
+        arquivados.append((ano, arquivo))
+    return arquivados
+
+
+def anexar_arquivo_vendas(db, ano, arquivo):
+    """Anexa (uma única vez por conexão) o arquivo de vendas de um ano e retorna o nome do esquema anexado."""
+    esquema = f"arquivo_{int(ano)}"
+    anexados = {linha[1] for linha in db.execute('PRAGMA database_list').fetchall()}
+    if esquema not in anexados:
+        caminho = os.path.join(app.config['ARQUIVO_DIR'], arquivo)
+        if not os.path.exists(caminho):
+            raise FileNotFoundError(f"Arquivo de vendas de {ano} não encontrado: {caminho}")
+        db.execute(f"ATTACH DATABASE ? AS {esquema}", (caminho,))
+    return esquema
+
+
+def desanexar_arquivos_vendas(db, manter=()):
+    """
+    Desanexa da conexão os arquivos de vendas que não estão em manter. Fora de uma transação, pois o
+    SQLite não desanexa um esquema lido pela transação em andamento.
+    """
+    if db.in_transaction:
+        return
+    for linha in db.execute('PRAGMA database_list').fetchall():
+        if linha[1].startswith('arquivo_') and linha[1] not in manter:
+            db.execute(f"DETACH DATABASE {linha[1]}")
+
+
+@contextmanager
+def abrir_arquivo_vendas(ano, arquivo):
+    """Abre, somente para leitura e em uma conexão própria, o arquivo de vendas de um ano."""
+    caminho = os.path.join(app.config['ARQUIVO_DIR'], arquivo)
+    if not os.path.exists(caminho):
+        raise FileNotFoundError(f"Arquivo de vendas de {ano} não encontrado: {caminho}")
+    origem = sqlite3.connect(f"file:{caminho}?mode=ro", uri=True)
+    try:
+        yield origem
+    finally:
+        origem.close()
+
+
+def selecao_vendas(colunas, existentes):
+    """Lista de colunas para ler vendas de um arquivo; as criadas depois do arquivamento são lidas como NULL."""
+    return ', '.join(c if c in existentes else f"NULL AS {c}" for c in colunas)
+
+
+def fonte_vendas(db, inicio=None, fim=None, ids=None):
+    """
+    Retorna a expressão a ser usada no FROM das consultas de vendas do período [inicio, fim]
+    (datas ISO; None deixa o período aberto) ou, com ids, das buscas por id. Os anos arquivados que
+    podem conter as vendas procuradas são anexados à conexão e unidos à tabela principal com UNION ALL;
+    quando só os dados recentes interessam, retorna simplesmente 'vendas'. Os arquivos anexados por
+    chamadas anteriores e que não interessam à consulta são desanexados, e uma consulta que precisaria
+    de mais arquivos do que o SQLite permite anexar é recusada: para percorrer todo o histórico, use
+    linhas_arquivos_vendas, que lê um arquivo por vez. Deve ser chamada fora de uma transação de escrita.
+    """
+    arquivados = arquivos_vendas_registrados(db, int(inicio[:4]) if inicio else None,
+                                             int(fim[:4]) if fim else None, ids)
+    desanexar_arquivos_vendas(db, {f"arquivo_{ano}" for ano, _arquivo in arquivados})
+    if not arquivados:
+        return 'vendas'
+    limite = db.getlimit(sqlite3.SQLITE_LIMIT_ATTACHED)
+    if len(arquivados) > limite:
+        raise sqlite3.OperationalError(
+            f"A consulta alcança {len(arquivados)} anos arquivados, mas o SQLite anexa no máximo {limite} "
+            f"arquivos por conexão; restrinja a consulta a menos anos.")
+
+    colunas = colunas_tabela(db, 'vendas')
+    partes = [f"SELECT {', '.join(colunas)} FROM main.vendas"]
+    for ano, arquivo in arquivados:
+        esquema = anexar_arquivo_vendas(db, ano, arquivo)
+        lista = selecao_vendas(colunas, set(colunas_tabela(db, 'vendas', esquema)))
+        partes.append(f"SELECT {lista} FROM {esquema}.vendas")
+    return '(' + ' UNION ALL '.join(partes) + ')'
+
+
+def linhas_arquivos_vendas(db, consulta, args=(), ids=None):
+    """
+    Executa a consulta em cada ano arquivado do banco (com ids, só nos que podem conter esses ids), um
+    arquivo por vez e em uma conexão própria com o mesmo row_factory de db, e gera as linhas resultantes.
+    Na consulta, {vendas} é substituído pela tabela de vendas do arquivo, com as mesmas colunas da tabela
+    principal. Serve para percorrer todo o histórico sem esbarrar no limite de arquivos anexados por conexão.
+    """
+    colunas = colunas_tabela(db, 'vendas')
+    for ano, arquivo in arquivos_vendas_registrados(db, ids=ids):
+        with abrir_arquivo_vendas(ano, arquivo) as origem:
+            origem.row_factory = db.row_factory
+            lista = selecao_vendas(colunas, set(colunas_tabela(origem, 'vendas')))
+            yield from origem.execute(consulta.format(vendas=f"(SELECT {lista} FROM vendas)"), args)
+
+
+def bancos_com_vendas():
+    """Lista os bancos que guardam vendas: o principal e, se houver, os shards."""
+    return [DATABASE] + listar_shards()
+
+
+def resumo_vendas(db, esquema, ano):
+    """Retorna (linhas, total em centavos) das vendas de um ano em um esquema da conexão."""
+    linha = db.execute(f"SELECT COUNT(*), COALESCE(SUM(valor_total_centavos), 0) FROM {esquema}.vendas "
+                       f"WHERE data_venda >= ? AND data_venda < ?", (f"{ano:04d}-01-01", f"{ano + 1:04d}-01-01")).fetchone()
+    return linha[0], linha[1]
+
+
+def arquivar_vendas(caminho_db, ano):
+    """
+    Move as vendas de um ano fechado do banco para o seu arquivo anual, em uma única transação:
+    as linhas são copiadas, as contagens e totais conferidos e só então removidas do banco.
+    Retorna a quantidade de vendas movidas.
+    """
+    ano = int(ano)
+    if ano >= datetime.now().year:
+        raise ValueError(f"O ano {ano} ainda não está fechado e não pode ser arquivado.")
+    preparar_banco(caminho_db)
+    caminho = caminho_arquivo_vendas(caminho_db, ano)
+    os.makedirs(os.path.dirname(caminho), exist_ok=True)
+    db = conectar(caminho_db)
+    try:
+        db.execute('ATTACH DATABASE ? AS arquivo', (caminho,))
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            # Mover vendas para o arquivo não é uma alteração para as integrações que leem o changelog.
+            pausar_changelog(db)
+            movidas, total = resumo_vendas(db, 'main', ano)
+            if movidas == 0:
+                db.rollback()
+                return 0
+            if not colunas_tabela(db, 'vendas', 'arquivo'):
+                db.execute('CREATE TABLE arquivo.vendas AS SELECT * FROM main.vendas WHERE 0')
+                db.execute('CREATE INDEX arquivo.idx_vendas_usuario_data '
+                           'ON vendas (usuario_id, data_venda, valor_total_centavos)')
+            # Colunas acrescentadas ao banco depois de um arquivamento anterior também passam a existir no arquivo.
+            existentes = set(colunas_tabela(db, 'vendas', 'arquivo'))
+            for coluna in colunas_tabela(db, 'vendas'):
+                if coluna not in existentes:
+                    db.execute(f"ALTER TABLE arquivo.vendas ADD COLUMN {coluna}")
+            colunas = ', '.join(colunas_tabela(db, 'vendas'))
+            # Em WAL, o commit é atômico em cada arquivo, mas não entre o banco e o arquivo anexado: se uma
+            # execução anterior gravou o arquivo e parou antes de remover as vendas do banco, as cópias são refeitas.
+            db.execute('DELETE FROM arquivo.vendas WHERE id IN (SELECT id FROM main.vendas '
+                       'WHERE data_venda >= ? AND data_venda < ?)', (f"{ano:04d}-01-01", f"{ano + 1:04d}-01-01"))
+            antes, total_antes = resumo_vendas(db, 'arquivo', ano)
+            db.execute(f"INSERT INTO arquivo.vendas ({colunas}) SELECT {colunas} FROM main.vendas "
+                       f"WHERE data_venda >= ? AND data_venda < ?", (f"{ano:04d}-01-01", f"{ano + 1:04d}-01-01"))
+            linhas, total_arquivo = resumo_vendas(db, 'arquivo', ano)
+            if (linhas - antes, total_arquivo - total_antes) != (movidas, total):
+                raise sqlite3.DatabaseError(f"Conferência do arquivo de {ano} falhou; nada foi removido.")
+            db.execute('DELETE FROM main.vendas WHERE data_venda >= ? AND data_venda < ?',
+                       (f"{ano:04d}-01-01", f"{ano + 1:04d}-01-01"))
+            id_min, id_max = db.execute('SELECT MIN(id), MAX(id) FROM arquivo.vendas').fetchone()
+            db.execute('''
+                       INSERT INTO arquivos_vendas (ano, arquivo, linhas, total_centavos, id_min, id_max)
+                       VALUES (?, ?, ?, ?, ?, ?)
+                       ON CONFLICT (ano) DO UPDATE SET linhas = excluded.linhas, total_centavos = excluded.total_centavos,
+                                                       id_min = excluded.id_min, id_max = excluded.id_max,
+                                                       arquivado_em = DATETIME('now', 'localtime')
+                       ''', (ano, os.path.basename(caminho), linhas, total_arquivo, id_min, id_max))
+            pausar_changelog(db, False)
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        db.execute('DETACH DATABASE arquivo')
+    finally:
+        db.close()
+    return movidas
+
+
+def restaurar_vendas(caminho_db, ano):
+    """Devolve ao banco as vendas arquivadas de um ano e remove o arquivo anual. Retorna a quantidade restaurada."""
+    ano = int(ano)
+    preparar_banco(caminho_db)
+    db = conectar(caminho_db)
+    try:
+        registro = db.execute('SELECT arquivo FROM arquivos_vendas WHERE ano = ?', (ano,)).fetchone()
+        if registro is None:
+            return 0
+        caminho = os.path.join(app.config['ARQUIVO_DIR'], registro['arquivo'])
+        db.execute('ATTACH DATABASE ? AS arquivo', (caminho,))
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            pausar_changelog(db)
+            existentes = set(colunas_tabela(db, 'vendas', 'arquivo'))
+            colunas = ', '.join(c for c in colunas_tabela(db, 'vendas') if c in existentes)
+            restauradas = db.execute(f"INSERT INTO main.vendas ({colunas}) SELECT {colunas} FROM arquivo.vendas").rowcount
+            db.execute('DELETE FROM arquivos_vendas WHERE ano = ?', (ano,))
+            pausar_changelog(db, False)
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        db.execute('DETACH DATABASE arquivo')
+    finally:
+        db.close()
+    os.remove(caminho)
+    return restauradas
+
+
+def verificar_arquivos_vendas(caminho_db):
+    """
+    Confere os arquivos anuais de um banco: existência do arquivo, contagem e total registrados,
+    vendas fora do ano e vendas do ano que ainda restam no banco. Retorna a lista de problemas encontrados.
+    """
+    problemas = []
+    preparar_banco(caminho_db)
+    db = conectar(caminho_db)
+    try:
+        if db.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'arquivos_vendas'").fetchone() is None:
+            return problemas
+        for registro in db.execute('SELECT * FROM arquivos_vendas ORDER BY ano').fetchall():
+            ano = registro['ano']
+            try:
+                esquema = anexar_arquivo_vendas(db, ano, registro['arquivo'])
+            except FileNotFoundError as e:
+                problemas.append(str(e))
+                continue
+            linhas, total = resumo_vendas(db, esquema, ano)
+            if (linhas, total) != (registro['linhas'], registro['total_centavos']):
+                problemas.append(f"{ano}: o arquivo tem {linhas} vendas / {total} centavos, mas o registro indica "
+                                 f"{registro['linhas']} / {registro['total_centavos']}.")
+            todas, id_min, id_max = db.execute(f"SELECT COUNT(*), MIN(id), MAX(id) FROM {esquema}.vendas").fetchone()
+            if todas != linhas:
+                problemas.append(f"{ano}: o arquivo contém {todas - linhas} vendas de outros anos.")
+            if registro['id_min'] is not None and (id_min, id_max) != (registro['id_min'], registro['id_max']):
+                problemas.append(f"{ano}: o arquivo tem os ids {id_min}..{id_max}, mas o registro indica "
+                                 f"{registro['id_min']}..{registro['id_max']}.")
+            restantes, _total = resumo_vendas(db, 'main', ano)
+            if restantes:
+                problemas.append(f"{ano}: {restantes} vendas do ano ainda estão no banco principal.")
+            # Um arquivo anexado por vez, para não esbarrar no limite de anexos do SQLite.
+            db.execute(f"DETACH DATABASE {esquema}")
+    finally:
+        db.close()
+    return problemas
+
+
+def preencher_faixas_ids_arquivos(db):
+    """Registra a faixa de ids dos anos arquivados antes da migração 13."""
+    for ano, arquivo in arquivos_vendas_registrados(db):
+        with abrir_arquivo_vendas(ano, arquivo) as origem:
+            id_min, id_max = origem.execute('SELECT MIN(id), MAX(id) FROM vendas').fetchone()
+        db.execute('UPDATE arquivos_vendas SET id_min = ?, id_max = ? WHERE ano = ?', (id_min, id_max, ano))
+
+
+def refazer_saldo_inicial(db):
+    """
+    Completa a migração 15: lança no livro as vendas arquivadas sem movimento e soma ao saldo inicial de cada
+    produto as unidades vendidas antes do livro, para que o saldo atual continue igual a roupas.quantidade.
+    """
+    db.executemany('''
+                   INSERT INTO movimentos_estoque (usuario_id, roupa_id, tipo, quantidade, venda_id, observacao,
+                                                   criado_em)
+                   SELECT ?, s.roupa_id, 'venda', -?, ?, 'Venda anterior ao livro', MAX(?, s.criado_em)
+                   FROM movimentos_estoque s
+                   WHERE s.roupa_id = ? AND s.tipo = 'ajuste' AND s.observacao = 'Saldo inicial'
+                     AND s.venda_id IS NULL
+                     AND NOT EXISTS (SELECT 1 FROM movimentos_estoque m WHERE m.venda_id = ?)
+                   ''', ((venda[1], venda[3], venda[0], venda[4], venda[2], venda[0])
+                         for venda in linhas_arquivos_vendas(db, '''
+                                                             SELECT id, usuario_id, roupa_id, quantidade_vendida,
+                                                                    data_venda
+                                                             FROM {vendas} ORDER BY id
+                                                             ''')))
+    db.execute('''
+               UPDATE movimentos_estoque
+               SET quantidade = quantidade - (SELECT COALESCE(SUM(m.quantidade), 0) FROM movimentos_estoque m
+                                              WHERE m.roupa_id = movimentos_estoque.roupa_id
+                                                AND m.tipo = 'venda' AND m.observacao = 'Venda anterior ao livro')
+               WHERE tipo = 'ajuste' AND observacao = 'Saldo inicial' AND venda_id IS NULL
+               ''')
+
+
+def complementar_migracao(db, numero):
+    """
+    Executa a parte em Python de uma migração, na transação aberta pelo seu script: o que depende dos
+    arquivos anuais de vendas, que são lidos um por vez e não podem ser alcançados pelo SQL da migração.
+    """
+    complemento = {10: somar_arquivos_vendas_local, 11: somar_arquivos_rfm, 12: somar_arquivos_vendas_diarias,
+                   13: preencher_faixas_ids_arquivos, 15: refazer_saldo_inicial}.get(numero)
+    if complemento is not None:
+        complemento(db)
+
+
+@app.cli.command('arquivar-vendas')
+@click.option('--ano', 'anos', type=int, multiple=True,
+              help='Ano a arquivar (pode ser repetido). Padrão: anos fora da janela de 12 meses das métricas.')
+def arquivar_vendas_command(anos):
+    """Move as vendas de anos fechados para arquivos anuais: 'flask arquivar-vendas --ano 2023'."""
+    # Por padrão, só arquiva os anos que os painéis (últimos 12 meses) não consultam mais.
+    limite = (datetime.now() - timedelta(days=365)).year
+    for caminho in bancos_com_vendas():
+        anos_banco = anos
+        if not anos_banco:
+            db = conectar(caminho)
+            try:
+                anos_banco = [int(linha[0]) for linha in db.execute(
+                    "SELECT DISTINCT strftime('%Y', data_venda) FROM vendas WHERE data_venda < ?",
+                    (f"{limite:04d}-01-01",)).fetchall()]
+            finally:
+                db.close()
+        for ano in anos_banco:
+            try:
+                movidas = arquivar_vendas(caminho, ano)
+            except (ValueError, sqlite3.Error) as e:
+                print(f"{os.path.basename(caminho)} / {ano}: {e}")
+                continue
+            print(f"{os.path.basename(caminho)} / {ano}: {movidas} vendas arquivadas em "
+                  f"{caminho_arquivo_vendas(caminho, ano)}")
+
+
+@app.cli.command('restaurar-vendas')
+@click.option('--ano', 'anos', type=int, multiple=True, required=True, help='Ano a restaurar (pode ser repetido).')
+def restaurar_vendas_command(anos):
+    """Devolve ao banco as vendas arquivadas de um ano: 'flask restaurar-vendas --ano 2023'."""
+    for caminho in bancos_com_vendas():
+        for ano in anos:
+            restauradas = restaurar_vendas(caminho, ano)
+            print(f"{os.path.basename(caminho)} / {ano}: {restauradas} vendas restauradas")
+
+
+@app.cli.command('verificar-arquivos')
+def verificar_arquivos_command():
+    """Confere a integridade dos arquivos anuais de vendas: 'flask verificar-arquivos'."""
+    problemas = 0
+    for caminho in bancos_com_vendas():
+        for problema in verificar_arquivos_vendas(caminho):
+            print(f"{os.path.basename(caminho)}: {problema}")
+            problemas += 1
+    print('Arquivos de vendas consistentes.' if problemas == 0 else f"{problemas} problema(s) encontrado(s).")
+
+
+# --- Previsão de Demanda e Ponto de Reposição ---
+
+def calcular_previsoes_banco(db):
+    """
+    Recalcula a previsão de demanda de todos os produtos de um banco em um único lote vetorizado
+    (ver previsao.py) e grava o resultado em previsoes_estoque. Retorna a quantidade de produtos.
+    """
+    if not PREVISAO_DISPONIVEL:
+        raise RuntimeError("A previsão de demanda precisa do NumPy: pip install numpy")
+    dias = app.config['PREVISAO_JANELA_DIAS']
+    inicio = (datetime.now() - timedelta(days=dias - 1)).strftime('%Y-%m-%d')
+
+    roupas = db.execute('SELECT id, usuario_id, quantidade FROM roupas ORDER BY id').fetchall()
+    if not roupas:
+        return 0
+    roupa_ids, usuario_ids, estoque = zip(*roupas)
+    vendas = db.execute(f"""
+                        SELECT roupa_id, data_venda, SUM(quantidade_vendida)
+                        FROM {fonte_vendas(db, inicio)}
+                        WHERE data_venda >= ?
+                        GROUP BY roupa_id, data_venda
+                        """, (inicio,)).fetchall()
+    colunas_vendas = list(zip(*vendas)) if vendas else [(), (), ()]
+
+    matriz = matriz_vendas_diarias(roupa_ids, *colunas_vendas, inicio=inicio, dias=dias)
+    resultado = calcular_previsoes(matriz, estoque, prazo_reposicao=app.config['PREVISAO_PRAZO_REPOSICAO'])
+
+    # Cobertura infinita (produto sem demanda) é gravada como NULL.
+    cobertura = [None if c == float('inf') else round(c, 1) for c in resultado['dias_cobertura'].tolist()]
+    calculado_em = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    linhas = zip(roupa_ids, usuario_ids, resultado['media_7d'].tolist(), resultado['media_28d'].tolist(),
+                 resultado['demanda_diaria'].tolist(), resultado['desvio'].tolist(), cobertura,
+                 resultado['ponto_reposicao'].tolist(), resultado['estoque_baixo'].astype(int).tolist(),
+                 [calculado_em] * len(roupa_ids))
+    db.execute('DELETE FROM previsoes_estoque')
+    db.executemany('''
+                   INSERT INTO previsoes_estoque (roupa_id, usuario_id, media_7d, media_28d, demanda_diaria, desvio,
+                                                  dias_cobertura, ponto_reposicao, estoque_baixo, calculado_em)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                   ''', linhas)
+    db.commit()
+    return len(roupa_ids)
+
+
+def tarefa_previsao(db, caminho):
+    """Tarefa de manutenção: recalcula a previsão de demanda e o ponto de reposição dos produtos."""
+    if not PREVISAO_DISPONIVEL:
+        return 'NumPy não instalado; previsão ignorada'
+    return f"{calcular_previsoes_banco(db)} produto(s)"
+
+
+@app.cli.command('calcular-previsoes')
+def calcular_previsoes_command():
+    """Recalcula a previsão de demanda de todos os produtos: 'flask calcular-previsoes'."""
+    for caminho in bancos_com_vendas():
+        preparar_banco(caminho)
+        db = conectar(caminho)
+        try:
+            t0 = time.perf_counter()
+            total = calcular_previsoes_banco(db)
+        finally:
+            db.close()
+        print(f"{os.path.basename(caminho)}: {total} produto(s) em {time.perf_counter() - t0:.2f} s")
+
+
+@app.cli.command('bench-previsao')
+@click.option('--skus', type=int, default=100000, show_default=True, help='Quantidade de produtos simulados.')
+def bench_previsao_command(skus):
+    """Mede o cálculo vetorizado da previsão com vendas simuladas: 'flask bench-previsao --skus 100000'."""
+    if not PREVISAO_DISPONIVEL:
+        print("A previsão de demanda precisa do NumPy: pip install numpy")
+        return
+    dias = app.config['PREVISAO_JANELA_DIAS']
+    gerador = np.random.default_rng(42)
+    matriz = gerador.poisson(gerador.gamma(0.5, 2.0, size=(skus, 1)), size=(skus, dias)).astype(np.float32)
+    estoque = gerador.integers(0, 200, size=skus)
+    t0 = time.perf_counter()
+    resultado = calcular_previsoes(matriz, estoque, prazo_reposicao=app.config['PREVISAO_PRAZO_REPOSICAO'])
+    duracao = time.perf_counter() - t0
+    print(f"{skus} produtos x {dias} dias: {duracao:.3f} s "
+          f"({int(resultado['estoque_baixo'].sum())} com estoque baixo)")
+
+
+# --- Segmentação RFM de Clientes ---
+
+def recalcular_notas_rfm(db, usuario_id=None):
+    """
+    Recalcula as notas e o segmento dos clientes (de um usuário ou de todos) a partir dos totais em clientes_rfm,
+    sem ler as vendas, e grava os limites dos quintis de cada usuário. Deve ser chamada dentro de uma unidade de
+    escrita (ou seguida de commit). Retorna a quantidade de clientes.
+    """
+    filtro, args = ('WHERE usuario_id = ?', (usuario_id,)) if usuario_id is not None else ('', ())
+    linhas = db.execute(f"""
+                        SELECT cliente_id, usuario_id,
+                               CAST(julianday('now', 'localtime', 'start of day') - julianday(ultima_compra) AS INTEGER),
+                               compras, total_centavos
+                        FROM clientes_rfm {filtro}
+                        """, args).fetchall()
+    if not linhas:
+        return 0
+    cliente_ids, usuario_ids, dias, compras, totais = zip(*linhas)
+    notas, limites_por_usuario = calcular_rfm(usuario_ids, dias, compras, totais)
+    db.executemany('UPDATE clientes_rfm SET recencia = ?, frequencia = ?, monetario = ?, segmento = ? '
+                   'WHERE cliente_id = ?', [(*nota, cliente_id) for nota, cliente_id in zip(notas, cliente_ids)])
+    calculado_em = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    clientes_por_usuario = {}
+    for id_usuario in usuario_ids:
+        clientes_por_usuario[id_usuario] = clientes_por_usuario.get(id_usuario, 0) + 1
+    db.executemany('''
+                   INSERT OR REPLACE INTO rfm_limites (usuario_id, recencia, frequencia, monetario, clientes,
+                                                       calculado_em)
+                   VALUES (?, ?, ?, ?, ?, ?)
+                   ''', [(id_usuario, json.dumps(limites['recencia']), json.dumps(limites['frequencia']),
+                          json.dumps(limites['monetario']), clientes_por_usuario[id_usuario], calculado_em)
+                         for id_usuario, limites in limites_por_usuario.items()])
+    return len(linhas)
+
+
+def somar_arquivos_rfm(db):
+    """
+    Soma aos totais de compras de clientes_rfm as vendas dos anos arquivados, um arquivo por vez
+    (um mesmo dia nunca está em dois arquivos nem no banco, então os dias com compra se somam).
+    """
+    db.executemany('''
+                   INSERT INTO clientes_rfm (cliente_id, usuario_id, primeira_compra, ultima_compra, compras,
+                                             total_centavos)
+                   SELECT ?1, ?2, ?3, ?4, ?5, ?6
+                   WHERE EXISTS (SELECT 1 FROM clientes c WHERE c.id = ?1 AND c.usuario_id = ?2)
+                   ON CONFLICT (cliente_id) DO UPDATE SET
+                       primeira_compra = MIN(primeira_compra, excluded.primeira_compra),
+                       ultima_compra = MAX(ultima_compra, excluded.ultima_compra),
+                       compras = compras + excluded.compras,
+                       total_centavos = total_centavos + excluded.total_centavos
+                   ''', linhas_arquivos_vendas(db, '''
+                                                SELECT cliente_id, usuario_id, MIN(data_venda), MAX(data_venda),
+                                                       COUNT(DISTINCT data_venda), SUM(valor_total_centavos)
+                                                FROM {vendas}
+                                                WHERE cliente_id IS NOT NULL
+                                                GROUP BY cliente_id, usuario_id
+                                                '''))
+
+
+def reconstruir_rfm_banco(db):
+    """
+    Refaz os totais de compras de todos os clientes de um banco a partir das vendas (inclusive dos anos
+    arquivados, somados arquivo por arquivo) e recalcula as notas. Retorna a quantidade de clientes.
+    """
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        db.execute('DELETE FROM clientes_rfm')
+        db.execute("""
+                   INSERT INTO clientes_rfm (cliente_id, usuario_id, primeira_compra, ultima_compra, compras,
+                                             total_centavos)
+                   SELECT v.cliente_id, v.usuario_id, MIN(v.data_venda), MAX(v.data_venda),
+                          COUNT(DISTINCT v.data_venda), SUM(v.valor_total_centavos)
+                   FROM vendas v
+                            JOIN clientes c ON c.id = v.cliente_id AND c.usuario_id = v.usuario_id
+                   GROUP BY v.cliente_id
+                   """)
+        somar_arquivos_rfm(db)
+        db.execute('DELETE FROM rfm_limites')
+        total = recalcular_notas_rfm(db)
+        db.commit()
+        return total
+    except Exception:
+        db.rollback()
+        raise
+
+
+def registrar_compra_rfm(db, usuario_id, cliente_id, total_centavos):
+    """
+    Soma uma compra de hoje aos totais do cliente e o pontua pelos limites atuais do usuário, sem recalcular
+    os demais clientes (a frequência conta dias com compra). Sem limites ainda calculados, as notas do usuário
+    são calculadas agora. Deve ser chamada dentro de uma unidade de escrita.
+    """
+    compras, total = db.execute('''
+                                INSERT INTO clientes_rfm (cliente_id, usuario_id, primeira_compra, ultima_compra,
+                                                          compras, total_centavos)
+                                VALUES (?, ?, DATE('now', 'localtime'), DATE('now', 'localtime'), 1, ?)
+                                ON CONFLICT (cliente_id) DO UPDATE SET
+                                    compras = compras + (ultima_compra < excluded.ultima_compra),
+                                    ultima_compra = MAX(ultima_compra, excluded.ultima_compra),
+                                    total_centavos = total_centavos + excluded.total_centavos
+                                RETURNING compras, total_centavos
+                                ''', (cliente_id, usuario_id, total_centavos)).fetchone()
+    limites = db.execute('SELECT recencia, frequencia, monetario FROM rfm_limites WHERE usuario_id = ?',
+                         (usuario_id,)).fetchone()
+    if limites is None:
+        recalcular_notas_rfm(db, usuario_id)
+        return
+    notas = pontuar({chave: json.loads(limites[chave]) for chave in limites.keys()}, 0, compras, total)
+    db.execute('UPDATE clientes_rfm SET recencia = ?, frequencia = ?, monetario = ?, segmento = ? '
+               'WHERE cliente_id = ?', (*notas, cliente_id))
+
+
+def garantir_notas_rfm(usuario_id):
+    """Calcula as notas do usuário se ainda não foram calculadas (ex.: logo após a migração)."""
+    if query_db('SELECT 1 FROM rfm_limites WHERE usuario_id = ?', [usuario_id], one=True) is None and \
+            query_db('SELECT 1 FROM clientes_rfm WHERE usuario_id = ? LIMIT 1', [usuario_id], one=True) is not None:
+        executar_escrita(lambda db: recalcular_notas_rfm(db, usuario_id))
+
+
+def tarefa_rfm(db, caminho):
+    """Tarefa de manutenção: recalcula as notas RFM, para a recência acompanhar os dias sem compra."""
+    return f"{recalcular_notas_rfm(db)} cliente(s)"
+
+
+@app.cli.command('recalcular-rfm')
+@click.option('--completo', is_flag=True, help='Refaz também os totais de compras a partir das vendas.')
+def recalcular_rfm_command(completo):
+    """Recalcula as notas RFM dos clientes: 'flask recalcular-rfm [--completo]'."""
+    for caminho in bancos_com_vendas():
+        preparar_banco(caminho)
+        db = conectar(caminho)
+        try:
+            t0 = time.perf_counter()
+            if completo:
+                total = reconstruir_rfm_banco(db)
+            else:
+                total = recalcular_notas_rfm(db)
+                db.commit()
+        finally:
+            db.close()
+        print(f"{os.path.basename(caminho)}: {total} cliente(s) em {time.perf_counter() - t0:.2f} s")
+
+
+@app.cli.command('bench-rfm')
+@click.option('--clientes', type=int, default=100000, show_default=True, help='Quantidade de clientes simulados.')
+@click.option('--usuarios', type=int, default=100, show_default=True, help='Quantidade de usuários (lojas).')
+def bench_rfm_command(clientes, usuarios):
+    """Mede o cálculo das notas RFM com clientes simulados: 'flask bench-rfm --clientes 100000'."""
+    gerador = random.Random(42)
+    usuario_ids = [gerador.randrange(usuarios) for _ in range(clientes)]
+    dias = [gerador.randrange(730) for _ in range(clientes)]
+    compras = [1 + int(gerador.expovariate(0.5)) for _ in range(clientes)]
+    totais = [gerador.randrange(1000, 500000) for _ in range(clientes)]
+    t0 = time.perf_counter()
+    notas, limites = calcular_rfm(usuario_ids, dias, compras, totais)
+    duracao = time.perf_counter() - t0
+    print(f"{clientes} clientes de {len(limites)} usuário(s): {duracao:.3f} s "
+          f"({'NumPy' if RFM_VETORIZADO else 'Python puro'})")
+
+
+# --- Manutenção Agendada do Banco de Dados ---
+
+# Identifica este processo na disputa pela liderança da manutenção.
+_ID_PROCESSO = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+_agendador_manutencao = None
+_manutencao_lock = threading.Lock()
+
+
+def tarefa_otimizar(db, caminho):
+    """Atualiza as estatísticas do planejador: ANALYZE completo na primeira vez, depois PRAGMA optimize."""
+    if db.execute("SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'").fetchone() is None:
+        db.execute('ANALYZE')
+        return 'ANALYZE completo'
+    # analysis_limit faz o optimize amostrar os índices em vez de percorrê-los por inteiro.
+    db.execute('PRAGMA analysis_limit = 1000')
+    db.execute('PRAGMA optimize')
+    return 'PRAGMA optimize'
+
+
+def tarefa_vacuum(db, caminho, completo=False):
+    """
+    Devolve ao sistema de arquivos as páginas livres deixadas por exclusões (ex.: arquivamento de vendas).
+    Bancos criados antes do auto_vacuum incremental só são convertidos com completo=True (VACUUM completo).
+    """
+    if db.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+        if not completo:
+            return "auto_vacuum não é incremental; execute 'flask manutencao --tarefa vacuum --completo'"
+        db.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        db.execute('VACUUM')
+        return 'convertido para auto_vacuum incremental (VACUUM completo)'
+    livres = db.execute('PRAGMA freelist_count').fetchone()[0]
+    paginas = app.config['MANUTENCAO_VACUUM_PAGINAS']
+    db.execute(f"PRAGMA incremental_vacuum({int(paginas)})").fetchall()
+    return f"{min(livres, paginas)} de {livres} página(s) livre(s) liberada(s)"
+
+
+def tarefa_checkpoint(db, caminho):
+    """Transfere o WAL para o arquivo principal e o trunca, evitando que ele cresça sem limite."""
+    if db.execute('PRAGMA journal_mode').fetchone()[0] != 'wal':
+        return 'banco fora do modo WAL'
+    ocupado, paginas_log, transferidas = db.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchone()
+    return f"{transferidas} de {paginas_log} página(s) transferida(s)" + (' (leitores ativos)' if ocupado else '')
+
+
+def tarefa_aquecimento(db, caminho):
+    """
+    Pré-carrega no cache do sistema operacional as páginas de índice usadas pelas métricas e pelas buscas
+    dos usuários ativos (com vendas nos últimos 30 dias) e atualiza a réplica analítica, quando ativa.
+    """
+    hoje = datetime.now()
+    ativos = [linha[0] for linha in db.execute('SELECT DISTINCT usuario_id FROM vendas WHERE data_venda >= ?',
+                                               ((hoje - timedelta(days=30)).strftime('%Y-%m-%d'),)).fetchall()]
+    inicio_12m = (hoje - timedelta(days=365)).strftime('%Y-%m-%d')
+    for usuario_id in ativos:
+        db.execute('SELECT COUNT(*), SUM(valor_total_centavos) FROM vendas WHERE usuario_id = ? AND data_venda >= ?',
+                   (usuario_id, inicio_12m)).fetchone()
+        db.execute("SELECT COUNT(*) FROM roupas WHERE usuario_id = ? AND codigo_produto >= ''", (usuario_id,)).fetchone()
+        db.execute('SELECT COUNT(*) FROM clientes WHERE usuario_id = ?', (usuario_id,)).fetchone()
+    if app.config['REPLICA_ANALITICA']:
+        atualizar_replica(caminho)
+    return f"{len(ativos)} usuário(s) ativo(s)"
+
+
+def tarefa_limpeza(db, caminho):
+    """
+    Tarefa de manutenção: remove as chaves de idempotência vencidas e os carrinhos da API abandonados (abertos
+    e não finalizados no prazo), com os seus itens. O estoque não é reservado no carrinho, então nada é devolvido.
+    """
+    retencao = f"-{app.config['IDEMPOTENCIA_RETENCAO_HORAS']} hours"
+    chaves = db.execute("DELETE FROM chaves_idempotencia WHERE criado_em < DATETIME('now', 'localtime', ?)",
+                        (retencao,)).rowcount
+    abandono = f"-{app.config['CARRINHO_ABANDONO_HORAS']} hours"
+    db.execute('''
+               DELETE FROM carrinho_itens WHERE carrinho_id IN (
+                   SELECT id FROM carrinhos
+                   WHERE finalizado_em IS NULL AND criado_em < DATETIME('now', 'localtime', ?))
+               ''', (abandono,))
+    carrinhos = db.execute("DELETE FROM carrinhos WHERE finalizado_em IS NULL "
+                           "AND criado_em < DATETIME('now', 'localtime', ?)", (abandono,)).rowcount
+    return f"{chaves} chave(s) de idempotência e {carrinhos} carrinho(s) abandonado(s) removido(s)"
+
+
+# Tarefas de manutenção, na ordem de execução; o intervalo de cada uma fica em MANUTENCAO_INTERVALOS.
+TAREFAS_MANUTENCAO = OrderedDict([
+    ('otimizar', tarefa_otimizar),
+    ('vacuum', tarefa_vacuum),
+    ('checkpoint', tarefa_checkpoint),
+    ('aquecimento', tarefa_aquecimento),
+    ('previsao', tarefa_previsao),
+    ('rfm', tarefa_rfm),
+    ('limpeza', tarefa_limpeza),
+])
+
+
+def registrar_execucao(tarefa, caminho, inicio, duracao_ms, sucesso, detalhe):
+    """Grava uma execução de manutenção no registro do banco principal."""
+    db = conectar(DATABASE)
+    try:
+        db.execute('''
+                   INSERT INTO manutencao_execucoes (tarefa, banco, inicio, duracao_ms, sucesso, detalhe, processo)
+                   VALUES (?, ?, ?, ?, ?, ?, ?)
+                   ''', (tarefa, os.path.basename(caminho), inicio, duracao_ms, 1 if sucesso else 0, detalhe,
+                         _ID_PROCESSO))
+        db.commit()
+    finally:
+        db.close()
+
+
+def executar_tarefa(tarefa, caminho, **opcoes):
+    """Executa uma tarefa de manutenção em um banco e registra a duração. Retorna (sucesso, detalhe, duracao_ms)."""
+    preparar_banco(caminho)
+    inicio = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    t0 = time.perf_counter()
+    db = conectar(caminho)
+    try:
+        detalhe = TAREFAS_MANUTENCAO[tarefa](db, caminho, **opcoes)
+        db.commit()
+        sucesso = True
+    except sqlite3.Error as e:
+        detalhe, sucesso = f"Erro: {e}", False
+    except Exception as e:
+        # Falhas que não são do SQLite (um arquivo anual ausente, um erro de programação) também ficam
+        # registradas como execução malsucedida, sem interromper as demais tarefas.
+        traceback.print_exc()
+        detalhe, sucesso = f"Erro: {type(e).__name__}: {e}", False
+    finally:
+        db.close()
+    duracao_ms = round((time.perf_counter() - t0) * 1000, 1)
+    registrar_execucao(tarefa, caminho, inicio, duracao_ms, sucesso, detalhe)
+    return sucesso, detalhe, duracao_ms
+
+
+def assumir_lideranca():
+    """
+    Disputa a liderança da manutenção entre os processos (workers) por meio de uma linha de trava no
+    banco principal. O líder renova a concessão a cada ciclo; se ele parar, outro processo assume
+    depois que a concessão expira. Retorna True se este processo é o líder.
+    """
+    agora = time.time()
+    concessao = app.config['MANUTENCAO_INTERVALO'] * 3
+    db = conectar(DATABASE)
+    try:
+        db.execute('INSERT OR IGNORE INTO manutencao_lider (id, processo, expira_em) VALUES (1, NULL, 0)')
+        cur = db.execute('UPDATE manutencao_lider SET processo = ?, expira_em = ? '
+                         'WHERE id = 1 AND (processo = ? OR processo IS NULL OR expira_em < ?)',
+                         (_ID_PROCESSO, agora + concessao, _ID_PROCESSO, agora))
+        db.commit()
+        return cur.rowcount == 1
+    finally:
+        db.close()
+
+
+def tarefa_vencida(tarefa, caminho):
+    """Indica se a última execução bem-sucedida da tarefa no banco é mais antiga que o seu intervalo."""
+    db = conectar(DATABASE)
+    try:
+        ultima = db.execute('''
+                            SELECT MAX(inicio) FROM manutencao_execucoes
+                            WHERE tarefa = ? AND banco = ? AND sucesso = 1
+                            ''', (tarefa, os.path.basename(caminho))).fetchone()[0]
+    finally:
+        db.close()
+    if ultima is None:
+        return True
+    intervalo = app.config['MANUTENCAO_INTERVALOS'][tarefa]
+    return datetime.strptime(ultima, '%Y-%m-%d %H:%M:%S') <= datetime.now() - timedelta(seconds=intervalo)
+
+
+def executar_manutencao_pendente():
+    """Executa, em todos os bancos, as tarefas cujo intervalo já venceu."""
+    for tarefa in TAREFAS_MANUTENCAO:
+        if tarefa == 'aquecimento' and not app.config['MANUTENCAO_AQUECER']:
+            continue
+        for caminho in bancos_com_vendas():
+            if tarefa_vencida(tarefa, caminho):
+                executar_tarefa(tarefa, caminho)
+
+
+def _loop_manutencao():
+    """
+    Verifica periodicamente as tarefas pendentes; só o processo líder as executa. Nenhuma exceção encerra
+    a thread: o erro é registrado no log e a verificação continua no ciclo seguinte.
+    """
+    while True:
+        try:
+            if assumir_lideranca():
+                executar_manutencao_pendente()
+        except sqlite3.Error as e:
+            print(f"Erro na manutenção agendada: {e}")
+        except Exception:
+            print('Erro inesperado na manutenção agendada:')
+            traceback.print_exc()
+        time.sleep(app.config['MANUTENCAO_INTERVALO'])
+
+
+def iniciar_agendador_manutencao():
+    """Inicia (uma única vez por processo) a thread da manutenção agendada."""
+    global _agendador_manutencao
+    with _manutencao_lock:
+        if _agendador_manutencao is None:
+            preparar_banco(DATABASE)
+            _agendador_manutencao = threading.Thread(target=_loop_manutencao, name='manutencao', daemon=True)
+            _agendador_manutencao.start()
+
+
+@app.before_request
+def iniciar_manutencao():
+    """Com a manutenção agendada ativa, inicia o agendador na primeira requisição do processo."""
+    if app.config['MANUTENCAO_ATIVA'] and _agendador_manutencao is None:
+        iniciar_agendador_manutencao()
+
+
+@app.cli.command('manutencao')
+@click.option('--tarefa', 'tarefas', type=click.Choice(list(TAREFAS_MANUTENCAO)), multiple=True,
+              help='Tarefa a executar (pode ser repetida). Padrão: todas.')
+@click.option('--completo', is_flag=True, help='Converte para auto_vacuum incremental com um VACUUM completo.')
+def manutencao_command(tarefas, completo):
+    """Executa agora as tarefas de manutenção em todos os bancos: 'flask manutencao'."""
+    for tarefa in tarefas or TAREFAS_MANUTENCAO:
+        opcoes = {'completo': completo} if tarefa == 'vacuum' else {}
+        for caminho in bancos_com_vendas():
+            sucesso, detalhe, duracao_ms = executar_tarefa(tarefa, caminho, **opcoes)
+            print(f"{os.path.basename(caminho)} / {tarefa}: {detalhe} ({duracao_ms} ms)"
+                  + ('' if sucesso else ' [FALHOU]'))
+
+
+@app.cli.command('manutencao-historico')
+@click.option('--limite', type=int, default=20, show_default=True, help='Quantidade de execuções listadas.')
+def manutencao_historico_command(limite):
+    """Lista as últimas execuções de manutenção: 'flask manutencao-historico'."""
+    db = conectar(DATABASE)
+    try:
+        execucoes = db.execute('SELECT * FROM manutencao_execucoes ORDER BY id DESC LIMIT ?', (limite,)).fetchall()
+    finally:
+        db.close()
+    for execucao in execucoes:
+        print(execucao['inicio'], execucao['banco'], execucao['tarefa'], f"{execucao['duracao_ms']} ms",
+              'ok' if execucao['sucesso'] else 'falhou', execucao['detalhe'], sep=' | ')
+
+
+# --- Perfil de Memória por Rota (tracemalloc) ---
+
+class OrcamentoMemoriaExcedido(Exception):
+    """O pico de memória alocada em um bloco orcamento_memoria passou do limite."""
+
+
+@contextmanager
+def orcamento_memoria(limite_mb=None):
+    """
+    Mede a memória alocada (tracemalloc) pelo bloco e, com limite_mb, levanta OrcamentoMemoriaExcedido se o
+    pico passar do limite. O dicionário entregue pelo with recebe 'pico_bytes' e 'retido_bytes' na saída:
+
+        with orcamento_memoria(50) as medicao:
+            partes, _mimetype = gerar_conteudo_nfe(empresa, vendas, 'xml')
+            tamanho = sum(len(parte) for parte in partes)
+    """
+    iniciou = not tracemalloc.is_tracing()
+    if iniciou:
+        tracemalloc.start()
+    medicao = {}
+    inicio, _pico = tracemalloc.get_traced_memory()
+    tracemalloc.reset_peak()
+    try:
+        yield medicao
+    finally:
+        atual, pico = tracemalloc.get_traced_memory()
+        if iniciou:
+            tracemalloc.stop()
+        medicao['pico_bytes'] = max(pico - inicio, 0)
+        medicao['retido_bytes'] = atual - inicio
+    if limite_mb is not None and medicao['pico_bytes'] > limite_mb * 2 ** 20:
+        raise OrcamentoMemoriaExcedido(f"pico de {medicao['pico_bytes'] / 2 ** 20:.1f} MiB "
+                                       f"acima do orçamento de {limite_mb} MiB")
+
+
+# Perfis acumulados por endpoint neste processo; as requisições perfiladas são medidas uma de cada vez.
+_perfis_memoria = {}
+_perfil_memoria_lock = threading.Lock()
+_perfis_memoria_dados_lock = threading.Lock()
+# O próprio rastreamento e a importação de módulos não entram nas linhas que mais alocam.
+_FILTROS_PERFIL_MEMORIA = (tracemalloc.Filter(False, tracemalloc.__file__),
+                           tracemalloc.Filter(False, '<frozen importlib._bootstrap*>'))
+
+
+def rota_perfilada():
+    """Indica se a requisição atual deve ser medida pelo perfil de memória."""
+    if not app.config['PERFIL_MEMORIA'] or request.endpoint in (None, 'static', 'perfil_memoria'):
+        return False
+    rotas = app.config['PERFIL_MEMORIA_ROTAS']
+    return not rotas or request.endpoint in rotas
+
+
+@app.before_request
+def iniciar_perfil_memoria():
+    """Com o perfil de memória ativo, marca a memória alocada no início da requisição."""
+    if not rota_perfilada():
+        return
+    # tracemalloc é global ao processo: medir uma requisição por vez evita somar as alocações das outras.
+    _perfil_memoria_lock.acquire()
+    g.perfil_memoria_lock = True
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+    retrato = tracemalloc.take_snapshot() if app.config['PERFIL_MEMORIA_LINHAS'] else None
+    g.perfil_memoria = (tracemalloc.get_traced_memory()[0], retrato)
+    tracemalloc.reset_peak()
+
+
+@app.after_request
+def registrar_perfil_memoria(response):
+    """
+    Registra o pico e a memória retida pela requisição (incluindo o corpo da resposta já montado). Nas respostas
+    enviadas em fluxo (exportação de NF-e, backup), o corpo só é gerado depois desta função: a medição, e a
+    exclusividade do tracemalloc, vão até a resposta ser fechada, ao fim do envio.
+    """
+    if 'perfil_memoria' not in g:
+        return response
+    endpoint, (inicio, retrato_inicio) = request.endpoint, g.pop('perfil_memoria')
+    if response.is_streamed and g.pop('perfil_memoria_lock', False):
+        def registrar_ao_fechar():
+            try:
+                salvar_perfil_memoria(endpoint, inicio, retrato_inicio)
+            finally:
+                _perfil_memoria_lock.release()
+        response.call_on_close(registrar_ao_fechar)
+    else:
+        salvar_perfil_memoria(endpoint, inicio, retrato_inicio)
+    return response
+
+
+def salvar_perfil_memoria(endpoint, inicio, retrato_inicio):
+    """Acumula no perfil do endpoint o pico e a memória retida desde o início da medição."""
+    atual, pico = tracemalloc.get_traced_memory()
+    pico, retido = max(pico - inicio, 0), atual - inicio
+    linhas = []
+    if retrato_inicio is not None:
+        diferencas = tracemalloc.take_snapshot().filter_traces(_FILTROS_PERFIL_MEMORIA).compare_to(
+            retrato_inicio.filter_traces(_FILTROS_PERFIL_MEMORIA), 'lineno')
+        linhas = [{'linha': f"{os.path.basename(d.traceback[0].filename)}:{d.traceback[0].lineno}",
+                   'bytes': d.size_diff, 'blocos': d.count_diff}
+                  for d in diferencas[:app.config['PERFIL_MEMORIA_LINHAS']] if d.size_diff > 0]
+
+    with _perfis_memoria_dados_lock:
+        perfil = _perfis_memoria.setdefault(endpoint, {
+            'requisicoes': 0, 'pico_max_bytes': 0, 'pico_total_bytes': 0,
+            'retido_max_bytes': 0, 'retido_total_bytes': 0, 'linhas_pico_max': []})
+        perfil['requisicoes'] += 1
+        perfil['pico_total_bytes'] += pico
+        perfil['retido_total_bytes'] += retido
+        perfil['retido_max_bytes'] = max(perfil['retido_max_bytes'], retido)
+        perfil['ultimo'] = {'pico_bytes': pico, 'retido_bytes': retido,
+                            'em': datetime.now().isoformat(timespec='seconds')}
+        if pico >= perfil['pico_max_bytes']:
+            # As linhas guardadas são as da requisição com o maior pico da rota.
+            perfil['pico_max_bytes'] = pico
+            perfil['linhas_pico_max'] = linhas
+
+
+@app.teardown_request
+def encerrar_perfil_memoria(exception):
+    """
+    Libera a medição da próxima requisição perfilada, mesmo quando a rota terminou com erro. Nas respostas em
+    fluxo, quem libera é o fechamento da resposta (registrar_perfil_memoria).
+    """
+    if g.pop('perfil_memoria_lock', False):
+        g.pop('perfil_memoria', None)
+        _perfil_memoria_lock.release()
+
+
+def resumo_perfis_memoria():
+    """Perfis por endpoint, do maior para o menor pico, com as médias por requisição."""
+    with _perfis_memoria_dados_lock:
+        perfis = {endpoint: dict(perfil) for endpoint, perfil in _perfis_memoria.items()}
+    for perfil in perfis.values():
+        perfil['pico_medio_bytes'] = perfil.pop('pico_total_bytes') // perfil['requisicoes']
+        perfil['retido_medio_bytes'] = perfil.pop('retido_total_bytes') // perfil['requisicoes']
+    return dict(sorted(perfis.items(), key=lambda item: item[1]['pico_max_bytes'], reverse=True))
+
+
+@app.cli.command('orcamento-memoria')
+@click.option('--vendas', type=int, default=100000, show_default=True, help='Quantidade de vendas simuladas.')
+@click.option('--formato', type=click.Choice(['csv', 'xml', 'zip']), default='xml', show_default=True)
+@click.option('--limite-mb', type=float, default=50, show_default=True, help='Orçamento do pico de memória, em MiB.')
+def orcamento_memoria_command(vendas, formato, limite_mb):
+    """
+    Verifica se a exportação de NF-e de N vendas simuladas cabe no orçamento de memória; termina com código 1
+    quando o pico passa do limite: 'flask orcamento-memoria --vendas 100000 --formato xml --limite-mb 50'.
+    As vendas são geradas uma a uma, como as linhas do cursor na rota, e o arquivo é consumido em blocos,
+    como pela resposta em fluxo.
+    """
+    empresa = {'cnpj': '00000000000191', 'razao_social': 'Loja Exemplo LTDA', 'nome_fantasia': 'Loja Exemplo',
+               'inscricao_estadual': 'ISENTO', 'inscricao_municipal': '', 'regime_tributario': 'Simples Nacional',
+               'cep': '01001000', 'rua': 'Praça da Sé, 1', 'bairro': 'Sé', 'cidade': 'São Paulo', 'estado': 'SP',
+               'pais': 'Brasil'}
+    dados_vendas = ((i, '2026-01-15', f'Cliente {i % 500}', 'ISENTO', '11999990000', f'20260101-{i % 2000:08d}',
+                     'Camiseta Azul P,M,G', '00000000', 'UN', 1 + i % 3, '49.90', f'{49.90 * (1 + i % 3):.2f}')
+                    for i in range(vendas))
+    t0 = time.perf_counter()
+    try:
+        with orcamento_memoria(limite_mb) as medicao:
+            if formato == 'zip':
+                partes = nfe.zip_em_fluxo(nfe.gerar_documentos(empresa, dados_vendas))
+            else:
+                partes, _mimetype = gerar_conteudo_nfe(empresa, dados_vendas, formato)
+            tamanho = sum(len(parte) for parte in partes)
+    except OrcamentoMemoriaExcedido as e:
+        print(f"{vendas} vendas em {formato.upper()}: FALHOU, {e}")
+        sys.exit(1)
+    print(f"{vendas} vendas em {formato.upper()}: pico {medicao['pico_bytes'] / 2 ** 20:.1f} MiB "
+          f"(orçamento {limite_mb} MiB), arquivo {tamanho / 2 ** 20:.1f} MiB, "
+          f"{time.perf_counter() - t0:.2f} s")
+
+
+# --- Cache de Templates (Bytecode e Fragmentos) ---
+
+def escopo_fragmentos(global_):
+    """
+    Parte da chave dos fragmentos {% cache %} que identifica o escopo. Fragmentos globais são iguais para
+    todos; os do usuário levam o id e a versão dos dados dele: o último seq do changelog, que muda a cada
+    escrita registrada pelos gatilhos, e o que muda sem passar pelo changelog, isto é, o horário do último
+    cálculo das notas RFM (manutenção diária) e o estado do arquivo morto (arquivamento e restauração de
+    vendas pausam o changelog). Retorna None (renderiza sem cache) sem usuário logado ou com o cache de
+    fragmentos desativado.
+    """
+    if not app.config['CACHE_FRAGMENTOS'] or not has_request_context():
+        return None
+    if global_:
+        return ('global',)
+    if 'usuario_id' not in session:
+        return None
+    if 'versao_fragmentos' not in g:
+        g.versao_fragmentos = tuple(get_db().execute('''
+                                                     SELECT (SELECT MAX(seq) FROM changelog WHERE usuario_id = ?1),
+                                                            (SELECT calculado_em FROM rfm_limites
+                                                             WHERE usuario_id = ?1),
+                                                            (SELECT COUNT(*) || '/' || MAX(arquivado_em)
+                                                             FROM arquivos_vendas)
+                                                     ''', (session['usuario_id'],)).fetchone())
+    return (session['usuario_id'], *g.versao_fragmentos)
+
+
+configurar_templates(app, app.config['JINJA_BYTECODE_DIR'], bytecode=app.config['JINJA_BYTECODE'],
+                     max_fragmentos=app.config['CACHE_FRAGMENTOS_MAX'], escopo=escopo_fragmentos)
+
+
+@app.cli.command('compilar-templates')
+def compilar_templates_command():
+    """
+    Compila todos os templates e grava o bytecode no cache em disco, para que os workers iniciem sem
+    compilá-los: 'flask compilar-templates' (execute após cada atualização da aplicação).
+    """
+    env = app.jinja_env
+    nomes = env.list_templates(filter_func=lambda nome: nome.endswith('.html'))
+    t0 = time.perf_counter()
+    for nome in nomes:
+        env.compile(env.loader.get_source(env, nome)[0], nome)
+    compilacao = (time.perf_counter() - t0) * 1000
+    for nome in nomes:
+        env.get_template(nome)
+    if env.bytecode_cache is None:
+        print(f"{len(nomes)} templates compilados em {compilacao:.1f} ms (cache de bytecode desativado)")
+        return
+    env.cache.clear()
+    t0 = time.perf_counter()
+    for nome in nomes:
+        env.get_template(nome)
+    carregamento = (time.perf_counter() - t0) * 1000
+    print(f"{len(nomes)} templates: compilação {compilacao:.1f} ms, carregamento do cache de bytecode "
+          f"{carregamento:.1f} ms ({env.bytecode_cache.directory})")
+
+
+# --- Controle de Admissão e Prazo das Consultas ---
+
+CLASSES_PRIORIDADE = ('critica', 'normal', 'baixa', 'exportacao')
+
+# Classe de cada endpoint; os que não estão aqui são 'normal'. O checkout (painel de compras, buscas do
+# autocompletar, carrinho e finalização) nunca é recusado nem tem prazo nas consultas.
+PRIORIDADE_ROTAS = {
+    **dict.fromkeys(('login', 'painel_compras', 'revisar_compra', 'finalizar_compra', 'vender_roupa',
+                     'buscar_clientes', 'buscar_funcionarios', 'buscar_produtos', 'buscar_produto_route',
+                     'buscar_detalhes_produto', 'grade_produto', 'catalogo_produtos', 'changes', 'disponibilidade',
+                     'api_abrir_carrinho', 'api_adicionar_item', 'api_remover_item', 'api_ver_carrinho',
+                     'api_finalizar_carrinho'), 'critica'),
+    **dict.fromkeys(('listar_roupas', 'painel_clientes', 'segmentos_clientes', 'dados_dashboard_metricas',
+                     'dados_metricas_funcionarios', 'dados_metricas_clientes', 'api_metricas_locais',
+                     'api_metricas_vendas', 'previsoes_estoque', 'estoque_em', 'grade_estoque',
+                     'exportar_vendas_nfe'), 'baixa'),
+    **dict.fromkeys(('gerar_arquivo_nfe', 'exportar_backup'), 'exportacao'),
+}
+# Rotas fora do controle de admissão: arquivos estáticos e o fluxo SSE, que tem limites próprios.
+ROTAS_SEM_ADMISSAO = frozenset(('static', 'eventos'))
+# Instruções da máquina virtual do SQLite entre duas verificações do prazo da consulta.
+PRAZO_CONSULTA_PASSOS = 10000
+
+
+class RequisicaoRecusada(Exception):
+    """A requisição não foi admitida; motivo é 'checkout', 'limite_baixa', 'limite_exportacao' ou 'limite_usuario'."""
+
+    def __init__(self, motivo, mensagem):
+        super().__init__(mensagem)
+        self.motivo = motivo
+
+
+class ControleAdmissao:
+    """
+    Contagem das requisições em andamento no processo, por classe de prioridade e por usuário (tenant), com
+    as recusas e as consultas interrompidas pelo prazo. As requisições críticas são sempre admitidas; a
+    quantidade delas em andamento é a fila do checkout, que faz as de prioridade baixa serem recusadas.
+    """
+
+    def __init__(self, max_baixa, max_por_usuario, limite_checkout, max_exportacao=2):
+        self.max_baixa = max_baixa
+        self.max_exportacao = max_exportacao
+        self.max_por_usuario = max_por_usuario
+        self.limite_checkout = limite_checkout
+        self._em_andamento = dict.fromkeys(CLASSES_PRIORIDADE, 0)
+        self._por_usuario = {}
+        self._lock = threading.Lock()
+        self._zerar_contadores()
+
+    def _zerar_contadores(self):
+        self._contadores = {classe: {'admitidas': 0, 'recusadas': 0, 'consultas_interrompidas': 0}
+                            for classe in CLASSES_PRIORIDADE}
+        self._motivos = {'checkout': 0, 'limite_baixa': 0, 'limite_exportacao': 0, 'limite_usuario': 0}
+
+    def _verificar(self, classe, usuario_id):
+        """Levanta RequisicaoRecusada se a requisição passar de algum limite. Chamada com o lock."""
+        if classe == 'critica':
+            return
+        if classe in ('baixa', 'exportacao'):
+            if self._em_andamento['critica'] >= self.limite_checkout:
+                raise RequisicaoRecusada('checkout', 'O sistema está priorizando as vendas em andamento. '
+                                                     'Tente novamente em instantes.')
+            if classe == 'baixa' and self._em_andamento['baixa'] >= self.max_baixa:
+                raise RequisicaoRecusada('limite_baixa', 'Muitos relatórios sendo gerados ao mesmo tempo. '
+                                                         'Tente novamente em instantes.')
+            if classe == 'exportacao' and self._em_andamento['exportacao'] >= self.max_exportacao:
+                raise RequisicaoRecusada('limite_exportacao', 'Muitas exportações sendo geradas ao mesmo tempo. '
+                                                              'Tente novamente em instantes.')
+        if usuario_id is not None and self._por_usuario.get(usuario_id, 0) >= self.max_por_usuario:
+            raise RequisicaoRecusada('limite_usuario', 'Muitas requisições simultâneas para esta conta. '
+                                                       'Tente novamente em instantes.')
+
+    def admitir(self, classe, usuario_id=None):
+        """Admite a requisição (que deve ser liberada com liberar) ou levanta RequisicaoRecusada."""
+        with self._lock:
+            try:
+                self._verificar(classe, usuario_id)
+            except RequisicaoRecusada as e:
+                self._contadores[classe]['recusadas'] += 1
+                self._motivos[e.motivo] += 1
+                raise
+            self._contadores[classe]['admitidas'] += 1
+            self._em_andamento[classe] += 1
+            if classe != 'critica' and usuario_id is not None:
+                self._por_usuario[usuario_id] = self._por_usuario.get(usuario_id, 0) + 1
+
+    def liberar(self, classe, usuario_id=None):
+        with self._lock:
+            self._em_andamento[classe] -= 1
+            if classe != 'critica' and usuario_id is not None:
+                restantes = self._por_usuario.pop(usuario_id, 1) - 1
+                if restantes:
+                    self._por_usuario[usuario_id] = restantes
+
+    def registrar_interrupcao(self, classe):
+        with self._lock:
+            self._contadores[classe]['consultas_interrompidas'] += 1
+
+    def zerar(self):
+        with self._lock:
+            self._zerar_contadores()
+
+    def estatisticas(self):
+        with self._lock:
+            return {
+                'limites': {'max_baixa': self.max_baixa, 'max_exportacao': self.max_exportacao,
+                            'max_por_usuario': self.max_por_usuario, 'limite_checkout': self.limite_checkout},
+                'em_andamento': dict(self._em_andamento),
+                'usuarios_em_andamento': len(self._por_usuario),
+                'classes': {classe: dict(contadores) for classe, contadores in self._contadores.items()},
+                'recusas_por_motivo': dict(self._motivos),
+            }
+
+
+_admissao = ControleAdmissao(app.config['ADMISSAO_MAX_BAIXA'], app.config['ADMISSAO_MAX_POR_USUARIO'],
+                             app.config['ADMISSAO_LIMITE_CHECKOUT'], app.config['ADMISSAO_MAX_EXPORTACAO'])
+
+
+def classe_prioridade(endpoint):
+    """Classe de prioridade do endpoint (a configurada em ADMISSAO_ROTAS ou a de PRIORIDADE_ROTAS)."""
+    classe = app.config['ADMISSAO_ROTAS'].get(endpoint) or PRIORIDADE_ROTAS.get(endpoint, 'normal')
+    return classe if classe in CLASSES_PRIORIDADE else 'normal'
+
+
+@app.before_request
+def admitir_requisicao():
+    """
+    Com o controle de admissão ativo, admite a requisição pela classe da rota ou responde 503 com Retry-After,
+    e define o prazo das consultas da requisição (aplicado às conexões abertas por ela).
+    """
+    if not app.config['ADMISSAO_ATIVA'] or request.endpoint in ROTAS_SEM_ADMISSAO or request.endpoint is None:
+        return None
+    classe = classe_prioridade(request.endpoint)
+    usuario_id = session.get('usuario_id')
+    try:
+        _admissao.admitir(classe, usuario_id)
+    except RequisicaoRecusada as e:
+        return jsonify({'erro': str(e), 'motivo': e.motivo}), 503, \
+            {'Retry-After': str(app.config['ADMISSAO_RETRY_AFTER'])}
+    g.admissao = (classe, usuario_id)
+    prazo_ms = app.config['ADMISSAO_PRAZO_MS'].get(classe, 0)
+    if prazo_ms:
+        g.prazo_consulta = time.monotonic() + prazo_ms / 1000
+    return None
+
+
+@app.after_request
+def manter_admissao_no_fluxo(response):
+    """
+    Respostas enviadas em fluxo (backup NDJSON, ZIP de NF-e, feed de alterações) continuam ocupando a vaga
+    enquanto o corpo é gerado: ela só é liberada quando a resposta é fechada, ao fim do envio ou quando o
+    cliente desconecta.
+    """
+    if response.is_streamed and 'admissao' in g:
+        admissao = g.pop('admissao')
+        response.call_on_close(lambda: _admissao.liberar(*admissao))
+    return response
+
+
+@app.teardown_request
+def liberar_admissao(exception):
+    """Libera a vaga da requisição admitida, mesmo quando a rota terminou com erro."""
+    admissao = g.pop('admissao', None)
+    if admissao is not None:
+        _admissao.liberar(*admissao)
+
+
+def aplicar_prazo_consulta(db):
+    """
+    Com prazo definido para a requisição, instala na conexão um progress handler do SQLite que interrompe a
+    consulta em andamento quando o prazo passa (sqlite3.OperationalError 'interrupted').
+    """
+    if 'prazo_consulta' not in g:
+        return db
+    prazo, classe = g.prazo_consulta, g.admissao[0]
+    interrompida = []
+
+    def verificar_prazo():
+        if time.monotonic() < prazo:
+            return 0
+        if not interrompida:
+            interrompida.append(True)
+            _admissao.registrar_interrupcao(classe)
+        return 1
+
+    db.set_progress_handler(verificar_prazo, PRAZO_CONSULTA_PASSOS)
+    return db
+
+
+@app.errorhandler(sqlite3.OperationalError)
+def consulta_interrompida(e):
+    """Consulta interrompida pelo prazo da requisição: 503 com Retry-After. Os demais erros seguem como 500."""
+    if str(e) != 'interrupted' or 'prazo_consulta' not in g:
+        raise e
+    return jsonify({'erro': 'A consulta excedeu o tempo máximo permitido. Tente um período menor ou tente '
+                            'novamente em instantes.', 'motivo': 'prazo_consulta'}), 503, \
+        {'Retry-After': str(app.config['ADMISSAO_RETRY_AFTER'])}
+
+
 # --- Decorador de Autenticação ---
 
 def login_required(f):
@@ -125,6 +2952,19 @@ def login_required(f):
 
     return decorated_function
 
+
+def admin_required_api(f):
+    """Restringe uma rota JSON ao administrador (usuário de id 1): 401 sem login e 403 para os demais usuários."""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if 'usuario_id' not in session:
+            return jsonify({'erro': 'Não autenticado.'}), 401
+        if session['usuario_id'] != 1:
+            return jsonify({'erro': 'Acesso restrito ao administrador.'}), 403
+        return f(*args, **kwargs)
+
+    return decorated_function
+
 # --- Rotas de Autenticação e Usuário ---
 @app.route('/', methods=['GET', 'POST'])
 def login():
@@ -133,7 +2973,7 @@ def login():
         print('Tentando fazer login...')
         email = request.form['email']
         senha = request.form['senha']
-        usuario = query_db('SELECT * FROM usuarios WHERE email = ?', [email], one=True)
+        usuario = query_db('SELECT * FROM usuarios WHERE email = ?', [email], one=True, diretorio=True)
 
         if usuario and check_password_hash(usuario['senha_hash'], senha):
             session['usuario_id'] = usuario['id']
@@ -141,7 +2981,7 @@ def login():
         else:
             print('E-mail ou senha inválidos.', 'danger')
     # Verifica se o usuário com ID 1 (administrador) já existe.
-    admin_existe = query_db('SELECT id FROM usuarios WHERE id = ?', [1], one=True)
+    admin_existe = query_db('SELECT id FROM usuarios WHERE id = ?', [1], one=True, diretorio=True)
 
     # Passa a variável 'admin_existe' para o template.
     # A função bool() converterá o resultado (que pode ser uma linha ou None) para True ou False.
@@ -153,7 +2993,6 @@ def registrar():
     if request.method == 'POST':
         nome = request.form['nome']
         sobrenome = request.form['sobrenome']
-        data_nascimento = request.form['data_nascimento']
         email = request.form['email']
         senha = request.form['senha']
         confirmar_senha = request.form['confirmar_senha']
@@ -161,12 +3000,21 @@ def registrar():
         if senha != confirmar_senha:
             print('As senhas não coincidem.', 'danger')
             return render_template('registrar.html')
+        try:
+            data_nascimento = data_iso(request.form['data_nascimento'])
+        except ValueError:
+            print('Data de nascimento inválida.', 'danger')
+            return render_template('registrar.html')
 
         senha_hash = generate_password_hash(senha)
         try:
             execute_db(
                 'INSERT INTO usuarios (nome, sobrenome, data_nascimento, email, senha_hash) VALUES (?, ?, ?, ?, ?)',
-                (nome, sobrenome, data_nascimento, email, senha_hash))
+                (nome, sobrenome, data_nascimento, email, senha_hash), diretorio=True)
+            if app.config['SHARDING_ATIVO']:
+                novo_usuario = query_db('SELECT id FROM usuarios WHERE email = ?', [email], one=True, diretorio=True)
+                if novo_usuario:
+                    criar_shard(caminho_shard(novo_usuario['id']))
             print('Registro bem-sucedido! Faça o login.', 'success')
             return redirect(url_for('login'))
         except sqlite3.IntegrityError:
@@ -178,9 +3026,12 @@ def registrar():
 def recuperar_senha():
     if request.method == 'POST':
         email = request.form['email']
-        data_nascimento = request.form['data_nascimento']
+        try:
+            data_nascimento = data_iso(request.form['data_nascimento'])
+        except ValueError:
+            data_nascimento = request.form['data_nascimento']
         usuario = query_db("SELECT * FROM usuarios WHERE email = ? AND data_nascimento = ?", (email, data_nascimento),
-                           one=True)
+                           one=True, diretorio=True)
         if usuario:
             session['email_recuperacao'] = email
             return render_template('recuperar_senha.html', mostrar_novo_formulario=True, email=email)
@@ -203,7 +3054,7 @@ def atualizar_senha():
         return render_template('recuperar_senha.html', mostrar_novo_formulario=True, email=email)
 
     senha_hash = generate_password_hash(nova_senha)
-    execute_db("UPDATE usuarios SET senha_hash = ? WHERE email = ?", (senha_hash, email))
+    execute_db("UPDATE usuarios SET senha_hash = ? WHERE email = ?", (senha_hash, email), diretorio=True)
     session.pop('email_recuperacao', None)
     print('Senha atualizada com sucesso!', 'success')
     return redirect(url_for('login'))
@@ -212,7 +3063,7 @@ def atualizar_senha():
 @app.route('/dashboard')
 @login_required
 def dashboard():
-    usuario = query_db('SELECT nome FROM usuarios WHERE id = ?', [session['usuario_id']], one=True)
+    usuario = usuario_cadastro(session['usuario_id'])
     return render_template('dashboard.html', usuario=usuario)
 
 
@@ -229,123 +3080,879 @@ def logout():
 def adicionar_roupa():
     if request.method == 'POST':
         try:
-            execute_db('''
+            usuario_id = session['usuario_id']
+            # Com grade (tamanho x cor), a quantidade do produto é a soma das variantes.
+            grade = ler_grade_formulario(request.form)
+            quantidade = sum(q for _tamanho, _cor, q in grade) if grade else int(request.form['quantidade'])
+            dados = (usuario_id, request.form['codigo_produto'], data_hora_iso(request.form['data_entrada']),
+                     request.form['tipo_roupa'],
+                     request.form['tecido'], quantidade, request.form['cor'],
+                     request.form['tamanhos'],
+                     request.form['detalhes'], para_centavos(request.form['preco_unitario']), 0)
+            # A unidade pode rodar na thread da escrita agrupada, fora do contexto da requisição.
+            local_id = request.form.get('local_id')
+
+            def inserir_roupa(db):
+                local = resolver_local(db, usuario_id, local_id)
+                cur = db.execute('''
                        INSERT INTO roupas (usuario_id, codigo_produto, data_entrada, tipo_roupa, tecido, quantidade,
-                                           cor, tamanhos, detalhes, preco_unitario, quantida_vendas)
+                                           cor, tamanhos, detalhes, preco_centavos, quantida_vendas)
                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                       ''', (session['usuario_id'], request.form['codigo_produto'], request.form['data_entrada'],
-                             request.form['tipo_roupa'],
-                             request.form['tecido'], request.form['quantidade'], request.form['cor'],
-                             request.form['tamanhos'],
-                             request.form['detalhes'], request.form['preco_unitario'], 0))
+                       ''', dados)
+                if grade:
+                    salvar_grade(db, usuario_id, cur.lastrowid, grade)
+                if quantidade:
+                    registrar_movimento(db, usuario_id, cur.lastrowid, 'entrada', quantidade)
+                # O estoque inicial entra no local escolhido no formulário.
+                sincronizar_estoque_local(db, usuario_id, cur.lastrowid, local['id'])
+                return cur.lastrowid
+
+            roupa_id = executar_escrita(inserir_roupa)
+            publicar_estoque(usuario_id, [roupa_id])
             print('Roupa adicionada com sucesso!', 'success')
             return redirect(url_for('listar_roupas'))
         except Exception as e:
             print(f"Ocorreu um erro ao adicionar a roupa: {e}", "danger")
-    return render_template('adicionar_roupa.html')
+    return render_template('adicionar_roupa.html', locais=listar_locais(get_db(), session['usuario_id']))
 
 
 @app.route('/listar_roupas')
 @login_required
 def listar_roupas():
-    ordenar_por = request.args.get('ordenar_por', 'id')
-    ordem = request.args.get('ordem', 'asc')
-    campos_validos = ['id', 'codigo_produto', 'tipo_roupa', 'tecido', 'quantidade', 'cor', 'tamanhos', 'detalhes',
-                      'preco_unitario', 'quantida_vendas']
-    if ordenar_por not in campos_validos:
-        ordenar_por = 'id'
-    if ordem.upper() not in ['ASC', 'DESC']:
-        ordem = 'ASC'
-
-    query = f"SELECT * FROM roupas WHERE usuario_id = ? ORDER BY {ordenar_por} {ordem}"
-    roupas = query_db(query, [session['usuario_id']])
+    # Com ?estoque_baixo=1, lista apenas os produtos que atingiram o ponto de reposição da última previsão.
+    estoque_baixo = request.args.get('estoque_baixo') == '1'
+    # Coluna e direção inválidas voltam para o padrão; cada ordenação permitida é uma instrução registrada.
+    instrucao, ordenar_por, ordem = repositorio.ordenacao(
+        'roupas.listar_estoque_baixo' if estoque_baixo else 'roupas.listar',
+        request.args.get('ordenar_por'), request.args.get('ordem'))
+    ordem = ordem.lower()
+    # A tabela é um fragmento em cache: a consulta só é executada quando o fragmento precisa ser renderizado.
+    roupas = ResultadoAdiado(lambda: consultar(instrucao, [session['usuario_id']]))
+    # Toda previsão é recalculada de uma vez, então qualquer linha do usuário traz o horário do último cálculo.
+    previsao = consultar('previsoes.calculado_em', [session['usuario_id']], one=True)
 
     def url_for_listar_roupas(campo_ordenacao, ordem_padrao, campo_atual, ordem_atual):
         nova_ordem = 'desc' if campo_ordenacao == campo_atual and ordem_atual == 'asc' else 'asc'
-        return url_for('listar_roupas', ordenar_por=campo_ordenacao, ordem=nova_ordem)
+        return url_for('listar_roupas', ordenar_por=campo_ordenacao, ordem=nova_ordem,
+                       **({'estoque_baixo': 1} if estoque_baixo else {}))
 
     return render_template('listar_roupas.html', roupas=roupas, ordenar_por=ordenar_por, ordem=ordem,
-                           url_for_listar_roupas=url_for_listar_roupas)
+                           url_for_listar_roupas=url_for_listar_roupas, estoque_baixo=estoque_baixo,
+                           previsao_em=previsao['calculado_em'] if previsao else None)
+
+
+@app.route('/previsoes_estoque')
+@login_required
+def previsoes_estoque():
+    """
+    API: Retorna a última previsão de demanda de cada produto (médias móveis, demanda diária, dias de
+    cobertura e ponto de reposição). Com ?estoque_baixo=1, retorna apenas os alertas de reposição.
+    Com ?formato=colunas, 'produtos' vem no formato colunar ({coluna: [valores]}), montado direto das
+    tuplas do cursor, o que reduz bastante a resposta de catálogos grandes.
+    """
+    filtro = 'AND p.estoque_baixo = 1' if request.args.get('estoque_baixo') == '1' else ''
+    colunas, linhas = query_tuplas(f"""
+        SELECT r.codigo_produto, r.tipo_roupa, r.cor, r.quantidade, p.media_7d, p.media_28d, p.demanda_diaria,
+               p.desvio, p.dias_cobertura, p.ponto_reposicao, p.estoque_baixo, p.calculado_em
+        FROM previsoes_estoque p
+        JOIN roupas r ON r.id = p.roupa_id
+        WHERE p.usuario_id = ? {filtro}
+        ORDER BY p.estoque_baixo DESC, p.dias_cobertura
+    """, [session['usuario_id']])
+    calculado_em = linhas[0][-1] if linhas else None
+    if request.args.get('formato') == 'colunas':
+        # Todas as linhas têm o mesmo calculado_em, enviado uma única vez.
+        produtos = colunas_para_arrays(colunas[:-1], [linha[:-1] for linha in linhas])
+        produtos['estoque_baixo'] = [bool(valor) for valor in produtos['estoque_baixo']]
+    else:
+        produtos = [dict(zip(colunas, linha), estoque_baixo=bool(linha[-2])) for linha in linhas]
+    return jsonify({'calculado_em': calculado_em, 'produtos': produtos})
 
 
 @app.route('/editar_roupa/<int:roupa_id>', methods=['GET', 'POST'])
 @login_required
 def editar_roupa(roupa_id):
     db = get_db()
-    roupa = db.execute('SELECT * FROM roupas WHERE id = ? AND usuario_id = ?',
-                       (roupa_id, session['usuario_id'])).fetchone()
+    roupa = repositorio.linha(db, 'roupas.por_id', (roupa_id, session['usuario_id']))
     if roupa is None:
         print('Roupa não encontrada.', 'warning')
         return redirect(url_for('listar_roupas'))
 
     if request.method == 'POST':
         try:
-            quantidade_nova = int(request.form['quantidade'])
-            vendas_novas = roupa['quantida_vendas'] if roupa['quantida_vendas'] is not None else 0
-            if quantidade_nova < roupa['quantidade']:
-                vendas_novas += roupa['quantidade'] - quantidade_nova
+            usuario_id = session['usuario_id']
+            # O formulário sempre envia a grade (vazia para produtos sem grade); com grade, a quantidade é a soma.
+            grade = ler_grade_formulario(request.form) if 'grade_enviada' in request.form else None
+            quantidade_nova = sum(q for _tamanho, _cor, q in grade) if grade else int(request.form['quantidade'])
+            # O tipo do movimento é informado pelo usuário; apenas 'venda' conta como venda do produto.
+            tipo_movimento = request.form.get('tipo_movimento', 'ajuste')
+
+            if quantidade_nova < 0:
+                print('A quantidade em estoque não pode ser negativa.', 'danger')
+                return render_template('editar_roupa.html', roupa=roupa, tipos_movimento=TIPOS_MOVIMENTO,
+                                       variantes=variantes_produto(db, roupa_id), locais=listar_locais(db, usuario_id))
+            if tipo_movimento not in TIPOS_MOVIMENTO:
+                print('Tipo de movimento de estoque inválido.', 'danger')
+                return render_template('editar_roupa.html', roupa=roupa, tipos_movimento=TIPOS_MOVIMENTO,
+                                       variantes=variantes_produto(db, roupa_id), locais=listar_locais(db, usuario_id))
+
+            dados = (request.form['codigo_produto'], request.form['tipo_roupa'], request.form['tecido'],
+                     quantidade_nova, request.form['cor'], request.form['tamanhos'],
+                     request.form['detalhes'], para_centavos(request.form['preco_unitario']), roupa_id)
+            # A unidade pode rodar na thread da escrita agrupada, fora do contexto da requisição.
+            local_id = request.form.get('local_id')
+
+            def atualizar_roupa(db):
+                local = resolver_local(db, usuario_id, local_id)
+                # A diferença é calculada dentro da escrita, sobre o estoque atual, e não sobre o lido no formulário.
+                atual = db.execute('SELECT quantidade FROM roupas WHERE id = ?', (roupa_id,)).fetchone()['quantidade']
+                diferenca = quantidade_nova - atual
+                if diferenca and tipo_movimento in ('entrada', 'devolucao') and diferenca < 0:
+                    raise ValueError(f"Um movimento de {TIPOS_MOVIMENTO[tipo_movimento].lower()} deve aumentar o estoque.")
+                if diferenca and tipo_movimento == 'venda' and diferenca > 0:
+                    raise ValueError('Um movimento de venda deve diminuir o estoque.')
+                db.execute('''
+                       UPDATE roupas
+                       SET codigo_produto  = ?,
+                           tipo_roupa      = ?,
+                           tecido          = ?,
+                           quantidade      = ?,
+                           cor             = ?,
+                           tamanhos        = ?,
+                           detalhes        = ?,
+                           preco_centavos  = ?
+                       WHERE id = ?
+                       ''', dados)
+                if grade is not None:
+                    salvar_grade(db, usuario_id, roupa_id, grade)
+                if diferenca:
+                    registrar_movimento(db, usuario_id, roupa_id, tipo_movimento, diferenca)
+                    if tipo_movimento == 'venda':
+                        db.execute('UPDATE roupas SET quantida_vendas = COALESCE(quantida_vendas, 0) + ? WHERE id = ?',
+                                   (-diferenca, roupa_id))
+                # A diferença de cada variante (ou do produto sem grade) entra ou sai do local escolhido.
+                sincronizar_estoque_local(db, usuario_id, roupa_id, local['id'])
+
+            executar_escrita(atualizar_roupa)
+            publicar_estoque(usuario_id, [roupa_id])
+            print('Roupa atualizada com sucesso!', 'success')
+            return redirect(url_for('listar_roupas'))
+        except Exception as e:
+            print(f'Ocorreu um erro ao editar a roupa: {e}', 'danger')
+            return redirect(url_for('listar_roupas'))
+
+    return render_template('editar_roupa.html', roupa=roupa, tipos_movimento=TIPOS_MOVIMENTO,
+                           variantes=variantes_produto(db, roupa_id), locais=listar_locais(db, session['usuario_id']))
+
+
+# --- Livro de Movimentos de Estoque ---
+
+# Tipos de movimento de estoque e seus rótulos.
+TIPOS_MOVIMENTO = {'ajuste': 'Ajuste', 'entrada': 'Entrada', 'venda': 'Venda', 'devolucao': 'Devolução'}
+
+# Data usada como "sem limite" nas consultas de saldo.
+_FIM_DOS_TEMPOS = '9999-12-31 23:59:59'
+
+
+def ultimo_snapshot(db, roupa_id, ate=_FIM_DOS_TEMPOS):
+    """Retorna (movimento_id, saldo, criado_em) do último instantâneo de saldo do produto até a data, ou zeros."""
+    snapshot = db.execute('''
+                          SELECT movimento_id, saldo, criado_em FROM snapshots_estoque
+                          WHERE roupa_id = ? AND criado_em <= ?
+                          ORDER BY criado_em DESC, movimento_id DESC LIMIT 1
+                          ''', (roupa_id, ate)).fetchone()
+    return tuple(snapshot) if snapshot else (0, 0, '')
+
+
+def saldo_estoque(db, roupa_id, ate=None):
+    """
+    Retorna o saldo do produto segundo o livro de movimentos, no momento 'ate' (data ISO) ou atual.
+    Parte do último instantâneo anterior à data e soma apenas os movimentos seguintes, que são no
+    máximo ESTOQUE_SNAPSHOT_INTERVALO, sem repetir todo o histórico.
+    """
+    ate = ate or _FIM_DOS_TEMPOS
+    movimento_id, saldo, desde = ultimo_snapshot(db, roupa_id, ate)
+    soma = db.execute('''
+                      SELECT COALESCE(SUM(quantidade), 0) FROM movimentos_estoque
+                      WHERE roupa_id = ? AND criado_em >= ? AND criado_em <= ? AND id > ?
+                      ''', (roupa_id, desde, ate, movimento_id)).fetchone()[0]
+    return saldo + soma
+
+
+def gravar_snapshot(db, usuario_id, roupa_id):
+    """Grava o saldo atual do produto como instantâneo do seu último movimento."""
+    ultimo = db.execute('''
+                        SELECT id, criado_em FROM movimentos_estoque WHERE roupa_id = ?
+                        ORDER BY criado_em DESC, id DESC LIMIT 1
+                        ''', (roupa_id,)).fetchone()
+    if ultimo is None:
+        return False
+    db.execute('''
+               INSERT OR IGNORE INTO snapshots_estoque (usuario_id, roupa_id, movimento_id, saldo, criado_em)
+               VALUES (?, ?, ?, ?, ?)
+               ''', (usuario_id, roupa_id, ultimo['id'], saldo_estoque(db, roupa_id), ultimo['criado_em']))
+    return True
+
+
+def registrar_movimento(db, usuario_id, roupa_id, tipo, quantidade, venda_id=None, observacao=None):
+    """
+    Acrescenta um movimento ao livro de estoque (quantidade positiva para entradas, negativa para saídas).
+    Deve ser chamada dentro da mesma unidade de escrita que altera roupas.quantidade. A cada
+    ESTOQUE_SNAPSHOT_INTERVALO movimentos do produto, grava um instantâneo do saldo.
+    """
+    cur = db.execute('''
+                     INSERT INTO movimentos_estoque (usuario_id, roupa_id, tipo, quantidade, venda_id, observacao)
+                     VALUES (?, ?, ?, ?, ?, ?)
+                     ''', (usuario_id, roupa_id, tipo, quantidade, venda_id, observacao))
+    movimento_id, _saldo, desde = ultimo_snapshot(db, roupa_id)
+    pendentes = db.execute('''
+                           SELECT COUNT(*) FROM movimentos_estoque
+                           WHERE roupa_id = ? AND criado_em >= ? AND id > ?
+                           ''', (roupa_id, desde, movimento_id)).fetchone()[0]
+    if pendentes >= app.config['ESTOQUE_SNAPSHOT_INTERVALO']:
+        gravar_snapshot(db, usuario_id, roupa_id)
+    return cur.lastrowid
+
+
+def verificar_estoque(db, usuario_id=None):
+    """
+    Compara roupas.quantidade com o saldo do livro de movimentos de cada produto.
+    Retorna a lista de divergências como tuplas (roupa, saldo do livro).
+    """
+    filtro, args = ('WHERE usuario_id = ?', (usuario_id,)) if usuario_id is not None else ('', ())
+    divergencias = []
+    for roupa in db.execute(f"SELECT id, usuario_id, codigo_produto, quantidade FROM roupas {filtro} ORDER BY id",
+                            args).fetchall():
+        saldo = saldo_estoque(db, roupa['id'])
+        if saldo != roupa['quantidade']:
+            divergencias.append((roupa, saldo))
+    return divergencias
+
+
+@app.route('/estoque_em')
+@login_required
+def estoque_em():
+    """
+    API: Retorna o estoque de cada produto em uma data (?data=AAAA-MM-DD ou DD/MM/AAAA, com hora opcional),
+    calculado pelo livro de movimentos. Aceita ?codigo= para consultar um único produto.
+    """
+    try:
+        ate = data_hora_iso(request.args['data']) if 'data' in request.args else None
+    except ValueError as e:
+        return jsonify({'erro': str(e)}), 400
+    if ate and len(request.args['data'].strip()) == 10:
+        # Sem hora, considera o estoque ao final do dia.
+        ate = ate[:10] + ' 23:59:59'
+
+    db = get_db()
+    filtro, args = 'usuario_id = ?', [session['usuario_id']]
+    if request.args.get('codigo'):
+        filtro += ' AND codigo_produto = ?'
+        args.append(request.args['codigo'])
+    roupas = db.execute(f"SELECT id, codigo_produto, tipo_roupa, cor FROM roupas WHERE {filtro} ORDER BY codigo_produto",
+                        args).fetchall()
+    return jsonify({
+        'data': ate or datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'produtos': [{'codigo_produto': roupa['codigo_produto'], 'tipo_roupa': roupa['tipo_roupa'],
+                      'cor': roupa['cor'], 'quantidade': saldo_estoque(db, roupa['id'], ate)}
+                     for roupa in roupas],
+    })
+
+
+@app.cli.command('snapshot-estoque')
+def snapshot_estoque_command():
+    """Grava o saldo dos produtos com movimentos desde o último instantâneo (uso diário): 'flask snapshot-estoque'."""
+    for caminho in bancos_com_vendas():
+        preparar_banco(caminho)
+        db = conectar(caminho)
+        try:
+            gravados = 0
+            for roupa in db.execute('SELECT id, usuario_id FROM roupas ORDER BY id').fetchall():
+                movimento_id, _saldo, desde = ultimo_snapshot(db, roupa['id'])
+                if db.execute('SELECT 1 FROM movimentos_estoque WHERE roupa_id = ? AND criado_em >= ? AND id > ? LIMIT 1',
+                              (roupa['id'], desde, movimento_id)).fetchone():
+                    gravados += gravar_snapshot(db, roupa['usuario_id'], roupa['id'])
+            db.commit()
+        finally:
+            db.close()
+        print(f"{os.path.basename(caminho)}: {gravados} instantâneo(s) gravado(s)")
+
+
+@app.cli.command('verificar-estoque')
+@click.option('--corrigir', is_flag=True, help='Registra movimentos de ajuste para alinhar o livro ao estoque atual.')
+def verificar_estoque_command(corrigir):
+    """
+    Concilia o livro de movimentos com roupas.quantidade: 'flask verificar-estoque [--corrigir]'.
+    Também confere se o estoque dos produtos com grade é a soma das variantes e se o estoque de cada produto é
+    a soma dos locais (apenas relatado, sem correção).
+    """
+    total = na_grade = nos_locais = 0
+    for caminho in bancos_com_vendas():
+        preparar_banco(caminho)
+        db = conectar(caminho)
+        try:
+            for roupa in divergencias_grade(db):
+                na_grade += 1
+                print(f"{os.path.basename(caminho)}: produto {roupa['codigo_produto']} (id {roupa['id']}) "
+                      f"tem {roupa['quantidade']} em estoque e {roupa['soma_grade']} na grade")
+            for roupa in divergencias_locais(db):
+                nos_locais += 1
+                variante = f" (variante {roupa['variante_id']})" if roupa['variante_id'] else ''
+                print(f"{os.path.basename(caminho)}: produto {roupa['codigo_produto']}{variante} "
+                      f"tem {roupa['quantidade']} em estoque e {roupa['soma_locais']} somando os locais")
+            for roupa, saldo in verificar_estoque(db):
+                total += 1
+                print(f"{os.path.basename(caminho)}: produto {roupa['codigo_produto']} (id {roupa['id']}) "
+                      f"tem {roupa['quantidade']} em estoque e {saldo} no livro")
+                if corrigir:
+                    registrar_movimento(db, roupa['usuario_id'], roupa['id'], 'ajuste',
+                                        roupa['quantidade'] - saldo, observacao='Conciliação')
+            db.commit()
+        finally:
+            db.close()
+    if total == 0:
+        print('Livro de estoque consistente.')
+    else:
+        print(f"{total} divergência(s) encontrada(s)" + (' e corrigida(s).' if corrigir else '.'))
+    if na_grade:
+        print(f"{na_grade} produto(s) com a grade divergente do estoque; ajuste a grade em 'Editar Roupa'.")
+    if nos_locais:
+        print(f"{nos_locais} produto(s)/variante(s) com o estoque por local divergente do total; "
+              f"salve o produto em 'Editar Roupa' para lançar a diferença em um local.")
+
+
+# --- Grade de Variantes (Tamanho x Cor) ---
+
+# Ordem de exibição dos tamanhos em letra; os tamanhos numéricos vêm depois, em ordem crescente.
+ORDEM_TAMANHOS = ('PP', 'P', 'M', 'G', 'GG', 'XG', 'XGG')
+
+
+def chave_tamanho(tamanho):
+    """Chave de ordenação dos tamanhos: letras na ordem de ORDEM_TAMANHOS, depois números, depois o restante."""
+    if tamanho in ORDEM_TAMANHOS:
+        return 0, ORDEM_TAMANHOS.index(tamanho), ''
+    if tamanho.isdigit():
+        return 1, int(tamanho), ''
+    return 2, 0, tamanho
+
+
+def variantes_produto(db, roupa_id):
+    """Retorna as variantes do produto ordenadas por cor e tamanho."""
+    variantes = repositorio.linhas(db, 'variantes.do_produto', (roupa_id,))
+    return sorted(variantes, key=lambda v: (v['cor'].lower(), chave_tamanho(v['tamanho'])))
+
+
+def ler_grade_formulario(form):
+    """
+    Lê a grade enviada pelos formulários de roupa (listas grade_tamanho, grade_cor e grade_quantidade).
+    Retorna uma lista de (tamanho, cor, quantidade); linhas sem tamanho e sem cor são ignoradas.
+    """
+    grade = []
+    vistas = set()
+    for tamanho, cor, quantidade in zip(form.getlist('grade_tamanho'), form.getlist('grade_cor'),
+                                        form.getlist('grade_quantidade')):
+        tamanho, cor = tamanho.strip().upper(), cor.strip()
+        if not tamanho and not cor:
+            continue
+        if not tamanho or not cor:
+            raise ValueError('Cada linha da grade precisa de tamanho e cor.')
+        quantidade = int(quantidade or 0)
+        if quantidade < 0:
+            raise ValueError('A quantidade de uma variante não pode ser negativa.')
+        if (tamanho, cor.lower()) in vistas:
+            raise ValueError(f"A variante {tamanho} / {cor} aparece mais de uma vez na grade.")
+        vistas.add((tamanho, cor.lower()))
+        grade.append((tamanho, cor, quantidade))
+    return grade
+
+
+def salvar_grade(db, usuario_id, roupa_id, grade):
+    """
+    Substitui a grade do produto pela informada e atualiza a descrição de tamanhos e cores em 'roupas'.
+    Variantes retiradas da grade que já foram vendidas ficam com estoque zero, para preservar o histórico.
+    Deve ser chamada dentro da unidade de escrita que grava roupas.quantidade (a soma da grade).
+    """
+    for tamanho, cor, quantidade in grade:
+        db.execute('''
+                   INSERT INTO variantes (usuario_id, roupa_id, tamanho, cor, quantidade) VALUES (?, ?, ?, ?, ?)
+                   ON CONFLICT (roupa_id, tamanho, cor) DO UPDATE SET quantidade = excluded.quantidade
+                   WHERE quantidade <> excluded.quantidade
+                   ''', (usuario_id, roupa_id, tamanho, cor, quantidade))
+    mantidas = {(tamanho, cor) for tamanho, cor, _quantidade in grade}
+    for variante in db.execute('SELECT id, tamanho, cor FROM variantes WHERE roupa_id = ?', (roupa_id,)).fetchall():
+        if (variante['tamanho'], variante['cor']) in mantidas:
+            continue
+        if db.execute('SELECT 1 FROM vendas WHERE variante_id = ? LIMIT 1', (variante['id'],)).fetchone():
+            db.execute('UPDATE variantes SET quantidade = 0 WHERE id = ? AND quantidade <> 0', (variante['id'],))
+        else:
+            db.execute('DELETE FROM variantes WHERE id = ?', (variante['id'],))
+    if grade:
+        tamanhos = sorted({tamanho for tamanho, _cor, _quantidade in grade}, key=chave_tamanho)
+        cores = list(dict.fromkeys(cor for _tamanho, cor, _quantidade in grade))
+        db.execute('UPDATE roupas SET tamanhos = ?, cor = ? WHERE id = ?',
+                   (', '.join(tamanhos), ', '.join(cores), roupa_id))
+    return sum(quantidade for _tamanho, _cor, quantidade in grade)
+
+
+def resolver_variante(db, roupa_id, tamanho=None, cor=None, variante_id=None):
+    """
+    Identifica a variante vendida de um produto pelo id ou pelo tamanho e cor. Retorna None para produtos
+    sem grade; o tamanho ou a cor podem ser omitidos quando só uma variante do produto os satisfaz.
+    Levanta ValueError se a variante não puder ser identificada.
+    """
+    variantes = repositorio.linhas(db, 'variantes.do_produto', (roupa_id,))
+    if not variantes:
+        return None
+    if variante_id:
+        candidatas = [v for v in variantes if v['id'] == int(variante_id)]
+    else:
+        tamanho = tamanho.strip().upper() if tamanho else None
+        cor = cor.strip().lower() if cor else None
+        candidatas = [v for v in variantes
+                      if (tamanho is None or v['tamanho'] == tamanho) and (cor is None or v['cor'].lower() == cor)]
+    if len(candidatas) != 1:
+        descricao = ' / '.join(str(valor) for valor in (tamanho, cor) if valor) or 'sem tamanho e cor'
+        raise ValueError(f"Variante do produto não identificada ({descricao}): informe o tamanho e a cor.")
+    return candidatas[0]
+
+
+def divergencias_grade(db):
+    """Retorna os produtos com grade cuja quantidade em 'roupas' difere da soma das variantes."""
+    return db.execute('''
+                      SELECT r.id, r.codigo_produto, r.quantidade, SUM(v.quantidade) AS soma_grade
+                      FROM roupas r
+                               JOIN variantes v ON v.roupa_id = r.id
+                      GROUP BY r.id
+                      HAVING r.quantidade <> SUM(v.quantidade)
+                      ORDER BY r.id
+                      ''').fetchall()
+
+
+@app.route('/grade_produto')
+@login_required
+def grade_produto():
+    """
+    API: Grade de um produto (?codigo=) em uma única consulta: o estoque de cada tamanho e cor e o total
+    por tamanho ('tamanhos' traz a ordem de exibição), para o painel de compras mostrar a disponibilidade.
+    Produtos sem grade têm 'variantes' vazia. Com ?local_id=, as quantidades são as do local e
+    'quantidade_total' traz o estoque do produto em todos os locais.
+    """
+    local_id = request.args.get('local_id', type=int)
+    linhas = consultar('roupas.grade', [local_id, local_id, request.args.get('codigo', ''), session['usuario_id']])
+    if not linhas:
+        return jsonify(None)
+    variantes = sorted((linha for linha in linhas if linha['id'] is not None),
+                       key=lambda v: (v['cor'].lower(), chave_tamanho(v['tamanho'])))
+    por_tamanho = {}
+    for variante in sorted(variantes, key=lambda v: chave_tamanho(v['tamanho'])):
+        por_tamanho[variante['tamanho']] = por_tamanho.get(variante['tamanho'], 0) + variante['quantidade']
+    return jsonify({
+        'codigo_produto': linhas[0]['codigo_produto'],
+        'quantidade': sum(linha['quantidade'] for linha in linhas) if local_id is not None else linhas[0]['total'],
+        'quantidade_total': linhas[0]['total'],
+        'tamanhos': list(por_tamanho),
+        'cores': list(dict.fromkeys(v['cor'] for v in variantes)),
+        'por_tamanho': por_tamanho,
+        'variantes': [{'id': v['id'], 'tamanho': v['tamanho'], 'cor': v['cor'], 'quantidade': v['quantidade'],
+                       'quantidade_total': v['total_variante']}
+                      for v in variantes],
+    })
+
+
+@app.route('/grade_estoque')
+@login_required
+def grade_estoque():
+    """
+    API: Estoque de todo o catálogo agregado por tamanho e cor (ex.: quantas peças M azuis restam).
+    Filtros opcionais: ?tamanho=, ?cor= e ?tipo_roupa=. Sem tipo_roupa, a consulta é respondida apenas
+    pelo índice (usuario_id, tamanho, cor, quantidade), sem ler as tabelas.
+    """
+    filtros, args = ['v.usuario_id = ?'], [session['usuario_id']]
+    juncao = ''
+    if request.args.get('tamanho'):
+        filtros.append('v.tamanho = ?')
+        args.append(request.args['tamanho'].strip().upper())
+    if request.args.get('cor'):
+        filtros.append('v.cor = ?')
+        args.append(request.args['cor'].strip())
+    if request.args.get('tipo_roupa'):
+        juncao = 'JOIN roupas r ON r.id = v.roupa_id AND r.tipo_roupa = ?'
+        args.insert(0, request.args['tipo_roupa'])
+    linhas = query_db(f"""
+                      SELECT v.tamanho, v.cor, SUM(v.quantidade) AS quantidade, COUNT(*) AS produtos
+                      FROM variantes v {juncao}
+                      WHERE {' AND '.join(filtros)}
+                      GROUP BY v.tamanho, v.cor
+                      """, args)
+    linhas = sorted(linhas, key=lambda linha: (chave_tamanho(linha['tamanho']), linha['cor'].lower()))
+    return jsonify({
+        'total': sum(linha['quantidade'] for linha in linhas),
+        'grade': [dict(linha) for linha in linhas],
+    })
+
+
+# --- Estoque por Local (Lojas e Depósitos) ---
+
+# Tipos de local e seus rótulos.
+TIPOS_LOCAL = {'loja': 'Loja', 'deposito': 'Depósito'}
+LOCAL_PADRAO = 'Loja Principal'
+
+
+def listar_locais(db, usuario_id, apenas_ativos=True):
+    """Retorna os locais do usuário (lojas primeiro, depois depósitos), por nome."""
+    return repositorio.linhas(db, 'locais.ativos' if apenas_ativos else 'locais.todos', (usuario_id,))
+
+
+def local_padrao(db, usuario_id):
+    """
+    Retorna o local usado quando nenhum é informado: a primeira loja ativa do usuário (ou o primeiro local
+    ativo). Usuários sem locais recebem a 'Loja Principal'; deve ser chamada dentro de uma unidade de escrita.
+    """
+    locais = listar_locais(db, usuario_id)
+    if locais:
+        return locais[0]
+    cur = db.execute("INSERT INTO locais (usuario_id, nome, tipo) VALUES (?, ?, 'loja')", (usuario_id, LOCAL_PADRAO))
+    return repositorio.linha(db, 'locais.por_id', (cur.lastrowid,))
+
+
+def resolver_local(db, usuario_id, local_id=None):
+    """Retorna o local ativo informado (id) ou o local padrão quando nenhum é informado; levanta ValueError."""
+    if local_id in (None, ''):
+        return local_padrao(db, usuario_id)
+    local = repositorio.linha(db, 'locais.ativo_por_id', (int(local_id), usuario_id))
+    if local is None:
+        raise ValueError('Local de estoque não encontrado ou inativo.')
+    return local
+
+
+def estoque_no_local(db, local_id, roupa_id, variante_id=0):
+    """Quantidade do produto (ou da variante) no local."""
+    linha = repositorio.linha(db, 'estoque_local.quantidade', (roupa_id, variante_id or 0, local_id))
+    return linha.quantidade if linha else 0
+
+
+def ajustar_estoque_local(db, usuario_id, local_id, roupa_id, variante_id, diferenca):
+    """
+    Soma 'diferenca' ao estoque do produto (variante_id = 0 para produto sem grade) no local, sem alterar o
+    total do produto. Levanta ValueError se o local ficar com estoque negativo. Dentro de uma unidade de escrita.
+    """
+    variante_id = variante_id or 0
+    atual = db.execute('SELECT quantidade FROM estoque_local WHERE roupa_id = ? AND variante_id = ? AND local_id = ?',
+                       (roupa_id, variante_id, local_id)).fetchone()
+    saldo = (atual['quantidade'] if atual else 0) + diferenca
+    if saldo < 0:
+        local = db.execute('SELECT nome FROM locais WHERE id = ?', (local_id,)).fetchone()
+        raise ValueError(f"Estoque insuficiente em {local['nome'] if local else 'local desconhecido'} "
+                         f"(disponível: {atual['quantidade'] if atual else 0}).")
+    if atual is not None:
+        db.execute('UPDATE estoque_local SET quantidade = ? WHERE roupa_id = ? AND variante_id = ? AND local_id = ?',
+                   (saldo, roupa_id, variante_id, local_id))
+    elif saldo:
+        variante = db.execute('SELECT tamanho, cor FROM variantes WHERE id = ?', (variante_id,)).fetchone()
+        db.execute('''
+                   INSERT INTO estoque_local (usuario_id, local_id, roupa_id, variante_id, tamanho, cor, quantidade)
+                   VALUES (?, ?, ?, ?, ?, ?, ?)
+                   ''', (usuario_id, local_id, roupa_id, variante_id, variante['tamanho'] if variante else '',
+                         variante['cor'] if variante else '', saldo))
+    return saldo
+
+
+def sincronizar_estoque_local(db, usuario_id, roupa_id, local_id):
+    """
+    Alinha o estoque por local ao total do produto depois de uma inclusão ou edição: a diferença de cada
+    variante (ou do produto sem grade) entra ou sai do local informado. Variantes zeradas são zeradas em todos
+    os locais e as que deixaram de existir (ou o estoque sem grade de um produto que passou a ter grade) saem
+    do estoque por local. Dentro da unidade de escrita que alterou o produto.
+    """
+    variantes = db.execute('SELECT id, quantidade FROM variantes WHERE roupa_id = ?', (roupa_id,)).fetchall()
+    if variantes:
+        totais = {variante['id']: variante['quantidade'] for variante in variantes}
+    else:
+        totais = {0: db.execute('SELECT quantidade FROM roupas WHERE id = ?', (roupa_id,)).fetchone()['quantidade']}
+    db.execute('DELETE FROM estoque_local WHERE roupa_id = ? AND variante_id NOT IN (SELECT value FROM json_each(?))',
+               (roupa_id, json.dumps(list(totais))))
+    somas = dict(db.execute('SELECT variante_id, SUM(quantidade) FROM estoque_local WHERE roupa_id = ? '
+                            'GROUP BY variante_id', (roupa_id,)).fetchall())
+    for variante_id, total in totais.items():
+        if total <= 0:
+            db.execute('UPDATE estoque_local SET quantidade = 0 WHERE roupa_id = ? AND variante_id = ? AND quantidade <> 0',
+                       (roupa_id, variante_id))
+        elif total != somas.get(variante_id, 0):
+            ajustar_estoque_local(db, usuario_id, local_id, roupa_id, variante_id, total - somas.get(variante_id, 0))
+
+
+def transferir_estoque(db, usuario_id, roupa_id, variante_id, origem_id, destino_id, quantidade, observacao=None):
+    """Move peças de um local para outro (o total do produto não muda) e registra a transferência."""
+    if quantidade <= 0:
+        raise ValueError('A quantidade transferida deve ser maior que zero.')
+    if origem_id == destino_id:
+        raise ValueError('A origem e o destino da transferência devem ser locais diferentes.')
+    ajustar_estoque_local(db, usuario_id, origem_id, roupa_id, variante_id, -quantidade)
+    ajustar_estoque_local(db, usuario_id, destino_id, roupa_id, variante_id, quantidade)
+    cur = db.execute('''
+                     INSERT INTO transferencias (usuario_id, roupa_id, variante_id, origem_id, destino_id, quantidade,
+                                                 observacao)
+                     VALUES (?, ?, ?, ?, ?, ?, ?)
+                     ''', (usuario_id, roupa_id, variante_id or 0, origem_id, destino_id, quantidade, observacao))
+    return cur.lastrowid
+
+
+def divergencias_locais(db):
+    """Retorna os produtos/variantes cuja soma do estoque por local difere do total em 'roupas' ou 'variantes'."""
+    return db.execute('''
+                      SELECT r.id, r.codigo_produto, COALESCE(v.id, 0) AS variante_id,
+                             COALESCE(v.quantidade, r.quantidade) AS quantidade,
+                             COALESCE((SELECT SUM(e.quantidade) FROM estoque_local e
+                                       WHERE e.roupa_id = r.id AND e.variante_id = COALESCE(v.id, 0)), 0) AS soma_locais
+                      FROM roupas r
+                               LEFT JOIN variantes v ON v.roupa_id = r.id
+                      WHERE soma_locais <> MAX(COALESCE(v.quantidade, r.quantidade), 0)
+                      ORDER BY r.id
+                      ''').fetchall()
+
+
+def metricas_locais(db, usuario_id, inicio, fim):
+    """
+    Peças em estoque e vendas (quantidade, itens, total e ticket médio) de cada local no período [inicio, fim],
+    lidas dos agregados por local, sem percorrer as vendas.
+    """
+    linhas = db.execute('''
+                        SELECT l.id, l.nome, l.tipo, l.ativo,
+                               (SELECT COALESCE(SUM(e.quantidade), 0) FROM estoque_local e
+                                WHERE e.usuario_id = l.usuario_id AND e.local_id = l.id) AS pecas_em_estoque,
+                               COALESCE(SUM(d.vendas), 0) AS vendas,
+                               COALESCE(SUM(d.itens), 0) AS itens,
+                               COALESCE(SUM(d.total_centavos), 0) AS total_centavos
+                        FROM locais l
+                                 LEFT JOIN vendas_local_dia d
+                                           ON d.usuario_id = l.usuario_id AND d.local_id = l.id
+                                               AND d.data_venda BETWEEN ? AND ?
+                        WHERE l.usuario_id = ?
+                        GROUP BY l.id
+                        ORDER BY l.tipo DESC, l.nome
+                        ''', (inicio, fim, usuario_id)).fetchall()
+    return [dict(linha, ticket_medio_centavos=linha['total_centavos'] // linha['vendas'] if linha['vendas'] else 0)
+            for linha in linhas]
+
+
+def somar_arquivos_vendas_local(db):
+    """
+    Soma a vendas_local_dia as vendas dos anos arquivados, um arquivo por vez. As vendas arquivadas antes
+    de existirem os locais (sem local_id) contam na loja principal do usuário, como a migração 10 fez
+    com as vendas que estavam no banco.
+    """
+    db.executemany('''
+                   INSERT INTO vendas_local_dia (usuario_id, local_id, data_venda, vendas, itens, total_centavos)
+                   SELECT ?1, local_id, ?3, ?4, ?5, ?6
+                   FROM (SELECT COALESCE(?2, (SELECT MIN(id) FROM locais WHERE usuario_id = ?1)) AS local_id)
+                   WHERE local_id IS NOT NULL
+                   ON CONFLICT (usuario_id, local_id, data_venda) DO UPDATE SET
+                       vendas = vendas + excluded.vendas, itens = itens + excluded.itens,
+                       total_centavos = total_centavos + excluded.total_centavos
+                   ''', linhas_arquivos_vendas(db, '''
+                                                SELECT usuario_id, local_id, data_venda, COUNT(*),
+                                                       SUM(quantidade_vendida), SUM(valor_total_centavos)
+                                                FROM {vendas}
+                                                GROUP BY usuario_id, local_id, data_venda
+                                                '''))
+
+
+def reconstruir_agregados_locais(caminho):
+    """Recalcula disponibilidade_grade e vendas_local_dia de um banco a partir das tabelas de origem."""
+    preparar_banco(caminho)
+    db = conectar(caminho)
+    try:
+        db.execute('BEGIN IMMEDIATE')
+        db.execute('DELETE FROM disponibilidade_grade')
+        db.execute('''
+                   INSERT INTO disponibilidade_grade (usuario_id, tamanho, cor, local_id, quantidade)
+                   SELECT usuario_id, tamanho, cor, local_id, SUM(quantidade) FROM estoque_local
+                   WHERE variante_id <> 0
+                   GROUP BY usuario_id, tamanho, cor, local_id
+                   ''')
+        db.execute('DELETE FROM vendas_local_dia')
+        db.execute('''
+                   INSERT INTO vendas_local_dia (usuario_id, local_id, data_venda, vendas, itens, total_centavos)
+                   SELECT usuario_id, local_id, data_venda, COUNT(*), SUM(quantidade_vendida), SUM(valor_total_centavos)
+                   FROM vendas
+                   WHERE local_id IS NOT NULL
+                   GROUP BY usuario_id, local_id, data_venda
+                   ''')
+        somar_arquivos_vendas_local(db)
+        db.commit()
+        return (db.execute('SELECT COUNT(*) FROM disponibilidade_grade').fetchone()[0],
+                db.execute('SELECT COUNT(*) FROM vendas_local_dia').fetchone()[0])
+    finally:
+        db.close()
+
+
+@app.cli.command('reconstruir-agregados-locais')
+def reconstruir_agregados_locais_command():
+    """Recalcula os agregados de estoque e de vendas por local: 'flask reconstruir-agregados-locais'."""
+    for caminho in bancos_com_vendas():
+        t0 = time.perf_counter()
+        grade, dias = reconstruir_agregados_locais(caminho)
+        print(f"{os.path.basename(caminho)}: {grade} linha(s) de disponibilidade e {dias} dia(s) de vendas por local "
+              f"em {time.perf_counter() - t0:.2f} s")
+
+
+@app.route('/locais', methods=['GET', 'POST'])
+@login_required
+def locais():
+    """Página das lojas e depósitos: cadastro, estoque e vendas de cada local e transferências entre eles."""
+    usuario_id = session['usuario_id']
+    if request.method == 'POST':
+        nome = request.form.get('nome', '').strip()
+        tipo = request.form.get('tipo', 'loja')
+        if not nome or tipo not in TIPOS_LOCAL:
+            print('Informe o nome e o tipo do local.', 'danger')
+        else:
+            try:
+                executar_escrita(lambda db: db.execute('INSERT INTO locais (usuario_id, nome, tipo) VALUES (?, ?, ?)',
+                                                       (usuario_id, nome, tipo)))
+                print('Local cadastrado com sucesso!', 'success')
+            except sqlite3.IntegrityError:
+                print(f"Já existe um local chamado '{nome}'.", 'danger')
+        return redirect(url_for('locais'))
+
+    hoje = datetime.now()
+    inicio = (hoje - timedelta(days=29)).strftime('%Y-%m-%d')
+    transferencias = query_db('''
+                              SELECT t.criado_em, r.codigo_produto, v.tamanho, v.cor, o.nome AS origem,
+                                     d.nome AS destino, t.quantidade, t.observacao
+                              FROM transferencias t
+                                       JOIN roupas r ON r.id = t.roupa_id
+                                       JOIN locais o ON o.id = t.origem_id
+                                       JOIN locais d ON d.id = t.destino_id
+                                       LEFT JOIN variantes v ON v.id = t.variante_id
+                              WHERE t.usuario_id = ?
+                              ORDER BY t.id DESC LIMIT 20
+                              ''', [usuario_id])
+    return render_template('locais.html', locais=metricas_locais(get_db(), usuario_id, inicio,
+                                                                  hoje.strftime('%Y-%m-%d')),
+                           tipos_local=TIPOS_LOCAL, transferencias=transferencias)
+
+
+@app.route('/transferir_estoque', methods=['POST'])
+@login_required
+def transferir_estoque_route():
+    """Transfere peças de um produto (e, com grade, de um tamanho/cor) entre dois locais."""
+    usuario_id = session['usuario_id']
+    codigo = request.form.get('codigo_produto', '').strip()
+    try:
+        quantidade = int(request.form.get('quantidade', 0))
+        origem_id, destino_id = int(request.form['origem_id']), int(request.form['destino_id'])
+    except (KeyError, ValueError):
+        print('Informe a origem, o destino e a quantidade da transferência.', 'danger')
+        return redirect(url_for('locais'))
+    # A unidade pode rodar na thread da escrita agrupada, fora do contexto da requisição.
+    tamanho, cor = request.form.get('tamanho'), request.form.get('cor')
+    observacao = request.form.get('observacao') or None
+
+    def transferir(db):
+        roupa = db.execute('SELECT id FROM roupas WHERE codigo_produto = ? AND usuario_id = ?',
+                           (codigo, usuario_id)).fetchone()
+        if roupa is None:
+            raise ValueError(f"Produto '{codigo}' não encontrado.")
+        for local_id in (origem_id, destino_id):
+            resolver_local(db, usuario_id, local_id)
+        variante = resolver_variante(db, roupa['id'], tamanho, cor)
+        transferir_estoque(db, usuario_id, roupa['id'], variante['id'] if variante else 0, origem_id, destino_id,
+                           quantidade, observacao)
+        return roupa['id']
 
-            if quantidade_nova < 0:
-                print('A quantidade em estoque não pode ser negativa.', 'danger')
-                return render_template('editar_roupa.html', roupa=roupa)
+    try:
+        roupa_id = executar_escrita(transferir)
+        publicar_estoque(usuario_id, [roupa_id])
+        print('Transferência registrada com sucesso!', 'success')
+    except ValueError as e:
+        print(f'Não foi possível transferir: {e}', 'danger')
+    return redirect(url_for('locais'))
 
-            db.execute('''
-                       UPDATE roupas
-                       SET codigo_produto  = ?,
-                           tipo_roupa      = ?,
-                           tecido          = ?,
-                           quantidade      = ?,
-                           quantida_vendas = ?,
-                           cor             = ?,
-                           tamanhos        = ?,
-                           detalhes        = ?,
-                           preco_unitario  = ?
-                       WHERE id = ?
-                       ''', (request.form['codigo_produto'], request.form['tipo_roupa'], request.form['tecido'],
-                             quantidade_nova, vendas_novas, request.form['cor'], request.form['tamanhos'],
-                             request.form['detalhes'], float(request.form['preco_unitario']), roupa_id))
-            db.commit()
-            print('Roupa atualizada com sucesso!', 'success')
-            return redirect(url_for('listar_roupas'))
-        except Exception as e:
-            print(f'Ocorreu um erro ao editar a roupa: {e}', 'danger')
-            return redirect(url_for('listar_roupas'))
 
-    return render_template('editar_roupa.html', roupa=roupa)
+@app.route('/disponibilidade')
+@login_required
+def disponibilidade():
+    """
+    API: Onde há estoque. Com ?codigo=, o estoque do produto em cada local (e de cada tamanho/cor, filtrável
+    por ?tamanho= e ?cor=), lido pela chave primária de estoque_local. Sem código, ?tamanho= (e ?cor=) consulta
+    o agregado disponibilidade_grade: "onde há M em estoque" é uma única busca pela chave primária.
+    """
+    usuario_id = session['usuario_id']
+    codigo = request.args.get('codigo', '').strip()
+    tamanho = request.args.get('tamanho', '').strip().upper()
+    cor = request.args.get('cor', '').strip()
+    if not codigo and not tamanho:
+        return jsonify({'erro': 'Informe o código do produto ou o tamanho.'}), 400
+
+    filtros, args = [], []
+    if tamanho:
+        filtros.append('AND e.tamanho = ?')
+        args.append(tamanho)
+    if cor:
+        filtros.append('AND e.cor = ?')
+        args.append(cor)
+    if codigo:
+        linhas = query_db(f"""
+                          SELECT e.local_id, l.nome, l.tipo, e.variante_id, e.tamanho, e.cor, e.quantidade
+                          FROM roupas r
+                                   JOIN estoque_local e ON e.roupa_id = r.id
+                                   JOIN locais l ON l.id = e.local_id
+                          WHERE r.usuario_id = ? AND r.codigo_produto = ? AND e.quantidade > 0 {' '.join(filtros)}
+                          """, [usuario_id, codigo] + args)
+    else:
+        linhas = query_db(f"""
+                          SELECT e.local_id, l.nome, l.tipo, NULL AS variante_id, e.tamanho, e.cor, e.quantidade
+                          FROM disponibilidade_grade e
+                                   JOIN locais l ON l.id = e.local_id
+                          WHERE e.usuario_id = ? AND e.quantidade > 0 {' '.join(filtros)}
+                          """, [usuario_id] + args)
+
+    locais_com_estoque = OrderedDict()
+    for linha in sorted(linhas, key=lambda item: (item['tipo'] != 'loja', item['nome'], item['cor'].lower(),
+                                                  chave_tamanho(item['tamanho']))):
+        local = locais_com_estoque.setdefault(linha['local_id'], {
+            'local_id': linha['local_id'], 'nome': linha['nome'], 'tipo': linha['tipo'], 'quantidade': 0,
+            'variantes': []})
+        local['quantidade'] += linha['quantidade']
+        if linha['tamanho'] or linha['cor']:
+            local['variantes'].append({'variante_id': linha['variante_id'], 'tamanho': linha['tamanho'],
+                                       'cor': linha['cor'], 'quantidade': linha['quantidade']})
+    return jsonify({
+        'codigo_produto': codigo or None,
+        'total': sum(local['quantidade'] for local in locais_com_estoque.values()),
+        'locais': list(locais_com_estoque.values()),
+    })
+
+
+@app.route('/metricas_locais')
+@login_required
+def api_metricas_locais():
+    """
+    API: Estoque e vendas de cada local no período ?inicio=&fim= (datas ISO; padrão: últimos 30 dias),
+    calculados a partir dos agregados por local.
+    """
+    hoje = datetime.now()
+    inicio = request.args.get('inicio') or (hoje - timedelta(days=29)).strftime('%Y-%m-%d')
+    fim = request.args.get('fim') or hoje.strftime('%Y-%m-%d')
+    try:
+        inicio, fim = data_iso(inicio), data_iso(fim)
+    except ValueError:
+        return jsonify({'erro': 'As datas devem estar no formato AAAA-MM-DD.'}), 400
+    return jsonify({'inicio': inicio, 'fim': fim, 'locais': metricas_locais(get_db(), session['usuario_id'],
+                                                                          inicio, fim)})
+
 
 # --- ROTAS DE GERENCIAMENTO DE FUNCIONÁRIOS ---
 @app.route('/gerenciar_funcionarios')
 @login_required
 def gerenciar_funcionarios():
     """ Rota para listar todos os funcionários, agora com dados de vendas do mês atual."""
-    ordenar_por = request.args.get('ordenar_por', 'nome_completo')
-    ordem = request.args.get('ordem', 'asc')
-
-    # Adiciona os novos campos calculados à lista de campos válidos para ordenação
-    campos_validos = ['nome_completo', 'cargo', 'data_inicio_contrato', 'total_valor_mes', 'numero_vendas_mes']
-    if ordenar_por not in campos_validos:
-        ordenar_por = 'nome_completo'
-    if ordem.upper() not in ['ASC', 'DESC']:
-        ordem = 'ASC'
-
-    # Query aprimorada com LEFT JOIN para buscar dados de vendas do mês atual
-    query = f"""
-        SELECT
-            f.id, f.nome_completo, f.cargo, f.data_inicio_contrato, f.data_fim_contrato, f.cidade, f.estado,
-            COALESCE(SUM(v.valor_total_venda), 0) as total_valor_mes,
-            COUNT(v.id) as numero_vendas_mes
-        FROM 
-            funcionarios f
-        LEFT JOIN 
-            vendas v ON f.id = v.funcionario_id AND STRFTIME('%Y-%m', v.data_venda) = STRFTIME('%Y-%m', 'now', 'localtime')
-        WHERE 
-            f.usuario_id = ?
-        GROUP BY 
-            f.id
-        ORDER BY 
-            {ordenar_por} {ordem}
-    """
-    funcionarios = query_db(query, [session['usuario_id']])
+    instrucao, ordenar_por, ordem = repositorio.ordenacao('funcionarios.listar', request.args.get('ordenar_por'),
+                                                          request.args.get('ordem'))
+    ordem = ordem.lower()
+    # Inclui o total e o número de vendas do mês atual de cada funcionário.
+    funcionarios = consultar(instrucao, [session['usuario_id']])
     return render_template('listar_funcionarios.html', funcionarios=funcionarios, ordenar_por=ordenar_por, ordem=ordem)
 
 @app.route('/cadastrar_funcionario', methods=['GET', 'POST'])
@@ -373,6 +3980,7 @@ def cadastrar_funcionario():
                                                  observacoes, is_gerente)
                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
                        ''', dados)
+            invalidar_registros('funcionario', session['usuario_id'])
             print('Funcionário cadastrado com sucesso!', 'success')
             return redirect(url_for('gerenciar_funcionarios'))
         except Exception as e:
@@ -403,14 +4011,14 @@ def editar_funcionario(funcionario_id):
                 is_gerente, # Adiciona o novo campo
                 funcionario_id, session['usuario_id']
             )
-            db.execute('''
+            executar_escrita(lambda conexao: conexao.execute('''
                        UPDATE funcionarios
                        SET nome_completo = ?, cep = ?, rua = ?, numero = ?, cidade = ?, estado = ?, 
                            pais = ?, data_inicio_contrato = ?, data_fim_contrato = ?, cargo = ?, 
                            definicao_cargo = ?, observacoes = ?, is_gerente = ?
                        WHERE id = ? AND usuario_id = ?
-                       ''', dados)
-            db.commit()
+                       ''', dados))
+            invalidar_registros('funcionario', session['usuario_id'])
             print('Funcionário atualizado com sucesso!', 'success')
             return redirect(url_for('gerenciar_funcionarios'))
         except Exception as e:
@@ -424,16 +4032,12 @@ def editar_funcionario(funcionario_id):
 @login_required
 def dados_empresa():
     usuario_id = session['usuario_id']
-    usuario = query_db("SELECT * FROM usuarios WHERE id = ?", [usuario_id], one=True)
-    empresa = query_db("SELECT * FROM empresas WHERE usuario_id = ?", [usuario_id], one=True)
+    usuario = usuario_cadastro(usuario_id)
+    empresa = empresa_do_usuario(usuario_id)
 
     data_nascimento_formatada = None
     if usuario and usuario['data_nascimento']:
-        try:
-            data_nascimento_dt = datetime.strptime(usuario['data_nascimento'], '%d/%m/%Y')
-            data_nascimento_formatada = data_nascimento_dt.strftime('%d/%m/%Y')
-        except ValueError:
-            data_nascimento_formatada = usuario['data_nascimento']
+        data_nascimento_formatada = formatar_data(usuario['data_nascimento'])
 
     return render_template('dados_empresa.html',
                            usuario=usuario,
@@ -453,33 +4057,23 @@ def atualizar_dados_empresa():
 
     db = get_db()
     cursor = db.cursor()
+    # Os dados do usuário ficam no diretório global (que é o próprio banco quando o sharding está desativado).
+    db_diretorio = get_db_diretorio()
+    cursor_diretorio = db_diretorio.cursor()
+
+    # Recupera os dados do usuário (nome, sobrenome, data de nascimento e email) pelo cache de registros.
+    usuario = usuario_cadastro(session['usuario_id'])
+
+    # Recupera os dados da empresa (se existir). Se não existir empresa associada ao usuário, 'empresa' será None.
+    empresa = empresa_do_usuario(session['usuario_id'])
 
-    # Recupera os dados do usuário
-    cursor.execute("SELECT nome, sobrenome, data_nascimento, email FROM usuarios WHERE id = ?",
-                   (session['usuario_id'],))
-    # Executa uma query para selecionar o nome, sobrenome, data de nascimento e email do usuário
-    # na tabela 'usuarios', filtrando pelo ID do usuário armazenado na sessão.
-    usuario = cursor.fetchone()
-    # Obtém o resultado da query e armazena na variável 'usuario'.
-
-    # Recupera os dados da empresa (se existir)
-    cursor.execute("SELECT * FROM empresas WHERE usuario_id = ?", (session['usuario_id'],))
-    # Executa uma query para selecionar todos os dados da empresa na tabela 'empresas',
-    # filtrando pelo ID do usuário armazenado na sessão.
-    empresa = cursor.fetchone()
-    # Obtém o resultado da query e armazena na variável 'empresa'. Se não existir empresa
-    # associada ao usuário, 'empresa' será None.
-
-    # Converte a data de nascimento para o formato YYYY-MM-DD
+    # A data de nascimento já é armazenada no formato YYYY-MM-DD, o mesmo usado pelo campo de data do formulário HTML.
     if usuario and usuario['data_nascimento']:
         # Verifica se o usuário existe e se possui uma data de nascimento.
         try:
-            data_nascimento_dt = datetime.strptime(usuario['data_nascimento'], '%d/%m/%Y')
-            # Converte a data de nascimento do formato string ('%d/%m/%Y') para um objeto datetime.
-            data_nascimento_formatada = data_nascimento_dt.strftime('%Y-%m-%d')
-            # Formata a data de nascimento para o formato 'YYYY-MM-DD' para ser exibida no formulário HTML.
+            data_nascimento_formatada = data_iso(usuario['data_nascimento'])
         except ValueError:
-            data_nascimento_formatada = None  # Ou defina um valor padrão
+            data_nascimento_formatada = None
             # Se a data de nascimento não estiver no formato esperado, define 'data_nascimento_formatada' como None.
     else:
         data_nascimento_formatada = None
@@ -508,21 +4102,18 @@ def atualizar_dados_empresa():
         # Recupera os dados do formulário enviados via POST.
 
         try:
-            # Converte a data de nascimento para o formato correto antes de salvar no banco
-            data_nascimento_dt = datetime.strptime(data_nascimento, '%Y-%m-%d')
-            # Converte a data de nascimento do formato 'YYYY-MM-DD' (vindo do formulário) para um objeto datetime.
-            data_nascimento_db = data_nascimento_dt.strftime('%d/%m/%Y')
-            # Formata a data de nascimento para o formato '%d/%m/%Y' para ser armazenada no banco de dados.
+            # Valida a data de nascimento antes de salvar no banco, que a armazena no formato ISO ('YYYY-MM-DD').
+            data_nascimento_db = datetime.strptime(data_nascimento, '%Y-%m-%d').strftime('%Y-%m-%d')
 
             # Atualiza os dados do usuário
-            cursor.execute("UPDATE usuarios SET nome = ?, sobrenome = ?, data_nascimento = ? WHERE id = ?",
-                           (nome, sobrenome, data_nascimento_db, session['usuario_id']))
+            cursor_diretorio.execute("UPDATE usuarios SET nome = ?, sobrenome = ?, data_nascimento = ? WHERE id = ?",
+                                     (nome, sobrenome, data_nascimento_db, session['usuario_id']))
             # Executa uma query para atualizar o nome, sobrenome e data de nascimento do usuário na tabela 'usuarios',
             # filtrando pelo ID do usuário armazenado na sessão.
 
-            # Se a empresa já existir, eu atualizo os dados
-            if empresa:
-                cursor.execute('''
+            # Se a empresa já existir, eu atualizo os dados. A decisão usa o banco (rowcount) e não o cache,
+            # que pode estar desatualizado em relação a outro processo.
+            cursor.execute('''
                                UPDATE empresas
                                SET nome_fantasia = ?,
                                    cnpj          = ?,
@@ -540,10 +4131,10 @@ def atualizar_dados_empresa():
                                WHERE usuario_id = ?
                 ''', (nome_fantasia, cnpj, razao_social, cnae, cep, rua, bairro, cidade, estado, pais, inscricao_estadual, inscricao_municipal, regime_tributario,
                       session['usuario_id']))
-                # Executa uma query para atualizar os dados da empresa na tabela 'empresas',
-                # filtrando pelo ID do usuário armazenado na sessão.
-            # Se a empresa não existir, eu crio uma nova
-            else:
+            # Executa uma query para atualizar os dados da empresa na tabela 'empresas',
+            # filtrando pelo ID do usuário armazenado na sessão.
+            # Se a empresa não existir (nenhuma linha atualizada), eu crio uma nova
+            if cursor.rowcount == 0:
                 cursor.execute('''
                                INSERT INTO empresas (usuario_id, nome_fantasia, cnpj, razao_social, cnae,
                                                      cep, rua, bairro, cidade, estado, pais, inscricao_estadual,
@@ -554,7 +4145,10 @@ def atualizar_dados_empresa():
                 # Executa uma query para inserir os dados da nova empresa na tabela 'empresas'.
 
             db.commit()
-            # Commita as alterações no banco de dados.
+            db_diretorio.commit()
+            # Commita as alterações no banco de dados (e no diretório, quando forem bancos distintos).
+            invalidar_registros('usuario', session['usuario_id'])
+            invalidar_registros('empresa', session['usuario_id'])
             print('Dados atualizados com sucesso!', 'success')
             return redirect(url_for('dados_empresa'))
             # Redireciona o usuário para a página 'dados_empresa' para visualizar os dados atualizados.
@@ -580,27 +4174,36 @@ def atualizar_dados_empresa():
 def painel_clientes():
     """
     Rota para o painel de gerenciamento de clientes, agora incluindo
-    métricas de histórico de compras.
+    métricas de histórico de compras e as notas e o segmento RFM de cada cliente.
     """
     usuario_id = session['usuario_id']
     data_limite_3m = (datetime.now() - timedelta(days=90)).strftime('%Y-%m-%d')
+    garantir_notas_rfm(usuario_id)
+    # O total de compras (dias com compra em todo o histórico, inclusive os anos arquivados) vem de clientes_rfm;
+    # só as vendas dos últimos 3 meses são lidas.
+    vendas = fonte_vendas(get_db(), data_limite_3m)
 
-    query = """
+    query = f"""
             SELECT c.id, \
                    c.nome, \
                    c.telefone, \
-                   COUNT(DISTINCT v.data_venda)                                                      as total_compras, \
-                   COALESCE(SUM(CASE WHEN v.data_venda >= ? THEN v.valor_total_venda ELSE 0 END), 0) as total_gasto_3m
+                   COALESCE(r.compras, 0)           as total_compras, \
+                   COALESCE(g.total_gasto_3m, 0)    as total_gasto_3m, \
+                   r.recencia, r.frequencia, r.monetario, r.segmento
             FROM clientes c \
-                     LEFT JOIN \
-                 vendas v ON c.id = v.cliente_id AND v.usuario_id = c.usuario_id
+                     LEFT JOIN clientes_rfm r ON r.cliente_id = c.id \
+                     LEFT JOIN (SELECT cliente_id, SUM(valor_total_centavos) as total_gasto_3m
+                                FROM {vendas}
+                                WHERE usuario_id = ? AND data_venda >= ?
+                                GROUP BY cliente_id) g ON g.cliente_id = c.id
             WHERE c.usuario_id = ?
-            GROUP BY c.id, c.nome, c.telefone
             ORDER BY c.nome; \
             """
-    clientes = query_db(query, (data_limite_3m, usuario_id))
+    # A tabela é um fragmento em cache por usuário e dia: a consulta só roda quando ele precisa ser renderizado.
+    clientes = ResultadoAdiado(lambda: query_db(query, (usuario_id, data_limite_3m, usuario_id)))
 
-    return render_template('painel_clientes.html', clientes=clientes)
+    return render_template('painel_clientes.html', clientes=clientes, data_limite_3m=data_limite_3m,
+                           rotulos_segmentos=ROTULOS_SEGMENTOS)
 
 @app.route('/cadastrar_cliente', methods=['POST'])
 @login_required
@@ -626,186 +4229,1253 @@ def editar_cliente(cliente_id):
 
     if request.method == 'POST':
         try:
-            db.execute('UPDATE clientes SET nome = ?, telefone = ? WHERE id = ? AND usuario_id = ?',
-                       (request.form['nome-cliente'], request.form['telefone-cliente'], cliente_id,
-                        session['usuario_id']))
-            db.commit()
+            dados = (request.form['nome-cliente'], request.form['telefone-cliente'], cliente_id, session['usuario_id'])
+            executar_escrita(lambda conexao: conexao.execute(
+                'UPDATE clientes SET nome = ?, telefone = ? WHERE id = ? AND usuario_id = ?', dados))
             print('Cliente atualizado com sucesso!', 'success')
             return redirect(url_for('painel_clientes'))
         except Exception as e:
             print(f'Ocorreu um erro ao editar o cliente: {e}', 'danger')
             return redirect(url_for('painel_clientes'))
 
-    return render_template('editar_cliente.html', cliente=cliente)
+    return render_template('editar_cliente.html', cliente=cliente)
+
+
+# --- Rotas do Painel de Compras e API ---
+@app.route('/painel_compras')
+@login_required
+def painel_compras():
+    """ Rota que exibe a interface principal para registrar novas compras/vendas."""
+    # Busca o nome do usuário logado para usar como vendedor padrão
+    usuario = usuario_cadastro(session['usuario_id'])
+    locais_venda = [dict(local) for local in listar_locais(get_db(), session['usuario_id'])]
+    return render_template('painel_compras.html', usuario=usuario, locais=locais_venda)
+
+@app.route('/vender_roupa', methods=['POST'])
+@login_required
+def vender_roupa():
+    print('Ação de venda registrada, mas a lógica final está em "Finalizar Compra".', 'info')
+    return redirect(url_for('painel_compras'))
+
+
+@app.route('/buscar_funcionarios')
+@login_required
+def buscar_funcionarios():
+    """
+    API: Busca funcionários ATIVOS para o autocompletar do painel de compras.
+    Funcionários com data_fim_contrato preenchida são considerados inativos.
+    """
+    termo = f"%{request.args.get('query', '')}%"
+    funcionarios_rows = consultar('funcionarios.buscar_ativos', (termo, session['usuario_id']), coalescer=True)
+    return jsonify(funcionarios_rows)
+
+@app.route('/buscar_clientes')
+@login_required
+def buscar_clientes():
+    termo = f"%{request.args.get('query', '')}%"
+    clientes_rows = consultar('clientes.buscar', (termo, session['usuario_id']), coalescer=True)
+    return jsonify(clientes_rows)
+
+@app.route('/buscar_produtos')
+@login_required
+def buscar_produtos():
+    """
+    API: Busca produtos para o autocompletar do painel de compras,
+    filtrando para incluir apenas aqueles com quantidade em estoque maior que zero.
+    Com ?tamanho= e/ou ?cor=, considera apenas o estoque das variantes da grade com esse tamanho e cor.
+    Vários caixas digitando o mesmo prefixo ao mesmo tempo compartilham uma única consulta (coalescer=True).
+    """
+    termo = f"%{request.args.get('query', '')}%"
+    tamanho = request.args.get('tamanho', '').strip().upper()
+    cor = request.args.get('cor', '').strip()
+
+    if tamanho or cor:
+        query = f"""
+                SELECT r.id, r.codigo_produto, SUM(v.quantidade) AS quantidade
+                FROM roupas r
+                         JOIN variantes v ON v.roupa_id = r.id
+                WHERE r.codigo_produto LIKE ?
+                  AND r.usuario_id = ?
+                  {'AND v.tamanho = ?' if tamanho else ''}
+                  {'AND v.cor = ?' if cor else ''}
+                  AND v.quantidade > 0
+                GROUP BY r.id
+                ORDER BY r.codigo_produto LIMIT 10
+                """
+        produtos_rows = query_db(query, [termo, session['usuario_id']] + [valor for valor in (tamanho, cor) if valor],
+                                 coalescer=True)
+        return jsonify(produtos_rows)
+
+    query = """
+            SELECT id, codigo_produto
+            FROM roupas
+            WHERE codigo_produto LIKE ?
+              AND usuario_id = ?
+              AND quantidade > 0
+            ORDER BY codigo_produto LIMIT 10 \
+            """
+
+    produtos_rows = query_db(query, (termo, session['usuario_id']), coalescer=True)
+    return jsonify(produtos_rows)
+
+@app.route('/buscar_detalhes_produto')
+@login_required
+def buscar_detalhes_produto():
+    codigo = request.args.get('codigo', '')
+    produto = query_db(
+        'SELECT codigo_produto, tipo_roupa, cor, detalhes FROM roupas WHERE codigo_produto = ? AND usuario_id = ?',
+        [codigo, session['usuario_id']], one=True)
+    return jsonify(produto)
+
+
+@app.route('/buscar_produto_route')
+@login_required
+def buscar_produto_route():
+    codigo = request.args.get('codigo', '')
+    produto = query_db('SELECT * FROM roupas WHERE codigo_produto = ? AND usuario_id = ?',
+                       [codigo, session['usuario_id']], one=True)
+    return jsonify(produto)
+
+
+# Colunas do instantâneo do catálogo, na ordem em que cada item é enviado ao painel de compras.
+COLUNAS_CATALOGO = ['codigo_produto', 'tipo_roupa', 'cor', 'detalhes', 'preco_centavos', 'quantidade']
+
+
+def resposta_json_compacta(dados, etag=None):
+    """
+    Monta uma resposta JSON sem espaços, comprimida com gzip quando o navegador aceita.
+    Com etag, o navegador pode revalidar o conteúdo e receber 304 se nada mudou.
+    """
+    corpo = serializacao.dumps(dados)
+    resposta = Response(corpo, mimetype='application/json')
+    if 'gzip' in request.accept_encodings and len(corpo) > 512:
+        resposta.set_data(gzip.compress(corpo, compresslevel=6))
+        resposta.headers['Content-Encoding'] = 'gzip'
+        resposta.headers['Vary'] = 'Accept-Encoding'
+    if etag:
+        resposta.set_etag(etag)
+        resposta.headers['Cache-Control'] = 'private, no-cache'
+    return resposta
+
+
+@app.route('/catalogo_produtos')
+@login_required
+def catalogo_produtos():
+    """
+    API: Instantâneo compacto do catálogo em estoque para o painel de compras, versionado pelo
+    contador de alterações de 'roupas'. Com ?since=<versao>, retorna apenas os produtos alterados
+    depois dessa versão, inclusive os que ficaram sem estoque (o painel deve removê-los).
+    """
+    usuario_id = session['usuario_id']
+    since = request.args.get('since', type=int)
+    versao = query_db('SELECT versao FROM catalogo_versao WHERE usuario_id = ?', [usuario_id], one=True)
+    versao = versao['versao'] if versao else 0
+
+    etag = f"catalogo-{usuario_id}-{versao}-{'completo' if since is None else since}"
+    if request.if_none_match.contains(etag):
+        return Response(status=304, headers={'ETag': f'"{etag}"'})
+
+    # As tuplas do cursor são serializadas diretamente como arrays, na ordem de COLUNAS_CATALOGO.
+    colunas = ', '.join(COLUNAS_CATALOGO)
+    if since is None:
+        _colunas, itens = query_tuplas(f"SELECT {colunas} FROM roupas WHERE usuario_id = ? AND quantidade > 0 "
+                                       f"ORDER BY codigo_produto", [usuario_id])
+    else:
+        _colunas, itens = query_tuplas(f"SELECT {colunas} FROM roupas WHERE usuario_id = ? AND versao > ? "
+                                       f"ORDER BY codigo_produto", [usuario_id, since])
+
+    return resposta_json_compacta({
+        'versao': versao,
+        'completo': since is None,
+        'colunas': COLUNAS_CATALOGO,
+        'itens': itens,
+    }, etag=etag)
+
+
+@app.cli.command('bench-json')
+@click.option('--linhas', type=int, default=100000, show_default=True, help='Quantidade de produtos simulados.')
+def bench_json_command(linhas):
+    """
+    Compara a serialização do catálogo com um dicionário por linha (json da biblioteca padrão) e direto das
+    tuplas do cursor (arrays e formato colunar), medindo o tempo e o pico de memória alocada (tracemalloc):
+    'flask bench-json --linhas 100000'.
+    """
+    db = sqlite3.connect(':memory:')
+    db.execute('CREATE TABLE roupas (codigo_produto TEXT, tipo_roupa TEXT, cor TEXT, detalhes TEXT, '
+               'preco_centavos INTEGER, quantidade INTEGER)')
+    db.executemany('INSERT INTO roupas VALUES (?, ?, ?, ?, ?, ?)',
+                   ((f"20260101-{i:08d}", 'Camiseta', 'Azul', 'Gola V', 4990 + i % 500, i % 40) for i in range(linhas)))
+    consulta = f"SELECT {', '.join(COLUNAS_CATALOGO)} FROM roupas ORDER BY codigo_produto"
+
+    def dict_por_linha():
+        db.row_factory = sqlite3.Row
+        itens = [dict(linha) for linha in db.execute(consulta).fetchall()]
+        return json.dumps(itens, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+    def tuplas():
+        db.row_factory = None
+        return serializacao.dumps({'colunas': COLUNAS_CATALOGO, 'itens': db.execute(consulta).fetchall()})
+
+    def colunar():
+        db.row_factory = None
+        return serializacao.dumps(colunas_para_arrays(COLUNAS_CATALOGO, db.execute(consulta).fetchall()))
+
+    print(f"{linhas} produtos; codificador: {'orjson' if ORJSON_DISPONIVEL else 'json (biblioteca padrão)'}")
+    for nome, funcao in (('dict por linha + json', dict_por_linha), ('tuplas do cursor', tuplas),
+                         ('formato colunar', colunar)):
+        t0 = time.perf_counter()
+        corpo = funcao()
+        duracao = time.perf_counter() - t0
+        tracemalloc.start()
+        funcao()
+        _atual, pico = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"{nome:<22} {duracao * 1000:8.1f} ms   pico {pico / 2 ** 20:7.1f} MiB   "
+              f"resposta {len(corpo) / 2 ** 20:6.1f} MiB")
+    db.close()
+
+
+# --- Rotas do Fluxo de Finalização de Compra ---
+@app.route('/revisar_compra', methods=['POST'])
+@login_required
+def revisar_compra():
+    dados_carrinho_json = request.form.get('dados_carrinho')
+    if not dados_carrinho_json:
+        print('Nenhum dado de compra recebido.', 'danger')
+        return redirect(url_for('painel_compras'))
+    dados_compra = json.loads(dados_carrinho_json)
+    # Os preços do carrinho chegam em reais; a revisão os exibe a partir de centavos, como o resto da aplicação.
+    for item in dados_compra['itens']:
+        item['preco'] = para_centavos(item['preco'])
+    total_compra = sum(item['preco'] or 0 for item in dados_compra['itens'])
+    return render_template('revisar_compra.html', compra=dados_compra, total=total_compra,
+                           dados_carrinho_json=dados_carrinho_json)
+
+
+def registrar_itens_venda(db, usuario_id, cliente_id, funcionario_id, itens, local_id=None):
+    """
+    Registra as vendas de uma compra e baixa o estoque do local da venda (local_id; padrão: o local padrão do
+    usuário). Deve ser chamada dentro de uma unidade de escrita.
+    'itens' é uma lista de dicionários com 'codigo', 'quantidade' e 'valor_total_centavos' e, para produtos
+    com grade, 'variante_id' ou 'tamanho' e 'cor'; códigos inexistentes são ignorados e estoque insuficiente
+    no local ou variante não identificada levantam ValueError. Retorna os ids das vendas criadas.
+    """
+    local = resolver_local(db, usuario_id, local_id)
+    venda_ids = []
+    total_centavos = 0
+    # Itera sobre cada item do carrinho
+    for item in itens:
+        roupa = repositorio.linha(db, 'roupas.por_codigo', (item['codigo'], usuario_id))
+        if not roupa:
+            continue
+
+        roupa_id = roupa.id
+        variante = resolver_variante(db, roupa_id, item.get('tamanho'), item.get('cor'), item.get('variante_id'))
+
+        # O painel de compras trabalha com uma cópia local do catálogo; o estoque do local é revalidado aqui.
+        variante_id = variante['id'] if variante else 0
+        disponivel = estoque_no_local(db, local['id'], roupa_id, variante_id)
+        if disponivel < item['quantidade']:
+            descricao = f" {variante['tamanho']} / {variante['cor']}" if variante else ''
+            raise ValueError(f"Estoque insuficiente para o produto {item['codigo']}{descricao} em {local['nome']} "
+                             f"(disponível: {disponivel}).")
+
+        # 1. Insere o registro na nova tabela 'vendas'
+        cur = repositorio.executar(db, 'vendas.inserir',
+                                   (usuario_id, cliente_id, roupa_id, funcionario_id, item['quantidade'],
+                                    item['valor_total_centavos'], variante['id'] if variante else None, local['id']))
+        venda_ids.append(cur.lastrowid)
+        registrar_movimento(db, usuario_id, roupa_id, 'venda', -item['quantidade'], venda_id=cur.lastrowid)
+        ajustar_estoque_local(db, usuario_id, local['id'], roupa_id, variante_id, -item['quantidade'])
+        if variante:
+            repositorio.executar(db, 'variantes.baixar', (item['quantidade'], variante['id']))
+
+        # 2. Atualiza o estoque e a contagem total de vendas na tabela 'roupas'
+        repositorio.executar(db, 'roupas.baixar_venda', (item['quantidade'], item['quantidade'], roupa_id, usuario_id))
+        total_centavos += item['valor_total_centavos']
+
+    # 3. Atualiza os totais e as notas RFM do cliente
+    if venda_ids and cliente_id is not None:
+        registrar_compra_rfm(db, usuario_id, cliente_id, total_centavos)
+    return venda_ids
+
+
+@app.route('/finalizar_compra', methods=['POST'])
+@login_required
+def finalizar_compra():
+    """
+    Rota que processa a compra, atualizando o estoque e registrando a venda.
+    """
+    dados_carrinho_json = request.form.get('dados_carrinho')
+    if not dados_carrinho_json:
+        print('Erro ao processar a compra. Tente novamente.', 'danger')
+        return redirect(url_for('painel_compras'))
+
+    dados_compra = json.loads(dados_carrinho_json)
+    usuario_id = session['usuario_id']
+    nome_dono = usuario_cadastro(usuario_id)['nome']
+
+    # Busca o ID do funcionário (se houver)
+    vendedor_nome = dados_compra.get('vendedor')
+    funcionario_id = None
+    if vendedor_nome and vendedor_nome != 'Nenhum' and vendedor_nome != nome_dono:
+        funcionario_id = funcionario_por_nome(usuario_id, vendedor_nome)
+
+    def registrar_compra(db):
+        """Unidade de escrita da compra: todas as instruções são confirmadas (ou desfeitas) juntas."""
+        # Primeiro, precisamos do ID do cliente
+        cliente = db.execute('SELECT id FROM clientes WHERE nome = ? AND usuario_id = ?',
+                             (dados_compra['cliente'], usuario_id)).fetchone()
+        if not cliente:
+            raise Exception(f"Cliente '{dados_compra['cliente']}' não encontrado.")
+        cliente_id = cliente['id']
+
+        itens = [{'codigo': item['codigo'], 'quantidade': int(item['quantidade']),
+                  'valor_total_centavos': para_centavos(item['preco']), 'variante_id': item.get('variante_id')}
+                 for item in dados_compra['itens']]
+        return registrar_itens_venda(db, usuario_id, cliente_id, funcionario_id, itens, dados_compra.get('local_id'))
+
+    try:
+        venda_ids = executar_escrita(registrar_compra)
+        # Os outros caixas e as métricas abertas recebem o novo estoque e o total de vendas (ver /eventos).
+        publicar_vendas(usuario_id, venda_ids)
+        print('Compra finalizada com sucesso!', 'success')
+        return redirect(url_for('dashboard'))
+
+    except Exception as e:
+        print(f'Ocorreu um erro ao finalizar a compra: {e}', 'danger')
+        return redirect(url_for('painel_compras'))
+
+
+# --- API JSON de Checkout (PDV e Leitores de Código de Barras) ---
+
+class ErroApi(Exception):
+    """Erro de negócio da API JSON, devolvido ao cliente com o status HTTP indicado."""
+
+    def __init__(self, status, mensagem):
+        super().__init__(mensagem)
+        self.status = status
+        self.mensagem = mensagem
+
+
+def login_required_api(f):
+    """Equivalente ao login_required para a API: responde 401 em JSON em vez de redirecionar."""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if 'usuario_id' not in session:
+            return jsonify({'erro': 'Não autenticado.'}), 401
+        try:
+            return f(*args, **kwargs)
+        except ErroApi as e:
+            return jsonify({'erro': e.mensagem}), e.status
+
+    return decorated_function
+
+
+def resposta_idempotente(salva, metodo, caminho):
+    """
+    Retorna (status, corpo) gravados para uma chave de idempotência. A chave já usada em outra operação
+    (método e caminho) levanta ErroApi 422; as chaves gravadas antes da migração 14 não têm esses dados.
+    """
+    if salva['metodo'] is not None and (salva['metodo'], salva['caminho']) != (metodo, caminho):
+        raise ErroApi(422, f"A chave de idempotência já foi usada em {salva['metodo']} {salva['caminho']}.")
+    return salva['status'], json.loads(salva['resposta'])
+
+
+def executar_idempotente(unidade):
+    """
+    Executa uma unidade de escrita da API que retorna (status, corpo). Se a requisição trouxer o
+    cabeçalho Idempotency-Key, a resposta é gravada na mesma transação da escrita, com o método e o
+    caminho da requisição, e as repetições com a mesma chave recebem a resposta original sem repetir
+    a operação; a mesma chave em outra operação é recusada com 422.
+    """
+    usuario_id = session['usuario_id']
+    chave = request.headers.get('Idempotency-Key')
+    if not chave:
+        status, corpo = executar_escrita(unidade)
+        return jsonify(corpo), status
+    # A unidade pode rodar na thread da escrita agrupada, fora do contexto da requisição.
+    metodo, caminho = request.method, request.path
+    consulta = 'SELECT status, resposta, metodo, caminho FROM chaves_idempotencia WHERE usuario_id = ? AND chave = ?'
+
+    def unidade_idempotente(db):
+        salva = db.execute(consulta, (usuario_id, chave)).fetchone()
+        if salva:
+            return resposta_idempotente(salva, metodo, caminho)
+        status, corpo = unidade(db)
+        db.execute('''
+                   INSERT INTO chaves_idempotencia (usuario_id, chave, status, resposta, metodo, caminho)
+                   VALUES (?, ?, ?, ?, ?, ?)
+                   ''', (usuario_id, chave, status, json.dumps(corpo), metodo, caminho))
+        return status, corpo
+
+    try:
+        status, corpo = executar_escrita(unidade_idempotente)
+    except sqlite3.IntegrityError:
+        # Outra requisição com a mesma chave terminou primeiro: devolve a resposta que ela gravou.
+        salva = query_db(consulta, (usuario_id, chave), one=True)
+        if salva is None:
+            raise
+        status, corpo = resposta_idempotente(salva, metodo, caminho)
+    return jsonify(corpo), status
+
+
+def resumo_carrinho(db, carrinho_id):
+    """Retorna os itens e o total (em centavos) de um carrinho, com os preços atuais do catálogo."""
+    itens = db.execute('''
+                       SELECT r.codigo_produto AS codigo, r.tipo_roupa, COALESCE(v.cor, r.cor) AS cor, v.tamanho,
+                              ci.variante_id, ci.quantidade, r.preco_centavos,
+                              ci.quantidade * r.preco_centavos AS valor_total_centavos
+                       FROM carrinho_itens ci
+                                JOIN roupas r ON r.id = ci.roupa_id
+                                LEFT JOIN variantes v ON v.id = ci.variante_id
+                       WHERE ci.carrinho_id = ?
+                       ORDER BY r.codigo_produto, v.tamanho, v.cor
+                       ''', (carrinho_id,)).fetchall()
+    return {
+        'carrinho_id': carrinho_id,
+        'itens': [dict(item) for item in itens],
+        'total_centavos': sum(item['valor_total_centavos'] or 0 for item in itens),
+    }
+
+
+def carrinho_aberto(db, carrinho_id, usuario_id):
+    """Busca um carrinho do usuário que ainda não foi finalizado, ou levanta ErroApi."""
+    carrinho = db.execute('SELECT * FROM carrinhos WHERE id = ? AND usuario_id = ?',
+                          (carrinho_id, usuario_id)).fetchone()
+    if carrinho is None:
+        raise ErroApi(404, 'Carrinho não encontrado.')
+    if carrinho['finalizado_em']:
+        raise ErroApi(409, 'Carrinho já finalizado.')
+    return carrinho
+
+
+@app.route('/api/carrinhos', methods=['POST'])
+@login_required_api
+def api_abrir_carrinho():
+    """
+    API: Abre um carrinho para o cliente (cliente_id) e, opcionalmente, o vendedor (funcionario_id) e o local
+    da venda (local_id; padrão: o local padrão do usuário). Retorna 201 com o id do carrinho.
+    """
+    dados = request.get_json(silent=True) or {}
+    usuario_id = session['usuario_id']
+    cliente_id = dados.get('cliente_id')
+    funcionario_id = dados.get('funcionario_id')
+    funcionario_valido = funcionario_id is None or funcionario_ativo(usuario_id, funcionario_id)
+
+    def abrir(db):
+        if db.execute('SELECT 1 FROM clientes WHERE id = ? AND usuario_id = ?',
+                      (cliente_id, usuario_id)).fetchone() is None:
+            raise ErroApi(422, 'Cliente não encontrado.')
+        if not funcionario_valido:
+            raise ErroApi(422, 'Funcionário não encontrado ou inativo.')
+        try:
+            local = resolver_local(db, usuario_id, dados.get('local_id'))
+        except ValueError as e:
+            raise ErroApi(422, str(e))
+        cur = db.execute('INSERT INTO carrinhos (usuario_id, cliente_id, funcionario_id, local_id) VALUES (?, ?, ?, ?)',
+                         (usuario_id, cliente_id, funcionario_id, local['id']))
+        return 201, {'carrinho_id': cur.lastrowid, 'local_id': local['id'], 'itens': [], 'total_centavos': 0}
+
+    return executar_idempotente(abrir)
+
+
+@app.route('/api/carrinhos/<int:carrinho_id>', methods=['GET'])
+@login_required_api
+def api_ver_carrinho(carrinho_id):
+    """API: Retorna os itens e o total de um carrinho."""
+    db = get_db()
+    if db.execute('SELECT 1 FROM carrinhos WHERE id = ? AND usuario_id = ?',
+                  (carrinho_id, session['usuario_id'])).fetchone() is None:
+        raise ErroApi(404, 'Carrinho não encontrado.')
+    return jsonify(resumo_carrinho(db, carrinho_id))
+
+
+@app.route('/api/carrinhos/<int:carrinho_id>/itens', methods=['POST'])
+@login_required_api
+def api_adicionar_item(carrinho_id):
+    """
+    API: Adiciona um código lido (codigo) ao carrinho; leituras repetidas do mesmo código somam a quantidade.
+    Produtos com grade exigem o tamanho e a cor (tamanho, cor) quando houver mais de uma variante possível.
+    Retorna o carrinho atualizado.
+    """
+    dados = request.get_json(silent=True) or {}
+    usuario_id = session['usuario_id']
+    codigo = str(dados.get('codigo', '')).strip()
+    tamanho, cor = dados.get('tamanho'), dados.get('cor')
+    try:
+        quantidade = int(dados.get('quantidade', 1))
+    except (TypeError, ValueError):
+        raise ErroApi(422, 'A quantidade deve ser um número inteiro.')
+    if quantidade < 1:
+        raise ErroApi(422, 'A quantidade deve ser maior que zero.')
+
+    def adicionar(db):
+        carrinho = carrinho_aberto(db, carrinho_id, usuario_id)
+        roupa = db.execute('SELECT id, quantidade FROM roupas WHERE codigo_produto = ? AND usuario_id = ?',
+                           (codigo, usuario_id)).fetchone()
+        if roupa is None:
+            raise ErroApi(404, f"Produto '{codigo}' não encontrado.")
+        try:
+            variante = resolver_variante(db, roupa['id'], tamanho, cor)
+        except ValueError as e:
+            raise ErroApi(422, str(e))
+        variante_id = variante['id'] if variante else 0
+        # Carrinhos abertos antes do estoque por local não têm local: valem o total do produto.
+        if carrinho['local_id']:
+            disponivel = estoque_no_local(db, carrinho['local_id'], roupa['id'], variante_id)
+        else:
+            disponivel = variante['quantidade'] if variante else roupa['quantidade']
+        no_carrinho = db.execute('''
+                                 SELECT quantidade FROM carrinho_itens
+                                 WHERE carrinho_id = ? AND roupa_id = ? AND variante_id = ?
+                                 ''', (carrinho_id, roupa['id'], variante_id)).fetchone()
+        total_item = quantidade + (no_carrinho['quantidade'] if no_carrinho else 0)
+        if total_item > disponivel:
+            raise ErroApi(409, f"Estoque insuficiente para o produto {codigo} (disponível: {disponivel}).")
+        db.execute('''
+                   INSERT INTO carrinho_itens (carrinho_id, roupa_id, variante_id, quantidade)
+                   VALUES (?, ?, ?, ?)
+                   ON CONFLICT (carrinho_id, roupa_id, variante_id) DO UPDATE SET quantidade = quantidade + excluded.quantidade
+                   ''', (carrinho_id, roupa['id'], variante_id, quantidade))
+        return 200, resumo_carrinho(db, carrinho_id)
+
+    return executar_idempotente(adicionar)
+
+
+@app.route('/api/carrinhos/<int:carrinho_id>/itens/<codigo>', methods=['DELETE'])
+@login_required_api
+def api_remover_item(carrinho_id, codigo):
+    """
+    API: Remove um produto do carrinho; com ?tamanho= e/ou ?cor=, remove apenas essa variante da grade.
+    Retorna o carrinho atualizado.
+    """
+    usuario_id = session['usuario_id']
+    tamanho, cor = request.args.get('tamanho'), request.args.get('cor')
+
+    def remover(db):
+        carrinho_aberto(db, carrinho_id, usuario_id)
+        filtro_variante, args = '', []
+        roupa = db.execute('SELECT id FROM roupas WHERE codigo_produto = ? AND usuario_id = ?',
+                           (codigo, usuario_id)).fetchone()
+        if roupa and (tamanho or cor):
+            try:
+                variante = resolver_variante(db, roupa['id'], tamanho, cor)
+            except ValueError as e:
+                raise ErroApi(422, str(e))
+            if variante:
+                filtro_variante, args = 'AND variante_id = ?', [variante['id']]
+        db.execute(f'''
+                   DELETE FROM carrinho_itens
+                   WHERE carrinho_id = ?
+                     AND roupa_id IN (SELECT id FROM roupas WHERE codigo_produto = ? AND usuario_id = ?)
+                     {filtro_variante}
+                   ''', [carrinho_id, codigo, usuario_id, *args])
+        return 200, resumo_carrinho(db, carrinho_id)
+
+    return executar_idempotente(remover)
+
+
+@app.route('/api/carrinhos/<int:carrinho_id>/finalizar', methods=['POST'])
+@login_required_api
+def api_finalizar_carrinho(carrinho_id):
+    """
+    API: Finaliza o carrinho, registrando as vendas com os preços atuais do catálogo e baixando o estoque.
+    Retorna 201 com os ids das vendas criadas. Use o cabeçalho Idempotency-Key para repetir com segurança.
+    """
+    usuario_id = session['usuario_id']
+    # Vendas criadas por esta chamada (uma repetição idempotente não cria vendas nem publica eventos).
+    criadas = []
+
+    def finalizar(db):
+        carrinho = carrinho_aberto(db, carrinho_id, usuario_id)
+        resumo = resumo_carrinho(db, carrinho_id)
+        if not resumo['itens']:
+            raise ErroApi(422, 'O carrinho está vazio.')
+        itens = [{'codigo': item['codigo'], 'quantidade': item['quantidade'],
+                  'valor_total_centavos': item['valor_total_centavos'], 'variante_id': item['variante_id'] or None}
+                 for item in resumo['itens']]
+        try:
+            venda_ids = registrar_itens_venda(db, usuario_id, carrinho['cliente_id'], carrinho['funcionario_id'],
+                                              itens, carrinho['local_id'])
+        except ValueError as e:
+            raise ErroApi(409, str(e))
+        db.execute("UPDATE carrinhos SET finalizado_em = DATETIME('now', 'localtime') WHERE id = ?", (carrinho_id,))
+        criadas[:] = venda_ids
+        return 201, {'carrinho_id': carrinho_id, 'venda_ids': venda_ids,
+                     'total_centavos': resumo['total_centavos']}
+
+    resposta = executar_idempotente(finalizar)
+    publicar_vendas(usuario_id, criadas)
+    return resposta
+
+# --- Feed de Alterações (CDC) para Integrações ---
+
+# Tabelas acompanhadas pelo changelog (preenchido pelos gatilhos trg_changelog_*).
+TABELAS_CHANGELOG = ('roupas', 'variantes', 'vendas', 'clientes', 'funcionarios')
+
+# Quantidade máxima de alterações por página do feed.
+CHANGES_LIMITE_PADRAO = 1000
+CHANGES_LIMITE_MAXIMO = 10000
+
+
+def pausar_changelog(db, pausado=True):
+    """
+    Liga ou desliga o registro de alterações na transação corrente. Manutenções que movem linhas sem
+    alterá-las (arquivamento de vendas) pausam o changelog e o religam antes do commit, de modo que
+    nenhuma outra conexão enxerga a pausa.
+    """
+    db.execute('UPDATE changelog_controle SET pausado = ? WHERE id = 1', (1 if pausado else 0,))
+
+
+def registros_atuais(db, tabela, ids, usuario_id):
+    """Retorna {id: linha} com o conteúdo atual dos registros de uma tabela do usuário."""
+    placeholders = ','.join('?' * len(ids))
+    linhas = db.execute(f"SELECT * FROM {tabela} WHERE usuario_id = ? AND id IN ({placeholders})",
+                        [usuario_id, *ids]).fetchall()
+    encontrados = {linha['id']: linha for linha in linhas}
+    if tabela == 'vendas' and len(encontrados) < len(ids):
+        # Vendas já arquivadas continuam disponíveis para quem ainda não as sincronizou.
+        faltantes = [i for i in ids if i not in encontrados]
+        placeholders = ','.join('?' * len(faltantes))
+        linhas = linhas_arquivos_vendas(db, f"SELECT * FROM {{vendas}} WHERE usuario_id = ? AND id IN ({placeholders})",
+                                        [usuario_id, *faltantes], ids=faltantes)
+        encontrados.update((linha['id'], linha) for linha in linhas)
+    return encontrados
+
+
+def gerar_changes(caminho, alteracoes, usuario_id, tamanho_bloco=200):
+    """
+    Gera as linhas NDJSON do feed, buscando o conteúdo atual dos registros em blocos.
+    Usa uma conexão própria, pois a resposta continua sendo enviada depois que a requisição termina.
+    """
+    db = conectar(caminho)
+    try:
+        yield from _linhas_changes(db, alteracoes, usuario_id, tamanho_bloco)
+    finally:
+        db.close()
+
+
+def _linhas_changes(db, alteracoes, usuario_id, tamanho_bloco):
+    for inicio in range(0, len(alteracoes), tamanho_bloco):
+        bloco = alteracoes[inicio:inicio + tamanho_bloco]
+        conteudo = {}
+        for tabela in TABELAS_CHANGELOG:
+            ids = sorted({a['registro_id'] for a in bloco if a['tabela'] == tabela and a['operacao'] != 'delete'})
+            if ids:
+                conteudo[tabela] = registros_atuais(db, tabela, ids, usuario_id)
+        linhas = []
+        for alteracao in bloco:
+            registro = conteudo.get(alteracao['tabela'], {}).get(alteracao['registro_id'])
+            # Um registro excluído depois desta alteração aparece como exclusão em uma linha posterior do feed.
+            linhas.append(serializacao.dumps({
+                'seq': alteracao['seq'],
+                'tabela': alteracao['tabela'],
+                'id': alteracao['registro_id'],
+                'operacao': alteracao['operacao'],
+                'criado_em': alteracao['criado_em'],
+                'dados': registro,
+            }))
+        yield b'\n'.join(linhas) + b'\n'
+
+
+@app.route('/changes')
+@login_required
+def changes():
+    """
+    API: Feed de alterações em NDJSON (uma alteração por linha) posteriores a ?since=<seq>, em ordem.
+    Cada linha traz o conteúdo atual do registro ('dados'); inclusões e alterações devem ser tratadas
+    como upsert. Pagine repetindo a chamada com since igual ao cabeçalho X-Proximo-Since enquanto
+    X-Tem-Mais for 1. O tamanho da página é definido por ?limit= (padrão 1000).
+    """
+    usuario_id = session['usuario_id']
+    try:
+        since = int(request.args.get('since', 0))
+        limite = min(int(request.args.get('limit', CHANGES_LIMITE_PADRAO)), CHANGES_LIMITE_MAXIMO)
+    except ValueError:
+        return jsonify({'erro': 'Os parâmetros since e limit devem ser números inteiros.'}), 400
+
+    db = get_db()
+    alteracoes = db.execute('''
+                            SELECT seq, tabela, registro_id, operacao, criado_em FROM changelog
+                            WHERE usuario_id = ? AND seq > ?
+                            ORDER BY seq LIMIT ?
+                            ''', (usuario_id, since, limite + 1)).fetchall()
+    tem_mais = len(alteracoes) > limite
+    alteracoes = alteracoes[:limite]
+    proximo = alteracoes[-1]['seq'] if alteracoes else since
+
+    return Response(stream_with_context(gerar_changes(caminho_db_atual(), alteracoes, usuario_id)),
+                    mimetype='application/x-ndjson',
+                    headers={'X-Proximo-Since': str(proximo), 'X-Tem-Mais': '1' if tem_mais else '0'})
+
+
+def compactar_changelog(db, reter_exclusoes_dias=30):
+    """
+    Compacta o changelog: mantém apenas a alteração mais recente de cada registro (o feed sempre envia o
+    conteúdo atual) e remove as exclusões mais antigas que reter_exclusoes_dias. Retorna as linhas removidas.
+    """
+    removidas = db.execute('''
+                           DELETE FROM changelog
+                           WHERE seq < (SELECT MAX(c.seq) FROM changelog c
+                                        WHERE c.tabela = changelog.tabela AND c.registro_id = changelog.registro_id)
+                           ''').rowcount
+    if reter_exclusoes_dias is not None:
+        removidas += db.execute("DELETE FROM changelog WHERE operacao = 'delete' AND criado_em < DATETIME('now', 'localtime', ?)",
+                                (f"-{int(reter_exclusoes_dias)} days",)).rowcount
+    return removidas
+
+
+@app.cli.command('compactar-changelog')
+@click.option('--reter-exclusoes-dias', type=int, default=30, show_default=True,
+              help='Por quantos dias as exclusões continuam no feed.')
+def compactar_changelog_command(reter_exclusoes_dias):
+    """Remove do changelog as alterações substituídas por outras mais recentes: 'flask compactar-changelog'."""
+    for caminho in bancos_com_vendas():
+        preparar_banco(caminho)
+        db = conectar(caminho)
+        try:
+            removidas = compactar_changelog(db, reter_exclusoes_dias)
+            db.commit()
+        finally:
+            db.close()
+        print(f"{os.path.basename(caminho)}: {removidas} alteração(ões) removida(s) do changelog")
+
 
+# --- Cópia de Segurança por Usuário (Backup e Restauração) ---
 
-# --- Rotas do Painel de Compras e API ---
-@app.route('/painel_compras')
-@login_required
-def painel_compras():
-    """ Rota que exibe a interface principal para registrar novas compras/vendas."""
-    # Busca o nome do usuário logado para usar como vendedor padrão
-    usuario = query_db('SELECT nome FROM usuarios WHERE id = ?', [session['usuario_id']], one=True)
-    return render_template('painel_compras.html', usuario=usuario)
+def caminho_db_usuario(usuario_id):
+    """Arquivo de banco com os dados do usuário: o seu shard, com o sharding ativo, ou o banco principal."""
+    return caminho_shard(usuario_id) if app.config['SHARDING_ATIVO'] else DATABASE
 
-@app.route('/vender_roupa', methods=['POST'])
-@login_required
-def vender_roupa():
-    print('Ação de venda registrada, mas a lógica final está em "Finalizar Compra".', 'info')
-    return redirect(url_for('painel_compras'))
 
+def nome_arquivo_backup(usuario_id, formato):
+    """Nome padrão do arquivo de backup de um usuário (ex.: backup_usuario_1_20260115_093000.ndjson.gz)."""
+    return f"backup_usuario_{usuario_id}_{datetime.now():%Y%m%d_%H%M%S}" + ('.db' if formato == 'sqlite' else '.ndjson.gz')
 
-@app.route('/buscar_funcionarios')
-@login_required
-def buscar_funcionarios():
+
+@contextmanager
+def leitura_consistente(caminho):
     """
-    API: Busca funcionários ATIVOS para o autocompletar do painel de compras.
-    Funcionários com data_fim_contrato preenchida são considerados inativos.
+    Conexão para ler um instante consistente do banco do usuário: tabelas_usuario lê todas as tabelas em uma
+    única transação de leitura, que percorre só as linhas do usuário pelos índices de usuario_id. Os bancos
+    ficam em WAL (preparar_banco), então os commits seguem durante a leitura, que não os enxerga.
     """
-    termo = f"%{request.args.get('query', '')}%"
+    preparar_banco(caminho)
+    db = conectar(caminho)
+    try:
+        yield db
+    finally:
+        db.close()
 
-    # A query foi modificada para incluir a condição de funcionário ativo
-    query = """
-            SELECT id, nome_completo
-            FROM funcionarios
-            WHERE nome_completo LIKE ?
-              AND usuario_id = ?
-              AND (data_fim_contrato IS NULL OR data_fim_contrato = '')
-            ORDER BY nome_completo LIMIT 10 \
-            """
 
-    funcionarios_rows = query_db(query, (termo, session['usuario_id']))
-    return jsonify([dict(row) for row in funcionarios_rows])
+def cabecalho_backup(db, usuario_id):
+    """Cabeçalho do backup: usuário, versão do schema (PRAGMA user_version) e data de geração."""
+    return {'usuario_id': usuario_id, 'schema': db.execute('PRAGMA user_version').fetchone()[0],
+            'criado_em': datetime.now().isoformat(timespec='seconds')}
 
-@app.route('/buscar_clientes')
-@login_required
-def buscar_clientes():
-    termo = f"%{request.args.get('query', '')}%"
-    clientes_rows = query_db(
-        'SELECT id, nome FROM clientes WHERE nome LIKE ? AND usuario_id = ? ORDER BY nome LIMIT 10',
-        (termo, session['usuario_id']))
-    return jsonify([dict(row) for row in clientes_rows])
 
-@app.route('/buscar_produtos')
-@login_required
-def buscar_produtos():
+def tabelas_usuario(db, usuario_id):
     """
-    API: Busca produtos para o autocompletar do painel de compras,
-    filtrando para incluir apenas aqueles com quantidade em estoque maior que zero.
+    Gera (tabela, colunas, linhas) para cada tabela de TABELAS_TENANT, com as linhas do usuário em ordem de
+    chave primária, lidas do cursor conforme são consumidas. As vendas começam pelos anos do arquivo morto,
+    lidos um arquivo por vez, e seguem com as do banco. Todas as tabelas do banco são lidas na mesma
+    transação, isto é, no mesmo instante.
     """
-    termo = f"%{request.args.get('query', '')}%"
+    db.execute('BEGIN')
+    try:
+        for tabela in TABELAS_TENANT:
+            colunas = colunas_tabela(db, tabela)
+            cursor = db.cursor()
+            cursor.row_factory = None
+            cursor.execute(f"SELECT {', '.join(colunas)} FROM {tabela} WHERE usuario_id = ? "
+                           f"ORDER BY {backup.ordem_tabela(db, tabela)}", (usuario_id,))
+            if tabela == 'vendas':
+                arquivadas = linhas_arquivos_vendas(db, f"SELECT {', '.join(colunas)} FROM {{vendas}} "
+                                                        f"WHERE usuario_id = ? ORDER BY id", (usuario_id,))
+                yield tabela, colunas, itertools.chain(arquivadas, cursor)
+            else:
+                yield tabela, colunas, cursor
+    finally:
+        db.rollback()
 
-    query = """
-            SELECT id, codigo_produto
-            FROM roupas
-            WHERE codigo_produto LIKE ?
-              AND usuario_id = ?
-              AND quantidade > 0
-            ORDER BY codigo_produto LIMIT 10 \
-            """
 
-    produtos_rows = query_db(query, (termo, session['usuario_id']))
-    return jsonify([dict(row) for row in produtos_rows])
+def gerar_backup_ndjson(usuario_id, ao_terminar=None):
+    """
+    Gera os bytes (gzip) do backup NDJSON de todos os dados do usuário, à medida que as linhas são lidas.
+    Usa uma conexão própria, pois a resposta continua sendo enviada depois que a requisição termina.
+    """
+    with leitura_consistente(caminho_db_usuario(usuario_id)) as db:
+        linhas = backup.gerar_ndjson(cabecalho_backup(db, usuario_id), tabelas_usuario(db, usuario_id), ao_terminar)
+        yield from backup.compactar(linhas)
 
-@app.route('/buscar_detalhes_produto')
-@login_required
-def buscar_detalhes_produto():
-    codigo = request.args.get('codigo', '')
-    produto = query_db(
-        'SELECT codigo_produto, tipo_roupa, cor, detalhes FROM roupas WHERE codigo_produto = ? AND usuario_id = ?',
-        [codigo, session['usuario_id']], one=True)
-    return jsonify(dict(produto) if produto else None)
 
+def gravar_backup_sqlite(usuario_id, destino):
+    """Grava o backup do usuário em um arquivo SQLite independente. Retorna o resumo por tabela."""
+    with leitura_consistente(caminho_db_usuario(usuario_id)) as db:
+        return backup.escrever_sqlite(destino, ler_schema(), cabecalho_backup(db, usuario_id),
+                                      tabelas_usuario(db, usuario_id))
 
-@app.route('/buscar_produto_route')
-@login_required
-def buscar_produto_route():
-    codigo = request.args.get('codigo', '')
-    produto = query_db('SELECT * FROM roupas WHERE codigo_produto = ? AND usuario_id = ?',
-                       [codigo, session['usuario_id']], one=True)
-    return jsonify(dict(produto) if produto else None)
 
+def insercao_backup(db, tabela, colunas, usuario_id):
+    """
+    Retorna a função que insere um bloco de registros de uma tabela do backup, apenas com as colunas que
+    existem no banco (backups de schemas anteriores) e com o usuario_id do destino.
+    """
+    if tabela not in TABELAS_TENANT:
+        raise backup.BackupInvalido(f"Tabela inesperada no backup: {tabela}.")
+    existentes = set(colunas_tabela(db, tabela))
+    posicoes = [i for i, coluna in enumerate(colunas) if coluna in existentes]
+    posicao_usuario = colunas.index('usuario_id')
+    sql = (f"INSERT INTO {tabela} ({', '.join(colunas[i] for i in posicoes)}) "
+           f"VALUES ({', '.join('?' * len(posicoes))})")
 
-# --- Rotas do Fluxo de Finalização de Compra ---
-@app.route('/revisar_compra', methods=['POST'])
-@login_required
-def revisar_compra():
-    dados_carrinho_json = request.form.get('dados_carrinho')
-    if not dados_carrinho_json:
-        print('Nenhum dado de compra recebido.', 'danger')
-        return redirect(url_for('painel_compras'))
-    dados_compra = json.loads(dados_carrinho_json)
-    total_compra = sum(float(item['preco']) for item in dados_compra['itens'])
-    return render_template('revisar_compra.html', compra=dados_compra, total=total_compra,
-                           dados_carrinho_json=dados_carrinho_json)
+    def inserir(bloco):
+        db.executemany(sql, ([usuario_id if i == posicao_usuario else valores[i] for i in posicoes]
+                             for valores in bloco))
+    return inserir
 
 
-@app.route('/finalizar_compra', methods=['POST'])
-@login_required
-def finalizar_compra():
+def restaurar_backup_usuario(arquivo, usuario_id=None, substituir=False):
     """
-    Rota que processa a compra, atualizando o estoque e registrando a venda.
+    Restaura um backup (NDJSON compactado ou SQLite) no banco do usuário, em uma única transação: as somas de
+    verificação são conferidas durante a leitura, e o commit só acontece depois que o arquivo inteiro confere.
+    Os ids são preservados e os agregados, refeitos pelos gatilhos. usuario_id restaura os dados em outro
+    usuário (padrão: o do backup); se ele já tiver dados, substituir=True os remove na mesma transação.
+    Retorna (usuario_id, {tabela: registros restaurados}).
     """
-    dados_carrinho_json = request.form.get('dados_carrinho')
-    if not dados_carrinho_json:
-        print('Erro ao processar a compra. Tente novamente.', 'danger')
-        return redirect(url_for('painel_compras'))
+    eventos = backup.ler_backup(arquivo)
+    _tipo, cabecalho = next(eventos)
+    usuario_id = cabecalho['usuario_id'] if usuario_id is None else usuario_id
+    caminho = caminho_db_usuario(usuario_id)
+    preparar_banco(caminho)
+    db = conectar(caminho)
+    restaurados = {}
+    try:
+        versao = db.execute('PRAGMA user_version').fetchone()[0]
+        if cabecalho.get('schema', 0) > versao:
+            raise backup.BackupInvalido(f"O backup é do schema {cabecalho['schema']}, mais novo que o do banco ({versao}).")
+        # As vendas arquivadas ficam nos arquivos anuais, que a restauração não altera: seriam duplicadas.
+        arquivados = []
+        for ano, nome in arquivos_vendas_registrados(db):
+            with abrir_arquivo_vendas(ano, nome) as origem:
+                if origem.execute('SELECT 1 FROM vendas WHERE usuario_id = ? LIMIT 1', (usuario_id,)).fetchone():
+                    arquivados.append(ano)
+        if arquivados:
+            raise ValueError(f"O usuário {usuario_id} tem vendas no arquivo morto ({', '.join(map(str, arquivados))}); "
+                             f"devolva-as ao banco com 'flask restaurar-vendas' antes de restaurar o backup.")
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            com_dados = [tabela for tabela in TABELAS_TENANT
+                         if db.execute(f"SELECT 1 FROM {tabela} WHERE usuario_id = ? LIMIT 1", (usuario_id,)).fetchone()]
+            if com_dados and not substituir:
+                raise ValueError(f"O usuário {usuario_id} já tem dados ({', '.join(com_dados)}); "
+                                 f"use --substituir para trocá-los pelos do backup.")
+            # Os ids são preservados: enquanto o usuário de origem tiver dados neste banco, restaurá-los em outro
+            # usuário repetiria as chaves primárias.
+            origem = cabecalho['usuario_id']
+            if origem != usuario_id and any(
+                    db.execute(f"SELECT 1 FROM {tabela} WHERE usuario_id = ? LIMIT 1", (origem,)).fetchone()
+                    for tabela in TABELAS_TENANT):
+                raise ValueError(f"O usuário {origem} do backup ainda tem dados neste banco e os ids são preservados; "
+                                 f"restaure-o no banco de outro shard ou remova antes os dados do usuário {origem}.")
+            db.execute('DELETE FROM carrinho_itens WHERE carrinho_id IN (SELECT id FROM carrinhos WHERE usuario_id = ?)',
+                       (usuario_id,))
+            for tabela in TABELAS_TRABALHO_USUARIO:
+                db.execute(f"DELETE FROM {tabela} WHERE usuario_id = ?", (usuario_id,))
+            for tabela in reversed(com_dados):
+                db.execute(f"DELETE FROM {tabela} WHERE usuario_id = ?", (usuario_id,))
+            inserir, tabela = None, None
+            for tipo, dados in eventos:
+                if tipo == 'tabela':
+                    tabela = dados[0]
+                    inserir = insercao_backup(db, *dados, usuario_id)
+                elif tipo == 'linhas':
+                    try:
+                        inserir(dados)
+                    except sqlite3.IntegrityError as e:
+                        raise ValueError(f"Os ids de {tabela} do backup já existem neste banco ({e}); "
+                                         f"restaure-o no banco de outro shard.") from e
+                elif tipo == 'fim_tabela':
+                    restaurados[dados[0]] = dados[1]
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+    finally:
+        db.close()
+    for tipo in ('usuario', 'empresa', 'funcionario'):
+        invalidar_registros(tipo, usuario_id)
+    return usuario_id, restaurados
 
-    dados_compra = json.loads(dados_carrinho_json)
+
+@app.route('/backup')
+@login_required
+def exportar_backup():
+    """
+    Baixa a cópia de segurança de todos os dados do usuário logado. ?formato=ndjson (padrão) envia o NDJSON
+    compactado em fluxo, à medida que as linhas são lidas; ?formato=sqlite monta um arquivo SQLite independente
+    em um arquivo temporário e o envia em blocos, com o SHA-256 no cabeçalho X-Backup-SHA256.
+    """
     usuario_id = session['usuario_id']
-    db = get_db()
+    formato = request.args.get('formato', 'ndjson')
+    if formato not in ('ndjson', 'sqlite'):
+        return jsonify({'erro': "O formato deve ser 'ndjson' ou 'sqlite'."}), 400
+    nome = nome_arquivo_backup(usuario_id, formato)
+    if formato == 'ndjson':
+        return Response(gerar_backup_ndjson(usuario_id), mimetype='application/gzip',
+                        headers={'Content-Disposition': f"attachment;filename={nome}"})
+
+    pasta = tempfile.mkdtemp(prefix='backup_')
+    arquivo = os.path.join(pasta, nome)
     try:
-        # Primeiro, precisamos do ID do cliente
-        cliente = db.execute('SELECT id FROM clientes WHERE nome = ? AND usuario_id = ?',
-                             (dados_compra['cliente'], usuario_id)).fetchone()
-        if not cliente:
-            raise Exception(f"Cliente '{dados_compra['cliente']}' não encontrado.")
-        cliente_id = cliente['id']
+        gravar_backup_sqlite(usuario_id, arquivo)
+    except Exception:
+        shutil.rmtree(pasta, ignore_errors=True)
+        raise
+
+    def enviar():
+        try:
+            yield from backup.ler_em_blocos(arquivo)
+        finally:
+            shutil.rmtree(pasta, ignore_errors=True)
+
+    return Response(enviar(), mimetype='application/vnd.sqlite3', headers={
+        'Content-Disposition': f"attachment;filename={nome}",
+        'Content-Length': str(os.path.getsize(arquivo)),
+        'X-Backup-SHA256': backup.sha256_arquivo(arquivo),
+    })
+
+
+@app.cli.command('backup-usuario')
+@click.option('--usuario', 'usuario_id', type=int, required=True, help='Usuário (loja) a copiar.')
+@click.option('--saida', 'arquivo', default=None, help='Arquivo gerado. Padrão: backup_usuario_<id>_<data>.ndjson.gz (ou .db).')
+@click.option('--formato', type=click.Choice(['ndjson', 'sqlite']), default='ndjson', show_default=True)
+def backup_usuario_command(usuario_id, arquivo, formato):
+    """Copia todos os dados de um usuário para um arquivo: 'flask backup-usuario --usuario 1'."""
+    arquivo = arquivo or nome_arquivo_backup(usuario_id, formato)
+    if os.path.exists(arquivo):
+        print(f"O arquivo {arquivo} já existe.")
+        return
+    inicio = time.perf_counter()
+    if formato == 'sqlite':
+        resumo = gravar_backup_sqlite(usuario_id, arquivo)
+    else:
+        # O arquivo só recebe o nome definitivo depois de completo.
+        final, parcial = {}, arquivo + '.parcial'
+        try:
+            with open(parcial, 'wb') as saida:
+                for bloco in gerar_backup_ndjson(usuario_id, ao_terminar=final.update):
+                    saida.write(bloco)
+        except BaseException:
+            os.remove(parcial)
+            raise
+        os.replace(parcial, arquivo)
+        resumo = final['tabelas']
+    for tabela, dados in resumo.items():
+        print(f"{tabela:>20}: {dados['linhas']:>9} registro(s)  sha256 {dados['sha256']}")
+    print(f"Backup do usuário {usuario_id} gravado em {arquivo} ({os.path.getsize(arquivo) / 2 ** 20:.1f} MiB em "
+          f"{time.perf_counter() - inicio:.1f} s); sha256 do arquivo: {backup.sha256_arquivo(arquivo)}")
+
+
+@app.cli.command('restaurar-usuario')
+@click.argument('arquivo', type=click.Path(exists=True, dir_okay=False))
+@click.option('--usuario', 'usuario_id', type=int, default=None, help='Restaura em outro usuário (padrão: o do backup).')
+@click.option('--substituir', is_flag=True, help='Remove os dados atuais do usuário na mesma transação.')
+def restaurar_usuario_command(arquivo, usuario_id, substituir):
+    """Restaura um backup de usuário (NDJSON ou SQLite): 'flask restaurar-usuario backup.ndjson.gz'."""
+    try:
+        usuario_id, restaurados = restaurar_backup_usuario(arquivo, usuario_id, substituir)
+    except (backup.BackupInvalido, ValueError, sqlite3.Error) as e:
+        print(f"Nada foi restaurado: {e}")
+        sys.exit(1)
+    resumo = ', '.join(f"{tabela}={total}" for tabela, total in restaurados.items())
+    print(f"Usuário {usuario_id} restaurado em {caminho_db_usuario(usuario_id)}: {resumo}")
+
+
+@app.cli.command('verificar-backup')
+@click.argument('arquivo', type=click.Path(exists=True, dir_okay=False))
+def verificar_backup_command(arquivo):
+    """Confere as somas de verificação de um backup sem restaurá-lo: 'flask verificar-backup backup.ndjson.gz'."""
+    try:
+        cabecalho, quantidades = backup.verificar_backup(arquivo)
+    except backup.BackupInvalido as e:
+        print(f"Backup inválido: {e}")
+        sys.exit(1)
+    resumo = ', '.join(f"{tabela}={total}" for tabela, total in quantidades.items())
+    print(f"Backup do usuário {cabecalho['usuario_id']} (schema {cabecalho['schema']}, gerado em "
+          f"{cabecalho['criado_em']}) confere: {resumo}")
+
+
+# --- Atualizações em Tempo Real (Server-Sent Events) ---
+
+# Intervalo de reconexão sugerido ao navegador (ms) e espera sugerida (s) quando o limite de conexões é atingido.
+EVENTOS_RETRY_MS = 3000
+EVENTOS_RETRY_APOS = 30
+
+
+class LimiteConexoesEventos(Exception):
+    """O limite de conexões de eventos do usuário ou do processo foi atingido."""
 
-        # Busca o ID do funcionário (se houver)
-        vendedor_nome = dados_compra.get('vendedor')
-        funcionario_id = None
-        if vendedor_nome and vendedor_nome != 'Nenhum' and vendedor_nome != \
-                query_db('SELECT nome FROM usuarios WHERE id = ?', [usuario_id], one=True)['nome']:
-            funcionario = db.execute('SELECT id FROM funcionarios WHERE nome_completo = ? AND usuario_id = ?',
-                                     (vendedor_nome, usuario_id)).fetchone()
-            if funcionario:
-                funcionario_id = funcionario['id']
-
-        # Itera sobre cada item do carrinho
-        for item in dados_compra['itens']:
-            roupa = db.execute('SELECT id FROM roupas WHERE codigo_produto = ? AND usuario_id = ?',
-                               (item['codigo'], usuario_id)).fetchone()
-            if not roupa:
+
+class AssinaturaEventos:
+    """Uma conexão SSE aberta: fila limitada com os eventos do usuário ainda não enviados."""
+
+    def __init__(self, usuario_id, tamanho_fila):
+        self.usuario_id = usuario_id
+        self.fila = queue.Queue(maxsize=tamanho_fila)
+
+
+class CanalEventos:
+    """
+    Publicação/assinatura em memória dos eventos de cada usuário (tenant) deste processo.
+
+    publicar() nunca bloqueia quem escreve: se a fila de uma conexão lenta enche, os eventos pendentes dela
+    são trocados por um único 'resync', que faz o cliente recarregar o estado. Os últimos eventos de cada
+    usuário ficam guardados, para que o navegador que reconecta com Last-Event-ID receba os que perdeu.
+    """
+
+    def __init__(self, max_conexoes, max_por_usuario, tamanho_fila=256, tamanho_historico=200,
+                 max_usuarios_historico=1000):
+        self.max_conexoes = max_conexoes
+        self.max_por_usuario = max_por_usuario
+        self.tamanho_fila = tamanho_fila
+        self.tamanho_historico = tamanho_historico
+        self.max_usuarios_historico = max_usuarios_historico
+        # Os ids dos eventos levam um prefixo do processo: um Last-Event-ID de outro processo, ou de antes de um
+        # reinício, não é confundido com um evento deste.
+        self.epoca = uuid.uuid4().hex[:8]
+        self._seq = 0
+        self._assinaturas = {}
+        # usuario_id -> [eventos recentes, seq do último evento que não está no histórico]
+        self._historico = OrderedDict()
+        self._lock = threading.Lock()
+        self._contadores = {'publicados': 0, 'entregues': 0, 'resyncs': 0, 'recusadas': 0}
+
+    def assinar(self, usuario_id):
+        """Abre uma assinatura ou levanta LimiteConexoesEventos."""
+        with self._lock:
+            abertas = sum(len(assinaturas) for assinaturas in self._assinaturas.values())
+            do_usuario = self._assinaturas.get(usuario_id, set())
+            if abertas >= self.max_conexoes or len(do_usuario) >= self.max_por_usuario:
+                self._contadores['recusadas'] += 1
+                raise LimiteConexoesEventos('Limite de conexões de atualização em tempo real atingido.')
+            assinatura = AssinaturaEventos(usuario_id, self.tamanho_fila)
+            self._assinaturas.setdefault(usuario_id, set()).add(assinatura)
+            self._historico_usuario(usuario_id)
+            return assinatura
+
+    def cancelar(self, assinatura):
+        """Encerra a assinatura (pode ser chamado mais de uma vez)."""
+        with self._lock:
+            do_usuario = self._assinaturas.get(assinatura.usuario_id)
+            if do_usuario is not None:
+                do_usuario.discard(assinatura)
+                if not do_usuario:
+                    del self._assinaturas[assinatura.usuario_id]
+
+    def interessado(self, usuario_id):
+        """
+        Indica se vale publicar eventos do usuário: ele tem conexões abertas ou teve há pouco (o histórico é
+        mantido para a reconexão). Permite pular as consultas dos eventos de quem não está ouvindo.
+        """
+        return usuario_id in self._historico
+
+    def _historico_usuario(self, usuario_id):
+        historico = self._historico.get(usuario_id)
+        if historico is None:
+            # Os eventos publicados antes da criação do histórico não podem ser recuperados.
+            historico = self._historico[usuario_id] = [deque(maxlen=self.tamanho_historico), self._seq]
+            while len(self._historico) > self.max_usuarios_historico:
+                self._historico.popitem(last=False)
+        self._historico.move_to_end(usuario_id)
+        return historico
+
+    def _resync(self, assinatura):
+        """Troca os eventos pendentes de uma conexão lenta por um pedido de recarga do estado."""
+        while True:
+            try:
+                assinatura.fila.get_nowait()
+            except queue.Empty:
+                break
+        assinatura.fila.put_nowait((self._seq, 'resync', b'{}'))
+        self._contadores['resyncs'] += 1
+
+    def publicar(self, usuario_id, tipo, dados):
+        """Envia o evento às conexões abertas do usuário e o guarda no histórico. Retorna o id do evento."""
+        with self._lock:
+            if usuario_id not in self._historico:
+                return None
+            self._seq += 1
+            evento = (self._seq, tipo, serializacao.dumps(dados))
+            eventos, _descartado = historico = self._historico_usuario(usuario_id)
+            if len(eventos) == eventos.maxlen:
+                historico[1] = eventos[0][0]
+            eventos.append(evento)
+            self._contadores['publicados'] += 1
+            # As filas são alimentadas sob o lock, para que cada conexão receba os eventos na ordem dos ids.
+            for assinatura in self._assinaturas.get(usuario_id, ()):
+                try:
+                    assinatura.fila.put_nowait(evento)
+                    self._contadores['entregues'] += 1
+                except queue.Full:
+                    self._resync(assinatura)
+            return f"{self.epoca}-{self._seq}"
+
+    def eventos_desde(self, usuario_id, ultimo_id):
+        """
+        Eventos do usuário posteriores a ultimo_id ('época-seq'), ou None quando não é possível saber quais
+        foram perdidos (id de outro processo ou eventos que já saíram do histórico).
+        """
+        epoca, _separador, seq = (ultimo_id or '').partition('-')
+        if epoca != self.epoca or not seq.isdigit():
+            return None
+        seq = int(seq)
+        with self._lock:
+            historico = self._historico.get(usuario_id)
+            if historico is None or historico[1] > seq:
+                return None
+            return [evento for evento in historico[0] if evento[0] > seq]
+
+    def evento_resync(self):
+        with self._lock:
+            return self._seq, 'resync', b'{}'
+
+    def formatar(self, evento):
+        """Serializa o evento (seq, tipo, dados JSON) no formato text/event-stream."""
+        seq, tipo, dados = evento
+        return b'id: %s-%d\nevent: %s\ndata: %s\n\n' % (self.epoca.encode(), seq, tipo.encode(), dados)
+
+    def estatisticas(self):
+        with self._lock:
+            por_usuario = {usuario_id: len(assinaturas) for usuario_id, assinaturas in self._assinaturas.items()}
+            return {'conexoes': sum(por_usuario.values()), 'max_conexoes': self.max_conexoes,
+                    'max_por_usuario': self.max_por_usuario, 'conexoes_por_usuario': por_usuario,
+                    'usuarios_com_historico': len(self._historico), **self._contadores}
+
+
+_canal_eventos = CanalEventos(app.config['EVENTOS_MAX_CONEXOES'], app.config['EVENTOS_MAX_POR_USUARIO'])
+
+
+def gerar_eventos(canal, assinatura, ultimo_id, heartbeat, duracao):
+    """
+    Gera o fluxo text/event-stream de uma assinatura: primeiro os eventos perdidos desde ultimo_id (ou um
+    'resync', se não for possível recuperá-los), depois os novos eventos, com um comentário de heartbeat a
+    cada 'heartbeat' segundos sem eventos. Não usa o contexto da requisição; termina após 'duracao' segundos.
+    """
+    try:
+        yield b'retry: %d\n\n' % EVENTOS_RETRY_MS
+        enviado = 0
+        if ultimo_id:
+            perdidos = canal.eventos_desde(assinatura.usuario_id, ultimo_id)
+            for evento in perdidos if perdidos is not None else [canal.evento_resync()]:
+                enviado = evento[0]
+                yield canal.formatar(evento)
+        fim = time.monotonic() + duracao
+        while True:
+            restante = fim - time.monotonic()
+            if restante <= 0:
+                return
+            try:
+                evento = assinatura.fila.get(timeout=min(heartbeat, restante))
+            except queue.Empty:
+                # Além de manter proxies e a conexão abertos, a escrita falha quando o cliente já saiu.
+                yield b': heartbeat\n\n'
                 continue
+            # Eventos já enviados na recuperação também podem estar na fila.
+            if evento[0] > enviado:
+                enviado = evento[0]
+                yield canal.formatar(evento)
+    finally:
+        canal.cancelar(assinatura)
 
-            roupa_id = roupa['id']
 
-            # 1. Insere o registro na nova tabela 'vendas'
-            db.execute('''
-                       INSERT INTO vendas (usuario_id, cliente_id, roupa_id, funcionario_id, quantidade_vendida,
-                                           valor_total_venda, data_venda)
-                       VALUES (?, ?, ?, ?, ?, ?, DATE ('now', 'localtime'))
-                       ''', (usuario_id, cliente_id, roupa_id, funcionario_id, int(item['quantidade']),
-                             float(item['preco'])))
+def publicar_estoque(usuario_id, roupa_ids):
+    """
+    Publica o estoque atual (produto e grade) dos produtos às conexões do usuário. Deve ser chamada após a
+    confirmação da escrita; os eventos trazem valores absolutos, então repetir ou reordenar não gera erro.
+    """
+    if not roupa_ids or not _canal_eventos.interessado(usuario_id):
+        return
+    try:
+        db = get_db()
+        produtos = db.execute('''
+                              SELECT id, codigo_produto, tipo_roupa, cor, detalhes, preco_centavos, quantidade
+                              FROM roupas
+                              WHERE usuario_id = ? AND id IN (SELECT value FROM json_each(?))
+                              ''', (usuario_id, json.dumps(sorted(set(roupa_ids))))).fetchall()
+        for produto in produtos:
+            # Estoque em cada local ({local_id: quantidade}) do produto e de cada variante.
+            por_local = {}
+            for linha in db.execute('SELECT variante_id, local_id, quantidade FROM estoque_local WHERE roupa_id = ?',
+                                    (produto['id'],)).fetchall():
+                por_local.setdefault(linha['variante_id'], {})[linha['local_id']] = linha['quantidade']
+            locais_produto = {}
+            for quantidades in por_local.values():
+                for local_id, quantidade in quantidades.items():
+                    locais_produto[local_id] = locais_produto.get(local_id, 0) + quantidade
+            _canal_eventos.publicar(usuario_id, 'estoque', {
+                **{chave: produto[chave] for chave in produto.keys() if chave != 'id'},
+                'locais': locais_produto,
+                'variantes': [dict(variante, locais=por_local.get(variante['id'], {}))
+                              for variante in variantes_produto(db, produto['id'])],
+            })
+    except sqlite3.Error as e:
+        print(f"Erro ao publicar o estoque em tempo real: {e}")
 
-            # 2. Atualiza o estoque e a contagem total de vendas na tabela 'roupas'
-            db.execute('''
-                       UPDATE roupas
-                       SET quantidade      = quantidade - ?,
-                           quantida_vendas = COALESCE(quantida_vendas, 0) + ?
-                       WHERE id = ?
-                         AND usuario_id = ?
-                       ''', (int(item['quantidade']), int(item['quantidade']), roupa_id, usuario_id))
 
-        db.commit()
-        print('Compra finalizada com sucesso!', 'success')
-        return redirect(url_for('dashboard'))
+def publicar_vendas(usuario_id, venda_ids):
+    """Publica o estoque dos produtos vendidos e o evento 'venda', com o total da compra e o total do dia."""
+    if not venda_ids or not _canal_eventos.interessado(usuario_id):
+        return
+    try:
+        db = get_db()
+        vendas = db.execute('''
+                            SELECT roupa_id, valor_total_centavos FROM vendas
+                            WHERE usuario_id = ? AND id IN (SELECT value FROM json_each(?))
+                            ''', (usuario_id, json.dumps(list(venda_ids)))).fetchall()
+        if not vendas:  # A escrita foi desfeita (ex.: repetição idempotente concorrente).
+            return
+        publicar_estoque(usuario_id, [venda['roupa_id'] for venda in vendas])
+        dia = db.execute('''
+                         SELECT COUNT(*) AS vendas, COALESCE(SUM(valor_total_centavos), 0) AS total_centavos
+                         FROM vendas
+                         WHERE usuario_id = ? AND data_venda = DATE('now', 'localtime')
+                         ''', (usuario_id,)).fetchone()
+        _canal_eventos.publicar(usuario_id, 'venda', {
+            'venda_ids': list(venda_ids),
+            'total_centavos': sum(venda['valor_total_centavos'] or 0 for venda in vendas),
+            'vendas_dia': dia['vendas'],
+            'total_dia_centavos': dia['total_centavos'],
+        })
+    except sqlite3.Error as e:
+        print(f"Erro ao publicar a venda em tempo real: {e}")
+
+
+@app.route('/eventos')
+@login_required
+def eventos():
+    """
+    Fluxo SSE (text/event-stream) com as atualizações do usuário logado: 'estoque' (quantidade do produto e
+    da grade após uma venda ou edição), 'venda' (total da compra e do dia) e 'resync' (o cliente deve recarregar
+    o estado). Ao reconectar, o navegador envia Last-Event-ID e recebe os eventos perdidos. Acima do limite
+    de conexões responde 503 com Retry-After.
+    """
+    usuario_id = session['usuario_id']
+    try:
+        assinatura = _canal_eventos.assinar(usuario_id)
+    except LimiteConexoesEventos as e:
+        return jsonify({'erro': str(e)}), 503, {'Retry-After': str(EVENTOS_RETRY_APOS)}
+
+    ultimo_id = request.headers.get('Last-Event-ID') or request.args.get('ultimo_id')
+    resposta = Response(gerar_eventos(_canal_eventos, assinatura, ultimo_id, app.config['EVENTOS_HEARTBEAT'],
+                                      app.config['EVENTOS_DURACAO_MAXIMA']),
+                        mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    # Se o fluxo nunca chegar a ser iterado, a assinatura é encerrada quando o servidor fecha a resposta.
+    resposta.call_on_close(lambda: _canal_eventos.cancelar(assinatura))
+    return resposta
 
-    except Exception as e:
-        db.rollback()
-        print(f'Ocorreu um erro ao finalizar a compra: {e}', 'danger')
-        return redirect(url_for('painel_compras'))
 
 # --- Rotas de Métricas e Gráficos ---
 @app.route('/metrica')
@@ -825,6 +5495,245 @@ def metrica_funcionarios():
 def metrica_clientes():
     return render_template('metrica_clientes.html')
 
+# --- API de Métricas de Vendas (Séries Temporais) ---
+
+# Granularidades: expressão SQL do início do período que contém a data {data} e o passo entre dois períodos.
+GRANULARIDADES_METRICAS = {
+    'dia': ('{data}', 1, 'days'),
+    'semana': ("DATE({data}, 'weekday 0', '-6 days')", 7, 'days'),
+    'mes': ("STRFTIME('%Y-%m-01', {data})", 1, 'months'),
+    'trimestre': ("PRINTF('%s-%02d-01', STRFTIME('%Y', {data}), "
+                  "(CAST(STRFTIME('%m', {data}) AS INTEGER) - 1) / 3 * 3 + 1)", 3, 'months'),
+    'ano': ("STRFTIME('%Y-01-01', {data})", 1, 'years'),
+}
+# Períodos em um ano, para a comparação com o ano anterior. Dias e semanas voltam 364 dias (52 semanas),
+# para comparar o mesmo dia da semana.
+PERIODOS_ANO = {'dia': 364, 'semana': 52, 'mes': 12, 'trimestre': 4, 'ano': 1}
+# Menor número de dias de um período, para limitar o tamanho da série antes de consultá-la.
+DIAS_MINIMOS_PERIODO = {'dia': 1, 'semana': 7, 'mes': 28, 'trimestre': 89, 'ano': 365}
+COMPARACOES_METRICAS = ('periodo_anterior', 'ano_anterior')
+METRICAS_MAX_PERIODOS = 1000
+METRICAS_LIMITE_PADRAO = 10
+METRICAS_LIMITE_MAXIMO = 100
+
+# Dimensões: buckets diários (data_venda, chave, vendas, itens, total_centavos) do usuário no intervalo
+# [:inicio_dados, :fim] e o rótulo de cada chave (b.chave). 'local' lê o agregado por local.
+DIMENSOES_METRICAS = {
+    'total': ("""SELECT data_venda, chave, vendas, itens, total_centavos FROM vendas_diarias
+                 WHERE usuario_id = :usuario_id AND dimensao = 'total'
+                   AND data_venda BETWEEN :inicio_dados AND :fim""", "'Total'"),
+    'tipo_roupa': ("""SELECT d.data_venda, COALESCE(r.tipo_roupa, 'Produto removido') AS chave, d.vendas, d.itens,
+                             d.total_centavos
+                      FROM vendas_diarias d LEFT JOIN roupas r ON r.id = d.chave
+                      WHERE d.usuario_id = :usuario_id AND d.dimensao = 'roupa'
+                        AND d.data_venda BETWEEN :inicio_dados AND :fim""", 'b.chave'),
+    'produto': ("""SELECT data_venda, chave, vendas, itens, total_centavos FROM vendas_diarias
+                   WHERE usuario_id = :usuario_id AND dimensao = 'roupa'
+                     AND data_venda BETWEEN :inicio_dados AND :fim""",
+                "COALESCE((SELECT codigo_produto || ' - ' || tipo_roupa FROM roupas WHERE id = b.chave), "
+                "'Produto removido')"),
+    'funcionario': ("""SELECT data_venda, chave, vendas, itens, total_centavos FROM vendas_diarias
+                       WHERE usuario_id = :usuario_id AND dimensao = 'funcionario'
+                         AND data_venda BETWEEN :inicio_dados AND :fim""",
+                    "COALESCE((SELECT nome_completo FROM funcionarios WHERE id = b.chave), 'Sem funcionário')"),
+    'cliente': ("""SELECT data_venda, chave, vendas, itens, total_centavos FROM vendas_diarias
+                   WHERE usuario_id = :usuario_id AND dimensao = 'cliente'
+                     AND data_venda BETWEEN :inicio_dados AND :fim""",
+                "COALESCE((SELECT nome FROM clientes WHERE id = b.chave), 'Sem cliente')"),
+    'local': ("""SELECT data_venda, local_id AS chave, vendas, itens, total_centavos FROM vendas_local_dia
+                 WHERE usuario_id = :usuario_id AND data_venda BETWEEN :inicio_dados AND :fim""",
+              "(SELECT nome FROM locais WHERE id = b.chave)"),
+}
+
+
+def consultar_metricas(db, usuario_id, inicio, fim, granularidade='mes', dimensao='total', comparar=None,
+                       limite=METRICAS_LIMITE_PADRAO):
+    """
+    Série de vendas, itens e total (centavos) por período de [inicio, fim], lida de vendas_diarias (ou de
+    vendas_local_dia), com uma série por chave da dimensão (as 'limite' de maior total no intervalo).
+    A série é densa (períodos sem vendas valem 0) e começa no início do período que contém 'inicio'; o último
+    período vai até 'fim'. Com comparar ('periodo_anterior' ou 'ano_anterior'), cada período traz o total do
+    período de comparação (LAG sobre a série) e a variação.
+    """
+    expressao, passo, unidade = GRANULARIDADES_METRICAS[granularidade]
+    fonte, rotulo = DIMENSOES_METRICAS[dimensao]
+    deslocamento = {'periodo_anterior': 1, 'ano_anterior': PERIODOS_ANO[granularidade]}.get(comparar, 0)
+    parametros = {'usuario_id': usuario_id, 'inicio': inicio, 'fim': fim, 'limite': limite,
+                  'passo': f"+{passo} {unidade}", 'recuo': f"-{passo * deslocamento} {unidade}"}
+    # Os períodos são inteiros: a série começa no início do período que contém 'inicio' (recuado para a comparação).
+    parametros['inicio_dados'] = db.execute(f"SELECT DATE({expressao.format(data=':inicio')}, :recuo)",
+                                            parametros).fetchone()[0]
+    if dimensao == 'total':
+        chaves = "SELECT 0 AS chave, 'Total' AS rotulo, 0 AS total"
+    else:
+        chaves = f"""SELECT b.chave, {rotulo} AS rotulo, SUM(b.total_centavos) AS total
+                     FROM buckets b
+                     WHERE b.periodo >= (SELECT inicio_periodo FROM limites)
+                     GROUP BY b.chave
+                     ORDER BY total DESC, b.chave
+                     LIMIT :limite"""
+    comparacao = (f"LAG(COALESCE(b.total_centavos, 0), {deslocamento}) OVER (PARTITION BY c.chave ORDER BY p.periodo)"
+                  if deslocamento else 'NULL')
+    linhas = db.execute(f"""
+        WITH RECURSIVE
+            limites(inicio_periodo, inicio_serie) AS (
+                SELECT {expressao.format(data=':inicio')}, :inicio_dados
+            ),
+            periodos(periodo) AS (
+                SELECT inicio_serie FROM limites
+                UNION ALL
+                SELECT DATE(periodo, :passo) FROM periodos WHERE DATE(periodo, :passo) <= :fim
+            ),
+            buckets AS (
+                SELECT {expressao.format(data='f.data_venda')} AS periodo, f.chave, SUM(f.vendas) AS vendas,
+                       SUM(f.itens) AS itens, SUM(f.total_centavos) AS total_centavos
+                FROM ({fonte}) f
+                GROUP BY 1, 2
+            ),
+            chaves AS ({chaves}),
+            serie AS (
+                SELECT p.periodo, c.chave, c.rotulo, c.total, COALESCE(b.vendas, 0) AS vendas,
+                       COALESCE(b.itens, 0) AS itens, COALESCE(b.total_centavos, 0) AS total_centavos,
+                       {comparacao} AS comparacao_centavos
+                FROM periodos p
+                         CROSS JOIN chaves c
+                         LEFT JOIN buckets b ON b.periodo = p.periodo AND b.chave = c.chave
+            )
+        SELECT p.periodo, s.chave, s.rotulo, s.vendas, s.itens, s.total_centavos, s.comparacao_centavos
+        FROM periodos p
+                 LEFT JOIN serie s ON s.periodo = p.periodo
+        WHERE p.periodo >= (SELECT inicio_periodo FROM limites)
+        ORDER BY s.total DESC, s.chave, p.periodo
+        """, parametros).fetchall()
+
+    series = OrderedDict()
+    for periodo, chave, rotulo_chave, vendas, itens, total_centavos, comparacao_centavos in linhas:
+        if chave is None:
+            continue
+        serie = series.get(chave)
+        if serie is None:
+            serie = series[chave] = {'chave': chave, 'rotulo': rotulo_chave,
+                                     'valores': {'vendas': [], 'itens': [], 'total_centavos': []}}
+            if comparar:
+                serie['valores'].update(comparacao_centavos=[], variacao=[])
+        valores = serie['valores']
+        valores['vendas'].append(vendas)
+        valores['itens'].append(itens)
+        valores['total_centavos'].append(total_centavos)
+        if comparar:
+            valores['comparacao_centavos'].append(comparacao_centavos)
+            valores['variacao'].append(round((total_centavos - comparacao_centavos) / comparacao_centavos, 4)
+                                       if comparacao_centavos else None)
+    for serie in series.values():
+        valores = serie['valores']
+        serie.update(vendas=sum(valores['vendas']), itens=sum(valores['itens']),
+                     total_centavos=sum(valores['total_centavos']))
+        if comparar:
+            serie['comparacao_centavos'] = sum(valores['comparacao_centavos'])
+            serie['variacao'] = (round((serie['total_centavos'] - serie['comparacao_centavos'])
+                                       / serie['comparacao_centavos'], 4) if serie['comparacao_centavos'] else None)
+    return {'inicio': inicio, 'fim': fim, 'granularidade': granularidade, 'dimensao': dimensao,
+            'comparar': comparar, 'periodos': sorted({linha[0] for linha in linhas}),
+            'series': list(series.values())}
+
+
+@app.route('/metricas_vendas')
+@login_required
+def api_metricas_vendas():
+    """
+    API: Série temporal de vendas do período ?inicio=&fim= (datas ISO; padrão: os últimos 12 meses), por
+    ?granularidade= (dia, semana, mes, trimestre ou ano; padrão: mes), opcionalmente aberta por ?dimensao=
+    (tipo_roupa, produto, funcionario, cliente ou local; até ?limite= séries) e comparada com
+    ?comparar=periodo_anterior ou ano_anterior. Calculada a partir das vendas diárias pré-agregadas.
+    """
+    hoje = datetime.now()
+    mes, ano = hoje.month - 11, hoje.year
+    if mes <= 0:
+        mes, ano = mes + 12, ano - 1
+    granularidade = request.args.get('granularidade', 'mes')
+    dimensao = request.args.get('dimensao') or 'total'
+    comparar = request.args.get('comparar') or None
+    limite = request.args.get('limite', METRICAS_LIMITE_PADRAO, type=int)
+    try:
+        inicio = data_iso(request.args.get('inicio') or f"{ano:04d}-{mes:02d}-01")
+        fim = data_iso(request.args.get('fim') or hoje.strftime('%Y-%m-%d'))
+        dias = (datetime.strptime(fim, '%Y-%m-%d') - datetime.strptime(inicio, '%Y-%m-%d')).days
+    except ValueError:
+        return jsonify({'erro': 'As datas devem estar no formato AAAA-MM-DD.'}), 400
+    if dias < 0:
+        return jsonify({'erro': 'A data inicial deve ser anterior à final.'}), 400
+    if granularidade not in GRANULARIDADES_METRICAS:
+        return jsonify({'erro': f"Granularidade inválida. Use: {', '.join(GRANULARIDADES_METRICAS)}."}), 400
+    if dimensao not in DIMENSOES_METRICAS:
+        return jsonify({'erro': f"Dimensão inválida. Use: {', '.join(DIMENSOES_METRICAS)}."}), 400
+    if comparar is not None and comparar not in COMPARACOES_METRICAS:
+        return jsonify({'erro': f"Comparação inválida. Use: {', '.join(COMPARACOES_METRICAS)}."}), 400
+    if not 1 <= limite <= METRICAS_LIMITE_MAXIMO:
+        return jsonify({'erro': f"O limite deve estar entre 1 e {METRICAS_LIMITE_MAXIMO}."}), 400
+    if dias // DIAS_MINIMOS_PERIODO[granularidade] + 1 > METRICAS_MAX_PERIODOS:
+        return jsonify({'erro': f"Período longo demais para a granularidade '{granularidade}' "
+                                f"(máximo de {METRICAS_MAX_PERIODOS} períodos)."}), 400
+    dados = consultar_metricas(get_db_relatorio(), session['usuario_id'], inicio, fim, granularidade, dimensao,
+                               comparar, limite)
+    dados['atualizado_em'] = frescor_relatorio()
+    return jsonify(dados)
+
+
+# Chave de cada dimensão de vendas_diarias, calculada sobre as colunas de vendas.
+CHAVES_VENDAS_DIARIAS = (('total', '0'), ('roupa', 'roupa_id'), ('funcionario', 'COALESCE(funcionario_id, 0)'),
+                         ('cliente', 'COALESCE(cliente_id, 0)'))
+
+
+def somar_arquivos_vendas_diarias(db):
+    """Soma a vendas_diarias as vendas dos anos arquivados, um arquivo por vez."""
+    for dimensao, chave in CHAVES_VENDAS_DIARIAS:
+        db.executemany('''
+                       INSERT INTO vendas_diarias (usuario_id, dimensao, data_venda, chave, vendas, itens,
+                                                   total_centavos)
+                       VALUES (?, ?, ?, ?, ?, ?, ?)
+                       ON CONFLICT (usuario_id, dimensao, data_venda, chave) DO UPDATE SET
+                           vendas = vendas + excluded.vendas, itens = itens + excluded.itens,
+                           total_centavos = total_centavos + excluded.total_centavos
+                       ''', linhas_arquivos_vendas(db, f"""
+                                                    SELECT usuario_id, '{dimensao}', data_venda, {chave} AS chave,
+                                                           COUNT(*), SUM(quantidade_vendida), SUM(valor_total_centavos)
+                                                    FROM {{vendas}}
+                                                    GROUP BY usuario_id, data_venda, chave
+                                                    """))
+
+
+def reconstruir_vendas_diarias(caminho):
+    """Recalcula vendas_diarias de um banco a partir de todas as vendas, inclusive as arquivadas."""
+    preparar_banco(caminho)
+    db = conectar(caminho)
+    try:
+        db.execute('BEGIN IMMEDIATE')
+        db.execute('DELETE FROM vendas_diarias')
+        for dimensao, chave in CHAVES_VENDAS_DIARIAS:
+            db.execute(f"""
+                       INSERT INTO vendas_diarias (usuario_id, dimensao, data_venda, chave, vendas, itens,
+                                                   total_centavos)
+                       SELECT usuario_id, '{dimensao}', data_venda, {chave} AS chave, COUNT(*),
+                              SUM(quantidade_vendida), SUM(valor_total_centavos)
+                       FROM vendas
+                       GROUP BY usuario_id, data_venda, chave
+                       """)
+        somar_arquivos_vendas_diarias(db)
+        db.commit()
+        return db.execute('SELECT COUNT(*) FROM vendas_diarias').fetchone()[0]
+    finally:
+        db.close()
+
+
+@app.cli.command('reconstruir-vendas-diarias')
+def reconstruir_vendas_diarias_command():
+    """Recalcula as vendas diárias pré-agregadas da API de métricas: 'flask reconstruir-vendas-diarias'."""
+    for caminho in bancos_com_vendas():
+        t0 = time.perf_counter()
+        linhas = reconstruir_vendas_diarias(caminho)
+        print(f"{os.path.basename(caminho)}: {linhas} linha(s) de vendas diárias em {time.perf_counter() - t0:.2f} s")
+
+
 @app.route('/dados_dashboard_metricas')
 @login_required
 def dados_dashboard_metricas():
@@ -834,42 +5743,24 @@ def dados_dashboard_metricas():
     usuario_id = session['usuario_id']
 
     # --- 1. Dados de Vendas Mensais (Gráfico de Barras) ---
-    meses_template = OrderedDict()
+    # Os 12 últimos meses, incluindo o atual, lidos das vendas diárias pré-agregadas.
     hoje = datetime.now()
-    for i in range(12):
-        ano, mes = hoje.year, hoje.month
-        mes_iter = mes - i
-        ano_iter = ano
-        if mes_iter <= 0:
-            mes_iter += 12
-            ano_iter -= 1
-        chave_mes = f"{ano_iter:04d}-{mes_iter:02d}"
-        meses_template[chave_mes] = 0
-
-    meses_template = OrderedDict(reversed(list(meses_template.items())))
-    data_inicio_filtro = list(meses_template.keys())[0] + "-01"
-
-    query_vendas = """
-                   SELECT strftime('%Y-%m', data_venda) as mes, SUM(valor_total_venda) as total
-                   FROM vendas
-                   WHERE usuario_id = ?
-                     AND data_venda >= ?
-                   GROUP BY mes
-                   ORDER BY mes;
-                   """
-    resultados_vendas = query_db(query_vendas, (usuario_id, data_inicio_filtro))
-
-    if resultados_vendas:
-        for linha in resultados_vendas:
-            if linha['mes'] in meses_template:
-                meses_template[linha['mes']] = linha['total'] or 0
-
-    labels_meses = [datetime.strptime(chave, '%Y-%m').strftime('%b/%y').capitalize() for chave in meses_template.keys()]
-    valores_meses = list(meses_template.values())
+    mes, ano = hoje.month - 11, hoje.year
+    if mes <= 0:
+        mes, ano = mes + 12, ano - 1
+    data_inicio_filtro = f"{ano:04d}-{mes:02d}-01"
+    data_fim = hoje.strftime('%Y-%m-%d')
+    db = get_db_relatorio()
+    mensal = consultar_metricas(db, usuario_id, data_inicio_filtro, data_fim, 'mes')
+
+    labels_meses = [datetime.strptime(periodo, '%Y-%m-%d').strftime('%b/%y').capitalize()
+                    for periodo in mensal['periodos']]
+    # Valores em centavos; os gráficos recebem reais.
+    valores_meses = mensal['series'][0]['valores']['total_centavos']
 
     # --- 2. KPIs (Indicadores-Chave) ---
     total_vendas_12m = sum(valores_meses)
-    media_mensal = total_vendas_12m / 12 if valores_meses else 0
+    media_mensal = round(total_vendas_12m / 12) if valores_meses else 0
     melhor_mes_valor = 0
     melhor_mes_label = "N/A"
     if valores_meses:
@@ -879,19 +5770,9 @@ def dados_dashboard_metricas():
             melhor_mes_label = labels_meses[idx]
 
     # --- 3. Top 10 Produtos (Gráfico de Pizza) ---
-    query_top_produtos = """
-                         SELECT r.tipo_roupa, SUM(v.valor_total_venda) as total_vendido
-                         FROM vendas v
-                                  JOIN roupas r ON v.roupa_id = r.id
-                         WHERE v.usuario_id = ?
-                           AND v.data_venda >= ?
-                         GROUP BY r.tipo_roupa
-                         ORDER BY total_vendido DESC LIMIT 6;
-                         """
-    resultados_top = query_db(query_top_produtos, (usuario_id, data_inicio_filtro))
-
-    labels_top_produtos = [row['tipo_roupa'] for row in resultados_top] if resultados_top else []
-    valores_top_produtos = [row['total_vendido'] for row in resultados_top] if resultados_top else []
+    top_tipos = consultar_metricas(db, usuario_id, data_inicio_filtro, data_fim, 'mes', 'tipo_roupa', limite=6)
+    labels_top_produtos = [serie['rotulo'] for serie in top_tipos['series']]
+    valores_top_produtos = [serie['total_centavos'] / 100 for serie in top_tipos['series']]
 
     # --- 4. NOVO CÁLCULO DE PROJEÇÃO DE VENDAS ---
     projecao_percentual = 0
@@ -923,15 +5804,16 @@ def dados_dashboard_metricas():
 
     # --- Montagem da Resposta JSON Final ---
     dados_finais = {
+        "atualizado_em": frescor_relatorio(),
         "monthly_sales": {
             "labels": labels_meses,
-            "values": valores_meses
+            "values": [valor / 100 for valor in valores_meses]
         },
         "kpis": {
-            "total": f"R$ {total_vendas_12m:,.2f}".replace(",", "X").replace(".", ",").replace("X", "."),
-            "average": f"R$ {media_mensal:,.2f}".replace(",", "X").replace(".", ",").replace("X", "."),
+            "total": formatar_brl(total_vendas_12m),
+            "average": formatar_brl(media_mensal),
             "best_month_label": melhor_mes_label,
-            "best_month_value": f"R$ {melhor_mes_valor:,.2f}".replace(",", "X").replace(".", ",").replace("X", "."),
+            "best_month_value": formatar_brl(melhor_mes_valor),
             "projection": {
                 "value": f"{'+' if projecao_percentual > 0 else ''}{projecao_percentual:.1f}%",
                 "color": projecao_cor
@@ -953,59 +5835,26 @@ def dados_metricas_funcionarios():
     usuario_id = session['usuario_id']
     hoje = datetime.now()
     data_inicio_12m = (hoje - timedelta(days=365)).strftime('%Y-%m-%d')
+    data_fim = hoje.strftime('%Y-%m-%d')
+    db = get_db_relatorio()
 
     # --- 1. Top 10 Vendedores (Gráfico de Barras) ---
-    query_top_vendedores = """
-                           SELECT f.nome_completo, SUM(v.valor_total_venda) as total_vendido
-                           FROM vendas v \
-                                    JOIN funcionarios f ON v.funcionario_id = f.id
-                           WHERE v.usuario_id = ? \
-                             AND v.data_venda >= ?
-                           GROUP BY f.nome_completo \
-                           ORDER BY total_vendido DESC LIMIT 10; \
-                           """
-    resultados_top = query_db(query_top_vendedores, (usuario_id, data_inicio_12m))
-
-    top_vendedores_labels = [row['nome_completo'] for row in resultados_top] if resultados_top else []
-    top_vendedores_valores = [row['total_vendido'] for row in resultados_top] if resultados_top else []
+    # Vendas sem funcionário (chave 0) não entram no ranking.
+    top = consultar_metricas(db, usuario_id, data_inicio_12m, data_fim, 'dia', 'funcionario', limite=11)
+    top_vendedores = [serie for serie in top['series'] if serie['chave']][:10]
+    top_vendedores_labels = [serie['rotulo'] for serie in top_vendedores]
+    top_vendedores_valores = [serie['total_centavos'] / 100 for serie in top_vendedores]
 
     # --- 2. Vendas Trimestrais por Funcionário (Gráfico de Barras Agrupado) ---
-    query_vendas_trimestrais = """
-                               SELECT f.nome_completo, v.data_venda, v.valor_total_venda
-                               FROM vendas v \
-                                        JOIN funcionarios f ON v.funcionario_id = f.id
-                               WHERE v.usuario_id = ? \
-                                 AND v.data_venda >= ?
-                               ORDER BY v.data_venda; \
-                               """
-    resultados_trimestrais = query_db(query_vendas_trimestrais, (usuario_id, data_inicio_12m))
-
-    # Define os 4 trimestres passados
-    trimestres = OrderedDict()
-    for i in range(4):
-        fim_trimestre = hoje - timedelta(days=i * 90)
-        label = f"T{(fim_trimestre.month - 1) // 3 + 1}/{fim_trimestre.year}"
-        trimestres[label] = {}
-
-    trimestres_labels = list(reversed(list(trimestres.keys())))
-
-    vendas_por_funcionario = {}
-    if resultados_trimestrais:
-        for venda in resultados_trimestrais:
-            nome = venda['nome_completo']
-            valor = venda['valor_total_venda']
-            data_venda = datetime.strptime(venda['data_venda'], '%Y-%m-%d')
-
-            if nome not in vendas_por_funcionario:
-                vendas_por_funcionario[nome] = {label: 0 for label in trimestres_labels}
-
-            # Encontra a qual trimestre a venda pertence
-            for label in reversed(trimestres_labels):
-                trimestre_num, ano = map(int, label.replace('T', '').split('/'))
-                mes_inicio_trimestre = (trimestre_num - 1) * 3 + 1
-                if data_venda.year == ano and data_venda.month >= mes_inicio_trimestre and data_venda.month <= mes_inicio_trimestre + 2:
-                    vendas_por_funcionario[nome][label] += valor
-                    break
+    # Os 4 últimos trimestres do calendário, incluindo o atual.
+    mes, ano = (hoje.month - 1) // 3 * 3 + 1 - 9, hoje.year
+    if mes <= 0:
+        mes, ano = mes + 12, ano - 1
+    trimestral = consultar_metricas(db, usuario_id, f"{ano:04d}-{mes:02d}-01", data_fim, 'trimestre', 'funcionario',
+                                    limite=METRICAS_LIMITE_MAXIMO)
+    trimestres_labels = [f"T{(int(periodo[5:7]) - 1) // 3 + 1}/{periodo[:4]}" for periodo in trimestral['periodos']]
+    vendas_por_funcionario = {serie['rotulo']: dict(zip(trimestres_labels, serie['valores']['total_centavos']))
+                              for serie in trimestral['series'] if serie['chave']}
 
     # Cores para o gráfico
     cores = ['rgba(255, 99, 132, 0.7)', 'rgba(54, 162, 235, 0.7)', 'rgba(255, 206, 86, 0.7)', 'rgba(75, 192, 192, 0.7)',
@@ -1014,12 +5863,13 @@ def dados_metricas_funcionarios():
     for i, nome in enumerate(vendas_por_funcionario.keys()):
         datasets_trimestrais.append({
             "label": nome,
-            "data": list(vendas_por_funcionario[nome].values()),
+            "data": [valor / 100 for valor in vendas_por_funcionario[nome].values()],
             "backgroundColor": cores[i % len(cores)]
         })
 
     # --- Montagem da Resposta JSON Final ---
     dados_finais = {
+        "atualizado_em": frescor_relatorio(),
         "top_sellers": {
             "labels": top_vendedores_labels,
             "values": top_vendedores_valores
@@ -1052,50 +5902,54 @@ def dados_metricas_clientes():
 
     # --- KPIs ---
     # Total de Clientes
-    total_clientes = query_db("SELECT COUNT(id) as total FROM clientes WHERE usuario_id = ?",
+    total_clientes = query_relatorio("SELECT COUNT(id) as total FROM clientes WHERE usuario_id = ?",
                               [usuario_id], one=True)['total'] or 0
 
     # Novos Clientes (últimos 30 dias)
-    novos_clientes_30d = query_db("SELECT COUNT(id) as total FROM clientes WHERE usuario_id = ? AND data_cadastro >= ?",
+    novos_clientes_30d = query_relatorio("SELECT COUNT(id) as total FROM clientes WHERE usuario_id = ? AND data_cadastro >= ?",
                                   [usuario_id, data_inicio_30d], one=True)['total'] or 0
 
     # Cliente com Maior Gasto (últimos 3 meses)
-    query_maior_gasto_3m = """
-                           SELECT c.nome, SUM(v.valor_total_venda) as total_gasto
-                           FROM vendas v \
+    query_maior_gasto_3m = f"""
+                           SELECT c.nome, SUM(v.valor_total_centavos) as total_gasto
+                           FROM {fonte_vendas(get_db_relatorio(), data_inicio_3m)} v \
                                     JOIN clientes c ON v.cliente_id = c.id
                            WHERE v.usuario_id = ? \
                              AND v.data_venda >= ?
                            GROUP BY c.nome \
                            ORDER BY total_gasto DESC LIMIT 1; \
                            """
-    maior_gastador_3m = query_db(query_maior_gasto_3m, (usuario_id, data_inicio_3m), one=True)
+    maior_gastador_3m = query_relatorio(query_maior_gasto_3m, (usuario_id, data_inicio_3m), one=True)
 
     kpi_maior_gastador_nome = "N/A"
     kpi_maior_gastador_valor = "R$ 0,00"
     if maior_gastador_3m and maior_gastador_3m['total_gasto'] > 0:
         kpi_maior_gastador_nome = maior_gastador_3m['nome']
-        kpi_maior_gastador_valor = f"R$ {maior_gastador_3m['total_gasto']:,.2f}".replace(",", "X").replace(".",
-                                                                                                           ",").replace(
-            "X", ".")
+        kpi_maior_gastador_valor = formatar_brl(maior_gastador_3m['total_gasto'])
 
     # --- Top 5 Clientes por Valor Gasto (Gráfico de Barras - últimos 12 meses) ---
-    query_top_clientes = """
-                         SELECT c.nome, SUM(v.valor_total_venda) as total_gasto
-                         FROM vendas v \
+    query_top_clientes = f"""
+                         SELECT c.nome, SUM(v.valor_total_centavos) as total_gasto
+                         FROM {fonte_vendas(get_db_relatorio(), data_inicio_12m)} v \
                                   JOIN clientes c ON v.cliente_id = c.id
                          WHERE v.usuario_id = ? \
                            AND v.data_venda >= ?
                          GROUP BY c.nome \
                          ORDER BY total_gasto DESC LIMIT 5; \
                          """
-    resultados_top_clientes = query_db(query_top_clientes, (usuario_id, data_inicio_12m))
+    _colunas, resultados_top_clientes = query_tuplas(query_top_clientes, (usuario_id, data_inicio_12m),
+                                                     relatorio=True)
 
-    labels_top_clientes = [row['nome'] for row in resultados_top_clientes] if resultados_top_clientes else []
-    valores_top_clientes = [row['total_gasto'] for row in resultados_top_clientes] if resultados_top_clientes else []
+    labels_top_clientes = [nome for nome, _total in resultados_top_clientes]
+    valores_top_clientes = [total / 100 for _nome, total in resultados_top_clientes]
+
+    # --- Segmentos RFM (Gráfico de Rosca), lidos de clientes_rfm sem percorrer as vendas ---
+    garantir_notas_rfm(usuario_id)
+    segmentos = resumo_segmentos_rfm(usuario_id, total_clientes)
 
     # --- Montagem da Resposta JSON Final ---
     dados_finais = {
+        "atualizado_em": frescor_relatorio(),
         "kpis": {
             "total_clientes": total_clientes,
             "novos_clientes_30d": novos_clientes_30d,
@@ -1105,10 +5959,163 @@ def dados_metricas_clientes():
         "top_clients_spending": {
             "labels": labels_top_clientes,
             "values": valores_top_clientes
+        },
+        "segmentos": {
+            "labels": [segmento['rotulo'] for segmento in segmentos],
+            "values": [segmento['clientes'] for segmento in segmentos]
         }
     }
     return jsonify(dados_finais)
 
+
+def resumo_segmentos_rfm(usuario_id, total_clientes):
+    """Quantidade de clientes e valor comprado em cada segmento RFM, na ordem de SEGMENTOS."""
+    por_segmento = {linha['segmento']: linha for linha in query_db('''
+        SELECT segmento, COUNT(*) AS clientes, SUM(total_centavos) AS total_centavos
+        FROM clientes_rfm
+        WHERE usuario_id = ?
+        GROUP BY segmento
+        ''', [usuario_id])}
+    resumo = []
+    for nome, rotulo, _condicao in SEGMENTOS:
+        linha = por_segmento.get(nome)
+        resumo.append({'segmento': nome, 'rotulo': rotulo, 'clientes': linha['clientes'] if linha else 0,
+                       'total_centavos': linha['total_centavos'] if linha else 0})
+    com_compras = sum(linha['clientes'] for linha in por_segmento.values())
+    resumo.append({'segmento': SEGMENTO_SEM_COMPRAS[0], 'rotulo': SEGMENTO_SEM_COMPRAS[1],
+                   'clientes': max(total_clientes - com_compras, 0), 'total_centavos': 0})
+    return resumo
+
+
+@app.route('/segmentos_clientes')
+@login_required
+def segmentos_clientes():
+    """
+    API: Segmentação RFM dos clientes: os limites das notas, o resumo de cada segmento e os clientes com as notas
+    (filtráveis por ?segmento=). Lê apenas clientes e clientes_rfm, sem percorrer o histórico de vendas.
+    """
+    usuario_id = session['usuario_id']
+    segmento = request.args.get('segmento')
+    if segmento is not None and segmento not in ROTULOS_SEGMENTOS:
+        return jsonify({'erro': f"Segmento desconhecido: {segmento}"}), 400
+    garantir_notas_rfm(usuario_id)
+    filtros, args = ['c.usuario_id = ?'], [usuario_id]
+    if segmento == SEGMENTO_SEM_COMPRAS[0]:
+        filtros.append('r.cliente_id IS NULL')
+    elif segmento is not None:
+        filtros.append('r.segmento = ?')
+        args.append(segmento)
+    clientes = query_db(f"""
+                        SELECT c.id, c.nome, c.telefone, r.primeira_compra, r.ultima_compra,
+                               COALESCE(r.compras, 0) AS compras, COALESCE(r.total_centavos, 0) AS total_centavos,
+                               r.recencia, r.frequencia, r.monetario,
+                               COALESCE(r.segmento, '{SEGMENTO_SEM_COMPRAS[0]}') AS segmento
+                        FROM clientes c
+                                 LEFT JOIN clientes_rfm r ON r.cliente_id = c.id
+                        WHERE {' AND '.join(filtros)}
+                        ORDER BY r.total_centavos DESC, c.nome
+                        """, args)
+    limites = query_db('SELECT * FROM rfm_limites WHERE usuario_id = ?', [usuario_id], one=True)
+    total_clientes = query_db('SELECT COUNT(*) AS total FROM clientes WHERE usuario_id = ?', [usuario_id],
+                              one=True)['total']
+    return jsonify({
+        'calculado_em': limites['calculado_em'] if limites else None,
+        'limites': {dimensao: json.loads(limites[dimensao]) for dimensao in ('recencia', 'frequencia', 'monetario')}
+        if limites else None,
+        'segmentos': resumo_segmentos_rfm(usuario_id, total_clientes),
+        'clientes': [dict(cliente) for cliente in clientes],
+    })
+
+@app.route('/metricas_leituras')
+@login_required
+def metricas_leituras():
+    """
+    API: contadores da coalescência de leituras deste processo. 'lideres' são as consultas executadas,
+    'seguidores' as que aguardaram uma consulta idêntica em andamento e 'taxa_deduplicacao' a fração evitada.
+    """
+    dados = _coalescedor.estatisticas()
+    dados['ativa'] = app.config['LEITURAS_COALESCIDAS']
+    return jsonify(dados)
+
+@app.route('/admin/perfil_memoria', methods=['GET', 'DELETE'])
+@admin_required_api
+def perfil_memoria():
+    """
+    API do administrador: pico e memória retida por rota (máximos e médias, em bytes) e as linhas que mais
+    alocaram na requisição de maior pico, medidos com CONTROLE_ESTOQUE_PERFIL_MEMORIA=1. DELETE zera os perfis.
+    """
+    if request.method == 'DELETE':
+        with _perfis_memoria_dados_lock:
+            _perfis_memoria.clear()
+    return jsonify({'ativo': app.config['PERFIL_MEMORIA'],
+                    'rotas_filtradas': sorted(app.config['PERFIL_MEMORIA_ROTAS']),
+                    'rotas': resumo_perfis_memoria()})
+
+@app.route('/admin/cache_templates', methods=['GET', 'DELETE'])
+@admin_required_api
+def cache_templates():
+    """
+    API do administrador: acertos, faltas e tempos de cada fragmento {% cache %} deste processo, com a economia
+    estimada de renderização. DELETE esvazia o cache de fragmentos e zera os contadores.
+    """
+    cache = app.jinja_env.cache_fragmentos
+    if request.method == 'DELETE':
+        cache.limpar()
+    bytecode = app.jinja_env.bytecode_cache
+    return jsonify({'cache_fragmentos': app.config['CACHE_FRAGMENTOS'],
+                    'bytecode_dir': bytecode.directory if bytecode is not None else None,
+                    **cache.estatisticas()})
+
+@app.route('/admin/cache_registros', methods=['GET', 'DELETE'])
+@admin_required_api
+def cache_registros():
+    """
+    API do administrador: acertos, faltas e taxa de acerto, por tipo de registro, do cache de usuário,
+    empresa e funcionários deste processo. DELETE esvazia o cache e zera os contadores.
+    """
+    if request.method == 'DELETE':
+        _cache_registros.limpar()
+    return jsonify(_cache_registros.estatisticas())
+
+@app.route('/admin/admissao', methods=['GET', 'DELETE'])
+@admin_required_api
+def admin_admissao():
+    """
+    API do administrador: limites do controle de admissão, requisições em andamento por classe de prioridade
+    e, por classe, as admitidas, as recusadas (com o motivo) e as consultas interrompidas pelo prazo neste
+    processo. DELETE zera os contadores.
+    """
+    if request.method == 'DELETE':
+        _admissao.zerar()
+    dados = _admissao.estatisticas()
+    dados['ativa'] = app.config['ADMISSAO_ATIVA']
+    dados['prazo_ms'] = app.config['ADMISSAO_PRAZO_MS']
+    dados['rotas'] = {classe: sorted(endpoint for endpoint in app.view_functions
+                                     if endpoint not in ROTAS_SEM_ADMISSAO and classe_prioridade(endpoint) == classe)
+                      for classe in CLASSES_PRIORIDADE}
+    return jsonify(dados)
+
+@app.route('/admin/consultas', methods=['GET', 'DELETE'])
+@admin_required_api
+def admin_consultas():
+    """
+    API do administrador: instruções registradas na camada de acesso a dados, tamanho do cache de instruções
+    das conexões e, por instrução, execuções, linhas e tempo total, médio e máximo neste processo, da que mais
+    consumiu tempo para a que menos consumiu. DELETE zera os contadores.
+    """
+    if request.method == 'DELETE':
+        repositorio.zerar()
+    return jsonify(repositorio.estatisticas())
+
+@app.route('/admin/eventos')
+@admin_required_api
+def admin_eventos():
+    """
+    API do administrador: conexões SSE abertas neste processo (total e por usuário), limites e contadores de
+    eventos publicados, entregues, 'resync' enviados a conexões lentas e conexões recusadas pelo limite.
+    """
+    return jsonify(_canal_eventos.estatisticas())
+
 # ===================== ROTAS PARA EXPORTAÇÃO NF-e ATUALIZADAS =====================
 @app.route('/exportar_vendas_nfe', methods=['GET'])
 @login_required
@@ -1117,23 +6124,94 @@ def exportar_vendas_nfe():
     usuario_id = session['usuario_id']
     data_inicio_filtro = (datetime.now() - timedelta(days=30)).strftime('%Y-%m-%d')
 
-    query_vendas_recentes = """
-                            SELECT v.id as venda_id, v.data_venda, c.nome as nome_cliente, v.valor_total_venda
-                            FROM vendas v
+    query_vendas_recentes = f"""
+                            SELECT v.id as venda_id, v.data_venda, c.nome as nome_cliente, v.valor_total_centavos
+                            FROM {fonte_vendas(get_db_relatorio(), data_inicio_filtro)} v
                                      JOIN clientes c ON v.cliente_id = c.id
                             WHERE v.usuario_id = ? \
                               AND v.data_venda >= ?
                             ORDER BY v.data_venda DESC, v.id DESC; \
                             """
-    vendas = query_db(query_vendas_recentes, (usuario_id, data_inicio_filtro))
+    vendas = query_relatorio(query_vendas_recentes, (usuario_id, data_inicio_filtro))
+
+    return render_template('exportar_vendas.html', vendas=vendas, atualizado_em=frescor_relatorio())
+
+
+# --- Geração de NF-e por Venda (Pool de Processos) ---
+
+_pool_nfe = None
+_pool_nfe_lock = threading.Lock()
+
+
+def pool_nfe():
+    """
+    Pool de processos da geração de NF-e, criado na primeira exportação e reaproveitado pelas seguintes.
+    Os processos são iniciados com 'spawn': um fork do servidor, que tem várias threads, poderia herdar
+    travas ocupadas por elas.
+    """
+    global _pool_nfe
+    with _pool_nfe_lock:
+        if _pool_nfe is None:
+            _pool_nfe = ProcessPoolExecutor(max_workers=app.config['NFE_PROCESSOS'] or None,
+                                            mp_context=multiprocessing.get_context('spawn'))
+        return _pool_nfe
+
+
+def resposta_zip_nfe(emitente, vendas, quantidade):
+    """
+    Resposta com um ZIP de documentos NF-e (um XML por venda), enviada em fluxo: cada entrada segue para o
+    cliente assim que o seu lote fica pronto. vendas é lido conforme os lotes são gerados (ex.: um cursor);
+    quantidade, o total de vendas, decide o uso do pool e vai no cabeçalho X-NFe-Documentos. A vazão da exportação é registrada no log ao final.
+    """
+    executor = pool_nfe() if quantidade > nfe.TAMANHO_LOTE else None
+    usuario_id = session['usuario_id']
 
-    return render_template('exportar_vendas.html', vendas=vendas)
+    def registrar_vazao(quantidade, segundos):
+        print(f"NF-e (usuário {usuario_id}): {quantidade} documento(s) em {segundos:.2f} s "
+              f"({quantidade / max(segundos, 1e-9):.0f} documentos/s)")
+
+    corpo = nfe.zip_em_fluxo(nfe.gerar_documentos(emitente, vendas, executor), ao_terminar=registrar_vazao)
+    return Response(corpo, mimetype='application/zip', headers={
+        'Content-Disposition': f"attachment;filename=nfe_{datetime.now():%Y%m%d_%H%M%S}.zip",
+        'X-NFe-Documentos': str(quantidade),
+    })
+
+
+@app.cli.command('bench-nfe')
+@click.option('--vendas', type=int, default=5000, show_default=True, help='Quantidade de vendas simuladas.')
+@click.option('--processos', default='1,4', show_default=True, help='Tamanhos do pool, separados por vírgula.')
+def bench_nfe_command(vendas, processos):
+    """Mede a exportação de um XML de NF-e por venda, sem e com o pool de processos: 'flask bench-nfe'."""
+    emitente = {'cnpj': '00000000000191', 'razao_social': 'Loja Exemplo LTDA', 'nome_fantasia': 'Loja Exemplo',
+                'inscricao_estadual': 'ISENTO', 'inscricao_municipal': '', 'regime_tributario': 'Simples Nacional',
+                'cep': '01001000', 'rua': 'Praça da Sé, 1', 'bairro': 'Sé', 'cidade': 'São Paulo', 'estado': 'SP',
+                'pais': 'Brasil'}
+    dados_vendas = [(i, '2026-01-15', f'Cliente {i % 500}', 'ISENTO', '11999990000', f'20260101-{i % 2000:08d}',
+                     'Camiseta Azul P,M,G', '00000000', 'UN', 1 + i % 3, '49.90', f'{49.90 * (1 + i % 3):.2f}')
+                    for i in range(vendas)]
+
+    def medir(executor):
+        t0 = time.perf_counter()
+        tamanho = sum(len(parte) for parte in nfe.zip_em_fluxo(nfe.gerar_documentos(emitente, dados_vendas, executor)))
+        return time.perf_counter() - t0, tamanho
+
+    duracao, tamanho = medir(None)
+    print(f"{'sem pool':>10}: {duracao:6.2f} s  {vendas / duracao:8.0f} documentos/s  ZIP {tamanho / 2 ** 20:.1f} MiB")
+    for n_processos in (int(n) for n in processos.split(',')):
+        with ProcessPoolExecutor(max_workers=n_processos, mp_context=multiprocessing.get_context('spawn')) as executor:
+            executor.submit(nfe.nome_documento, (0,)).result()  # Inicia os processos fora da medição.
+            duracao, tamanho = medir(executor)
+        print(f"{n_processos:>4} proc.: {duracao:6.2f} s  {vendas / duracao:8.0f} documentos/s  "
+              f"ZIP {tamanho / 2 ** 20:.1f} MiB")
 
 
 @app.route('/gerar_arquivo_nfe', methods=['POST'])
 @login_required
 def gerar_arquivo_nfe():
-    """ Gera o arquivo (CSV ou XML) com os dados das vendas selecionadas E os dados da empresa. """
+    """
+    Gera o arquivo (CSV ou XML) com os dados das vendas selecionadas E os dados da empresa.
+    Com o formato 'zip', gera um documento XML de NF-e por venda, compactados em um ZIP enviado em fluxo.
+    """
     usuario_id = session['usuario_id']
     venda_ids_selecionadas = request.form.getlist('venda_ids')
     formato_exportacao = request.form.get('formato_exportacao', 'csv')  # Pega o formato escolhido, default CSV
@@ -1143,40 +6221,94 @@ def gerar_arquivo_nfe():
         return redirect(url_for('exportar_vendas_nfe'))
 
     # --- Busca os Dados da Empresa ---
-    empresa = query_db("SELECT * FROM empresas WHERE usuario_id = ?", [usuario_id], one=True)
+    empresa = empresa_do_usuario(usuario_id)
     if not empresa:
         print('Dados da empresa não encontrados. Cadastre-os antes de exportar.', 'danger')
         return redirect(url_for('dados_empresa'))
 
     # --- Busca os Dados das Vendas ---
-    placeholders = ','.join('?' * len(venda_ids_selecionadas))
-    query_dados_export = f"""
-        SELECT 
-            v.id as VendaID, v.data_venda as DataEmissao,
-            c.nome as DestNome, 'ISENTO' as DestIE, c.telefone as DestFone, 
-            r.codigo_produto as ProdCodigo,
-            r.tipo_roupa || ' ' || r.cor || ' ' || COALESCE(r.tamanhos, '') as ProdDescricao, 
-            '00000000' as ProdNCM, 'UN' as ProdUnidade, 
-            v.quantidade_vendida as ProdQuantidade, r.preco_unitario as ProdValorUnitario,
-            v.valor_total_venda as ProdValorTotal
-        FROM vendas v
-        JOIN clientes c ON v.cliente_id = c.id
-        JOIN roupas r ON v.roupa_id = r.id
-        WHERE v.usuario_id = ? AND v.id IN ({placeholders})
-        ORDER BY v.id; 
-    """
-    args = [usuario_id] + venda_ids_selecionadas
-    dados_vendas = query_db(query_dados_export, args)
-
-    if not dados_vendas:
+    # As vendas selecionadas podem estar em um ano já arquivado; só os arquivos que podem contê-las são anexados.
+    ids = [int(venda_id) for venda_id in venda_ids_selecionadas if venda_id.isdigit()]
+    db = get_db()
+    try:
+        vendas = fonte_vendas(db, ids=ids)
+    except sqlite3.OperationalError as e:
+        print(str(e), 'danger')
+        return redirect(url_for('exportar_vendas_nfe'))
+    # Os ids vão em um único parâmetro (array JSON): com milhares de vendas selecionadas, um '?' por id
+    # passaria do limite de variáveis do SQLite.
+    args = (usuario_id, json.dumps(ids))
+    quantidade = db.execute(f"SELECT COUNT(*) FROM ({CONSULTA_EXPORTACAO_NFE.format(vendas=vendas)})",
+                            args).fetchone()[0]
+
+    if not quantidade:
         print('Não foi possível encontrar os dados para as vendas selecionadas.', 'error')
         return redirect(url_for('exportar_vendas_nfe'))
 
-    # --- Geração do Arquivo baseado no Formato ---
-    output = io.StringIO()
-    mimetype = "text/plain"  # Default, será ajustado
+    # As vendas são lidas do cursor conforme o arquivo é enviado, sem carregar a seleção inteira em memória.
+    dados_vendas = vendas_para_exportacao(caminho_db_atual(), ids, args)
+    if formato_exportacao == 'zip':
+        return resposta_zip_nfe(dict(empresa), dados_vendas, quantidade)
+
+    try:
+        conteudo, mimetype = gerar_conteudo_nfe(empresa, dados_vendas, formato_exportacao)
+    except ValueError:
+        # Caso um formato inválido seja passado (pouco provável com radio buttons)
+        print('Formato de exportação inválido selecionado.', 'danger')
+        return redirect(url_for('exportar_vendas_nfe'))
+
+    # --- Prepara a Resposta para Download ---
     filename = f"vendas_para_nfe.{formato_exportacao}"
+    return Response(
+        conteudo,
+        mimetype=mimetype,
+        headers={"Content-Disposition": f"attachment;filename={filename}"}
+    )
+
+
+# Uma linha por venda selecionada, na ordem de nfe.COLUNAS_VENDA; {vendas} é a fonte dada por fonte_vendas.
+CONSULTA_EXPORTACAO_NFE = """
+    SELECT 
+        v.id as VendaID, v.data_venda as DataEmissao,
+        c.nome as DestNome, 'ISENTO' as DestIE, c.telefone as DestFone, 
+        r.codigo_produto as ProdCodigo,
+        r.tipo_roupa || ' ' || r.cor || ' ' || COALESCE(r.tamanhos, '') as ProdDescricao, 
+        '00000000' as ProdNCM, 'UN' as ProdUnidade, 
+        v.quantidade_vendida as ProdQuantidade,
+        printf('%d.%02d', r.preco_centavos / 100, r.preco_centavos % 100) as ProdValorUnitario,
+        printf('%d.%02d', v.valor_total_centavos / 100, v.valor_total_centavos % 100) as ProdValorTotal
+    FROM {vendas} v
+    JOIN clientes c ON v.cliente_id = c.id
+    JOIN roupas r ON v.roupa_id = r.id
+    WHERE v.usuario_id = ? AND v.id IN (SELECT value FROM json_each(?))
+    ORDER BY v.id
+"""
+
+# Linhas por bloco enviado ao cliente na exportação em CSV ou XML.
+NFE_LINHAS_POR_BLOCO = 500
+
+
+def vendas_para_exportacao(caminho, ids, args):
+    """
+    Gera as vendas da exportação de NF-e (tuplas na ordem de nfe.COLUNAS_VENDA), lidas do cursor conforme
+    são consumidas. Usa uma conexão própria, pois a resposta continua sendo enviada depois que a requisição
+    termina.
+    """
+    db = conectar(caminho)
+    try:
+        cursor = db.cursor()
+        cursor.row_factory = None
+        yield from cursor.execute(CONSULTA_EXPORTACAO_NFE.format(vendas=fonte_vendas(db, ids=ids)), args)
+    finally:
+        db.close()
+
 
+def gerar_conteudo_nfe(empresa, dados_vendas, formato_exportacao):
+    """
+    Gera o conteúdo do arquivo de exportação (CSV ou XML) com os dados da empresa e uma linha por item de venda.
+    Retorna (partes, mimetype): partes é um gerador de blocos de texto, que lê dados_vendas (qualquer iterável,
+    ex.: um cursor) conforme é consumido. Levanta ValueError para um formato desconhecido.
+    """
     # Define o cabeçalho base (pode precisar de ajuste por formato)
     cabecalho_base = [
         'EmitCNPJ', 'EmitRazaoSocial', 'EmitNomeFantasia', 'EmitIE', 'EmitIM',
@@ -1195,52 +6327,53 @@ def gerar_arquivo_nfe():
 
     # --- Lógica para CSV ---
     if formato_exportacao == 'csv':
-        mimetype = "text/csv"
-        writer = csv.writer(output, delimiter=';', quotechar='"', quoting=csv.QUOTE_MINIMAL)
-        writer.writerow(cabecalho_base)
-        for venda in dados_vendas:
-            linha_completa = dados_empresa_linha + list(venda)
-            writer.writerow(linha_completa)
+        return _partes_csv_nfe(cabecalho_base, dados_empresa_linha, dados_vendas), "text/csv"
 
     # --- Lógica para XML (Simplificado) ---
-    elif formato_exportacao == 'xml':
-        mimetype = "application/xml"
-        root = ET.Element("ExportacaoNFe")
-
-        emitente_el = ET.SubElement(root, "Emitente")
-        for i, chave in enumerate(cabecalho_base[:12]):
-            valor = dados_empresa_linha[i] if dados_empresa_linha[i] is not None else ""
-            ET.SubElement(emitente_el, chave).text = str(valor)
-
-        vendas_el = ET.SubElement(root, "Vendas")
-        for venda_dict in dados_vendas:
-            item_el = ET.SubElement(vendas_el, "ItemVenda")
-            # Converter a linha do banco (sqlite3.Row) para dicionário para acesso por índice numérico
-            venda_list = list(venda_dict)
-            for i, chave in enumerate(cabecalho_base[12:]):
-                valor = venda_list[i] if venda_list[i] is not None else ""
-                ET.SubElement(item_el, chave).text = str(valor)
-
-        xml_str = ET.tostring(root, encoding='unicode')
-        dom = minidom.parseString(xml_str)
-        output.write(dom.toprettyxml(indent="  "))
+    if formato_exportacao == 'xml':
+        return _partes_xml_nfe(cabecalho_base, dados_empresa_linha, dados_vendas), "application/xml"
 
     # --- Lógica para TXT (REMOVIDA) ---
     # O bloco 'elif formato_exportacao == 'txt':' foi removido.
 
-    else:
-        # Caso um formato inválido seja passado (pouco provável com radio buttons)
-        print('Formato de exportação inválido selecionado.', 'danger')
-        return redirect(url_for('exportar_vendas_nfe'))
+    raise ValueError(f"Formato de exportação inválido: {formato_exportacao}")
 
-    # --- Prepara a Resposta para Download ---
-    output.seek(0)
-    return Response(
-        output.getvalue(),
-        mimetype=mimetype,
-        headers={"Content-Disposition": f"attachment;filename={filename}"}
-    )
 
+def _partes_csv_nfe(cabecalho_base, dados_empresa_linha, dados_vendas):
+    output = io.StringIO()
+    writer = csv.writer(output, delimiter=';', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+    writer.writerow(cabecalho_base)
+    dados_vendas = iter(dados_vendas)
+    for bloco in iter(lambda: list(itertools.islice(dados_vendas, NFE_LINHAS_POR_BLOCO)), []):
+        writer.writerows(dados_empresa_linha + list(venda) for venda in bloco)
+        yield output.getvalue()
+        output.seek(0)
+        output.truncate()
+    yield output.getvalue()
+
+
+def _elemento_xml(nivel, chave, valor):
+    """Elemento de texto indentado como o toprettyxml do minidom (vazio para None)."""
+    texto = '' if valor is None else escape(str(valor))
+    return f"{'  ' * nivel}<{chave}>{texto}</{chave}>\n" if texto else f"{'  ' * nivel}<{chave}/>\n"
+
+
+def _partes_xml_nfe(cabecalho_base, dados_empresa_linha, dados_vendas):
+    # O documento é escrito em texto, elemento por elemento: montar a árvore inteira (ElementTree + minidom)
+    # ocupava centenas de MiB com 100 mil vendas.
+    partes = ['<?xml version="1.0" ?>\n<ExportacaoNFe>\n  <Emitente>\n']
+    partes.extend(_elemento_xml(2, chave, valor) for chave, valor in zip(cabecalho_base[:12], dados_empresa_linha))
+    partes.append('  </Emitente>\n  <Vendas>\n')
+    yield ''.join(partes)
+    dados_vendas = iter(dados_vendas)
+    for bloco in iter(lambda: list(itertools.islice(dados_vendas, NFE_LINHAS_POR_BLOCO)), []):
+        partes = []
+        for venda in bloco:
+            partes.append('    <ItemVenda>\n')
+            partes.extend(_elemento_xml(3, chave, valor) for chave, valor in zip(cabecalho_base[12:], venda))
+            partes.append('    </ItemVenda>\n')
+        yield ''.join(partes)
+    yield '  </Vendas>\n</ExportacaoNFe>\n'
 
 
 if __name__ == '__main__':
@@ -0,0 +1,307 @@
+"""
+Cópia de segurança (backup) de todos os dados de um usuário (tenant), em dois formatos.
+
+NDJSON compactado com gzip: uma linha de cabeçalho; para cada tabela, uma linha de abertura com o nome e as
+colunas, uma linha por registro (array JSON com os valores na ordem das colunas) e uma linha de fechamento
+com a quantidade de registros e o SHA-256 das linhas da tabela; por fim, uma linha com o resumo de todas as
+tabelas e o SHA-256 de todas as linhas anteriores. As linhas são geradas, compactadas e lidas uma a uma,
+de modo que a memória usada não depende da quantidade de vendas do usuário.
+
+SQLite: um arquivo independente, com o schema completo da aplicação, apenas as linhas do usuário e as
+tabelas backup_cabecalho e backup_manifesto, que guardam a quantidade de registros e o SHA-256 de cada
+tabela como gravada no arquivo (calculados da mesma forma que no formato NDJSON).
+
+A leitura dos dois formatos gera os mesmos eventos, e as somas são conferidas durante a leitura: quem
+restaura só confirma a transação depois do evento 'fim', que só é gerado se o arquivo inteiro conferir.
+"""
+
+import gzip
+import hashlib
+import json
+import os
+import sqlite3
+import zlib
+from itertools import islice
+
+import serializacao
+
+FORMATO = 'controle_estoque-backup'
+VERSAO_FORMATO = 1
+
+# Registros por bloco na leitura e na escrita dos arquivos (limita a memória usada por tabela).
+TAMANHO_BLOCO = 1000
+# Bytes de NDJSON acumulados antes de cada passo do compressor, e bytes por bloco na leitura de arquivos.
+TAMANHO_BUFFER = 64 * 1024
+NIVEL_COMPRESSAO = 6
+
+ASSINATURA_GZIP = b'\x1f\x8b'
+ASSINATURA_SQLITE = b'SQLite format 3\x00'
+
+SCHEMA_MANIFESTO = '''
+CREATE TABLE backup_cabecalho (dados TEXT NOT NULL);
+CREATE TABLE backup_manifesto (
+    ordem INTEGER PRIMARY KEY,
+    tabela TEXT NOT NULL UNIQUE,
+    colunas TEXT NOT NULL,
+    linhas INTEGER NOT NULL,
+    sha256 TEXT NOT NULL
+);
+'''
+
+
+class BackupInvalido(Exception):
+    """Arquivo de backup ilegível, incompleto ou cujas somas de verificação não conferem."""
+
+
+def linha_registro(valores):
+    """Linha NDJSON de um registro; é também a unidade das somas SHA-256 por tabela."""
+    return serializacao.dumps(tuple(valores)) + b'\n'
+
+
+def ordem_tabela(db, tabela, esquema='main'):
+    """Expressão do ORDER BY pela chave primária da tabela (rowid, se ela não tiver uma)."""
+    info = db.execute(f"PRAGMA {esquema}.table_info({tabela})").fetchall()
+    chave = [coluna[1] for coluna in sorted(info, key=lambda coluna: coluna[5]) if coluna[5]]
+    return ', '.join(chave) or 'rowid'
+
+
+def sha256_arquivo(caminho):
+    """SHA-256 (hexadecimal) do conteúdo de um arquivo, lido em blocos."""
+    soma = hashlib.sha256()
+    for bloco in ler_em_blocos(caminho):
+        soma.update(bloco)
+    return soma.hexdigest()
+
+
+def ler_em_blocos(caminho, tamanho=TAMANHO_BUFFER):
+    """Gera o conteúdo de um arquivo em blocos de bytes."""
+    with open(caminho, 'rb') as arquivo:
+        while bloco := arquivo.read(tamanho):
+            yield bloco
+
+
+# --- Escrita ---
+
+def gerar_ndjson(cabecalho, tabelas, ao_terminar=None):
+    """
+    Gera as linhas (bytes) do backup NDJSON. tabelas é um iterável de (tabela, colunas, linhas), em que linhas
+    é um iterável de tuplas de valores. ao_terminar(resumo) recebe a linha final já montada.
+    """
+    total = hashlib.sha256()
+    resumo = {}
+
+    def registrar(linha):
+        total.update(linha)
+        return linha
+
+    yield registrar(serializacao.dumps({'formato': FORMATO, 'versao': VERSAO_FORMATO, **cabecalho}) + b'\n')
+    for tabela, colunas, linhas in tabelas:
+        yield registrar(serializacao.dumps({'tabela': tabela, 'colunas': list(colunas)}) + b'\n')
+        soma, quantidade = hashlib.sha256(), 0
+        for valores in linhas:
+            linha = linha_registro(valores)
+            soma.update(linha)
+            quantidade += 1
+            yield registrar(linha)
+        resumo[tabela] = {'linhas': quantidade, 'sha256': soma.hexdigest()}
+        yield registrar(serializacao.dumps({'fim_tabela': tabela, **resumo[tabela]}) + b'\n')
+    final = {'fim': True, 'tabelas': resumo, 'sha256': total.hexdigest()}
+    yield serializacao.dumps(final) + b'\n'
+    if ao_terminar is not None:
+        ao_terminar(final)
+
+
+def compactar(linhas, nivel=NIVEL_COMPRESSAO):
+    """Compacta as linhas em gzip, entregando os bytes a cada TAMANHO_BUFFER de entrada."""
+    compressor = zlib.compressobj(nivel, zlib.DEFLATED, 16 + zlib.MAX_WBITS)  # 16 + MAX_WBITS: formato gzip.
+    pendentes, tamanho = [], 0
+    for linha in linhas:
+        pendentes.append(linha)
+        tamanho += len(linha)
+        if tamanho >= TAMANHO_BUFFER:
+            dados = compressor.compress(b''.join(pendentes))
+            pendentes, tamanho = [], 0
+            if dados:
+                yield dados
+    yield compressor.compress(b''.join(pendentes)) + compressor.flush()
+
+
+def escrever_sqlite(destino, schema, cabecalho, tabelas):
+    """
+    Grava o backup em um novo arquivo SQLite: aplica o schema, insere as linhas de cada (tabela, colunas,
+    linhas) em blocos e registra o cabeçalho e o manifesto. Os gatilhos do schema refazem os agregados, de
+    modo que o arquivo também serve como shard do usuário. Retorna o resumo por tabela.
+    """
+    if os.path.exists(destino):
+        raise FileExistsError(f"O arquivo {destino} já existe.")
+    db = sqlite3.connect(destino)
+    try:
+        db.executescript(schema)
+        db.executescript(SCHEMA_MANIFESTO)
+        # O arquivo é novo e só passa a valer no final: em caso de falha ele é removido.
+        db.execute('PRAGMA journal_mode=OFF')
+        db.execute('PRAGMA synchronous=OFF')
+        inseridas = {}
+        for tabela, colunas, linhas in tabelas:
+            sql = f"INSERT INTO {tabela} ({', '.join(colunas)}) VALUES ({', '.join('?' * len(colunas))})"
+            inseridas[tabela], linhas = (colunas, 0), iter(linhas)
+            while bloco := list(islice(linhas, TAMANHO_BLOCO)):
+                db.executemany(sql, bloco)
+                inseridas[tabela] = (colunas, inseridas[tabela][1] + len(bloco))
+        # As somas são calculadas sobre as linhas como ficaram no arquivo: os gatilhos do schema podem ajustar
+        # colunas derivadas das linhas inseridas (a versão do catálogo em roupas, por exemplo).
+        resumo = {}
+        for ordem, (tabela, (colunas, quantidade)) in enumerate(inseridas.items()):
+            soma, gravadas = _somar_tabela(db, tabela, colunas)
+            if gravadas != quantidade:
+                raise sqlite3.DatabaseError(f"{tabela}: {quantidade} registros inseridos, {gravadas} no arquivo.")
+            resumo[tabela] = {'linhas': quantidade, 'sha256': soma}
+            db.execute('INSERT INTO backup_manifesto (ordem, tabela, colunas, linhas, sha256) VALUES (?, ?, ?, ?, ?)',
+                       (ordem, tabela, json.dumps(list(colunas)), quantidade, soma))
+        db.execute('INSERT INTO backup_cabecalho (dados) VALUES (?)',
+                   (json.dumps({'formato': FORMATO, 'versao': VERSAO_FORMATO, **cabecalho}),))
+        db.commit()
+    except BaseException:
+        db.close()
+        os.remove(destino)
+        raise
+    db.close()
+    return resumo
+
+
+def _blocos_tabela(db, tabela, colunas):
+    """Gera as linhas de uma tabela do arquivo SQLite em blocos, na ordem da chave primária."""
+    cursor = db.execute(f"SELECT {', '.join(colunas)} FROM {tabela} ORDER BY {ordem_tabela(db, tabela)}")
+    while bloco := cursor.fetchmany(TAMANHO_BLOCO):
+        yield bloco
+
+
+def _somar_tabela(db, tabela, colunas):
+    """Retorna (SHA-256, quantidade) das linhas de uma tabela do arquivo SQLite."""
+    soma, quantidade = hashlib.sha256(), 0
+    for bloco in _blocos_tabela(db, tabela, colunas):
+        for valores in bloco:
+            soma.update(linha_registro(valores))
+        quantidade += len(bloco)
+    return soma.hexdigest(), quantidade
+
+
+# --- Leitura ---
+
+def ler_backup(caminho):
+    """
+    Lê um backup (NDJSON compactado ou SQLite, reconhecido pelo conteúdo) e gera eventos (tipo, dados):
+    ('cabecalho', dict), ('tabela', (tabela, colunas)), ('linhas', [valores, ...]) em blocos,
+    ('fim_tabela', (tabela, quantidade)) e, depois de conferidas todas as somas, ('fim', resumo).
+    Levanta BackupInvalido se o arquivo estiver corrompido, incompleto ou não conferir.
+    """
+    with open(caminho, 'rb') as arquivo:
+        assinatura = arquivo.read(len(ASSINATURA_SQLITE))
+    if assinatura.startswith(ASSINATURA_SQLITE):
+        leitor = _ler_sqlite
+    elif assinatura.startswith(ASSINATURA_GZIP):
+        leitor = _ler_ndjson
+    else:
+        raise BackupInvalido(f"{caminho} não é um backup NDJSON compactado nem um arquivo SQLite.")
+    try:
+        yield from leitor(caminho)
+    except (OSError, EOFError, zlib.error, ValueError, KeyError, TypeError, AttributeError,
+            sqlite3.DatabaseError) as e:
+        raise BackupInvalido(f"Arquivo de backup ilegível: {e}") from e
+
+
+def verificar_backup(caminho):
+    """Lê o backup inteiro conferindo as somas. Retorna (cabeçalho, {tabela: quantidade de registros})."""
+    cabecalho, quantidades = None, {}
+    for tipo, dados in ler_backup(caminho):
+        if tipo == 'cabecalho':
+            cabecalho = dados
+        elif tipo == 'fim_tabela':
+            quantidades[dados[0]] = dados[1]
+    return cabecalho, quantidades
+
+
+def _conferir_cabecalho(cabecalho):
+    if not isinstance(cabecalho, dict) or cabecalho.get('formato') != FORMATO:
+        raise BackupInvalido('O arquivo não é um backup do controle de estoque.')
+    if cabecalho.get('versao', 0) > VERSAO_FORMATO:
+        raise BackupInvalido(f"Versão {cabecalho['versao']} do formato de backup não suportada.")
+    return cabecalho
+
+
+def _ler_ndjson(caminho):
+    total = hashlib.sha256()
+    tabela = colunas = soma = None
+    bloco, quantidade, resumo = [], 0, {}
+    with gzip.open(caminho, 'rb') as arquivo:
+        linhas = iter(arquivo)
+        primeira = next(linhas, b'')
+        total.update(primeira)
+        yield 'cabecalho', _conferir_cabecalho(serializacao.loads(primeira) if primeira else None)
+        for linha in linhas:
+            if linha.startswith(b'['):
+                if tabela is None:
+                    raise BackupInvalido('Registro fora de uma tabela.')
+                valores = serializacao.loads(linha)
+                if len(valores) != len(colunas):
+                    raise BackupInvalido(f"Registro de {tabela} com {len(valores)} valores para {len(colunas)} colunas.")
+                soma.update(linha)
+                total.update(linha)
+                quantidade += 1
+                bloco.append(valores)
+                if len(bloco) >= TAMANHO_BLOCO:
+                    yield 'linhas', bloco
+                    bloco = []
+                continue
+            controle = serializacao.loads(linha)
+            if 'tabela' in controle and tabela is None:
+                tabela, colunas = controle['tabela'], controle['colunas']
+                soma, quantidade = hashlib.sha256(), 0
+                total.update(linha)
+                yield 'tabela', (tabela, colunas)
+            elif controle.get('fim_tabela') == tabela and tabela is not None:
+                if bloco:
+                    yield 'linhas', bloco
+                    bloco = []
+                if (controle['linhas'], controle['sha256']) != (quantidade, soma.hexdigest()):
+                    raise BackupInvalido(f"A soma de verificação da tabela {tabela} não confere.")
+                resumo[tabela] = {'linhas': quantidade, 'sha256': controle['sha256']}
+                total.update(linha)
+                yield 'fim_tabela', (tabela, quantidade)
+                tabela = None
+            elif controle.get('fim') and tabela is None:
+                if controle['sha256'] != total.hexdigest() or controle['tabelas'] != resumo:
+                    raise BackupInvalido('A soma de verificação do arquivo não confere.')
+                if next(linhas, None) is not None:
+                    raise BackupInvalido('Há conteúdo depois do final do backup.')
+                yield 'fim', resumo
+                return
+            else:
+                raise BackupInvalido(f"Linha de controle inesperada: {linha[:80]!r}")
+    raise BackupInvalido('O backup está incompleto (falta o final do arquivo).')
+
+
+def _ler_sqlite(caminho):
+    db = sqlite3.connect(f"file:{caminho}?mode=ro", uri=True)
+    try:
+        if db.execute('PRAGMA quick_check').fetchone()[0] != 'ok':
+            raise BackupInvalido('O arquivo SQLite do backup está corrompido.')
+        yield 'cabecalho', _conferir_cabecalho(json.loads(db.execute('SELECT dados FROM backup_cabecalho').fetchone()[0]))
+        resumo = {}
+        for tabela, colunas, linhas, sha256 in db.execute(
+                'SELECT tabela, colunas, linhas, sha256 FROM backup_manifesto ORDER BY ordem').fetchall():
+            colunas = json.loads(colunas)
+            yield 'tabela', (tabela, colunas)
+            soma, quantidade = hashlib.sha256(), 0
+            for bloco in _blocos_tabela(db, tabela, colunas):
+                for valores in bloco:
+                    soma.update(linha_registro(valores))
+                quantidade += len(bloco)
+                yield 'linhas', bloco
+            if (quantidade, soma.hexdigest()) != (linhas, sha256):
+                raise BackupInvalido(f"A soma de verificação da tabela {tabela} não confere.")
+            resumo[tabela] = {'linhas': quantidade, 'sha256': sha256}
+            yield 'fim_tabela', (tabela, quantidade)
+        yield 'fim', resumo
+    finally:
+        db.close()
@@ -0,0 +1,103 @@
+"""
+Formatação e conversão de valores monetários (BRL) e datas da aplicação.
+
+No banco de dados, os valores em dinheiro são guardados como inteiros em centavos e as datas no
+formato ISO (AAAA-MM-DD ou AAAA-MM-DD HH:MM:SS). Este módulo concentra a conversão entre esses
+formatos de armazenamento e os formatos de exibição usados pelas rotas e pelos templates.
+"""
+
+import re
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+
+# Troca os separadores do formato americano ("1,234.56") pelos do brasileiro ("1.234,56") em uma única passada.
+_SEPARADORES_BR = str.maketrans(',.', '.,')
+
+# Datas digitadas no formato brasileiro, com hora opcional (ex.: "20/10/2025" ou "20/10/2025 - 12:15:11").
+_DATA_BR = re.compile(r'^(\d{2})/(\d{2})/(\d{4})(?:\s*-?\s*(\d{2}:\d{2}(?::\d{2})?))?$')
+_DATA_ISO = re.compile(r'^(\d{4})-(\d{2})-(\d{2})(?:[ T](\d{2}:\d{2}(?::\d{2})?))?')
+
+_CENTAVO = Decimal('0.01')
+
+
+def para_centavos(valor):
+    """
+    Converte um valor em reais para centavos (inteiro). Aceita números e textos como
+    "12.5", "12,50" ou "1.234,56". Retorna None para valores vazios.
+    """
+    if valor is None or valor == '':
+        return None
+    if isinstance(valor, int):
+        return valor * 100
+    texto = str(valor).strip().replace('R$', '').strip()
+    if ',' in texto:
+        texto = texto.replace('.', '').replace(',', '.')
+    try:
+        reais = Decimal(texto).quantize(_CENTAVO, rounding=ROUND_HALF_UP)
+    except InvalidOperation:
+        raise ValueError(f"Valor monetário inválido: {valor!r}")
+    return int(reais * 100)
+
+
+def formatar_reais(centavos):
+    """Formata centavos como número decimal com ponto (ex.: 123456 -> "1234.56"), para formulários e exportação."""
+    if centavos is None:
+        return ''
+    sinal = '-' if centavos < 0 else ''
+    reais, resto = divmod(abs(int(centavos)), 100)
+    return f"{sinal}{reais}.{resto:02d}"
+
+
+def formatar_brl(centavos):
+    """Formata centavos em moeda brasileira (ex.: 123456 -> "R$ 1.234,56")."""
+    centavos = int(centavos or 0)
+    sinal = '-' if centavos < 0 else ''
+    reais, resto = divmod(abs(centavos), 100)
+    return f"{sinal}R$ {reais:,}.{resto:02d}".translate(_SEPARADORES_BR)
+
+
+def data_iso(valor):
+    """
+    Normaliza uma data para o formato ISO (AAAA-MM-DD). Aceita datas no formato brasileiro
+    (DD/MM/AAAA) ou já em ISO; levanta ValueError para outros formatos.
+    """
+    texto = str(valor or '').strip()
+    if _DATA_ISO.match(texto):
+        return texto[:10]
+    encontrado = _DATA_BR.match(texto)
+    if not encontrado:
+        raise ValueError(f"Data inválida: {valor!r}")
+    dia, mes, ano, _hora = encontrado.groups()
+    return f"{ano}-{mes}-{dia}"
+
+
+def data_hora_iso(valor):
+    """Normaliza uma data com hora para o formato ISO (AAAA-MM-DD HH:MM:SS)."""
+    texto = str(valor or '').strip()
+    encontrado = _DATA_ISO.match(texto)
+    if encontrado:
+        ano, mes, dia, hora = encontrado.groups()
+    else:
+        encontrado = _DATA_BR.match(texto)
+        if not encontrado:
+            raise ValueError(f"Data inválida: {valor!r}")
+        dia, mes, ano, hora = encontrado.groups()
+    hora = hora or '00:00:00'
+    if len(hora) == 5:
+        hora += ':00'
+    return f"{ano}-{mes}-{dia} {hora}"
+
+
+def formatar_data(valor):
+    """Formata uma data ISO no padrão brasileiro (DD/MM/AAAA, com HH:MM quando houver hora)."""
+    encontrado = _DATA_ISO.match(str(valor or ''))
+    if not encontrado:
+        return valor or ''
+    ano, mes, dia, hora = encontrado.groups()
+    return f"{dia}/{mes}/{ano}" + (f" {hora[:5]}" if hora else '')
+
+
+def registrar_filtros(app):
+    """Registra os filtros de formatação nos templates Jinja da aplicação."""
+    app.add_template_filter(formatar_brl, 'brl')
+    app.add_template_filter(formatar_reais, 'reais')
+    app.add_template_filter(formatar_data, 'data_br')
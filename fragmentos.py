@@ -0,0 +1,161 @@
+"""
+Cache dos templates Jinja: bytecode compilado em disco e fragmentos já renderizados em memória.
+
+O FileSystemBytecodeCache guarda o código compilado de cada template, então um worker novo carrega os
+templates sem compilá-los outra vez. A tag {% cache %} guarda o HTML de um trecho do template:
+
+    {% cache 'listar_roupas', ordenar_por, ordem %} ... {% endcache %}   (fragmento do usuário logado)
+    {% cache 'painel_compras_formulario' global %} ... {% endcache %}     (fragmento igual para todos)
+
+A chave de um fragmento é o nome, os valores listados depois dele e o escopo devolvido pela função de
+escopo da aplicação. Para os fragmentos do usuário, o escopo inclui a versão dos dados do usuário, que
+muda a cada escrita: o fragmento antigo deixa de ser encontrado e sai do cache pela ordem LRU.
+"""
+
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from jinja2 import FileSystemBytecodeCache, nodes
+from jinja2.ext import Extension
+
+
+class CacheFragmentos:
+    """Fragmentos renderizados (LRU limitado a max_itens) e os contadores de cada fragmento."""
+
+    def __init__(self, max_itens=1000):
+        self.max_itens = max_itens
+        self._itens = OrderedDict()
+        self._contadores = {}
+        self._lock = threading.Lock()
+
+    def obter(self, chave):
+        with self._lock:
+            html = self._itens.get(chave)
+            if html is not None:
+                self._itens.move_to_end(chave)
+            return html
+
+    def guardar(self, chave, html):
+        with self._lock:
+            self._itens[chave] = html
+            self._itens.move_to_end(chave)
+            while len(self._itens) > self.max_itens:
+                self._itens.popitem(last=False)
+
+    def registrar(self, nome, acerto, duracao_ms):
+        """Soma um acerto (HTML servido do cache) ou uma falta (trecho renderizado) e o tempo gasto."""
+        with self._lock:
+            contadores = self._contadores.setdefault(nome, [0, 0, 0.0, 0.0])
+            if acerto:
+                contadores[0] += 1
+                contadores[2] += duracao_ms
+            else:
+                contadores[1] += 1
+                contadores[3] += duracao_ms
+
+    def limpar(self):
+        with self._lock:
+            self._itens.clear()
+            self._contadores.clear()
+
+    def estatisticas(self):
+        """
+        Por fragmento: acertos, faltas, tempo médio de uma renderização e de um acerto e a economia
+        estimada (acertos x tempo médio de renderização, menos o tempo gasto nos acertos).
+        """
+        with self._lock:
+            contadores = {nome: list(valores) for nome, valores in self._contadores.items()}
+            itens = len(self._itens)
+        fragmentos = {}
+        for nome, (acertos, faltas, ms_acertos, ms_faltas) in sorted(contadores.items()):
+            media_renderizacao = ms_faltas / faltas if faltas else 0.0
+            fragmentos[nome] = {
+                'acertos': acertos,
+                'faltas': faltas,
+                'taxa_acerto': round(acertos / (acertos + faltas), 4) if acertos + faltas else 0.0,
+                'renderizacao_media_ms': round(media_renderizacao, 3),
+                'acerto_medio_ms': round(ms_acertos / acertos, 3) if acertos else 0.0,
+                'economia_estimada_ms': round(max(acertos * media_renderizacao - ms_acertos, 0.0), 1),
+            }
+        return {'itens': itens, 'max_itens': self.max_itens, 'fragmentos': fragmentos}
+
+
+class ExtensaoCacheFragmentos(Extension):
+    """Tag {% cache 'nome'[, valores da chave...] [global] %} ... {% endcache %}."""
+
+    tags = {'cache'}
+
+    def __init__(self, environment):
+        super().__init__(environment)
+        # escopo_fragmentos(global_) devolve a parte da chave que identifica o escopo do fragmento, ou None
+        # para renderizar sem cache (ex.: sem usuário logado).
+        environment.extend(cache_fragmentos=CacheFragmentos(), escopo_fragmentos=None)
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        partes = [parser.parse_expression()]
+        while parser.stream.skip_if('comma'):
+            partes.append(parser.parse_expression())
+        global_ = parser.stream.skip_if('name:global')
+        corpo = parser.parse_statements(('name:endcache',), drop_needle=True)
+        # Identifica esta compilação do template: quando o arquivo muda e é recompilado (auto_reload),
+        # os fragmentos renderizados com a versão anterior deixam de ser usados.
+        origem = nodes.Const(f"{parser.name}:{lineno}:{uuid.uuid4().hex[:8]}")
+        chamada = self.call_method('_renderizar', [nodes.List(partes), nodes.Const(global_), origem])
+        return nodes.CallBlock(chamada, [], [], corpo).set_lineno(lineno)
+
+    def _renderizar(self, partes, global_, origem, caller):
+        inicio = time.perf_counter()
+        escopo = self.environment.escopo_fragmentos
+        escopo = escopo(global_) if escopo is not None else None
+        if escopo is None:
+            return caller()
+        cache = self.environment.cache_fragmentos
+        chave = (origem, tuple(partes), escopo)
+        html = cache.obter(chave)
+        acerto = html is not None
+        if not acerto:
+            html = caller()
+            cache.guardar(chave, html)
+        cache.registrar(partes[0], acerto, (time.perf_counter() - inicio) * 1000)
+        return html
+
+
+class ResultadoAdiado:
+    """
+    Resultado de consulta executado só quando o template o usa (iteração, if ou len). Com o trecho que o
+    exibe servido pelo cache de fragmentos, a consulta não chega a ser executada.
+    """
+
+    def __init__(self, consulta):
+        self._consulta = consulta
+        self._linhas = None
+
+    def _carregar(self):
+        if self._linhas is None:
+            self._linhas = self._consulta()
+        return self._linhas
+
+    def __iter__(self):
+        return iter(self._carregar())
+
+    def __len__(self):
+        return len(self._carregar())
+
+    def __bool__(self):
+        return bool(self._carregar())
+
+
+def configurar_templates(app, diretorio_bytecode=None, bytecode=True, max_fragmentos=1000, escopo=None):
+    """
+    Ativa no ambiente Jinja da aplicação o cache de bytecode em disco (no diretório informado ou no
+    diretório temporário do sistema) e a tag {% cache %}, com o escopo dos fragmentos definido pela
+    função escopo(global_).
+    """
+    if bytecode:
+        app.jinja_env.bytecode_cache = FileSystemBytecodeCache(diretorio_bytecode, 'controle_estoque_%s.cache')
+    app.jinja_env.add_extension(ExtensaoCacheFragmentos)
+    app.jinja_env.cache_fragmentos.max_itens = max_fragmentos
+    app.jinja_env.escopo_fragmentos = escopo
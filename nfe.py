@@ -0,0 +1,194 @@
+"""
+Geração dos documentos XML de NF-e, um por venda, compactados em um arquivo ZIP gerado em fluxo.
+
+Os documentos são montados a partir de tuplas e dicionários simples, para que os lotes possam ser enviados
+a um pool de processos: cada processo gera um lote inteiro de vendas e devolve os XMLs prontos (bytes).
+O ZIP é escrito entrada por entrada, conforme os lotes terminam, sem guardar o arquivo inteiro em memória.
+"""
+
+import itertools
+import os
+import struct
+import time
+import zipfile
+import zlib
+import xml.etree.ElementTree as ET
+from concurrent.futures import FIRST_COMPLETED, wait
+
+# Ordem das colunas de cada venda (mesma ordem da consulta de exportação em app.py).
+COLUNAS_VENDA = ('VendaID', 'DataEmissao', 'DestNome', 'DestIE', 'DestFone', 'ProdCodigo', 'ProdDescricao',
+                 'ProdNCM', 'ProdUnidade', 'ProdQuantidade', 'ProdValorUnitario', 'ProdValorTotal')
+
+# Vendas por tarefa enviada ao pool: lotes maiores diluem o custo de enviar os dados entre os processos.
+TAMANHO_LOTE = 250
+
+
+def _texto(pai, tag, valor):
+    """Cria o elemento filho com o valor como texto (vazio para None)."""
+    ET.SubElement(pai, tag).text = '' if valor is None else str(valor)
+
+
+def gerar_xml_venda(emitente, venda):
+    """
+    Gera o documento XML (bytes UTF-8) de uma venda no leiaute simplificado da NF-e: identificação,
+    emitente, destinatário, produto e totais. emitente é um dicionário com os dados da tabela empresas e
+    venda uma tupla na ordem de COLUNAS_VENDA.
+    """
+    dados = dict(zip(COLUNAS_VENDA, venda))
+    nfe = ET.Element('NFe')
+    inf = ET.SubElement(nfe, 'infNFe', Id=f"NFe{dados['VendaID']}", versao='4.00')
+
+    ide = ET.SubElement(inf, 'ide')
+    _texto(ide, 'nNF', dados['VendaID'])
+    _texto(ide, 'dhEmi', dados['DataEmissao'])
+    _texto(ide, 'tpNF', 1)
+
+    emit = ET.SubElement(inf, 'emit')
+    _texto(emit, 'CNPJ', emitente.get('cnpj'))
+    _texto(emit, 'xNome', emitente.get('razao_social'))
+    _texto(emit, 'xFant', emitente.get('nome_fantasia'))
+    ender_emit = ET.SubElement(emit, 'enderEmit')
+    for tag, chave in (('xLgr', 'rua'), ('xBairro', 'bairro'), ('xMun', 'cidade'), ('UF', 'estado'),
+                       ('CEP', 'cep'), ('xPais', 'pais')):
+        _texto(ender_emit, tag, emitente.get(chave))
+    _texto(emit, 'IE', emitente.get('inscricao_estadual'))
+    _texto(emit, 'IM', emitente.get('inscricao_municipal'))
+    _texto(emit, 'CRT', emitente.get('regime_tributario'))
+
+    dest = ET.SubElement(inf, 'dest')
+    _texto(dest, 'xNome', dados['DestNome'])
+    _texto(dest, 'IE', dados['DestIE'])
+    _texto(dest, 'fone', dados['DestFone'])
+
+    det = ET.SubElement(inf, 'det', nItem='1')
+    prod = ET.SubElement(det, 'prod')
+    for tag, coluna in (('cProd', 'ProdCodigo'), ('xProd', 'ProdDescricao'), ('NCM', 'ProdNCM'),
+                        ('uCom', 'ProdUnidade'), ('qCom', 'ProdQuantidade'), ('vUnCom', 'ProdValorUnitario'),
+                        ('vProd', 'ProdValorTotal')):
+        _texto(prod, tag, dados[coluna])
+
+    icms_tot = ET.SubElement(ET.SubElement(inf, 'total'), 'ICMSTot')
+    _texto(icms_tot, 'vProd', dados['ProdValorTotal'])
+    _texto(icms_tot, 'vNF', dados['ProdValorTotal'])
+
+    ET.indent(nfe)
+    return ET.tostring(nfe, encoding='utf-8', xml_declaration=True)
+
+
+def nome_documento(venda):
+    """Nome da entrada do ZIP para a venda (ex.: NFe_000123.xml)."""
+    return f"NFe_{int(venda[0]):06d}.xml"
+
+
+def gerar_lote(emitente, vendas):
+    """Tarefa do pool: gera os documentos de um lote de vendas e retorna [(nome, xml)]."""
+    return [(nome_documento(venda), gerar_xml_venda(emitente, venda)) for venda in vendas]
+
+
+def gerar_documentos(emitente, vendas, executor=None, tamanho_lote=TAMANHO_LOTE):
+    """
+    Gera (nome, xml) para cada venda, na ordem em que os lotes terminam. vendas pode ser qualquer iterável
+    (ex.: um cursor): os lotes são lidos conforme são enviados. Com executor (um pool de processos), os lotes
+    são gerados em paralelo, com no máximo dois lotes por processo em andamento para limitar a memória; sem
+    executor, os documentos são gerados no próprio processo.
+    """
+    vendas = iter(vendas)
+    proximos = iter(lambda: list(itertools.islice(vendas, tamanho_lote)), [])
+    if executor is None:
+        for lote in proximos:
+            yield from gerar_lote(emitente, lote)
+        return
+
+    limite = 2 * getattr(executor, '_max_workers', os.cpu_count() or 1)
+    pendentes = set()
+    try:
+        while True:
+            for lote in proximos:
+                pendentes.add(executor.submit(gerar_lote, emitente, lote))
+                if len(pendentes) >= limite:
+                    break
+            if not pendentes:
+                return
+            prontos, pendentes = wait(pendentes, return_when=FIRST_COMPLETED)
+            for futuro in prontos:
+                yield from futuro.result()
+    finally:
+        # Se o download for interrompido, os lotes ainda não iniciados não são gerados.
+        for futuro in pendentes:
+            futuro.cancel()
+
+
+# Campos "não cabe em 32/16 bits" do formato ZIP: o valor real vai nos registros ZIP64.
+_LIMITE_ZIP32 = 0xFFFFFFFF
+_LIMITE_ENTRADAS_ZIP32 = 0xFFFF
+
+
+def _data_hora_dos(instante):
+    """Data e hora no formato do MS-DOS usado nos cabeçalhos do ZIP."""
+    t = time.localtime(instante)
+    return (t.tm_hour << 11 | t.tm_min << 5 | t.tm_sec // 2,
+            (max(t.tm_year, 1980) - 1980) << 9 | t.tm_mon << 5 | t.tm_mday)
+
+
+def _entrada_zip(nome, conteudo, deslocamento, hora, data):
+    """
+    Compacta um documento e retorna (entrada, registro): entrada são os bytes do cabeçalho local seguido dos
+    dados; registro, a linha do diretório central que aponta para ela.
+    """
+    nome = nome.encode('utf-8')
+    compactador = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+    dados = compactador.compress(conteudo) + compactador.flush()
+    crc = zlib.crc32(conteudo)
+    cabecalho = struct.pack('<IHHHHHIIIHH', 0x04034B50, 20, 0x800, zipfile.ZIP_DEFLATED, hora, data, crc,
+                            len(dados), len(conteudo), len(nome), 0)
+    extra = b''
+    if deslocamento >= _LIMITE_ZIP32:
+        extra = struct.pack('<HHQ', 0x0001, 8, deslocamento)
+    registro = struct.pack('<IHHHHHHIIIHHHHHII', 0x02014B50, 45 if extra else 20, 45 if extra else 20, 0x800,
+                           zipfile.ZIP_DEFLATED, hora, data, crc, len(dados), len(conteudo), len(nome), len(extra),
+                           0, 0, 0, 0o600 << 16, min(deslocamento, _LIMITE_ZIP32))
+    return cabecalho + nome + dados, registro + nome + extra
+
+
+def _fim_zip(quantidade, tamanho_diretorio, inicio_diretorio):
+    """Registros de fim do ZIP, com os registros ZIP64 quando a quantidade ou os deslocamentos pedem."""
+    fim = b''
+    if (quantidade >= _LIMITE_ENTRADAS_ZIP32 or tamanho_diretorio >= _LIMITE_ZIP32
+            or inicio_diretorio >= _LIMITE_ZIP32):
+        fim = struct.pack('<IQHHIIQQQQ', 0x06064B50, 44, 45, 45, 0, 0, quantidade, quantidade,
+                          tamanho_diretorio, inicio_diretorio)
+        fim += struct.pack('<IIQI', 0x07064B50, 0, inicio_diretorio + tamanho_diretorio, 1)
+    return fim + struct.pack('<IHHHHIIH', 0x06054B50, 0, 0, min(quantidade, _LIMITE_ENTRADAS_ZIP32),
+                             min(quantidade, _LIMITE_ENTRADAS_ZIP32), min(tamanho_diretorio, _LIMITE_ZIP32),
+                             min(inicio_diretorio, _LIMITE_ZIP32), 0)
+
+
+def zip_em_fluxo(documentos, ao_terminar=None, tamanho_bloco=2 ** 16):
+    """
+    Compacta os documentos (nome, conteúdo) em um ZIP, entregando os bytes em blocos de ~tamanho_bloco
+    conforme as entradas são escritas. Só o diretório central (algumas dezenas de bytes por entrada) fica em
+    memória até o fim; o zipfile guardaria um ZipInfo por entrada, cerca de 1 KiB cada.
+    ao_terminar(quantidade, segundos) é chamado ao final, para registrar a vazão.
+    """
+    inicio = time.perf_counter()
+    hora, data = _data_hora_dos(time.time())
+    diretorio = bytearray()
+    bloco = bytearray()
+    deslocamento = quantidade = 0
+    for nome, conteudo in documentos:
+        entrada, registro = _entrada_zip(nome, conteudo, deslocamento, hora, data)
+        deslocamento += len(entrada)
+        diretorio += registro
+        quantidade += 1
+        bloco += entrada
+        if len(bloco) >= tamanho_bloco:
+            yield bytes(bloco)
+            bloco.clear()
+    if bloco:
+        yield bytes(bloco)
+    # O diretório central é escrito no fim, em blocos.
+    for i in range(0, len(diretorio), tamanho_bloco):
+        yield bytes(diretorio[i:i + tamanho_bloco])
+    yield _fim_zip(quantidade, len(diretorio), deslocamento)
+    if ao_terminar is not None:
+        ao_terminar(quantidade, time.perf_counter() - inicio)
@@ -0,0 +1,82 @@
+"""
+Previsão de demanda e ponto de reposição por produto (SKU).
+
+As vendas diárias de todos os produtos são carregadas em uma única matriz NumPy (produtos x dias) e
+todas as métricas são calculadas de uma vez, com operações vetorizadas sobre a matriz inteira, sem
+laços em Python por produto. O NumPy é opcional: sem ele, PREVISAO_DISPONIVEL é False.
+"""
+
+try:
+    import numpy as np
+except ImportError:  # O restante da aplicação funciona sem o NumPy; só a previsão fica indisponível.
+    np = None
+
+PREVISAO_DISPONIVEL = np is not None
+
+# Peso da observação mais recente na suavização exponencial simples.
+ALFA_PADRAO = 0.3
+# Dias entre o pedido de reposição e a chegada da mercadoria.
+PRAZO_REPOSICAO_PADRAO = 7
+# Fator da distribuição normal para o nível de serviço do estoque de segurança (1,65 ~ 95%).
+Z_NIVEL_SERVICO_PADRAO = 1.65
+
+
+def matriz_vendas_diarias(roupa_ids, vendas_roupa_ids, vendas_datas, vendas_quantidades, inicio, dias):
+    """
+    Monta a matriz (produtos x dias) de unidades vendidas.
+
+    roupa_ids são os ids dos produtos, em ordem crescente (uma linha da matriz por produto);
+    vendas_* são colunas paralelas com o id do produto, a data ISO e a quantidade de cada venda
+    (ou de cada soma diária). inicio é a data ISO da primeira coluna.
+    """
+    roupa_ids = np.asarray(roupa_ids, dtype=np.int64)
+    matriz = np.zeros((len(roupa_ids), dias), dtype=np.float32)
+    if len(vendas_roupa_ids) == 0:
+        return matriz
+    linhas = np.searchsorted(roupa_ids, np.asarray(vendas_roupa_ids, dtype=np.int64))
+    colunas = (np.asarray(vendas_datas, dtype='datetime64[D]') - np.datetime64(inicio, 'D')).astype(np.int64)
+    validas = (linhas < len(roupa_ids)) & (colunas >= 0) & (colunas < dias)
+    validas[validas] &= roupa_ids[linhas[validas]] == np.asarray(vendas_roupa_ids, dtype=np.int64)[validas]
+    # add.at soma corretamente várias vendas do mesmo produto no mesmo dia.
+    np.add.at(matriz, (linhas[validas], colunas[validas]),
+              np.asarray(vendas_quantidades, dtype=np.float32)[validas])
+    return matriz
+
+
+def calcular_previsoes(matriz, estoque, alfa=ALFA_PADRAO, prazo_reposicao=PRAZO_REPOSICAO_PADRAO,
+                       z=Z_NIVEL_SERVICO_PADRAO):
+    """
+    Calcula, para todos os produtos de uma vez, as médias móveis de 7 e 28 dias, a demanda diária
+    prevista por suavização exponencial, o desvio padrão diário, os dias de cobertura do estoque
+    atual e o ponto de reposição (demanda no prazo + estoque de segurança).
+    Retorna um dicionário de arrays, uma posição por linha da matriz.
+    """
+    matriz = np.asarray(matriz, dtype=np.float64)
+    estoque = np.asarray(estoque, dtype=np.float64)
+    dias = matriz.shape[1]
+
+    media_7d = matriz[:, -7:].mean(axis=1)
+    media_28d = matriz[:, -28:].mean(axis=1)
+
+    # Suavização exponencial: n_t = a*x_t + (1-a)*n_(t-1), com n_0 = x_0. O nível final é uma média
+    # ponderada de todos os dias, calculada como um único produto matriz x vetor.
+    expoentes = np.arange(dias - 1, -1, -1)
+    pesos = alfa * (1 - alfa) ** expoentes
+    pesos[0] = (1 - alfa) ** (dias - 1)
+    demanda_diaria = matriz @ pesos
+
+    desvio = matriz.std(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        dias_cobertura = np.where(demanda_diaria > 0, estoque / demanda_diaria, np.inf)
+    ponto_reposicao = np.ceil(demanda_diaria * prazo_reposicao + z * desvio * np.sqrt(prazo_reposicao))
+    estoque_baixo = (demanda_diaria > 0) & (estoque <= ponto_reposicao)
+
+    return {
+        'media_7d': media_7d,
+        'media_28d': media_28d,
+        'demanda_diaria': demanda_diaria,
+        'desvio': desvio,
+        'dias_cobertura': dias_cobertura,
+        'ponto_reposicao': ponto_reposicao.astype(np.int64),
+        'estoque_baixo': estoque_baixo,
+    }
@@ -0,0 +1,266 @@
+"""
+Camada de acesso a dados: registro central das instruções SQL das consultas mais frequentes.
+
+Cada instrução é registrada uma única vez, com um nome, quando o módulo é carregado; a aplicação a executa
+pelo nome. O texto SQL de uma instrução é sempre o mesmo, então o cache de instruções do sqlite3 (um por
+conexão, dimensionado pelo tamanho do registro em tamanho_cache()) a compila uma única vez por conexão.
+Ordenações escolhidas pelo usuário viram uma instrução por coluna e direção permitidas, em vez de um
+ORDER BY montado a cada requisição.
+
+As linhas são devolvidas como dataclasses com __slots__, criadas a partir das colunas da consulta: sem o
+dicionário por instância, ocupam menos memória que um sqlite3.Row e continuam aceitando linha['coluna'],
+dict(linha) e linha.coluna (templates). Cada instrução acumula execuções, linhas e tempo de execução.
+"""
+
+import threading
+import time
+from dataclasses import make_dataclass
+
+
+class Linha:
+    """Base dos tipos de linha: acesso por chave e keys(), como sqlite3.Row, para dict(linha) e linha['coluna']."""
+
+    __slots__ = ()
+
+    def __getitem__(self, chave):
+        if isinstance(chave, int):
+            return getattr(self, self.__slots__[chave])
+        return getattr(self, chave)
+
+    def keys(self):
+        return list(self.__slots__)
+
+
+def tipo_linha(nome, colunas):
+    """Cria a dataclass com __slots__ de uma instrução a partir dos nomes das colunas."""
+    nome_tipo = 'Linha_' + ''.join(c if c.isalnum() else '_' for c in nome)
+    return make_dataclass(nome_tipo, list(colunas), bases=(Linha,), slots=True, eq=False)
+
+
+class Instrucao:
+    """Instrução registrada: texto SQL, tipo das linhas (criado na primeira execução) e contadores."""
+
+    __slots__ = ('nome', 'sql', 'colunas', 'tipo', 'execucoes', 'linhas', 'segundos', 'maximo')
+
+    def __init__(self, nome, sql):
+        self.nome = nome
+        self.sql = sql
+        self.colunas = None
+        self.tipo = None
+        self.execucoes = self.linhas = 0
+        self.segundos = self.maximo = 0.0
+
+    def tipo_para(self, descricao):
+        """Tipo das linhas para as colunas do cursor (refeito se as colunas mudarem, ex.: após uma migração)."""
+        colunas = tuple(coluna[0] for coluna in descricao)
+        if colunas != self.colunas:
+            self.tipo = tipo_linha(self.nome, colunas)
+            self.colunas = colunas
+        return self.tipo
+
+
+class Repositorio:
+    """Registro das instruções SQL, com execução pelo nome e contadores por instrução."""
+
+    # Entradas do cache de instruções além das registradas, para as consultas que ainda são montadas no código.
+    FOLGA_CACHE = 64
+
+    def __init__(self):
+        self._instrucoes = {}
+        self._ordenacoes = {}
+        self._lock = threading.Lock()
+
+    def registrar(self, nome, sql):
+        """Registra a instrução com o nome informado. Retorna o nome."""
+        if nome in self._instrucoes:
+            raise ValueError(f"Instrução já registrada: {nome}")
+        self._instrucoes[nome] = Instrucao(nome, sql)
+        return nome
+
+    def registrar_ordenacoes(self, nome, sql, colunas, padrao):
+        """
+        Registra uma instrução para cada coluna de ordenação permitida e cada direção. sql tem o marcador
+        {ordem} no lugar do ORDER BY; colunas mapeia o nome aceito na URL para a expressão SQL.
+        """
+        for coluna, expressao in colunas.items():
+            for direcao in ('ASC', 'DESC'):
+                self.registrar(f"{nome}:{coluna}:{direcao}", sql.format(ordem=f"{expressao} {direcao}"))
+        self._ordenacoes[nome] = (frozenset(colunas), padrao)
+
+    def ordenacao(self, nome, coluna, direcao):
+        """
+        Retorna (instrução, coluna, direção) para a ordenação pedida; coluna ou direção inválidas são
+        trocadas pela coluna padrão e pela ordem ascendente.
+        """
+        colunas, padrao = self._ordenacoes[nome]
+        coluna = coluna if coluna in colunas else padrao
+        direcao = direcao.upper() if direcao and direcao.upper() in ('ASC', 'DESC') else 'ASC'
+        return f"{nome}:{coluna}:{direcao}", coluna, direcao
+
+    def sql(self, nome):
+        return self._instrucoes[nome].sql
+
+    def _registrar_execucao(self, instrucao, linhas, segundos):
+        with self._lock:
+            instrucao.execucoes += 1
+            instrucao.linhas += linhas
+            instrucao.segundos += segundos
+            if segundos > instrucao.maximo:
+                instrucao.maximo = segundos
+
+    def linhas(self, db, nome, args=()):
+        """Executa a consulta registrada e retorna as linhas como objetos do tipo da instrução."""
+        instrucao = self._instrucoes[nome]
+        inicio = time.perf_counter()
+        cur = db.cursor()
+        cur.row_factory = None
+        cur.execute(instrucao.sql, args)
+        tuplas = cur.fetchall()
+        tipo = instrucao.tipo_para(cur.description)
+        cur.close()
+        linhas = [tipo(*tupla) for tupla in tuplas]
+        self._registrar_execucao(instrucao, len(linhas), time.perf_counter() - inicio)
+        return linhas
+
+    def linha(self, db, nome, args=()):
+        """Executa a consulta registrada e retorna a primeira linha (ou None)."""
+        linhas = self.linhas(db, nome, args)
+        return linhas[0] if linhas else None
+
+    def executar(self, db, nome, args=()):
+        """Executa uma instrução de escrita registrada e retorna o cursor (lastrowid, rowcount)."""
+        instrucao = self._instrucoes[nome]
+        inicio = time.perf_counter()
+        cur = db.execute(instrucao.sql, args)
+        self._registrar_execucao(instrucao, max(cur.rowcount, 0), time.perf_counter() - inicio)
+        return cur
+
+    def tamanho_cache(self):
+        """Tamanho do cache de instruções das conexões: todas as instruções registradas mais a folga."""
+        return len(self._instrucoes) + self.FOLGA_CACHE
+
+    def zerar(self):
+        with self._lock:
+            for instrucao in self._instrucoes.values():
+                instrucao.execucoes = instrucao.linhas = 0
+                instrucao.segundos = instrucao.maximo = 0.0
+
+    def estatisticas(self):
+        """Contadores das instruções já executadas, da que mais consumiu tempo para a que menos consumiu."""
+        with self._lock:
+            executadas = [(i.nome, i.execucoes, i.linhas, i.segundos, i.maximo)
+                          for i in self._instrucoes.values() if i.execucoes]
+        executadas.sort(key=lambda item: item[3], reverse=True)
+        return {
+            'registradas': len(self._instrucoes),
+            'cache_instrucoes': self.tamanho_cache(),
+            'instrucoes': [{'nome': nome, 'execucoes': execucoes, 'linhas': linhas,
+                            'tempo_total_ms': round(segundos * 1000, 3),
+                            'tempo_medio_ms': round(segundos * 1000 / execucoes, 3),
+                            'tempo_maximo_ms': round(maximo * 1000, 3)}
+                           for nome, execucoes, linhas, segundos, maximo in executadas],
+        }
+
+
+repositorio = Repositorio()
+
+# --- Roupas ---
+
+# Colunas aceitas em ?ordenar_por= na lista de roupas.
+ORDENACOES_ROUPAS = {coluna: f"r.{coluna}" for coluna in ('id', 'codigo_produto', 'tipo_roupa', 'tecido', 'quantidade',
+                                                          'cor', 'tamanhos', 'detalhes', 'preco_centavos',
+                                                          'quantida_vendas')}
+
+repositorio.registrar_ordenacoes('roupas.listar', '''
+    SELECT r.*, p.ponto_reposicao, p.dias_cobertura, p.estoque_baixo
+    FROM roupas r
+             LEFT JOIN previsoes_estoque p ON p.roupa_id = r.id
+    WHERE r.usuario_id = ?
+    ORDER BY {ordem}
+    ''', ORDENACOES_ROUPAS, 'id')
+repositorio.registrar_ordenacoes('roupas.listar_estoque_baixo', '''
+    SELECT r.*, p.ponto_reposicao, p.dias_cobertura, p.estoque_baixo
+    FROM roupas r
+             JOIN previsoes_estoque p ON p.roupa_id = r.id
+    WHERE r.usuario_id = ? AND p.estoque_baixo = 1
+    ORDER BY {ordem}
+    ''', ORDENACOES_ROUPAS, 'id')
+repositorio.registrar('roupas.por_id', 'SELECT * FROM roupas WHERE id = ? AND usuario_id = ?')
+repositorio.registrar('roupas.por_codigo',
+                      'SELECT id, quantidade FROM roupas WHERE codigo_produto = ? AND usuario_id = ?')
+repositorio.registrar('roupas.baixar_venda', '''
+    UPDATE roupas
+    SET quantidade      = quantidade - ?,
+        quantida_vendas = COALESCE(quantida_vendas, 0) + ?
+    WHERE id = ?
+      AND usuario_id = ?
+    ''')
+repositorio.registrar('roupas.grade', '''
+    SELECT r.codigo_produto, r.quantidade AS total, v.id, v.tamanho, v.cor,
+           v.quantidade AS total_variante,
+           CASE WHEN ? IS NULL THEN COALESCE(v.quantidade, r.quantidade)
+                ELSE COALESCE(e.quantidade, 0) END AS quantidade
+    FROM roupas r
+             LEFT JOIN variantes v ON v.roupa_id = r.id
+             LEFT JOIN estoque_local e
+                       ON e.roupa_id = r.id AND e.variante_id = COALESCE(v.id, 0) AND e.local_id = ?
+    WHERE r.codigo_produto = ? AND r.usuario_id = ?
+    ''')
+repositorio.registrar('previsoes.calculado_em',
+                      'SELECT calculado_em FROM previsoes_estoque WHERE usuario_id = ? LIMIT 1')
+
+# --- Grade (variantes) ---
+
+repositorio.registrar('variantes.do_produto', 'SELECT id, tamanho, cor, quantidade FROM variantes WHERE roupa_id = ?')
+repositorio.registrar('variantes.baixar', 'UPDATE variantes SET quantidade = quantidade - ? WHERE id = ?')
+
+# --- Locais e estoque por local ---
+
+repositorio.registrar('locais.ativos', '''
+    SELECT id, nome, tipo, ativo FROM locais
+    WHERE usuario_id = ? AND ativo = 1
+    ORDER BY tipo DESC, nome
+    ''')
+repositorio.registrar('locais.todos', '''
+    SELECT id, nome, tipo, ativo FROM locais
+    WHERE usuario_id = ?
+    ORDER BY tipo DESC, nome
+    ''')
+repositorio.registrar('locais.por_id', 'SELECT id, nome, tipo, ativo FROM locais WHERE id = ?')
+repositorio.registrar('locais.ativo_por_id',
+                      'SELECT id, nome, tipo, ativo FROM locais WHERE id = ? AND usuario_id = ? AND ativo = 1')
+repositorio.registrar('estoque_local.quantidade',
+                      'SELECT quantidade FROM estoque_local WHERE roupa_id = ? AND variante_id = ? AND local_id = ?')
+
+# --- Vendas ---
+
+repositorio.registrar('vendas.inserir', '''
+    INSERT INTO vendas (usuario_id, cliente_id, roupa_id, funcionario_id, quantidade_vendida,
+                        valor_total_centavos, data_venda, variante_id, local_id)
+    VALUES (?, ?, ?, ?, ?, ?, DATE ('now', 'localtime'), ?, ?)
+    ''')
+
+# --- Funcionários e clientes ---
+
+repositorio.registrar_ordenacoes('funcionarios.listar', '''
+    SELECT f.id, f.nome_completo, f.cargo, f.data_inicio_contrato, f.data_fim_contrato, f.cidade, f.estado,
+           COALESCE(SUM(v.valor_total_centavos), 0) AS total_valor_mes,
+           COUNT(v.id) AS numero_vendas_mes
+    FROM funcionarios f
+             LEFT JOIN vendas v ON f.id = v.funcionario_id
+        AND STRFTIME('%Y-%m', v.data_venda) = STRFTIME('%Y-%m', 'now', 'localtime')
+    WHERE f.usuario_id = ?
+    GROUP BY f.id
+    ORDER BY {ordem}
+    ''', {coluna: coluna for coluna in ('nome_completo', 'cargo', 'data_inicio_contrato', 'total_valor_mes',
+                                        'numero_vendas_mes')}, 'nome_completo')
+repositorio.registrar('funcionarios.buscar_ativos', '''
+    SELECT id, nome_completo
+    FROM funcionarios
+    WHERE nome_completo LIKE ?
+      AND usuario_id = ?
+      AND (data_fim_contrato IS NULL OR data_fim_contrato = '')
+    ORDER BY nome_completo LIMIT 10
+    ''')
+repositorio.registrar('clientes.buscar',
+                      'SELECT id, nome FROM clientes WHERE nome LIKE ? AND usuario_id = ? ORDER BY nome LIMIT 10')
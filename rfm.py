@@ -0,0 +1,113 @@
+"""
+Segmentação RFM dos clientes: recência, frequência e valor (monetário) das compras.
+
+Cada cliente recebe uma nota de 1 a 5 em cada dimensão, pelo quintil em que está entre os clientes do mesmo
+usuário (loja). Os limites dos quintis de cada usuário são calculados no recálculo completo, em uma única
+passada vetorizada sobre todos os clientes de todos os usuários (NumPy), e guardados para que a compra de um
+cliente seja pontuada sozinha, com uma busca binária em cada dimensão. Sem o NumPy, o recálculo usa o
+mesmo critério em Python puro.
+"""
+
+from bisect import bisect_left
+
+try:
+    import numpy as np
+except ImportError:  # O recálculo cai para a versão em Python puro; o resultado é o mesmo.
+    np = None
+
+RFM_VETORIZADO = np is not None
+
+# Posição dos limites entre as notas (20%, 40%, 60% e 80% dos clientes, ordenados por valor).
+QUANTIS = (0.2, 0.4, 0.6, 0.8)
+
+# Segmentos na ordem de avaliação: o cliente fica no primeiro cuja condição atende. As condições usam apenas
+# comparações e '&', para valerem tanto com notas inteiras quanto com arrays do NumPy.
+SEGMENTOS = (
+    ('campeoes', 'Campeões', lambda r, f, m: (r >= 4) & (f + m >= 8)),
+    ('fieis', 'Fiéis', lambda r, f, m: (r >= 3) & (f + m >= 6)),
+    ('novos', 'Novos', lambda r, f, m: (r >= 4) & (f == 1)),
+    ('promissores', 'Promissores', lambda r, f, m: r >= 3),
+    ('em_risco', 'Em risco', lambda r, f, m: f + m >= 6),
+    ('hibernando', 'Hibernando', lambda r, f, m: r == 2),
+    ('perdidos', 'Perdidos', lambda r, f, m: r == 1),
+)
+SEGMENTO_SEM_COMPRAS = ('sem_compras', 'Sem compras')
+ROTULOS_SEGMENTOS = dict([(nome, rotulo) for nome, rotulo, _condicao in SEGMENTOS] + [SEGMENTO_SEM_COMPRAS])
+
+
+def limites(valores_ordenados):
+    """Limites dos quintis de uma lista ordenada (o valor na posição de cada quantil, sem interpolação)."""
+    ultimo = len(valores_ordenados) - 1
+    return [valores_ordenados[int(q * ultimo)] for q in QUANTIS]
+
+
+def segmento(r, f, m):
+    """Nome do segmento das notas r, f e m."""
+    for nome, _rotulo, condicao in SEGMENTOS:
+        if condicao(r, f, m):
+            return nome
+    return SEGMENTOS[-1][0]
+
+
+def pontuar(limites_usuario, dias, compras, total_centavos):
+    """
+    Notas (r, f, m) e segmento de um cliente pelos limites do seu usuário ({'recencia', 'frequencia',
+    'monetario'}). dias é o número de dias desde a última compra: quanto menos dias, maior a nota.
+    """
+    r = 5 - bisect_left(limites_usuario['recencia'], dias)
+    f = 1 + bisect_left(limites_usuario['frequencia'], compras)
+    m = 1 + bisect_left(limites_usuario['monetario'], total_centavos)
+    return r, f, m, segmento(r, f, m)
+
+
+def calcular_rfm(usuario_ids, dias, compras, totais):
+    """
+    Calcula as notas e o segmento de todos os clientes e os limites de cada usuário. As entradas são colunas
+    paralelas, uma posição por cliente com compras. Retorna (notas, limites_por_usuario), em que notas é uma
+    lista de tuplas (r, f, m, segmento) na ordem das entradas.
+    """
+    if not usuario_ids:
+        return [], {}
+    if np is None:
+        return _calcular_rfm_python(usuario_ids, dias, compras, totais)
+
+    usuarios = np.asarray(usuario_ids, dtype=np.int64)
+    colunas = {'recencia': np.asarray(dias, dtype=np.int64), 'frequencia': np.asarray(compras, dtype=np.int64),
+               'monetario': np.asarray(totais, dtype=np.int64)}
+    quantis = np.asarray(QUANTIS)
+    por_usuario, notas = {}, {}
+    for dimensao, valores in colunas.items():
+        # Ordena por usuário e valor: cada usuário vira um trecho contínuo e os limites são lidos por índice.
+        ordem = np.lexsort((valores, usuarios))
+        usuarios_ordenados, valores_ordenados = usuarios[ordem], valores[ordem]
+        inicios = np.flatnonzero(np.r_[True, usuarios_ordenados[1:] != usuarios_ordenados[:-1]])
+        tamanhos = np.diff(np.r_[inicios, len(ordem)])
+        limites_grupos = valores_ordenados[inicios[:, None] + (quantis[None, :] * (tamanhos[:, None] - 1))
+                                           .astype(np.int64)]
+        grupos = usuarios_ordenados[inicios]
+        # Quantidade de limites abaixo do valor de cada cliente (o mesmo que bisect_left em pontuar).
+        acima = (valores[:, None] > limites_grupos[np.searchsorted(grupos, usuarios)]).sum(axis=1)
+        notas[dimensao] = 5 - acima if dimensao == 'recencia' else 1 + acima
+        for usuario_id, limites_usuario in zip(grupos.tolist(), limites_grupos.tolist()):
+            por_usuario.setdefault(usuario_id, {})[dimensao] = limites_usuario
+
+    r, f, m = notas['recencia'], notas['frequencia'], notas['monetario']
+    segmentos = np.select([condicao(r, f, m) for _nome, _rotulo, condicao in SEGMENTOS],
+                          [nome for nome, _rotulo, _condicao in SEGMENTOS], default=SEGMENTOS[-1][0])
+    return list(zip(r.tolist(), f.tolist(), m.tolist(), segmentos.tolist())), por_usuario
+
+
+def _calcular_rfm_python(usuario_ids, dias, compras, totais):
+    """Versão de calcular_rfm sem o NumPy: limites por usuário com sorted e notas com pontuar."""
+    valores_por_usuario = {}
+    for usuario_id, d, c, t in zip(usuario_ids, dias, compras, totais):
+        valores = valores_por_usuario.setdefault(usuario_id, ([], [], []))
+        valores[0].append(d)
+        valores[1].append(c)
+        valores[2].append(t)
+    por_usuario = {usuario_id: {dimensao: limites(sorted(lista))
+                                for dimensao, lista in zip(('recencia', 'frequencia', 'monetario'), valores)}
+                   for usuario_id, valores in valores_por_usuario.items()}
+    notas = [pontuar(por_usuario[usuario_id], d, c, t)
+             for usuario_id, d, c, t in zip(usuario_ids, dias, compras, totais)]
+    return notas, por_usuario
@@ -1,3 +1,6 @@
+-- O vacuum incremental (flask manutencao) só funciona se o auto_vacuum for definido antes das tabelas.
+PRAGMA auto_vacuum = INCREMENTAL;
+
 -- DROP TABLE IF EXISTS usuarios;
 CREATE TABLE usuarios (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -8,6 +11,9 @@ CREATE TABLE usuarios (
     senha_hash TEXT NOT NULL
 );
 
+-- Valores em dinheiro são guardados em centavos (INTEGER) e datas no formato ISO (AAAA-MM-DD [HH:MM:SS]).
+-- A ordem das colunas de roupas e vendas é a de um banco migrado pelas MIGRACOES, em que a migração dos centavos
+-- recriou as colunas de valor no fim: assim as linhas de SELECT * têm as mesmas colunas, na mesma ordem, nos dois.
 -- DROP TABLE IF EXISTS roupas;
 CREATE TABLE roupas (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -20,11 +26,53 @@ CREATE TABLE roupas (
     cor TEXT NOT NULL,
     tamanhos TEXT,
     detalhes TEXT,
-    preco_unitario REAL,
     quantida_vendas INTEGER,
+    versao INTEGER NOT NULL DEFAULT 0,
+    preco_centavos INTEGER,
     FOREIGN KEY (usuario_id) REFERENCES usuarios(id)
 );
 CREATE UNIQUE INDEX idx_roupas_usuario_codigo ON roupas (usuario_id, codigo_produto);
+CREATE INDEX idx_roupas_usuario_versao ON roupas (usuario_id, versao);
+
+-- Grade do produto: estoque por tamanho e cor. Em um produto com grade, roupas.quantidade é a soma das variantes
+-- e roupas.tamanhos/cor apenas descrevem a grade. O segundo índice cobre a disponibilidade de um tamanho/cor
+-- em todo o catálogo sem ler a tabela.
+CREATE TABLE variantes (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    usuario_id INTEGER NOT NULL,
+    roupa_id INTEGER NOT NULL,
+    tamanho TEXT NOT NULL,
+    cor TEXT NOT NULL,
+    quantidade INTEGER NOT NULL DEFAULT 0 CHECK (quantidade >= 0),
+    FOREIGN KEY (usuario_id) REFERENCES usuarios(id),
+    FOREIGN KEY (roupa_id) REFERENCES roupas(id)
+);
+CREATE UNIQUE INDEX idx_variantes_roupa_tamanho_cor ON variantes (roupa_id, tamanho, cor);
+CREATE INDEX idx_variantes_usuario_tamanho_cor ON variantes (usuario_id, tamanho, cor, quantidade);
+
+-- Contador de alterações do catálogo de cada usuário (sincronização incremental do painel de compras).
+-- Toda inclusão ou alteração relevante em 'roupas' recebe o próximo número da versão do catálogo.
+CREATE TABLE catalogo_versao (
+    usuario_id INTEGER PRIMARY KEY,
+    versao INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE TRIGGER trg_roupas_versao_insert AFTER INSERT ON roupas
+BEGIN
+    INSERT INTO catalogo_versao (usuario_id, versao) VALUES (NEW.usuario_id, 1)
+        ON CONFLICT (usuario_id) DO UPDATE SET versao = versao + 1;
+    UPDATE roupas SET versao = (SELECT versao FROM catalogo_versao WHERE usuario_id = NEW.usuario_id)
+    WHERE id = NEW.id;
+END;
+
+CREATE TRIGGER trg_roupas_versao_update
+    AFTER UPDATE OF codigo_produto, tipo_roupa, cor, detalhes, preco_centavos, quantidade ON roupas
+BEGIN
+    INSERT INTO catalogo_versao (usuario_id, versao) VALUES (NEW.usuario_id, 1)
+        ON CONFLICT (usuario_id) DO UPDATE SET versao = versao + 1;
+    UPDATE roupas SET versao = (SELECT versao FROM catalogo_versao WHERE usuario_id = NEW.usuario_id)
+    WHERE id = NEW.id;
+END;
 
 CREATE TABLE IF NOT EXISTS funcionarios (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -82,11 +130,380 @@ CREATE TABLE vendas (
     roupa_id INTEGER NOT NULL,
     funcionario_id INTEGER,
     quantidade_vendida INTEGER NOT NULL,
-    valor_total_venda REAL NOT NULL,
     data_venda DATE NOT NULL,
+    valor_total_centavos INTEGER NOT NULL DEFAULT 0,
+    variante_id INTEGER REFERENCES variantes(id),
+    local_id INTEGER REFERENCES locais(id),
     FOREIGN KEY (usuario_id) REFERENCES usuarios(id),
     FOREIGN KEY (cliente_id) REFERENCES clientes(id),
     FOREIGN KEY (roupa_id) REFERENCES roupas(id),
     FOREIGN KEY (funcionario_id) REFERENCES funcionarios(id)
 );
+CREATE INDEX idx_vendas_usuario_data ON vendas (usuario_id, data_venda, valor_total_centavos);
+CREATE INDEX idx_vendas_variante ON vendas (variante_id) WHERE variante_id IS NOT NULL;
+
+-- Anos de vendas movidos para arquivos SQLite separados (flask arquivar-vendas).
+CREATE TABLE arquivos_vendas (
+    ano INTEGER PRIMARY KEY,
+    arquivo TEXT NOT NULL,
+    linhas INTEGER NOT NULL,
+    total_centavos INTEGER NOT NULL,
+    arquivado_em TEXT NOT NULL DEFAULT (DATETIME('now', 'localtime')),
+    id_min INTEGER,
+    id_max INTEGER
+);
+
+-- ======================= LIVRO DE MOVIMENTOS DE ESTOQUE =======================
+-- Quantidade positiva para entradas e negativa para saídas; o saldo de um produto é a soma dos seus movimentos.
+CREATE TABLE movimentos_estoque (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    usuario_id INTEGER NOT NULL,
+    roupa_id INTEGER NOT NULL,
+    tipo TEXT NOT NULL CHECK (tipo IN ('entrada', 'venda', 'ajuste', 'devolucao')),
+    quantidade INTEGER NOT NULL,
+    venda_id INTEGER,
+    observacao TEXT,
+    criado_em TEXT NOT NULL DEFAULT (DATETIME('now', 'localtime'))
+);
+CREATE INDEX idx_movimentos_roupa_data ON movimentos_estoque (roupa_id, criado_em);
+CREATE INDEX idx_movimentos_venda ON movimentos_estoque (venda_id);
+
+-- Saldo de um produto logo após o movimento 'movimento_id', gravado periodicamente.
+CREATE TABLE snapshots_estoque (
+    usuario_id INTEGER NOT NULL,
+    roupa_id INTEGER NOT NULL,
+    movimento_id INTEGER NOT NULL,
+    saldo INTEGER NOT NULL,
+    criado_em TEXT NOT NULL,
+    PRIMARY KEY (roupa_id, movimento_id)
+);
+CREATE INDEX idx_snapshots_roupa_data ON snapshots_estoque (roupa_id, criado_em);
+
+-- ======================= REGISTRO DE ALTERAÇÕES (CDC) =======================
+-- Cada linha indica que um registro foi incluído, alterado ou excluído; o conteúdo atual é lido na tabela de origem.
+CREATE TABLE changelog (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    usuario_id INTEGER NOT NULL,
+    tabela TEXT NOT NULL,
+    registro_id INTEGER NOT NULL,
+    operacao TEXT NOT NULL CHECK (operacao IN ('insert', 'update', 'delete')),
+    criado_em TEXT NOT NULL DEFAULT (DATETIME('now', 'localtime'))
+);
+CREATE INDEX idx_changelog_usuario_seq ON changelog (usuario_id, seq);
+CREATE INDEX idx_changelog_registro ON changelog (tabela, registro_id, seq);
+-- Com pausado = 1 (dentro da transação de uma manutenção, como o arquivamento de vendas) nada é registrado.
+CREATE TABLE changelog_controle (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    pausado INTEGER NOT NULL DEFAULT 0
+);
+INSERT INTO changelog_controle (id, pausado) VALUES (1, 0);
+CREATE TRIGGER trg_changelog_roupas_insert AFTER INSERT ON roupas
+WHEN NOT EXISTS (SELECT 1 FROM changelog_controle WHERE pausado = 1)
+BEGIN
+    INSERT INTO changelog (usuario_id, tabela, registro_id, operacao) VALUES (NEW.usuario_id, 'roupas', NEW.id, 'insert');
+END;
+CREATE TRIGGER trg_changelog_roupas_update AFTER UPDATE OF codigo_produto, data_entrada, tipo_roupa, tecido, quantidade, cor, tamanhos, detalhes,
+    preco_centavos, quantida_vendas ON roupas
+WHEN NOT EXISTS (SELECT 1 FROM changelog_controle WHERE pausado = 1)
+BEGIN
+    INSERT INTO changelog (usuario_id, tabela, registro_id, operacao) VALUES (NEW.usuario_id, 'roupas', NEW.id, 'update');
+END;
+CREATE TRIGGER trg_changelog_roupas_delete AFTER DELETE ON roupas
+WHEN NOT EXISTS (SELECT 1 FROM changelog_controle WHERE pausado = 1)
+BEGIN
+    INSERT INTO changelog (usuario_id, tabela, registro_id, operacao) VALUES (OLD.usuario_id, 'roupas', OLD.id, 'delete');
+END;
+CREATE TRIGGER trg_changelog_variantes_insert AFTER INSERT ON variantes
+WHEN NOT EXISTS (SELECT 1 FROM changelog_controle WHERE pausado = 1)
+BEGIN
+    INSERT INTO changelog (usuario_id, tabela, registro_id, operacao) VALUES (NEW.usuario_id, 'variantes', NEW.id, 'insert');
+END;
+CREATE TRIGGER trg_changelog_variantes_update AFTER UPDATE ON variantes
+WHEN NOT EXISTS (SELECT 1 FROM changelog_controle WHERE pausado = 1)
+BEGIN
+    INSERT INTO changelog (usuario_id, tabela, registro_id, operacao) VALUES (NEW.usuario_id, 'variantes', NEW.id, 'update');
+END;
+CREATE TRIGGER trg_changelog_variantes_delete AFTER DELETE ON variantes
+WHEN NOT EXISTS (SELECT 1 FROM changelog_controle WHERE pausado = 1)
+BEGIN
+    INSERT INTO changelog (usuario_id, tabela, registro_id, operacao) VALUES (OLD.usuario_id, 'variantes', OLD.id, 'delete');
+END;
+CREATE TRIGGER trg_changelog_vendas_insert AFTER INSERT ON vendas
+WHEN NOT EXISTS (SELECT 1 FROM changelog_controle WHERE pausado = 1)
+BEGIN
+    INSERT INTO changelog (usuario_id, tabela, registro_id, operacao) VALUES (NEW.usuario_id, 'vendas', NEW.id, 'insert');
+END;
+CREATE TRIGGER trg_changelog_vendas_update AFTER UPDATE ON vendas
+WHEN NOT EXISTS (SELECT 1 FROM changelog_controle WHERE pausado = 1)
+BEGIN
+    INSERT INTO changelog (usuario_id, tabela, registro_id, operacao) VALUES (NEW.usuario_id, 'vendas', NEW.id, 'update');
+END;
+CREATE TRIGGER trg_changelog_vendas_delete AFTER DELETE ON vendas
+WHEN NOT EXISTS (SELECT 1 FROM changelog_controle WHERE pausado = 1)
+BEGIN
+    INSERT INTO changelog (usuario_id, tabela, registro_id, operacao) VALUES (OLD.usuario_id, 'vendas', OLD.id, 'delete');
+END;
+CREATE TRIGGER trg_changelog_clientes_insert AFTER INSERT ON clientes
+WHEN NOT EXISTS (SELECT 1 FROM changelog_controle WHERE pausado = 1)
+BEGIN
+    INSERT INTO changelog (usuario_id, tabela, registro_id, operacao) VALUES (NEW.usuario_id, 'clientes', NEW.id, 'insert');
+END;
+CREATE TRIGGER trg_changelog_clientes_update AFTER UPDATE ON clientes
+WHEN NOT EXISTS (SELECT 1 FROM changelog_controle WHERE pausado = 1)
+BEGIN
+    INSERT INTO changelog (usuario_id, tabela, registro_id, operacao) VALUES (NEW.usuario_id, 'clientes', NEW.id, 'update');
+END;
+CREATE TRIGGER trg_changelog_clientes_delete AFTER DELETE ON clientes
+WHEN NOT EXISTS (SELECT 1 FROM changelog_controle WHERE pausado = 1)
+BEGIN
+    INSERT INTO changelog (usuario_id, tabela, registro_id, operacao) VALUES (OLD.usuario_id, 'clientes', OLD.id, 'delete');
+END;
+CREATE TRIGGER trg_changelog_funcionarios_insert AFTER INSERT ON funcionarios
+WHEN NOT EXISTS (SELECT 1 FROM changelog_controle WHERE pausado = 1)
+BEGIN
+    INSERT INTO changelog (usuario_id, tabela, registro_id, operacao) VALUES (NEW.usuario_id, 'funcionarios', NEW.id, 'insert');
+END;
+CREATE TRIGGER trg_changelog_funcionarios_update AFTER UPDATE ON funcionarios
+WHEN NOT EXISTS (SELECT 1 FROM changelog_controle WHERE pausado = 1)
+BEGIN
+    INSERT INTO changelog (usuario_id, tabela, registro_id, operacao) VALUES (NEW.usuario_id, 'funcionarios', NEW.id, 'update');
+END;
+CREATE TRIGGER trg_changelog_funcionarios_delete AFTER DELETE ON funcionarios
+WHEN NOT EXISTS (SELECT 1 FROM changelog_controle WHERE pausado = 1)
+BEGIN
+    INSERT INTO changelog (usuario_id, tabela, registro_id, operacao) VALUES (OLD.usuario_id, 'funcionarios', OLD.id, 'delete');
+END;
+
+-- ======================= API JSON DE CHECKOUT (PDV) =======================
+CREATE TABLE carrinhos (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    usuario_id INTEGER NOT NULL,
+    cliente_id INTEGER NOT NULL,
+    funcionario_id INTEGER,
+    criado_em TEXT NOT NULL DEFAULT (DATETIME('now', 'localtime')),
+    finalizado_em TEXT,
+    local_id INTEGER REFERENCES locais(id),
+    FOREIGN KEY (usuario_id) REFERENCES usuarios(id),
+    FOREIGN KEY (cliente_id) REFERENCES clientes(id),
+    FOREIGN KEY (funcionario_id) REFERENCES funcionarios(id)
+);
+
+-- variante_id = 0 indica produto sem grade (a chave primária não pode depender de NULL).
+CREATE TABLE carrinho_itens (
+    carrinho_id INTEGER NOT NULL,
+    roupa_id INTEGER NOT NULL,
+    variante_id INTEGER NOT NULL DEFAULT 0,
+    quantidade INTEGER NOT NULL,
+    PRIMARY KEY (carrinho_id, roupa_id, variante_id),
+    FOREIGN KEY (carrinho_id) REFERENCES carrinhos(id),
+    FOREIGN KEY (roupa_id) REFERENCES roupas(id)
+);
+
+-- Respostas já enviadas por requisição (cabeçalho Idempotency-Key), para que repetições não dupliquem operações.
+CREATE TABLE chaves_idempotencia (
+    usuario_id INTEGER NOT NULL,
+    chave TEXT NOT NULL,
+    status INTEGER NOT NULL,
+    resposta TEXT NOT NULL,
+    criado_em TEXT NOT NULL DEFAULT (DATETIME('now', 'localtime')),
+    metodo TEXT,
+    caminho TEXT,
+    PRIMARY KEY (usuario_id, chave)
+);
+
+-- ======================= MANUTENÇÃO AGENDADA =======================
+CREATE TABLE manutencao_lider (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    processo TEXT,
+    expira_em REAL NOT NULL DEFAULT 0
+);
+CREATE TABLE manutencao_execucoes (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    tarefa TEXT NOT NULL,
+    banco TEXT NOT NULL,
+    inicio TEXT NOT NULL,
+    duracao_ms REAL NOT NULL,
+    sucesso INTEGER NOT NULL,
+    detalhe TEXT,
+    processo TEXT
+);
+CREATE INDEX idx_manutencao_tarefa ON manutencao_execucoes (tarefa, banco, inicio);
+
+-- ======================= PREVISÃO DE DEMANDA =======================
+-- Resultado do último cálculo de 'flask calcular-previsoes' (ou da manutenção agendada), um por produto.
+CREATE TABLE previsoes_estoque (
+    roupa_id INTEGER PRIMARY KEY,
+    usuario_id INTEGER NOT NULL,
+    media_7d REAL NOT NULL,
+    media_28d REAL NOT NULL,
+    demanda_diaria REAL NOT NULL,
+    desvio REAL NOT NULL,
+    dias_cobertura REAL,
+    ponto_reposicao INTEGER NOT NULL,
+    estoque_baixo INTEGER NOT NULL,
+    calculado_em TEXT NOT NULL
+);
+CREATE INDEX idx_previsoes_usuario_baixo ON previsoes_estoque (usuario_id, estoque_baixo);
+
+-- ======================= ESTOQUE POR LOCAL (LOJAS E DEPÓSITOS) =======================
+CREATE TABLE locais (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    usuario_id INTEGER NOT NULL,
+    nome TEXT NOT NULL,
+    tipo TEXT NOT NULL DEFAULT 'loja' CHECK (tipo IN ('loja', 'deposito')),
+    ativo INTEGER NOT NULL DEFAULT 1,
+    FOREIGN KEY (usuario_id) REFERENCES usuarios(id)
+);
+CREATE UNIQUE INDEX idx_locais_usuario_nome ON locais (usuario_id, nome);
+
+-- Estoque de cada produto (variante_id = 0 para produto sem grade) em cada local. A soma dos locais é
+-- roupas.quantidade (ou variantes.quantidade). Tamanho e cor são copiados da variante para os agregados.
+-- A chave primária responde "onde este produto/variante tem estoque" sem ler outra tabela.
+CREATE TABLE estoque_local (
+    usuario_id INTEGER NOT NULL,
+    local_id INTEGER NOT NULL,
+    roupa_id INTEGER NOT NULL,
+    variante_id INTEGER NOT NULL DEFAULT 0,
+    tamanho TEXT NOT NULL DEFAULT '',
+    cor TEXT NOT NULL DEFAULT '',
+    quantidade INTEGER NOT NULL DEFAULT 0 CHECK (quantidade >= 0),
+    PRIMARY KEY (roupa_id, variante_id, local_id)
+) WITHOUT ROWID;
+CREATE INDEX idx_estoque_local_usuario_local ON estoque_local (usuario_id, local_id, quantidade);
+
+-- Agregados mantidos pelos gatilhos abaixo: estoque por tamanho, cor e local ("onde há M em estoque" é uma
+-- busca pela chave primária) e vendas por local e dia (métricas por loja).
+CREATE TABLE disponibilidade_grade (
+    usuario_id INTEGER NOT NULL,
+    tamanho TEXT NOT NULL,
+    cor TEXT NOT NULL,
+    local_id INTEGER NOT NULL,
+    quantidade INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (usuario_id, tamanho, cor, local_id)
+) WITHOUT ROWID;
+CREATE TABLE vendas_local_dia (
+    usuario_id INTEGER NOT NULL,
+    local_id INTEGER NOT NULL,
+    data_venda TEXT NOT NULL,
+    vendas INTEGER NOT NULL DEFAULT 0,
+    itens INTEGER NOT NULL DEFAULT 0,
+    total_centavos INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (usuario_id, local_id, data_venda)
+) WITHOUT ROWID;
+
+CREATE TABLE transferencias (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    usuario_id INTEGER NOT NULL,
+    roupa_id INTEGER NOT NULL,
+    variante_id INTEGER NOT NULL DEFAULT 0,
+    origem_id INTEGER NOT NULL,
+    destino_id INTEGER NOT NULL,
+    quantidade INTEGER NOT NULL CHECK (quantidade > 0),
+    observacao TEXT,
+    criado_em TEXT NOT NULL DEFAULT (DATETIME('now', 'localtime')),
+    FOREIGN KEY (origem_id) REFERENCES locais(id),
+    FOREIGN KEY (destino_id) REFERENCES locais(id)
+);
+CREATE INDEX idx_transferencias_usuario ON transferencias (usuario_id, id);
+
+CREATE TRIGGER trg_estoque_local_insert AFTER INSERT ON estoque_local WHEN NEW.variante_id <> 0
+BEGIN
+    INSERT INTO disponibilidade_grade (usuario_id, tamanho, cor, local_id, quantidade)
+    VALUES (NEW.usuario_id, NEW.tamanho, NEW.cor, NEW.local_id, NEW.quantidade)
+    ON CONFLICT (usuario_id, tamanho, cor, local_id) DO UPDATE SET quantidade = quantidade + excluded.quantidade;
+END;
+CREATE TRIGGER trg_estoque_local_update AFTER UPDATE OF quantidade ON estoque_local WHEN NEW.variante_id <> 0
+BEGIN
+    UPDATE disponibilidade_grade SET quantidade = quantidade + NEW.quantidade - OLD.quantidade
+    WHERE usuario_id = NEW.usuario_id AND tamanho = NEW.tamanho AND cor = NEW.cor AND local_id = NEW.local_id;
+END;
+CREATE TRIGGER trg_estoque_local_delete AFTER DELETE ON estoque_local WHEN OLD.variante_id <> 0
+BEGIN
+    UPDATE disponibilidade_grade SET quantidade = quantidade - OLD.quantidade
+    WHERE usuario_id = OLD.usuario_id AND tamanho = OLD.tamanho AND cor = OLD.cor AND local_id = OLD.local_id;
+END;
+-- Como o changelog, o agregado de vendas ignora o arquivamento e a restauração de vendas (controle pausado):
+-- as vendas arquivadas continuam contadas nas métricas por local.
+CREATE TRIGGER trg_vendas_local_insert AFTER INSERT ON vendas
+WHEN NEW.local_id IS NOT NULL AND NOT EXISTS (SELECT 1 FROM changelog_controle WHERE pausado = 1)
+BEGIN
+    INSERT INTO vendas_local_dia (usuario_id, local_id, data_venda, vendas, itens, total_centavos)
+    VALUES (NEW.usuario_id, NEW.local_id, NEW.data_venda, 1, NEW.quantidade_vendida, NEW.valor_total_centavos)
+    ON CONFLICT (usuario_id, local_id, data_venda) DO UPDATE SET vendas = vendas + 1,
+        itens = itens + excluded.itens, total_centavos = total_centavos + excluded.total_centavos;
+END;
+CREATE TRIGGER trg_vendas_local_delete AFTER DELETE ON vendas
+WHEN OLD.local_id IS NOT NULL AND NOT EXISTS (SELECT 1 FROM changelog_controle WHERE pausado = 1)
+BEGIN
+    UPDATE vendas_local_dia SET vendas = vendas - 1, itens = itens - OLD.quantidade_vendida,
+                                total_centavos = total_centavos - OLD.valor_total_centavos
+    WHERE usuario_id = OLD.usuario_id AND local_id = OLD.local_id AND data_venda = OLD.data_venda;
+END;
+
+-- ======================= SEGMENTAÇÃO RFM DE CLIENTES =======================
+-- Totais de compras de cada cliente (compras = dias com compra), somados a cada venda, com as notas de 1 a 5
+-- (recência, frequência e valor) e o segmento. 'flask recalcular-rfm --completo' os refaz a partir das vendas.
+CREATE TABLE clientes_rfm (
+    cliente_id INTEGER PRIMARY KEY REFERENCES clientes(id),
+    usuario_id INTEGER NOT NULL,
+    primeira_compra TEXT NOT NULL,
+    ultima_compra TEXT NOT NULL,
+    compras INTEGER NOT NULL,
+    total_centavos INTEGER NOT NULL,
+    recencia INTEGER,
+    frequencia INTEGER,
+    monetario INTEGER,
+    segmento TEXT
+);
+CREATE INDEX idx_clientes_rfm_usuario_segmento ON clientes_rfm (usuario_id, segmento);
+-- Limites dos quintis (listas JSON) de cada usuário, usados para pontuar um cliente a cada compra.
+CREATE TABLE rfm_limites (
+    usuario_id INTEGER PRIMARY KEY,
+    recencia TEXT NOT NULL,
+    frequencia TEXT NOT NULL,
+    monetario TEXT NOT NULL,
+    clientes INTEGER NOT NULL,
+    calculado_em TEXT NOT NULL
+);
+
+-- ======================= VENDAS DIÁRIAS (API DE MÉTRICAS) =======================
+-- Vendas, itens e total de cada dia por dimensão: 'total' (chave 0), 'roupa' (roupa_id), 'funcionario' e
+-- 'cliente' (0 para vendas sem funcionário ou cliente). Mantido pelos gatilhos abaixo; como vendas_local_dia,
+-- ignora o arquivamento e a restauração de vendas. 'flask reconstruir-vendas-diarias' o refaz a partir das vendas.
+CREATE TABLE vendas_diarias (
+    usuario_id INTEGER NOT NULL,
+    dimensao TEXT NOT NULL,
+    data_venda TEXT NOT NULL,
+    chave INTEGER NOT NULL,
+    vendas INTEGER NOT NULL DEFAULT 0,
+    itens INTEGER NOT NULL DEFAULT 0,
+    total_centavos INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (usuario_id, dimensao, data_venda, chave)
+) WITHOUT ROWID;
+CREATE TRIGGER trg_vendas_diarias_insert AFTER INSERT ON vendas
+WHEN NOT EXISTS (SELECT 1 FROM changelog_controle WHERE pausado = 1)
+BEGIN
+    INSERT INTO vendas_diarias (usuario_id, dimensao, data_venda, chave, vendas, itens, total_centavos)
+    VALUES (NEW.usuario_id, 'total', NEW.data_venda, 0, 1, NEW.quantidade_vendida, NEW.valor_total_centavos),
+           (NEW.usuario_id, 'roupa', NEW.data_venda, NEW.roupa_id, 1, NEW.quantidade_vendida,
+            NEW.valor_total_centavos),
+           (NEW.usuario_id, 'funcionario', NEW.data_venda, COALESCE(NEW.funcionario_id, 0), 1,
+            NEW.quantidade_vendida, NEW.valor_total_centavos),
+           (NEW.usuario_id, 'cliente', NEW.data_venda, COALESCE(NEW.cliente_id, 0), 1, NEW.quantidade_vendida,
+            NEW.valor_total_centavos)
+    ON CONFLICT (usuario_id, dimensao, data_venda, chave) DO UPDATE SET vendas = vendas + 1,
+        itens = itens + excluded.itens, total_centavos = total_centavos + excluded.total_centavos;
+END;
+CREATE TRIGGER trg_vendas_diarias_delete AFTER DELETE ON vendas
+WHEN NOT EXISTS (SELECT 1 FROM changelog_controle WHERE pausado = 1)
+BEGIN
+    UPDATE vendas_diarias SET vendas = vendas - 1, itens = itens - OLD.quantidade_vendida,
+                              total_centavos = total_centavos - OLD.valor_total_centavos
+    WHERE usuario_id = OLD.usuario_id AND data_venda = OLD.data_venda
+      AND ((dimensao = 'total' AND chave = 0) OR (dimensao = 'roupa' AND chave = OLD.roupa_id)
+           OR (dimensao = 'funcionario' AND chave = COALESCE(OLD.funcionario_id, 0))
+           OR (dimensao = 'cliente' AND chave = COALESCE(OLD.cliente_id, 0)));
+END;
 
+-- Número da última migração de app.py (MIGRACOES) já incorporada a este schema.
+PRAGMA user_version = 15;
@@ -0,0 +1,85 @@
+"""
+Serialização JSON das respostas da API.
+
+Usa o orjson quando instalado (pip install orjson) e o módulo json da biblioteca padrão caso contrário.
+As respostas grandes (catálogo, séries de métricas, feed de alterações) são montadas a partir das tuplas
+do cursor, sem um dicionário por linha: tuplas viram arrays JSON e colunas_para_arrays gera o formato
+colunar ({coluna: [valores]}), em que o nome de cada coluna aparece uma única vez.
+"""
+
+import dataclasses
+import json
+import sqlite3
+
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:  # Sem o orjson, as respostas continuam sendo geradas pelo json da biblioteca padrão.
+    orjson = None
+
+ORJSON_DISPONIVEL = orjson is not None
+
+
+def _padrao(obj):
+    """
+    Converte os tipos que o codificador não conhece: linhas do sqlite3 e do repositório (dataclasses) viram
+    objetos; o resto segue o Flask.
+    """
+    if isinstance(obj, sqlite3.Row):
+        return dict(zip(obj.keys(), obj))
+    if dataclasses.is_dataclass(obj) and not isinstance(obj, type):
+        return {campo.name: getattr(obj, campo.name) for campo in dataclasses.fields(obj)}
+    return DefaultJSONProvider.default(obj)
+
+
+def dumps(obj, ordenar_chaves=False, indentar=False):
+    """Serializa obj em JSON UTF-8 (bytes), compacto por padrão. Tuplas e listas viram arrays."""
+    if orjson is not None:
+        # Datas seguem para _padrao, para sair no mesmo formato do provedor padrão do Flask.
+        opcoes = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+        if ordenar_chaves:
+            opcoes |= orjson.OPT_SORT_KEYS
+        if indentar:
+            opcoes |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, default=_padrao, option=opcoes)
+    return json.dumps(obj, default=_padrao, ensure_ascii=False, sort_keys=ordenar_chaves,
+                      indent=2 if indentar else None,
+                      separators=(', ', ': ') if indentar else (',', ':')).encode('utf-8')
+
+
+def loads(dados):
+    """Converte um documento JSON (str ou bytes) em objetos Python."""
+    if orjson is not None:
+        return orjson.loads(dados)
+    return json.loads(dados)
+
+
+def colunas_para_arrays(colunas, linhas):
+    """Transpõe as tuplas de uma consulta para o formato colunar: {coluna: [valor de cada linha]}."""
+    if not linhas:
+        return {coluna: [] for coluna in colunas}
+    return {coluna: list(valores) for coluna, valores in zip(colunas, zip(*linhas))}
+
+
+class ProvedorJsonRapido(DefaultJSONProvider):
+    """
+    Provedor JSON do Flask (jsonify, request.get_json e o filtro tojson) baseado em dumps/loads.
+    As chaves saem na ordem de inserção: ordená-las só custa tempo nas respostas grandes.
+    """
+
+    sort_keys = False
+
+    def dumps(self, obj, **kwargs):
+        return dumps(obj, ordenar_chaves=kwargs.get('sort_keys', self.sort_keys),
+                     indentar=bool(kwargs.get('indent'))).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        return loads(s)
+
+    def response(self, *args, **kwargs):
+        # Gera os bytes da resposta diretamente, sem passar por uma str intermediária.
+        obj = self._prepare_response_obj(args, kwargs)
+        indentar = not (self.compact or (self.compact is None and not self._app.debug))
+        corpo = dumps(obj, ordenar_chaves=self.sort_keys, indentar=indentar) + b'\n'
+        return self._app.response_class(corpo, mimetype=self.mimetype)
@@ -0,0 +1,31 @@
+import os
+import shutil
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as aplicacao  # noqa: E402
+
+
+@pytest.fixture
+def banco(tmp_path, monkeypatch):
+    """Cópia do banco de exemplo em uma pasta temporária, já migrada, com o arquivo morto na mesma pasta."""
+    caminho = str(tmp_path / 'controle_estoque.db')
+    shutil.copy(os.path.join(aplicacao.app.root_path, 'controle_estoque.db'), caminho)
+    monkeypatch.setattr(aplicacao, 'DATABASE', caminho)
+    monkeypatch.setitem(aplicacao.app.config, 'ARQUIVO_DIR', str(tmp_path / 'arquivo'))
+    monkeypatch.setitem(aplicacao.app.config, 'SHARDING_DIR', str(tmp_path / 'shards'))
+    monkeypatch.setitem(aplicacao.app.config, 'TESTING', True)
+    aplicacao.preparar_banco(caminho)
+    return caminho
+
+
+@pytest.fixture
+def cliente(banco):
+    """Cliente de teste com o usuário 1 (o do banco de exemplo) logado."""
+    cliente = aplicacao.app.test_client()
+    with cliente.session_transaction() as sessao:
+        sessao['usuario_id'] = 1
+    return cliente
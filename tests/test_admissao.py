@@ -0,0 +1,84 @@
+import sqlite3
+import threading
+import time
+
+import pytest
+
+import app as aplicacao
+
+
+def aguardar(condicao, limite=5):
+    fim = time.monotonic() + limite
+    while not condicao():
+        assert time.monotonic() < fim
+        time.sleep(0.005)
+
+
+def test_resposta_em_fluxo_ocupa_a_vaga_ate_ser_fechada(cliente, monkeypatch):
+    monkeypatch.setitem(aplicacao.app.config, 'ADMISSAO_ATIVA', True)
+    aplicacao._admissao.zerar()
+    antes = aplicacao._admissao.estatisticas()['em_andamento']['exportacao']
+
+    resposta = cliente.get('/backup', buffered=False)
+    assert resposta.status_code == 200
+    assert aplicacao._admissao.estatisticas()['em_andamento']['exportacao'] == antes + 1
+    b''.join(resposta.response)
+    resposta.close()
+    assert aplicacao._admissao.estatisticas()['em_andamento']['exportacao'] == antes
+
+
+def test_seguidora_repete_a_leitura_interrompida_pelo_prazo_da_lider():
+    coalescedor = aplicacao.CoalescedorLeituras()
+    liberar = threading.Event()
+    resultados = {}
+
+    def ler_lider():
+        liberar.wait(5)
+        raise sqlite3.OperationalError('interrupted')
+
+    def executar(nome, ler):
+        try:
+            resultados[nome] = coalescedor.executar('chave', ler)
+        except sqlite3.OperationalError as e:
+            resultados[nome] = e
+
+    lider = threading.Thread(target=executar, args=('lider', ler_lider))
+    lider.start()
+    aguardar(lambda: coalescedor.lideres == 1)
+    seguidora = threading.Thread(target=executar, args=('seguidora', lambda: [(42,)]))
+    seguidora.start()
+    aguardar(lambda: coalescedor.seguidores == 1)
+    liberar.set()
+    lider.join(5)
+    seguidora.join(5)
+
+    assert isinstance(resultados['lider'], sqlite3.OperationalError)
+    assert resultados['seguidora'] == [(42,)]
+
+
+def test_exportacoes_em_fluxo_nao_tem_o_prazo_dos_relatorios(cliente, monkeypatch):
+    monkeypatch.setitem(aplicacao.app.config, 'ADMISSAO_ATIVA', True)
+    monkeypatch.setitem(aplicacao.app.config['ADMISSAO_PRAZO_MS'], 'baixa', 1)
+    aplicacao._admissao.zerar()
+
+    with cliente.get('/backup') as resposta:
+        assert resposta.status_code == 200
+        assert resposta.data
+    assert aplicacao._admissao.estatisticas()['classes']['exportacao']['consultas_interrompidas'] == 0
+    assert aplicacao.classe_prioridade('gerar_arquivo_nfe') == 'exportacao'
+
+
+def test_exportacoes_tem_limite_proprio_e_cedem_ao_checkout():
+    admissao = aplicacao.ControleAdmissao(max_baixa=1, max_por_usuario=10, limite_checkout=1, max_exportacao=2)
+    admissao.admitir('baixa')
+    admissao.admitir('exportacao')
+    admissao.admitir('exportacao')
+    with pytest.raises(aplicacao.RequisicaoRecusada) as recusa:
+        admissao.admitir('exportacao')
+    assert recusa.value.motivo == 'limite_exportacao'
+
+    admissao.liberar('exportacao')
+    admissao.admitir('critica')
+    with pytest.raises(aplicacao.RequisicaoRecusada) as recusa:
+        admissao.admitir('exportacao')
+    assert recusa.value.motivo == 'checkout'
@@ -0,0 +1,58 @@
+import sqlite3
+
+import app as aplicacao
+
+
+def cliente_id(banco):
+    db = sqlite3.connect(banco)
+    try:
+        return db.execute('SELECT MIN(id) FROM clientes WHERE usuario_id = 1').fetchone()[0]
+    finally:
+        db.close()
+
+
+def test_chave_de_idempotencia_repetida_em_outra_operacao_e_recusada(cliente, banco):
+    cabecalhos = {'Idempotency-Key': 'leitura-1'}
+    primeira = cliente.post('/api/carrinhos', json={'cliente_id': cliente_id(banco)}, headers=cabecalhos)
+    repetida = cliente.post('/api/carrinhos', json={'cliente_id': cliente_id(banco)}, headers=cabecalhos)
+    assert primeira.status_code == repetida.status_code == 201
+    assert repetida.get_json() == primeira.get_json()
+
+    carrinho = primeira.get_json()['carrinho_id']
+    outra = cliente.post(f"/api/carrinhos/{carrinho}/itens", json={'codigo': 'x'}, headers=cabecalhos)
+    assert outra.status_code == 422
+    assert 'POST /api/carrinhos' in outra.get_json()['erro']
+
+
+def test_quantidade_invalida_responde_422(cliente, banco):
+    carrinho = cliente.post('/api/carrinhos', json={'cliente_id': cliente_id(banco)}).get_json()['carrinho_id']
+    for quantidade in ('duas', None, [1]):
+        resposta = cliente.post(f"/api/carrinhos/{carrinho}/itens", json={'codigo': 'x', 'quantidade': quantidade})
+        assert resposta.status_code == 422, quantidade
+
+
+def test_limpeza_remove_chaves_vencidas_e_carrinhos_abandonados(banco):
+    db = aplicacao.conectar(banco)
+    cliente = db.execute('SELECT MIN(id) FROM clientes WHERE usuario_id = 1').fetchone()[0]
+    roupa = db.execute('SELECT MIN(id) FROM roupas WHERE usuario_id = 1').fetchone()[0]
+    for chave, criado_em in (('antiga', "DATETIME('now', 'localtime', '-3 days')"),
+                             ('recente', "DATETIME('now', 'localtime')")):
+        db.execute(f"INSERT INTO chaves_idempotencia (usuario_id, chave, status, resposta, criado_em) "
+                   f"VALUES (1, ?, 200, '{{}}', {criado_em})", (chave,))
+    abandonado = db.execute("INSERT INTO carrinhos (usuario_id, cliente_id, criado_em) "
+                            "VALUES (1, ?, DATETIME('now', 'localtime', '-2 days'))", (cliente,)).lastrowid
+    db.execute('INSERT INTO carrinho_itens (carrinho_id, roupa_id, quantidade) VALUES (?, ?, 1)', (abandonado, roupa))
+    aberto = db.execute('INSERT INTO carrinhos (usuario_id, cliente_id) VALUES (1, ?)', (cliente,)).lastrowid
+    finalizado = db.execute("INSERT INTO carrinhos (usuario_id, cliente_id, criado_em, finalizado_em) "
+                            "VALUES (1, ?, DATETIME('now', 'localtime', '-2 days'), DATETIME('now', 'localtime'))",
+                            (cliente,)).lastrowid
+    db.commit()
+
+    aplicacao.tarefa_limpeza(db, banco)
+    db.commit()
+
+    assert [linha[0] for linha in db.execute('SELECT chave FROM chaves_idempotencia')] == ['recente']
+    restantes = {linha[0] for linha in db.execute('SELECT id FROM carrinhos')}
+    assert abandonado not in restantes and {aberto, finalizado} <= restantes
+    assert db.execute('SELECT COUNT(*) FROM carrinho_itens WHERE carrinho_id = ?', (abandonado,)).fetchone()[0] == 0
+    db.close()
@@ -0,0 +1,118 @@
+import gzip
+import json
+import sqlite3
+from datetime import datetime
+
+import pytest
+
+import app as aplicacao
+
+# Mais anos arquivados do que o SQLite permite anexar a uma conexão (10).
+ANOS = list(range(datetime.now().year - 13, datetime.now().year - 1))
+
+
+def inserir_vendas_antigas(caminho):
+    """Duas vendas do usuário 1 em cada ano de ANOS, com o cliente, o produto e o local do banco de exemplo."""
+    db = aplicacao.conectar(caminho)
+    try:
+        cliente_id = db.execute('SELECT MIN(id) FROM clientes WHERE usuario_id = 1').fetchone()[0]
+        roupa_id = db.execute('SELECT MIN(id) FROM roupas WHERE usuario_id = 1').fetchone()[0]
+        local_id = db.execute('SELECT MIN(id) FROM locais WHERE usuario_id = 1').fetchone()[0]
+        for ano in ANOS:
+            for mes, quantidade in ((3, 1), (9, 2)):
+                db.execute('''
+                           INSERT INTO vendas (usuario_id, cliente_id, roupa_id, quantidade_vendida,
+                                               valor_total_centavos, data_venda, local_id)
+                           VALUES (1, ?, ?, ?, ?, ?, ?)
+                           ''', (cliente_id, roupa_id, quantidade, quantidade * 1990, f"{ano}-{mes:02d}-10", local_id))
+        db.commit()
+    finally:
+        db.close()
+
+
+def conteudo(caminho, tabela):
+    db = sqlite3.connect(caminho)
+    try:
+        colunas = ', '.join(c for c in aplicacao.colunas_tabela(db, tabela) if c not in ('r', 'f', 'm', 'segmento'))
+        return sorted(db.execute(f"SELECT {colunas} FROM {tabela}").fetchall())
+    finally:
+        db.close()
+
+
+@pytest.fixture
+def arquivado(banco):
+    """Banco com as vendas de ANOS movidas para um arquivo por ano; retorna os ids das vendas arquivadas."""
+    inserir_vendas_antigas(banco)
+    db = sqlite3.connect(banco)
+    ids = [linha[0] for linha in db.execute('SELECT id FROM vendas WHERE data_venda < ? ORDER BY id',
+                                            (f"{ANOS[-1] + 1}-01-01",))]
+    db.close()
+    for ano in ANOS:
+        assert aplicacao.arquivar_vendas(banco, ano) == 2
+    return ids
+
+
+def test_recalculos_percorrem_mais_arquivos_do_que_o_limite_de_anexos(banco):
+    inserir_vendas_antigas(banco)
+    aplicacao.reconstruir_vendas_diarias(banco)
+    aplicacao.reconstruir_agregados_locais(banco)
+    db = aplicacao.conectar(banco)
+    aplicacao.reconstruir_rfm_banco(db)
+    db.close()
+    esperado = {tabela: conteudo(banco, tabela) for tabela in ('vendas_diarias', 'vendas_local_dia', 'clientes_rfm')}
+
+    for ano in ANOS:
+        aplicacao.arquivar_vendas(banco, ano)
+    aplicacao.reconstruir_vendas_diarias(banco)
+    aplicacao.reconstruir_agregados_locais(banco)
+    db = aplicacao.conectar(banco)
+    aplicacao.reconstruir_rfm_banco(db)
+    db.close()
+
+    for tabela, linhas in esperado.items():
+        assert conteudo(banco, tabela) == linhas, tabela
+    assert aplicacao.verificar_arquivos_vendas(banco) == []
+
+
+def test_fonte_vendas_anexa_so_os_arquivos_necessarios(banco, arquivado):
+    db = aplicacao.conectar(banco)
+    try:
+        with pytest.raises(sqlite3.OperationalError, match='anexa no máximo'):
+            aplicacao.fonte_vendas(db)
+        fonte = aplicacao.fonte_vendas(db, ids=[arquivado[0], arquivado[-1]])
+        assert db.execute(f"SELECT COUNT(*) FROM {fonte} WHERE id IN (?, ?)",
+                          (arquivado[0], arquivado[-1])).fetchone()[0] == 2
+        anexados = [linha[1] for linha in db.execute('PRAGMA database_list') if linha[1].startswith('arquivo_')]
+        assert sorted(anexados) == [f"arquivo_{ANOS[0]}", f"arquivo_{ANOS[-1]}"]
+        assert aplicacao.fonte_vendas(db, f"{ANOS[-1]}-01-01") != 'vendas'
+        anexados = [linha[1] for linha in db.execute('PRAGMA database_list') if linha[1].startswith('arquivo_')]
+        assert anexados == [f"arquivo_{ANOS[-1]}"]
+    finally:
+        db.close()
+
+
+def test_changes_traz_as_vendas_de_todos_os_arquivos(cliente, arquivado):
+    resposta = cliente.get('/changes?limit=10000')
+    assert resposta.status_code == 200
+    linhas = [json.loads(linha) for linha in resposta.data.splitlines()]
+    dados = {linha['id']: linha['dados'] for linha in linhas if linha['tabela'] == 'vendas'}
+    assert all(dados[venda_id] is not None for venda_id in arquivado)
+
+
+def test_backup_inclui_as_vendas_de_todos_os_arquivos(cliente, arquivado):
+    with cliente.get('/backup') as resposta:
+        assert resposta.status_code == 200
+        texto = gzip.decompress(resposta.data).decode()
+    fim = json.loads(texto.splitlines()[-1])
+    db = sqlite3.connect(aplicacao.DATABASE)
+    no_banco = db.execute('SELECT COUNT(*) FROM vendas WHERE usuario_id = 1').fetchone()[0]
+    db.close()
+    assert fim['tabelas']['vendas']['linhas'] == no_banco + len(arquivado)
+
+
+def test_nfe_de_vendas_arquivadas(cliente, arquivado):
+    selecionadas = [arquivado[0], arquivado[-1]]
+    with cliente.post('/gerar_arquivo_nfe', data={'venda_ids': [str(i) for i in selecionadas],
+                                                  'formato_exportacao': 'csv'}) as resposta:
+        assert resposta.status_code == 200
+        assert resposta.data.decode('utf-8-sig').count('\n') >= len(selecionadas) + 1
@@ -0,0 +1,75 @@
+import sqlite3
+
+import pytest
+
+import app as aplicacao
+
+
+def gravar_backup(tmp_path, formato='ndjson'):
+    arquivo = str(tmp_path / ('backup.db' if formato == 'sqlite' else 'backup.ndjson.gz'))
+    if formato == 'sqlite':
+        aplicacao.gravar_backup_sqlite(1, arquivo)
+    else:
+        with open(arquivo, 'wb') as saida:
+            for bloco in aplicacao.gerar_backup_ndjson(1):
+                saida.write(bloco)
+    return arquivo
+
+
+@pytest.mark.parametrize('formato', ['ndjson', 'sqlite'])
+def test_substituir_descarta_os_dados_de_trabalho_do_usuario(banco, tmp_path, formato):
+    arquivo = gravar_backup(tmp_path, formato)
+    db = sqlite3.connect(banco)
+    cliente_id, roupa_id = db.execute('SELECT (SELECT MIN(id) FROM clientes WHERE usuario_id = 1), '
+                                      '(SELECT MIN(id) FROM roupas WHERE usuario_id = 1)').fetchone()
+    carrinho_id = db.execute('INSERT INTO carrinhos (usuario_id, cliente_id) VALUES (1, ?)', (cliente_id,)).lastrowid
+    db.execute('INSERT INTO carrinho_itens (carrinho_id, roupa_id, quantidade) VALUES (?, ?, 1)', (carrinho_id, roupa_id))
+    db.execute("INSERT INTO chaves_idempotencia (usuario_id, chave, status, resposta) VALUES (1, 'k', 200, '{}')")
+    db.commit()
+    db.close()
+
+    usuario_id, restaurados = aplicacao.restaurar_backup_usuario(arquivo, substituir=True)
+
+    assert usuario_id == 1 and restaurados['roupas'] > 0
+    db = sqlite3.connect(banco)
+    for tabela in ('carrinhos', 'chaves_idempotencia', 'previsoes_estoque'):
+        assert db.execute(f"SELECT COUNT(*) FROM {tabela} WHERE usuario_id = 1").fetchone()[0] == 0, tabela
+    assert db.execute('SELECT COUNT(*) FROM carrinho_itens WHERE carrinho_id = ?', (carrinho_id,)).fetchone()[0] == 0
+    db.close()
+
+
+def test_restaurar_em_outro_usuario_do_mesmo_banco_e_recusado(banco, tmp_path):
+    arquivo = gravar_backup(tmp_path)
+    with pytest.raises(ValueError, match='ids são preservados'):
+        aplicacao.restaurar_backup_usuario(arquivo, usuario_id=2)
+    db = sqlite3.connect(banco)
+    assert db.execute('SELECT COUNT(*) FROM roupas WHERE usuario_id = 2').fetchone()[0] == 0
+    db.close()
+
+
+def test_backup_sqlite_pela_rota(cliente):
+    resposta = cliente.get('/backup?formato=sqlite')
+    assert resposta.status_code == 200
+    assert resposta.data[:16] == b'SQLite format 3\x00'
+
+
+def test_escrita_durante_o_backup_nao_espera_a_leitura(banco):
+    db = sqlite3.connect(banco)
+    roupa_id, quantidade = db.execute('SELECT id, quantidade FROM roupas WHERE usuario_id = 1 ORDER BY id').fetchone()
+    db.close()
+
+    with aplicacao.leitura_consistente(banco) as leitura:
+        tabelas = aplicacao.tabelas_usuario(leitura, 1)
+        _tabela, _colunas, linhas = next(tabelas)
+        next(iter(linhas), None)  # A transação de leitura do backup está aberta.
+
+        escrita = sqlite3.connect(banco, timeout=0.2)
+        escrita.execute('UPDATE roupas SET quantidade = quantidade + 1 WHERE id = ?', (roupa_id,))
+        escrita.commit()
+        escrita.close()
+
+        roupas = next((colunas, linhas) for tabela, colunas, linhas in tabelas if tabela == 'roupas')
+        lidas = {linha[roupas[0].index('id')]: linha for linha in roupas[1]}
+        tabelas.close()
+    # O backup continua vendo o instante em que começou.
+    assert lidas[roupa_id][roupas[0].index('quantidade')] == quantidade
@@ -0,0 +1,69 @@
+import sqlite3
+
+import pytest
+
+import app as aplicacao
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    """Cache de registros vazio, com ttl longo: só a invalidação faz um registro ser relido."""
+    cache = aplicacao.CacheRegistros(max_itens=100, ttl=3600)
+    monkeypatch.setattr(aplicacao, '_cache_registros', cache)
+    return cache
+
+
+def faltas(cache, tipo):
+    return cache.estatisticas()['tipos'].get(tipo, {}).get('faltas', 0)
+
+
+def test_atualizar_dados_empresa_invalida_usuario_e_empresa(cliente, cache):
+    assert b'Grupo 9' in cliente.get('/dados_empresa').data
+    cliente.get('/dados_empresa')
+    assert (faltas(cache, 'empresa'), faltas(cache, 'usuario')) == (1, 1)
+
+    formulario = {'nome': 'Ana', 'sobrenome': 'Souza', 'data_nascimento': '1990-05-01', 'nome_fantasia': 'Loja Nova',
+                  'cnpj_sim': 'nao', 'cep': '01001000', 'rua': 'Rua A', 'bairro': 'Sé', 'cidade': 'São Paulo',
+                  'estado': 'SP', 'pais': 'Brasil'}
+    assert cliente.post('/atualizar_dados_empresa', data=formulario).status_code == 302
+
+    pagina = cliente.get('/dados_empresa').data.decode()
+    assert 'Loja Nova' in pagina and 'Ana Souza' in pagina
+    assert (faltas(cache, 'empresa'), faltas(cache, 'usuario')) == (2, 2)
+
+
+def test_editar_funcionario_invalida_os_funcionarios_do_usuario(cliente, banco, cache):
+    db = sqlite3.connect(banco)
+    db.row_factory = sqlite3.Row
+    funcionario = dict(db.execute('SELECT * FROM funcionarios WHERE usuario_id = 1 AND data_fim_contrato IS NULL '
+                                  'ORDER BY id LIMIT 1').fetchone())
+    db.close()
+    with aplicacao.app.test_request_context():
+        assert aplicacao.funcionario_ativo(1, funcionario['id']) is True
+        assert aplicacao.funcionario_por_nome(1, funcionario['nome_completo']) == funcionario['id']
+
+    formulario = {campo: funcionario[campo] or '' for campo in (
+        'cep', 'rua', 'numero', 'cidade', 'estado', 'pais', 'data_inicio_contrato', 'cargo', 'definicao_cargo',
+        'observacoes')}
+    formulario.update(nome_completo='Nome Alterado', data_fim_contrato='2026-01-31')
+    assert cliente.post(f"/editar_funcionario/{funcionario['id']}", data=formulario).status_code == 302
+
+    with aplicacao.app.test_request_context():
+        assert aplicacao.funcionario_ativo(1, funcionario['id']) is False
+        assert aplicacao.funcionario_por_nome(1, funcionario['nome_completo']) is None
+        assert aplicacao.funcionario_por_nome(1, 'Nome Alterado') == funcionario['id']
+
+
+def test_valor_lido_antes_da_invalidacao_nao_e_guardado(cache):
+    def carregar_durante_alteracao():
+        # Outra requisição altera o registro enquanto este valor (já desatualizado) está sendo lido.
+        cache.invalidar('empresa', 1)
+        return 'antigo'
+
+    assert cache.obter(('empresa', 1), carregar_durante_alteracao) == 'antigo'
+    assert cache.obter(('empresa', 1), lambda: 'novo') == 'novo'
+    assert cache.obter(('empresa', 1), lambda: 'nao lido') == 'novo'
+    # A invalidação de um usuário não descarta os registros dos outros.
+    cache.obter(('empresa', 2), lambda: 'outro')
+    cache.invalidar('empresa', 1)
+    assert cache.obter(('empresa', 2), lambda: 'nao lido') == 'outro'
@@ -0,0 +1,110 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+import app as aplicacao
+
+
+def aguardar(condicao, limite=5):
+    fim = time.monotonic() + limite
+    while not condicao():
+        assert time.monotonic() < fim
+        time.sleep(0.005)
+
+
+def test_seguidoras_recebem_o_resultado_da_unica_leitura_da_lider():
+    coalescedor = aplicacao.CoalescedorLeituras()
+    liberar = threading.Event()
+    leituras = []
+    resultados = {}
+
+    def ler():
+        leituras.append(threading.current_thread().name)
+        liberar.wait(5)
+        return [(1, 'a'), (2, 'b')]
+
+    def executar(nome):
+        resultados[nome] = coalescedor.executar(('db', 'x.db', 'SELECT 1', ()), ler, rota='listar')
+
+    threads = [threading.Thread(target=executar, args=(f"t{i}",), name=f"t{i}") for i in range(5)]
+    threads[0].start()
+    aguardar(lambda: coalescedor.lideres == 1)
+    for thread in threads[1:]:
+        thread.start()
+    aguardar(lambda: coalescedor.seguidores == 4)
+    liberar.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert leituras == ['t0']
+    assert all(resultado is resultados['t0'] for resultado in resultados.values())
+    estatisticas = coalescedor.estatisticas()
+    assert (estatisticas['lideres'], estatisticas['seguidores'], estatisticas['em_andamento']) == (1, 4, 0)
+    assert estatisticas['taxa_deduplicacao'] == 0.8
+    assert estatisticas['por_rota'] == {'listar': {'lideres': 1, 'seguidores': 4, 'taxa_deduplicacao': 0.8}}
+
+    # Não é cache: terminada a líder, a mesma chave executa a leitura de novo.
+    coalescedor.executar(('db', 'x.db', 'SELECT 1', ()), ler)
+    assert len(leituras) == 2
+
+
+def test_seguidoras_recebem_a_excecao_da_lider():
+    coalescedor = aplicacao.CoalescedorLeituras()
+    liberar = threading.Event()
+    erros = []
+
+    def ler():
+        liberar.wait(5)
+        raise ValueError('falhou')
+
+    def executar():
+        with pytest.raises(ValueError) as erro:
+            coalescedor.executar('chave', ler)
+        erros.append(erro.value)
+
+    threads = [threading.Thread(target=executar) for _ in range(3)]
+    threads[0].start()
+    aguardar(lambda: coalescedor.lideres == 1)
+    for thread in threads[1:]:
+        thread.start()
+    aguardar(lambda: coalescedor.seguidores == 2)
+    liberar.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert len(erros) == 3 and all(erro is erros[0] for erro in erros)
+    assert coalescedor.lideres == 1
+
+
+def test_rotas_assincronas_compartilham_a_leitura():
+    coalescedor = aplicacao.CoalescedorLeituras()
+    liberar = threading.Event()
+    leituras = []
+
+    def ler():
+        leituras.append(1)
+        liberar.wait(5)
+        return [(42,)]
+
+    async def principal():
+        tarefas = [asyncio.ensure_future(coalescedor.executar_async('chave', ler)) for _ in range(4)]
+        while coalescedor.lideres + coalescedor.seguidores < 4:
+            await asyncio.sleep(0.005)
+        liberar.set()
+        return await asyncio.gather(*tarefas)
+
+    assert asyncio.run(principal()) == [[(42,)]] * 4
+    assert leituras == [1]
+    assert (coalescedor.lideres, coalescedor.seguidores) == (1, 3)
+
+
+def test_chave_separa_bancos_e_parametros():
+    consulta = 'SELECT * FROM roupas WHERE usuario_id = ?'
+    chave = aplicacao.chave_leitura(('db', 'a.db'), consulta, [1])
+
+    assert chave == aplicacao.chave_leitura(('db', 'a.db'), consulta, (1,))
+    assert chave != aplicacao.chave_leitura(('db', 'shard_001.db'), consulta, (1,))
+    assert chave != aplicacao.chave_leitura(('db', 'a.db'), consulta, (2,))
+    assert aplicacao.chave_leitura(('db', 'a.db'), consulta, {'ids': [1, 2]}) is None
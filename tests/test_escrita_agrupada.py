@@ -0,0 +1,49 @@
+import sqlite3
+
+import pytest
+
+import app as aplicacao
+
+
+@pytest.fixture
+def agrupada(cliente, monkeypatch):
+    """Cliente com a escrita agrupada ativa: as unidades de escrita rodam na thread do EscritorAgrupado."""
+    monkeypatch.setitem(aplicacao.app.config, 'ESCRITA_AGRUPADA', True)
+    return cliente
+
+
+def consultar(caminho, consulta, args=()):
+    db = sqlite3.connect(caminho)
+    try:
+        return db.execute(consulta, args).fetchone()
+    finally:
+        db.close()
+
+
+def test_rotas_de_roupa_e_transferencia_com_escrita_agrupada(agrupada, banco):
+    db = sqlite3.connect(banco)
+    origem = db.execute("SELECT id FROM locais WHERE usuario_id = 1 AND nome = 'Loja Principal'").fetchone()[0]
+    destino = db.execute("INSERT INTO locais (usuario_id, nome, tipo) VALUES (1, 'Depósito Teste', 'deposito')").lastrowid
+    db.commit()
+    db.close()
+    formulario = {'codigo_produto': 'AGRUP-1', 'data_entrada': '2026-01-15 10:00', 'tipo_roupa': 'Camiseta',
+                  'tecido': 'Algodão', 'quantidade': '5', 'cor': 'Azul', 'tamanhos': 'M', 'detalhes': '',
+                  'preco_unitario': '49,90', 'local_id': str(origem)}
+
+    assert agrupada.post('/adicionar_roupa', data=formulario).status_code == 302
+    roupa_id, quantidade = consultar(banco, "SELECT id, quantidade FROM roupas WHERE codigo_produto = 'AGRUP-1'")
+    assert quantidade == 5
+
+    resposta = agrupada.post(f'/editar_roupa/{roupa_id}', data=dict(formulario, quantidade='8',
+                                                                     tipo_movimento='entrada'))
+    assert resposta.status_code == 302
+    assert consultar(banco, 'SELECT quantidade FROM roupas WHERE id = ?', (roupa_id,)) == (8,)
+
+    resposta = agrupada.post('/transferir_estoque', data={'codigo_produto': 'AGRUP-1', 'quantidade': '3',
+                                                          'origem_id': str(origem), 'destino_id': str(destino),
+                                                          'observacao': 'reposição'})
+    assert resposta.status_code == 302
+    assert consultar(banco, 'SELECT quantidade, observacao FROM transferencias WHERE roupa_id = ?',
+                     (roupa_id,)) == (3, 'reposição')
+    assert consultar(banco, 'SELECT quantidade FROM estoque_local WHERE roupa_id = ? AND local_id = ?',
+                     (roupa_id, destino)) == (3,)
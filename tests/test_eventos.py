@@ -0,0 +1,63 @@
+import pytest
+
+import app as aplicacao
+
+
+@pytest.fixture
+def canal(monkeypatch):
+    """Canal de eventos novo, com histórico curto; as conexões de teste terminam logo após a recuperação."""
+    canal = aplicacao.CanalEventos(max_conexoes=10, max_por_usuario=5, tamanho_historico=3)
+    monkeypatch.setattr(aplicacao, '_canal_eventos', canal)
+    monkeypatch.setitem(aplicacao.app.config, 'EVENTOS_DURACAO_MAXIMA', 0)
+    return canal
+
+
+def publicar(canal, usuario_id, quantidade):
+    """Publica eventos 'estoque' numerados e retorna os ids."""
+    return [canal.publicar(usuario_id, 'estoque', {'n': n}) for n in range(quantidade)]
+
+
+def test_reconexao_com_last_event_id_recebe_so_os_eventos_perdidos(cliente, canal):
+    canal.cancelar(canal.assinar(1))  # o navegador já esteve conectado: o histórico existe
+    ids = publicar(canal, 1, 3)
+    canal.assinar(2)
+    publicar(canal, 2, 1)  # de outro usuário: nunca é entregue ao usuário 1
+
+    with cliente.get('/eventos', headers={'Last-Event-ID': ids[0]}) as resposta:
+        assert resposta.mimetype == 'text/event-stream'
+        corpo = resposta.data.decode()
+
+    assert corpo.startswith(f"retry: {aplicacao.EVENTOS_RETRY_MS}\n\n")
+    assert [linha[4:] for linha in corpo.splitlines() if linha.startswith('id: ')] == ids[1:]
+    assert 'data: {"n":1}' in corpo and 'data: {"n":0}' not in corpo
+    assert 'resync' not in corpo
+    assert canal.estatisticas()['conexoes_por_usuario'] == {2: 1}
+
+
+def test_last_event_id_que_nao_pode_ser_recuperado_pede_resync(cliente, canal):
+    canal.cancelar(canal.assinar(1))
+    ids = publicar(canal, 1, 5)
+
+    # O evento seguinte ao informado já saiu do histórico (guarda só os 3 últimos).
+    with cliente.get('/eventos', headers={'Last-Event-ID': ids[0]}) as resposta:
+        assert 'event: resync' in resposta.data.decode()
+    # Id de outro processo (ou de antes de um reinício).
+    with cliente.get('/eventos', headers={'Last-Event-ID': 'outro-1'}) as resposta:
+        assert 'event: resync' in resposta.data.decode()
+    # Com o id de um evento ainda guardado, a recuperação é completa.
+    with cliente.get('/eventos', query_string={'ultimo_id': ids[2]}) as resposta:
+        corpo = resposta.data.decode()
+    assert 'resync' not in corpo and corpo.count('event: estoque') == 2
+
+
+def test_evento_recuperado_nao_se_repete_pela_fila():
+    canal = aplicacao.CanalEventos(max_conexoes=10, max_por_usuario=5)
+    canal.cancelar(canal.assinar(1))
+    ids = publicar(canal, 1, 2)
+    assinatura = canal.assinar(1)
+    ids += publicar(canal, 1, 1)  # entra no histórico e também na fila da nova conexão
+
+    corpo = b''.join(aplicacao.gerar_eventos(canal, assinatura, ids[0], heartbeat=0.01, duracao=0.05)).decode()
+
+    assert [linha[4:] for linha in corpo.splitlines() if linha.startswith('id: ')] == ids[1:]
+    assert canal.estatisticas()['conexoes'] == 0
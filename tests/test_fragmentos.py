@@ -0,0 +1,29 @@
+from flask import session
+
+import app as aplicacao
+
+
+def escopo_do_usuario():
+    with aplicacao.app.test_request_context():
+        session['usuario_id'] = 1
+        return aplicacao.escopo_fragmentos(False)
+
+
+def test_escopo_muda_com_escritas_fora_do_changelog(banco, monkeypatch):
+    monkeypatch.setitem(aplicacao.app.config, 'CACHE_FRAGMENTOS', True)
+    inicial = escopo_do_usuario()
+    assert escopo_do_usuario() == inicial
+
+    # O recálculo das notas RFM (manutenção diária) não passa pelo changelog.
+    db = aplicacao.conectar(banco)
+    db.execute("INSERT OR REPLACE INTO rfm_limites (usuario_id, recencia, frequencia, monetario, clientes, calculado_em) "
+               "VALUES (1, '[]', '[]', '[]', 0, '2000-01-01 00:00:00')")
+    db.commit()
+    depois_rfm = escopo_do_usuario()
+    assert depois_rfm != inicial
+
+    # Nem o registro do arquivo morto, atualizado com o changelog pausado.
+    db.execute("INSERT INTO arquivos_vendas (ano, arquivo, linhas, total_centavos) VALUES (2001, 'x.db', 0, 0)")
+    db.commit()
+    db.close()
+    assert escopo_do_usuario() != depois_rfm
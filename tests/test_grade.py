@@ -0,0 +1,56 @@
+import sqlite3
+
+import app as aplicacao
+
+GRADE = {'grade_tamanho': ['P', 'M', 'M'], 'grade_cor': ['Azul', 'Azul', 'Preto'], 'grade_quantidade': ['2', '3', '4']}
+
+
+def variantes(banco, roupa_id):
+    db = sqlite3.connect(banco)
+    try:
+        return dict(((tamanho, cor), quantidade) for tamanho, cor, quantidade in
+                    db.execute('SELECT tamanho, cor, quantidade FROM variantes WHERE roupa_id = ?', (roupa_id,)))
+    finally:
+        db.close()
+
+
+def test_venda_de_variantes_mantem_o_estoque_igual_a_soma_da_grade(cliente, banco):
+    db = sqlite3.connect(banco)
+    cliente_id = db.execute('SELECT MIN(id) FROM clientes WHERE usuario_id = 1').fetchone()[0]
+    db.close()
+    formulario = dict(GRADE, codigo_produto='GRADE-1', data_entrada='2026-01-15 10:00', tipo_roupa='Camiseta',
+                      tecido='Algodão', quantidade='0', cor='', tamanhos='', detalhes='', preco_unitario='50,00')
+    assert cliente.post('/adicionar_roupa', data=formulario).status_code == 302
+    db = sqlite3.connect(banco)
+    roupa_id, quantidade = db.execute("SELECT id, quantidade FROM roupas WHERE codigo_produto = 'GRADE-1'").fetchone()
+    db.close()
+    assert quantidade == 9
+    assert variantes(banco, roupa_id) == {('P', 'Azul'): 2, ('M', 'Azul'): 3, ('M', 'Preto'): 4}
+
+    carrinho = cliente.post('/api/carrinhos', json={'cliente_id': cliente_id}).get_json()['carrinho_id']
+    itens = f"/api/carrinhos/{carrinho}/itens"
+    # Só o tamanho M não identifica a variante; só a cor Preto, sim.
+    assert cliente.post(itens, json={'codigo': 'GRADE-1', 'tamanho': 'M'}).status_code == 422
+    assert cliente.post(itens, json={'codigo': 'GRADE-1', 'cor': 'preto', 'quantidade': 3}).status_code == 200
+    assert cliente.post(itens, json={'codigo': 'GRADE-1', 'tamanho': 'm', 'cor': 'Azul'}).status_code == 200
+    assert cliente.post(itens, json={'codigo': 'GRADE-1', 'tamanho': 'P', 'cor': 'Azul', 'quantidade': 3}).status_code == 409
+
+    resposta = cliente.post(f"/api/carrinhos/{carrinho}/finalizar")
+    assert resposta.status_code == 201
+    venda_ids = resposta.get_json()['venda_ids']
+    assert resposta.get_json()['total_centavos'] == 4 * 5000
+
+    assert variantes(banco, roupa_id) == {('P', 'Azul'): 2, ('M', 'Azul'): 2, ('M', 'Preto'): 1}
+    db = aplicacao.conectar(banco)
+    try:
+        assert db.execute('SELECT quantidade FROM roupas WHERE id = ?', (roupa_id,)).fetchone()[0] == 5
+        assert aplicacao.divergencias_grade(db) == []
+        assert aplicacao.divergencias_locais(db) == []
+        assert aplicacao.verificar_estoque(db, 1) == []
+        vendidas = db.execute(f"SELECT v.quantidade_vendida, g.tamanho, g.cor FROM vendas v "
+                              f"JOIN variantes g ON g.id = v.variante_id "
+                              f"WHERE v.id IN ({', '.join('?' * len(venda_ids))}) ORDER BY g.tamanho, g.cor",
+                              venda_ids).fetchall()
+        assert [tuple(linha) for linha in vendidas] == [(1, 'M', 'Azul'), (3, 'M', 'Preto')]
+    finally:
+        db.close()
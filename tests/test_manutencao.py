@@ -0,0 +1,39 @@
+import pytest
+
+import app as aplicacao
+
+
+class FimDoCiclo(BaseException):
+    pass
+
+
+def test_tarefa_com_erro_inesperado_e_registrada_como_falha(banco, monkeypatch):
+    def tarefa_com_defeito(db, caminho):
+        raise KeyError('coluna')
+    monkeypatch.setitem(aplicacao.TAREFAS_MANUTENCAO, 'otimizar', tarefa_com_defeito)
+
+    sucesso, detalhe, _duracao = aplicacao.executar_tarefa('otimizar', banco)
+
+    assert not sucesso and detalhe.startswith('Erro: KeyError')
+    db = aplicacao.conectar(banco)
+    assert db.execute("SELECT sucesso FROM manutencao_execucoes WHERE tarefa = 'otimizar' "
+                      "ORDER BY rowid DESC").fetchone()[0] == 0
+    db.close()
+
+
+def test_loop_de_manutencao_sobrevive_a_erros_inesperados(monkeypatch):
+    ciclos = []
+
+    def assumir_lideranca():
+        ciclos.append(1)
+        raise RuntimeError('falha qualquer')
+
+    def dormir(_segundos):
+        if len(ciclos) == 2:
+            raise FimDoCiclo
+    monkeypatch.setattr(aplicacao, 'assumir_lideranca', assumir_lideranca)
+    monkeypatch.setattr(aplicacao.time, 'sleep', dormir)
+
+    with pytest.raises(FimDoCiclo):
+        aplicacao._loop_manutencao()
+    assert len(ciclos) == 2
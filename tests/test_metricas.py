@@ -0,0 +1,83 @@
+import sqlite3
+
+import pytest
+
+import app as aplicacao
+
+USUARIO = 99
+# (data, produto, itens, total em centavos): a Camiseta e a Calça de um usuário sem outras vendas.
+VENDAS = [('2024-03-10', 'Camiseta', 2, 10000), ('2024-05-02', 'Calça', 1, 5000),
+          ('2025-02-15', 'Camiseta', 1, 3000), ('2025-03-01', 'Camiseta', 3, 15000),
+          ('2025-03-31', 'Calça', 1, 7000), ('2025-04-01', 'Calça', 2, 8000)]
+
+
+@pytest.fixture
+def metricas(banco):
+    """Cliente logado em um usuário cujas únicas vendas são VENDAS (os agregados diários vêm dos gatilhos)."""
+    db = sqlite3.connect(banco)
+    cliente_id = db.execute("INSERT INTO clientes (usuario_id, nome, telefone) VALUES (?, 'Cliente', '0')", (USUARIO,)).lastrowid
+    roupas = {tipo: db.execute("INSERT INTO roupas (usuario_id, codigo_produto, data_entrada, tipo_roupa, "
+                               "quantidade, cor) VALUES (?, ?, '2024-01-01 00:00:00', ?, 100, 'Azul')",
+                               (USUARIO, f"M-{tipo}", tipo)).lastrowid
+              for tipo in ('Camiseta', 'Calça')}
+    for data, tipo, itens, total in VENDAS:
+        db.execute('''
+                   INSERT INTO vendas (usuario_id, cliente_id, roupa_id, quantidade_vendida, valor_total_centavos,
+                                       data_venda)
+                   VALUES (?, ?, ?, ?, ?, ?)
+                   ''', (USUARIO, cliente_id, roupas[tipo], itens, total, data))
+    db.commit()
+    db.close()
+    cliente = aplicacao.app.test_client()
+    with cliente.session_transaction() as sessao:
+        sessao['usuario_id'] = USUARIO
+    return cliente
+
+
+def test_trimestres_comparados_com_o_ano_anterior(metricas):
+    resposta = metricas.get('/metricas_vendas', query_string={'inicio': '2025-01-15', 'fim': '2025-06-30',
+                                                              'granularidade': 'trimestre', 'comparar': 'ano_anterior'})
+    assert resposta.status_code == 200
+    dados = resposta.get_json()
+
+    assert dados['periodos'] == ['2025-01-01', '2025-04-01']
+    [serie] = dados['series']
+    assert serie['valores'] == {'vendas': [3, 1], 'itens': [5, 2], 'total_centavos': [25000, 8000],
+                                'comparacao_centavos': [10000, 5000], 'variacao': [1.5, 0.6]}
+    assert (serie['total_centavos'], serie['comparacao_centavos'], serie['variacao']) == (33000, 15000, 1.2)
+
+
+def test_meses_por_tipo_de_roupa_comparados_com_o_periodo_anterior(metricas):
+    dados = metricas.get('/metricas_vendas', query_string={'inicio': '2025-02-01', 'fim': '2025-04-30',
+                                                           'dimensao': 'tipo_roupa',
+                                                           'comparar': 'periodo_anterior'}).get_json()
+
+    assert dados['periodos'] == ['2025-02-01', '2025-03-01', '2025-04-01']
+    camiseta, calca = dados['series']
+    assert (camiseta['rotulo'], camiseta['total_centavos'], calca['rotulo'], calca['total_centavos']) == \
+        ('Camiseta', 18000, 'Calça', 15000)
+    assert camiseta['valores'] == {'vendas': [1, 1, 0], 'itens': [1, 3, 0], 'total_centavos': [3000, 15000, 0],
+                                   'comparacao_centavos': [0, 3000, 15000], 'variacao': [None, 4.0, -1.0]}
+    assert calca['valores']['total_centavos'] == [0, 7000, 8000]
+    assert calca['valores']['comparacao_centavos'] == [0, 0, 7000]
+    assert calca['valores']['variacao'] == [None, None, 0.1429]
+
+    # Com limite=1, só a série de maior total no intervalo.
+    dados = metricas.get('/metricas_vendas', query_string={'inicio': '2025-02-01', 'fim': '2025-04-30',
+                                                           'dimensao': 'tipo_roupa', 'limite': 1}).get_json()
+    assert [serie['rotulo'] for serie in dados['series']] == ['Camiseta']
+
+
+def test_semanas_comecam_na_segunda_feira_e_a_serie_e_densa(metricas):
+    dados = metricas.get('/metricas_vendas', query_string={'inicio': '2025-03-01', 'fim': '2025-03-20',
+                                                           'granularidade': 'semana'}).get_json()
+
+    assert dados['periodos'] == ['2025-02-24', '2025-03-03', '2025-03-10', '2025-03-17']
+    assert dados['series'][0]['valores']['total_centavos'] == [15000, 0, 0, 0]
+
+
+@pytest.mark.parametrize('parametros', [{'granularidade': 'hora'}, {'dimensao': 'cor'}, {'comparar': 'semana'},
+                                        {'inicio': '2025-02-01', 'fim': '2025-01-01'}, {'limite': 0},
+                                        {'inicio': '2020-01-01', 'fim': '2025-01-01', 'granularidade': 'dia'}])
+def test_parametros_invalidos_respondem_400(metricas, parametros):
+    assert metricas.get('/metricas_vendas', query_string=parametros).status_code == 400
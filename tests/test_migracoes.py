@@ -0,0 +1,156 @@
+import os
+import shutil
+import sqlite3
+from datetime import datetime
+
+import pytest
+
+import app as aplicacao
+
+ANO = datetime.now().year - 3
+
+
+@pytest.fixture
+def banco_antigo(tmp_path, monkeypatch):
+    """Retorna uma função que cria uma cópia do banco de exemplo migrada só até uma versão."""
+    monkeypatch.setitem(aplicacao.app.config, 'ARQUIVO_DIR', str(tmp_path / 'arquivo'))
+    os.makedirs(aplicacao.app.config['ARQUIVO_DIR'])
+
+    def criar(versao):
+        caminho = str(tmp_path / 'controle_estoque.db')
+        shutil.copy(os.path.join(aplicacao.app.root_path, 'controle_estoque.db'), caminho)
+        monkeypatch.setattr(aplicacao, 'DATABASE', caminho)
+        db = sqlite3.connect(caminho)
+        aplicacao.aplicar_migracoes(db, ate=versao)
+        db.close()
+        return caminho
+    return criar
+
+
+def arquivar_como_na_versao(caminho):
+    """
+    Move as vendas de ANO para o arquivo anual como arquivar_vendas fazia na versão do banco: o arquivo
+    tem as colunas que vendas tinha então, e o registro não tem a faixa de ids.
+    """
+    destino = os.path.join(aplicacao.app.config['ARQUIVO_DIR'], f"controle_estoque_vendas_{ANO}.db")
+    db = sqlite3.connect(caminho)
+    cliente_id = db.execute('SELECT MIN(id) FROM clientes WHERE usuario_id = 1').fetchone()[0]
+    roupa_id = db.execute('SELECT MIN(id) FROM roupas WHERE usuario_id = 1').fetchone()[0]
+    for mes, quantidade in ((2, 1), (7, 3)):
+        db.execute('''
+                   INSERT INTO vendas (usuario_id, cliente_id, roupa_id, quantidade_vendida, valor_total_centavos,
+                                       data_venda)
+                   VALUES (1, ?, ?, ?, ?, ?)
+                   ''', (cliente_id, roupa_id, quantidade, quantidade * 4990, f"{ANO}-{mes:02d}-15"))
+    db.commit()
+    db.execute('ATTACH DATABASE ? AS arquivo', (destino,))
+    db.execute('UPDATE changelog_controle SET pausado = 1')
+    db.execute('CREATE TABLE arquivo.vendas AS SELECT * FROM main.vendas WHERE 0')
+    linhas = db.execute('INSERT INTO arquivo.vendas SELECT * FROM main.vendas WHERE data_venda LIKE ?',
+                        (f"{ANO}-%",)).rowcount
+    total = db.execute('SELECT SUM(valor_total_centavos) FROM arquivo.vendas').fetchone()[0]
+    db.execute('DELETE FROM main.vendas WHERE data_venda LIKE ?', (f"{ANO}-%",))
+    db.execute('INSERT INTO arquivos_vendas (ano, arquivo, linhas, total_centavos) VALUES (?, ?, ?, ?)',
+               (ANO, os.path.basename(destino), linhas, total))
+    db.execute('UPDATE changelog_controle SET pausado = 0')
+    db.commit()
+    db.execute('DETACH DATABASE arquivo')
+    db.close()
+
+
+def conteudo(caminho, consulta):
+    db = sqlite3.connect(caminho)
+    try:
+        return sorted(db.execute(consulta).fetchall())
+    finally:
+        db.close()
+
+
+def test_migracao_12_soma_os_anos_ja_arquivados(banco_antigo):
+    caminho = banco_antigo(11)
+    arquivar_como_na_versao(caminho)
+    aplicacao.preparar_banco(caminho)
+
+    migrado = conteudo(caminho, 'SELECT * FROM vendas_diarias')
+    assert any(linha[2].startswith(str(ANO)) for linha in migrado)
+    aplicacao.reconstruir_vendas_diarias(caminho)
+    assert conteudo(caminho, 'SELECT * FROM vendas_diarias') == migrado
+    assert conteudo(caminho, 'SELECT id_min IS NOT NULL FROM arquivos_vendas') == [(1,)]
+
+
+def test_migracao_10_soma_os_anos_ja_arquivados_na_loja_principal(banco_antigo):
+    caminho = banco_antigo(9)
+    arquivar_como_na_versao(caminho)
+    aplicacao.preparar_banco(caminho)
+
+    consulta = 'SELECT * FROM vendas_local_dia'
+    migrado = conteudo(caminho, consulta)
+    principal = conteudo(caminho, "SELECT id FROM locais WHERE usuario_id = 1 AND nome = 'Loja Principal'")
+    assert [linha[1] for linha in migrado if linha[2].startswith(str(ANO))] == [principal[0][0]] * 2
+    aplicacao.reconstruir_agregados_locais(caminho)
+    assert conteudo(caminho, consulta) == migrado
+
+
+def test_migracao_11_soma_as_compras_dos_anos_ja_arquivados(banco_antigo):
+    caminho = banco_antigo(10)
+    arquivar_como_na_versao(caminho)
+    aplicacao.preparar_banco(caminho)
+
+    consulta = 'SELECT cliente_id, primeira_compra, ultima_compra, compras, total_centavos FROM clientes_rfm'
+    migrado = conteudo(caminho, consulta)
+    assert any(linha[1].startswith(str(ANO)) for linha in migrado)
+    db = aplicacao.conectar(caminho)
+    aplicacao.reconstruir_rfm_banco(db)
+    db.close()
+    assert conteudo(caminho, consulta) == migrado
+
+
+def test_schema_novo_tem_as_colunas_do_banco_migrado(banco_antigo, tmp_path):
+    migrado = sqlite3.connect(banco_antigo(None))
+    novo = sqlite3.connect(str(tmp_path / 'novo.db'))
+    novo.executescript(aplicacao.ler_schema())
+    try:
+        tabelas = [linha[0] for linha in novo.execute("SELECT name FROM sqlite_master WHERE type = 'table' "
+                                                      "AND name NOT LIKE 'sqlite_%' ORDER BY name")]
+        for tabela in tabelas:
+            assert aplicacao.colunas_tabela(novo, tabela) == aplicacao.colunas_tabela(migrado, tabela), tabela
+    finally:
+        novo.close()
+        migrado.close()
+
+
+def test_migracao_15_lanca_as_vendas_anteriores_ao_livro(banco_antigo):
+    caminho = banco_antigo(4)
+    db = sqlite3.connect(caminho)
+    roupa_id, quantidade, entrada = db.execute('SELECT id, quantidade, data_entrada FROM roupas WHERE usuario_id = 1 '
+                                               'ORDER BY id LIMIT 1').fetchone()
+    cliente_id = db.execute('SELECT MIN(id) FROM clientes WHERE usuario_id = 1').fetchone()[0]
+    # Venda feita antes do livro existir: só baixou roupas.quantidade.
+    db.execute('''
+               INSERT INTO vendas (usuario_id, cliente_id, roupa_id, quantidade_vendida, valor_total_centavos,
+                                   data_venda)
+               VALUES (1, ?, ?, 2, 9980, '2025-11-10')
+               ''', (cliente_id, roupa_id))
+    db.execute('UPDATE roupas SET quantidade = quantidade - 2 WHERE id = ?', (roupa_id,))
+    db.commit()
+    aplicacao.aplicar_migracoes(db, ate=11)
+    db.close()
+    arquivar_como_na_versao(caminho)
+    aplicacao.preparar_banco(caminho)
+
+    db = aplicacao.conectar(caminho)
+    try:
+        vendidas = db.execute('SELECT SUM(quantidade_vendida) FROM vendas WHERE roupa_id = ?', (roupa_id,)).fetchone()[0]
+        inicial = db.execute("SELECT quantidade, criado_em FROM movimentos_estoque WHERE roupa_id = ? "
+                             "AND observacao = 'Saldo inicial'", (roupa_id,)).fetchone()
+        # As duas vendas do ano arquivado também entram no saldo inicial.
+        assert tuple(inicial) == (quantidade - 2 + vendidas + 4, aplicacao.data_hora_iso(entrada))
+        assert aplicacao.verificar_estoque(db) == []
+        assert aplicacao.saldo_estoque(db, roupa_id, '2025-10-19 23:59:59') == 0
+        assert aplicacao.saldo_estoque(db, roupa_id, '2025-11-09 23:59:59') == quantidade
+        assert aplicacao.saldo_estoque(db, roupa_id) == quantidade - 2
+        assert db.execute("SELECT COUNT(*) FROM movimentos_estoque WHERE roupa_id = ? AND tipo = 'venda'",
+                          (roupa_id,)).fetchone()[0] == db.execute('SELECT COUNT(*) FROM vendas WHERE roupa_id = ?',
+                                                                   (roupa_id,)).fetchone()[0] + 2
+    finally:
+        db.close()
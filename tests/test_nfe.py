@@ -0,0 +1,77 @@
+import io
+import sqlite3
+import xml.etree.ElementTree as ET
+import zipfile
+
+import pytest
+
+import app as aplicacao
+import nfe
+
+EMPRESA = {'cnpj': '00000000000191', 'razao_social': 'Loja & Filhos', 'nome_fantasia': 'Loja', 'inscricao_estadual': 'ISENTO',
+           'inscricao_municipal': None, 'regime_tributario': 'Simples Nacional', 'cep': '01001000', 'rua': 'Rua <A>, 1',
+           'bairro': 'Sé', 'cidade': 'São Paulo', 'estado': 'SP', 'pais': 'Brasil'}
+
+
+def vendas_simuladas(quantidade):
+    """Vendas na ordem de nfe.COLUNAS_VENDA, geradas uma a uma como as linhas de um cursor."""
+    return ((i, '2026-01-15', f'Cliente {i % 50}', 'ISENTO', '11999990000', f'P-{i % 20:04d}', 'Camiseta Azul P,M,G',
+             '00000000', 'UN', 1 + i % 3, '49.90', f'{49.90 * (1 + i % 3):.2f}') for i in range(quantidade))
+
+
+def test_xml_escrito_em_partes_equivale_ao_documento_montado_em_arvore():
+    partes, mimetype = aplicacao.gerar_conteudo_nfe(EMPRESA, vendas_simuladas(1200), 'xml')
+    raiz = ET.fromstring(''.join(partes))
+
+    assert mimetype == 'application/xml'
+    assert raiz.findtext('Emitente/EmitRazaoSocial') == 'Loja & Filhos'
+    assert raiz.findtext('Emitente/EmitRua') == 'Rua <A>, 1'
+    assert raiz.findtext('Emitente/EmitIM') == ''
+    itens = raiz.findall('Vendas/ItemVenda')
+    assert len(itens) == 1200
+    assert [e.text for e in itens[-1]] == [str(valor) for valor in list(vendas_simuladas(1200))[-1]]
+
+
+@pytest.mark.parametrize('formato', ['csv', 'xml', 'zip'])
+def test_exportacao_de_muitas_vendas_cabe_no_orcamento_de_memoria(formato):
+    # A memória não cresce com a quantidade de vendas: a exportação é escrita e entregue em partes.
+    with aplicacao.orcamento_memoria(5) as medicao:
+        if formato == 'zip':
+            partes = nfe.zip_em_fluxo(nfe.gerar_documentos(EMPRESA, vendas_simuladas(2000)))
+        else:
+            partes, _mimetype = aplicacao.gerar_conteudo_nfe(EMPRESA, vendas_simuladas(30000), formato)
+        tamanho = sum(len(parte) for parte in partes)
+    assert tamanho > 5 * 2 ** 20 or formato == 'zip'
+    assert medicao['pico_bytes'] < 5 * 2 ** 20
+
+
+def test_zip_com_mais_entradas_do_que_o_limite_do_formato_sem_zip64():
+    documentos = ((f"NFe_{i:06d}.xml", b'<NFe>%d</NFe>' % i) for i in range(70000))
+    arquivo_zip = zipfile.ZipFile(io.BytesIO(b''.join(nfe.zip_em_fluxo(documentos))))
+
+    assert arquivo_zip.testzip() is None
+    assert len(arquivo_zip.infolist()) == 70000
+    assert arquivo_zip.read('NFe_069999.xml') == b'<NFe>69999</NFe>'
+
+
+def test_zip_pela_rota(cliente):
+    db = sqlite3.connect(aplicacao.DATABASE)
+    db.execute('''
+               INSERT INTO empresas (usuario_id, cnpj, razao_social, nome_fantasia, inscricao_estadual,
+                                     inscricao_municipal, regime_tributario, cep, rua, bairro, cidade, estado, pais)
+               SELECT 1, '00000000000191', 'Loja', 'Loja', 'ISENTO', '', 'Simples Nacional', '01001000', 'Rua A',
+                      'Sé', 'São Paulo', 'SP', 'Brasil'
+               WHERE NOT EXISTS (SELECT 1 FROM empresas WHERE usuario_id = 1)
+               ''')
+    db.commit()
+    ids = [linha[0] for linha in db.execute('SELECT id FROM vendas WHERE usuario_id = 1 ORDER BY id LIMIT 3')]
+    db.close()
+
+    # A resposta em fluxo ocupa a vaga da admissão até ser fechada, como faz o servidor WSGI.
+    with cliente.post('/gerar_arquivo_nfe', data={'venda_ids': [str(i) for i in ids],
+                                                  'formato_exportacao': 'zip'}) as resposta:
+        assert resposta.status_code == 200
+        assert resposta.headers['X-NFe-Documentos'] == str(len(ids))
+        arquivo_zip = zipfile.ZipFile(io.BytesIO(resposta.data))
+    assert arquivo_zip.namelist() == [nfe.nome_documento((venda_id,)) for venda_id in ids]
+    assert ET.fromstring(arquivo_zip.read(arquivo_zip.namelist()[0])).tag == 'NFe'
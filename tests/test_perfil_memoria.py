@@ -0,0 +1,30 @@
+import tracemalloc
+
+import pytest
+
+import app as aplicacao
+
+
+@pytest.fixture
+def perfil(cliente, monkeypatch):
+    """Perfil de memória ativo só para o backup, com os perfis zerados; o tracemalloc é parado no fim."""
+    monkeypatch.setitem(aplicacao.app.config, 'PERFIL_MEMORIA', True)
+    monkeypatch.setitem(aplicacao.app.config, 'PERFIL_MEMORIA_ROTAS', {'exportar_backup'})
+    monkeypatch.setitem(aplicacao.app.config, 'PERFIL_MEMORIA_LINHAS', 0)
+    monkeypatch.setattr(aplicacao, '_perfis_memoria', {})
+    yield cliente
+    tracemalloc.stop()
+
+
+def test_resposta_em_fluxo_e_medida_ate_ser_fechada(perfil):
+    with perfil.get('/backup', buffered=False) as resposta:
+        assert resposta.status_code == 200
+        # O corpo ainda não foi gerado: nada foi registrado e a medição continua exclusiva.
+        assert 'exportar_backup' not in aplicacao._perfis_memoria
+        assert aplicacao._perfil_memoria_lock.locked()
+        tamanho = len(b''.join(resposta.response))
+
+    registrado = aplicacao._perfis_memoria['exportar_backup']
+    assert registrado['requisicoes'] == 1
+    assert registrado['pico_max_bytes'] >= tamanho
+    assert not aplicacao._perfil_memoria_lock.locked()
@@ -0,0 +1,74 @@
+import math
+from datetime import datetime, timedelta
+
+import pytest
+
+import app as aplicacao
+
+np = pytest.importorskip('numpy')
+import previsao  # noqa: E402
+
+
+def previsao_em_laco(serie, estoque, alfa, prazo, z):
+    """Mesmas métricas de previsao.calcular_previsoes, dia a dia e produto a produto, como referência."""
+    nivel = serie[0]
+    for valor in serie[1:]:
+        nivel = alfa * valor + (1 - alfa) * nivel
+    media = sum(serie) / len(serie)
+    desvio = math.sqrt(sum((valor - media) ** 2 for valor in serie) / len(serie))
+    ponto = math.ceil(nivel * prazo + z * desvio * math.sqrt(prazo))
+    return {'media_7d': sum(serie[-7:]) / 7, 'media_28d': sum(serie[-28:]) / 28, 'demanda_diaria': nivel,
+            'desvio': desvio, 'dias_cobertura': estoque / nivel if nivel > 0 else math.inf,
+            'ponto_reposicao': ponto, 'estoque_baixo': nivel > 0 and estoque <= ponto}
+
+
+def test_matriz_soma_as_vendas_do_dia_e_ignora_o_que_esta_fora_da_janela():
+    vendas = [(7, '2026-01-02', 2), (7, '2026-01-02', 3), (10, '2026-01-01', 1), (3, '2026-01-04', 4),
+              (5, '2026-01-01', 9),   # produto que não está na lista
+              (99, '2026-01-01', 9),  # id maior que todos os produtos
+              (3, '2025-12-31', 4),   # antes do início
+              (3, '2026-01-05', 4)]   # depois do último dia
+    matriz = previsao.matriz_vendas_diarias([3, 7, 10], *zip(*vendas), inicio='2026-01-01', dias=4)
+
+    assert matriz.tolist() == [[0, 0, 0, 4],
+                               [0, 5, 0, 0],
+                               [1, 0, 0, 0]]
+
+
+def test_previsoes_vetorizadas_iguais_ao_calculo_produto_a_produto():
+    gerador = np.random.default_rng(7)
+    matriz = gerador.poisson(3, size=(4, 35)).astype(np.float32)
+    matriz[2] = 0  # produto sem vendas: cobertura infinita e nunca abaixo do ponto de reposição
+    estoque = [5, 200, 10, 0]
+    resultado = previsao.calcular_previsoes(matriz, estoque, alfa=0.3, prazo_reposicao=7, z=1.65)
+
+    for linha, quantidade in enumerate(estoque):
+        esperado = previsao_em_laco(matriz[linha].tolist(), quantidade, 0.3, 7, 1.65)
+        for metrica, valor in esperado.items():
+            assert resultado[metrica][linha] == pytest.approx(valor), (linha, metrica)
+    assert resultado['dias_cobertura'][2] == math.inf
+    assert resultado['estoque_baixo'].tolist() == [True, False, False, True]
+
+
+def test_previsao_gravada_a_partir_das_vendas_do_banco(banco):
+    hoje = datetime.now()
+    db = aplicacao.conectar(banco)
+    roupa = db.execute('SELECT id, quantidade FROM roupas WHERE usuario_id = 1 ORDER BY id LIMIT 1').fetchone()
+    cliente_id = db.execute('SELECT MIN(id) FROM clientes WHERE usuario_id = 1').fetchone()[0]
+    for dias_atras, quantidade in ((0, 3), (0, 1), (6, 2), (20, 5)):
+        db.execute('''
+                   INSERT INTO vendas (usuario_id, cliente_id, roupa_id, quantidade_vendida, valor_total_centavos,
+                                       data_venda)
+                   VALUES (1, ?, ?, ?, ?, ?)
+                   ''', (cliente_id, roupa['id'], quantidade, quantidade * 4990,
+                         (hoje - timedelta(days=dias_atras)).strftime('%Y-%m-%d')))
+    db.commit()
+    try:
+        assert aplicacao.calcular_previsoes_banco(db) == db.execute('SELECT COUNT(*) FROM roupas').fetchone()[0]
+        gravada = db.execute('SELECT media_7d, media_28d FROM previsoes_estoque WHERE roupa_id = ?',
+                             (roupa['id'],)).fetchone()
+    finally:
+        db.close()
+
+    # As vendas de fora da janela de 90 dias (as do banco de exemplo) não entram na conta.
+    assert tuple(gravada) == (pytest.approx(6 / 7), pytest.approx(11 / 28))
@@ -0,0 +1,59 @@
+import sqlite3
+import threading
+
+import pytest
+
+import app as aplicacao
+
+
+@pytest.fixture
+def replica(banco, monkeypatch):
+    """Réplica analítica ativa para o banco de teste, atualizada a cada leitura de relatório."""
+    monkeypatch.setitem(aplicacao.app.config, 'REPLICA_ANALITICA', True)
+    monkeypatch.setitem(aplicacao.app.config, 'REPLICA_MAX_ATRASO', -1)
+    monkeypatch.setattr(aplicacao, 'iniciar_agendador_replica', lambda: None)
+    aplicacao.atualizar_replica(banco, forcar=True)
+    return aplicacao.caminho_replica(banco)
+
+
+def quantidade_roupas(caminho):
+    db = sqlite3.connect(f"file:{caminho}?mode=ro", uri=True)
+    try:
+        return db.execute('SELECT COUNT(*) FROM roupas').fetchone()[0]
+    finally:
+        db.close()
+
+
+def test_atualizacao_nao_espera_as_leituras_abertas_na_replica(banco, replica):
+    antes = quantidade_roupas(replica)
+    leitura = sqlite3.connect(f"file:{replica}?mode=ro", uri=True)
+    # Fora do WAL, a leitura aberta segura a trava compartilhada do arquivo da réplica.
+    assert leitura.execute('PRAGMA journal_mode').fetchone()[0] == 'delete'
+    leitura.execute('BEGIN')
+    assert leitura.execute('SELECT COUNT(*) FROM roupas').fetchone()[0] == antes
+
+    db = sqlite3.connect(banco)
+    db.execute("INSERT INTO roupas (usuario_id, codigo_produto, data_entrada, tipo_roupa, quantidade, cor) "
+               "VALUES (1, 'REPLICA-1', '2026-01-15 00:00:00', 'Camiseta', 1, 'Azul')")
+    db.commit()
+    db.close()
+    atualizacao = threading.Thread(target=aplicacao.atualizar_replica, args=(banco,), daemon=True)
+    atualizacao.start()
+    atualizacao.join(5)
+
+    assert not atualizacao.is_alive()
+    assert quantidade_roupas(replica) == antes + 1
+    # A leitura aberta continua no instantâneo anterior.
+    assert leitura.execute('SELECT COUNT(*) FROM roupas').fetchone()[0] == antes
+    leitura.close()
+
+
+def test_relatorio_usa_o_instantaneo_anterior_se_a_atualizacao_falhar(banco, replica, monkeypatch):
+    def falhar(caminho, forcar=False):
+        raise sqlite3.OperationalError('database is locked')
+
+    monkeypatch.setattr(aplicacao, 'atualizar_replica', falhar)
+    with aplicacao.app.test_request_context():
+        db = aplicacao.get_db_relatorio()
+        assert db.execute('PRAGMA database_list').fetchone()[2] == replica
+        assert db.execute('SELECT COUNT(*) FROM roupas').fetchone()[0] == quantidade_roupas(replica)
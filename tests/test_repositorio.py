@@ -0,0 +1,74 @@
+import json
+import sqlite3
+
+import pytest
+
+import repositorio as modulo
+import serializacao
+from repositorio import repositorio
+
+
+def test_instrucoes_registradas_compilam_no_schema_migrado(banco):
+    db = sqlite3.connect(banco)
+    try:
+        for nome in list(repositorio._instrucoes):
+            # EXPLAIN compila a instrução sem executá-la (nem as escritas).
+            db.execute(f"EXPLAIN {repositorio.sql(nome)}", [None] * repositorio.sql(nome).count('?'))
+    finally:
+        db.close()
+    assert repositorio.tamanho_cache() == len(repositorio._instrucoes) + modulo.Repositorio.FOLGA_CACHE
+
+
+def test_ordenacao_invalida_volta_para_a_instrucao_padrao():
+    assert repositorio.ordenacao('roupas.listar', 'quantidade', 'desc') == ('roupas.listar:quantidade:DESC',
+                                                                           'quantidade', 'DESC')
+    assert repositorio.ordenacao('roupas.listar', 'id; DROP TABLE roupas', 'asc; --') == ('roupas.listar:id:ASC',
+                                                                                        'id', 'ASC')
+    assert repositorio.ordenacao('roupas.listar', None, None)[0] == 'roupas.listar:id:ASC'
+    assert 'ORDER BY r.quantidade DESC' in repositorio.sql('roupas.listar:quantidade:DESC')
+
+
+def test_linhas_sao_dataclasses_compativeis_com_sqlite3_row():
+    repo = modulo.Repositorio()
+    repo.registrar('teste.listar', 'SELECT id, nome FROM itens ORDER BY id')
+    with pytest.raises(ValueError):
+        repo.registrar('teste.listar', 'SELECT 1')
+    db = sqlite3.connect(':memory:')
+    db.execute('CREATE TABLE itens (id INTEGER PRIMARY KEY, nome TEXT)')
+    db.executemany('INSERT INTO itens (nome) VALUES (?)', [('a',), ('b',)])
+
+    linhas = repo.linhas(db, 'teste.listar')
+    primeira = linhas[0]
+    assert (primeira['nome'], primeira[0], primeira.nome, primeira.keys()) == ('a', 1, 'a', ['id', 'nome'])
+    assert dict(primeira) == {'id': 1, 'nome': 'a'}
+    assert not hasattr(primeira, '__dict__')
+    assert json.loads(serializacao.dumps(linhas)) == [{'id': 1, 'nome': 'a'}, {'id': 2, 'nome': 'b'}]
+    assert repo.linha(db, 'teste.listar').nome == 'a'
+
+    # Uma coluna nova (ex.: após uma migração) gera um novo tipo de linha.
+    db.execute('ALTER TABLE itens ADD COLUMN extra INTEGER DEFAULT 7')
+    repo._instrucoes['teste.listar'].sql = 'SELECT * FROM itens ORDER BY id'
+    assert repo.linha(db, 'teste.listar').extra == 7
+
+    estatisticas = repo.estatisticas()['instrucoes']
+    assert [(e['nome'], e['execucoes'], e['linhas']) for e in estatisticas] == [('teste.listar', 3, 6)]
+    repo.zerar()
+    assert repo.estatisticas()['instrucoes'] == []
+    db.close()
+
+
+def test_venda_conta_as_instrucoes_de_escrita(cliente, banco):
+    repositorio.zerar()
+    db = sqlite3.connect(banco)
+    cliente_id = db.execute('SELECT MIN(id) FROM clientes WHERE usuario_id = 1').fetchone()[0]
+    codigo = db.execute('SELECT codigo_produto FROM roupas r WHERE usuario_id = 1 AND quantidade > 0 '
+                        'AND NOT EXISTS (SELECT 1 FROM variantes v WHERE v.roupa_id = r.id) '
+                        'ORDER BY id LIMIT 1').fetchone()[0]
+    db.close()
+    carrinho = cliente.post('/api/carrinhos', json={'cliente_id': cliente_id}).get_json()['carrinho_id']
+    assert cliente.post(f"/api/carrinhos/{carrinho}/itens", json={'codigo': codigo}).status_code == 200
+    assert cliente.post(f"/api/carrinhos/{carrinho}/finalizar").status_code == 201
+
+    execucoes = {e['nome']: e['execucoes'] for e in repositorio.estatisticas()['instrucoes']}
+    assert execucoes['vendas.inserir'] == 1
+    assert execucoes['roupas.baixar_venda'] == 1